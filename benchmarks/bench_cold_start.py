@@ -0,0 +1,91 @@
+"""
+Measure the cold and warm start costs of read_source_data. Each run starts a fresh
+Python process, imports the function's module and then times:
+
+- the first invocation for an event that is dropped because it is not under
+  source-data/, which no longer imports phdi or the GCP client libraries,
+- getting the GCS and Pub/Sub clients on the first (cold) and second (warm)
+  invocation, which imports and creates them once per function instance,
+- creating both clients from scratch, which is what every invocation did before
+  clients were reused.
+
+GCP credentials are replaced with anonymous credentials, so no network access is
+needed. The get_bucket metadata round trip that was also removed is not included.
+
+Usage:
+    python benchmarks/bench_cold_start.py --runs 5
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+FUNCTION_DIRECTORY = (
+    Path(__file__).resolve().parent.parent / "cloud-functions" / "read_source_data"
+)
+
+CHILD_SCRIPT = """
+import json
+import time
+from unittest import mock
+
+timings = {}
+start = time.perf_counter()
+import main
+timings["import main"] = time.perf_counter() - start
+
+cloud_event = mock.MagicMock()
+cloud_event.data = {"name": "other-data/some-file", "bucket": "some-bucket"}
+start = time.perf_counter()
+main.read_source_data(cloud_event)
+timings["dropped event"] = time.perf_counter() - start
+
+from google.auth.credentials import AnonymousCredentials
+
+with mock.patch(
+    "google.auth.default", return_value=(AnonymousCredentials(), "some-project")
+):
+    for label in ["cold clients", "warm clients"]:
+        start = time.perf_counter()
+        main.get_storage_client()
+        main.get_publisher_client()
+        timings[label] = time.perf_counter() - start
+
+    from google.cloud import storage
+
+    start = time.perf_counter()
+    storage.Client()
+    main.build_publisher_client()
+    timings["new clients per invocation"] = time.perf_counter() - start
+
+print(json.dumps(timings))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    results = {}
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, "-c", CHILD_SCRIPT],
+            cwd=FUNCTION_DIRECTORY,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        for label, elapsed in json.loads(output.splitlines()[-1]).items():
+            results.setdefault(label, []).append(elapsed)
+
+    print(f"Median of {args.runs} runs, each in a new process")
+    for label, timings in results.items():
+        print(f"{label:>28}: {statistics.median(timings) * 1000:9.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Measure the compression ratio and CPU cost of `compress_payload` with gzip and zstd
+(when the zstandard package is installed) on the example HL7v2 messages and the
+sample FHIR bundles shipped with phdi_cloud_function_utils.
+
+Usage:
+    python benchmarks/bench_compression.py --iterations 200
+"""
+
+import argparse
+import time
+from pathlib import Path
+from phdi_cloud_function_utils import (
+    compress_payload,
+    decompress_payload,
+    stream_hl7_batch_messages,
+)
+from phdi_cloud_function_utils.compression import zstandard
+
+UTILS_DIRECTORY = (
+    Path(__file__).resolve().parent.parent
+    / "cloud-functions"
+    / "phdi_cloud_function_utils"
+    / "phdi_cloud_function_utils"
+)
+
+
+def load_samples() -> dict:
+    samples = {}
+    for path in sorted((UTILS_DIRECTORY / "example_messages").glob("*.hl7")):
+        for idx, message in enumerate(stream_hl7_batch_messages([path.read_bytes()])):
+            samples[f"{path.stem}[{idx}]"] = message.encode("utf-8")
+    for path in sorted(UTILS_DIRECTORY.glob("*.json")) + sorted(
+        (UTILS_DIRECTORY / "example_messages").glob("*.json")
+    ):
+        samples[path.name] = path.read_bytes()
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    encodings = ["gzip"] + (["zstd"] if zstandard is not None else [])
+    if zstandard is None:
+        print("zstandard is not installed, skipping zstd.")
+
+    print(
+        f"{'sample':>56} {'bytes':>8} "
+        + " ".join(
+            f"{encoding + ' ' + column:>14}"
+            for encoding in encodings
+            for column in ["ratio", "comp µs", "decomp µs"]
+        )
+    )
+    for name, data in load_samples().items():
+        row = f"{name[:56]:>56} {len(data):8d}"
+        for encoding in encodings:
+            compressed, attributes = compress_payload(data, encoding, threshold=0)
+
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                compress_payload(data, encoding, threshold=0)
+            compress_time = (time.perf_counter() - start) / args.iterations
+
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                decompress_payload(compressed, attributes)
+            decompress_time = (time.perf_counter() - start) / args.iterations
+
+            row += (
+                f" {len(data) / len(compressed):14.1f}"
+                f" {compress_time * 1e6:14.1f}"
+                f" {decompress_time * 1e6:14.1f}"
+            )
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Measure the overhead per message of deduplicating messages in read_source_data:
+hashing a message with `hash_message` (compared to BLAKE2b and MD5), and looking up
+and adding hashes in a `DedupIndex` with no persistent store, with a SQLite store,
+and with GCS stores backed by a `FakeStorageClient` whose requests take
+--gcs-latency seconds each:
+
+- gcs (per object): the previous store, an object per hash, checked with a request
+  per lookup and written with a request per hash.
+- gcs (sharded): `GCSDedupStore`, which downloads each shard of hashes once and
+  writes the hashes added to each shard as a new object in a single concurrent
+  flush.
+
+Adds are timed together with flushing the store. Cold hits look the hashes up from a
+new index and store, as a new function instance does. As its requests are slow, the
+per object store is measured with the first --gcs-messages messages.
+
+Usage:
+    python benchmarks/bench_dedup.py --messages 100000 --message-size 2000
+"""
+
+import argparse
+import hashlib
+import random
+import string
+import tempfile
+import time
+from pathlib import Path
+from phdi_cloud_function_utils import (
+    DedupIndex,
+    DedupStore,
+    GCSDedupStore,
+    SQLiteDedupStore,
+    hash_message,
+)
+from phdi_cloud_function_utils_testing.fakes import FakeStorageClient
+
+
+class PerObjectGCSDedupStore(DedupStore):
+    def __init__(self, storage_client, bucket_name: str, prefix: str = "dedup/"):
+        self.bucket = storage_client.bucket(bucket_name)
+        self.prefix = prefix
+
+    def contains(self, key: str) -> bool:
+        return self.bucket.blob(f"{self.prefix}{key}").exists()
+
+    def add(self, key: str) -> None:
+        self.bucket.blob(f"{self.prefix}{key}").upload_from_string(b"")
+
+
+def make_messages(count: int, size: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    alphabet = string.ascii_uppercase + string.digits + "|^~&"
+    messages = []
+    for idx in range(count):
+        body = "".join(rng.choices(alphabet, k=max(0, size - 20)))
+        messages.append(f"MSH|^~\\&|{idx}\rOBX|{body}\r")
+    return messages
+
+
+def time_per_message(function, items, flush=None) -> float:
+    start = time.perf_counter()
+    for item in items:
+        function(item)
+    if flush is not None:
+        flush()
+    return (time.perf_counter() - start) / len(items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--message-size", type=int, default=2000)
+    parser.add_argument("--cache-size", type=int, default=100000)
+    parser.add_argument("--gcs-messages", type=int, default=500)
+    parser.add_argument("--gcs-latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages, args.message_size)
+    print(f"{args.messages} messages of {args.message_size} bytes")
+
+    print("\nHashing (µs per message)")
+    hashes = {
+        "hash_message (SHA-256)": lambda message: hash_message(message, "ORU_R01"),
+        "BLAKE2b": lambda message: hashlib.blake2b(message.encode("utf-8")).hexdigest(),
+        "MD5": lambda message: hashlib.md5(message.encode("utf-8")).hexdigest(),
+    }
+    for name, function in hashes.items():
+        print(f"{name:>24} {time_per_message(function, messages) * 1e6:10.2f}")
+
+    keys = [hash_message(message) for message in messages]
+    per_object_keys = keys[: args.gcs_messages]
+    storage_client = FakeStorageClient(latency=args.gcs_latency)
+    with tempfile.TemporaryDirectory() as directory:
+        sqlite_path = str(Path(directory) / "dedup.db")
+        # Each configuration makes a new store on the same persistent state.
+        configurations = {
+            "memory": (keys, lambda: None),
+            "sqlite": (keys, lambda: SQLiteDedupStore(sqlite_path)),
+            "gcs (per object)": (
+                per_object_keys,
+                lambda: PerObjectGCSDedupStore(storage_client, "per-object-bucket"),
+            ),
+            "gcs (sharded)": (
+                keys,
+                lambda: GCSDedupStore(storage_client, "sharded-bucket"),
+            ),
+        }
+
+        print(
+            f"\nIndex operations (µs per message, GCS requests take "
+            f"{args.gcs_latency * 1000:g} ms)"
+        )
+        print(
+            f"{'index':>24} {'messages':>10} {'miss':>12} {'add':>12} {'hit':>12} "
+            f"{'cold hit':>12}"
+        )
+        for name, (index_keys, make_store) in configurations.items():
+            index = DedupIndex(max_size=args.cache_size, store=make_store())
+            miss = time_per_message(index.contains, index_keys)
+            add = time_per_message(index.add, index_keys, flush=index.flush)
+            hit = time_per_message(index.contains, index_keys)
+            cold_store = make_store()
+            if cold_store is not None:
+                cold_index = DedupIndex(max_size=args.cache_size, store=cold_store)
+                cold_hit = time_per_message(cold_index.contains, index_keys)
+                cold_hit = f"{cold_hit * 1e6:12.2f}"
+            else:
+                cold_hit = f"{'-':>12}"
+            print(
+                f"{name:>24} {len(index_keys):>10} {miss * 1e6:12.2f} "
+                f"{add * 1e6:12.2f} {hit * 1e6:12.2f} {cold_hit}"
+            )
+
+
+if __name__ == "__main__":
+    main()
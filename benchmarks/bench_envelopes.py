@@ -0,0 +1,94 @@
+"""
+Compare the size and CPU cost per message of the JSON and binary Pub/Sub envelopes
+built by `encode_envelope`, using the example HL7v2 messages. Sizes include the
+attribute keys and values, which Pub/Sub counts towards the size of a message.
+
+Usage:
+    python benchmarks/bench_envelopes.py --iterations 2000
+"""
+
+import argparse
+import time
+from pathlib import Path
+from phdi_cloud_function_utils import (
+    BINARY_ENVELOPE,
+    JSON_ENVELOPE,
+    decode_envelope,
+    encode_envelope,
+    stream_hl7_batch_messages,
+)
+
+EXAMPLE_MESSAGES = (
+    Path(__file__).resolve().parent.parent
+    / "cloud-functions"
+    / "phdi_cloud_function_utils"
+    / "phdi_cloud_function_utils"
+    / "example_messages"
+)
+FIELDS = {
+    "message_type": "hl7v2",
+    "root_template": "VXU_V04",
+    "filename": "source-data/vxu/VXU-V04-02_success_batch.hl7",
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    messages = []
+    for path in sorted(EXAMPLE_MESSAGES.glob("*.hl7")):
+        messages.extend(stream_hl7_batch_messages([path.read_bytes()]))
+    raw_bytes = sum(len(message.encode("utf-8")) for message in messages)
+    print(
+        f"{len(messages)} example messages, {raw_bytes / len(messages):.0f} bytes per "
+        "message on average"
+    )
+
+    results = {}
+    for envelope in [JSON_ENVELOPE, BINARY_ENVELOPE]:
+        encoded = [
+            encode_envelope(message, envelope=envelope, **FIELDS)
+            for message in messages
+        ]
+        size = sum(
+            len(data) + sum(len(key) + len(value) for key, value in attributes.items())
+            for data, attributes in encoded
+        )
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            for message in messages:
+                encode_envelope(message, envelope=envelope, **FIELDS)
+        encode_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            for data, attributes in encoded:
+                decode_envelope(data, attributes)
+        decode_time = time.perf_counter() - start
+
+        count = args.iterations * len(messages)
+        results[envelope] = (
+            size / len(messages),
+            encode_time / count * 1e6,
+            decode_time / count * 1e6,
+        )
+
+    print(f"{'envelope':>10} {'bytes/msg':>10} {'encode µs':>10} {'decode µs':>10}")
+    for envelope, (size, encode_time, decode_time) in results.items():
+        print(f"{envelope:>10} {size:10.0f} {encode_time:10.2f} {decode_time:10.2f}")
+
+    json_size, json_encode, json_decode = results[JSON_ENVELOPE]
+    binary_size, binary_encode, binary_decode = results[BINARY_ENVELOPE]
+    print(
+        f"\nThe binary envelope saves {json_size - binary_size:.0f} bytes "
+        f"({(1 - binary_size / json_size) * 100:.1f}%), "
+        f"{json_encode - binary_encode:.2f} µs to encode and "
+        f"{json_decode - binary_decode:.2f} µs to decode per message."
+    )
+
+
+if __name__ == "__main__":
+    main()
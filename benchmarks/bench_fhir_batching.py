@@ -0,0 +1,146 @@
+"""
+Compare uploading each harmonized bundle to the FHIR store in its own request, as the
+ingestion workflow does, with pulling bundles from a subscription and uploading them
+in merged bundles with `upload_fhir_batches`.
+
+Bundles are synthetic single-patient FHIR bundles, drawn from --patients distinct
+patients so that some messages are about the same patient. They are uploaded to a
+fake FHIR store that takes --latency seconds per request plus --entry-cost seconds per
+entry, and counts requests against a quota of --quota requests per minute, as the
+Cloud Healthcare API does.
+
+For each configuration the benchmark reports the requests made, the entries uploaded,
+the requests per minute the upload rate would need at --messages-per-second, and the
+time taken.
+
+Usage:
+    python benchmarks/bench_fhir_batching.py --messages 2000 --patients 500
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+from pathlib import Path
+from unittest import mock
+
+FUNCTION_DIRECTORY = (
+    Path(__file__).resolve().parent.parent / "cloud-functions" / "upload_fhir_batches"
+)
+CONFIGURATIONS = ("per message", "batched")
+
+
+class FakeFhirStore:
+    def __init__(self, latency: float, entry_cost: float):
+        self.latency = latency
+        self.entry_cost = entry_cost
+        self.request_count = 0
+        self.entry_count = 0
+
+    def upload(self, bundle: dict, *args) -> mock.Mock:
+        entries = bundle.get("entry", [])
+        self.request_count += 1
+        self.entry_count += len(entries)
+        time.sleep(self.latency + self.entry_cost * len(entries))
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {
+            "resourceType": "Bundle",
+            "type": "batch-response",
+            "entry": [{"response": {"status": "201 Created"}} for _ in entries],
+        }
+        return response
+
+
+def make_bundles(args: argparse.Namespace) -> list:
+    from phdi_cloud_function_utils_testing.synthetic import write_fhir_bundle
+
+    rng = random.Random(0)
+    bundles = []
+    for _ in range(args.messages):
+        file = io.StringIO()
+        write_fhir_bundle(
+            file,
+            patient_count=1,
+            observations_per_patient=args.observations,
+            seed=rng.randrange(args.patients),
+            bundle_type="batch",
+        )
+        bundles.append(file.getvalue().encode())
+    return bundles
+
+
+def run(configuration: str, bundles: list, args: argparse.Namespace) -> dict:
+    import main
+    from phdi_cloud_function_utils_testing.fakes import (
+        FakeStorageClient,
+        FakeSubscriberClient,
+    )
+
+    store = FakeFhirStore(args.latency, args.entry_cost)
+    start = time.perf_counter()
+    if configuration == "per message":
+        for data in bundles:
+            store.upload(json.loads(data))
+    else:
+        subscriber = FakeSubscriberClient()
+        for data in bundles:
+            subscriber.publish(data, filename="source-data/vxu/batch.hl7")
+        uploader = main.BatchUploader(
+            subscriber=subscriber,
+            subscription_path="some-subscription",
+            fhir_url="https://some-fhir-server/fhir",
+            failed_upload_bucket=FakeStorageClient().bucket("some-bucket"),
+        )
+        with mock.patch("main.upload_bundle", store.upload):
+            uploader.run(deadline=time.monotonic() + 3600)
+        assert subscriber.outstanding_count == 0
+    elapsed = time.perf_counter() - start
+
+    requests_per_message = store.request_count / len(bundles)
+    return {
+        "requests": store.request_count,
+        "entries": store.entry_count,
+        "requests_per_minute": requests_per_message * args.messages_per_second * 60,
+        "seconds": elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--patients", type=int, default=500)
+    parser.add_argument("--observations", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.002)
+    parser.add_argument("--entry-cost", type=float, default=0.0001)
+    parser.add_argument("--quota", type=int, default=3000)
+    parser.add_argument("--messages-per-second", type=float, default=100.0)
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(FUNCTION_DIRECTORY))
+    os.environ.setdefault("FHIR_BATCH_MAX_ENTRIES", "500")
+    bundles = make_bundles(args)
+
+    print(
+        f"{args.messages} messages about {args.patients} patients, quota of "
+        f"{args.quota} requests per minute at {args.messages_per_second:g} messages "
+        "per second"
+    )
+    print(
+        f"{'configuration':>14} {'requests':>9} {'entries':>8} {'req/min':>9} "
+        f"{'in quota':>9} {'seconds':>8}"
+    )
+    for configuration in CONFIGURATIONS:
+        result = run(configuration, bundles, args)
+        in_quota = "yes" if result["requests_per_minute"] <= args.quota else "no"
+        print(
+            f"{configuration:>14} {result['requests']:9d} {result['entries']:8d} "
+            f"{result['requests_per_minute']:9.0f} {in_quota:>9} "
+            f"{result['seconds']:8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
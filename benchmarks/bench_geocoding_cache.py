@@ -0,0 +1,138 @@
+"""
+Compare geocoding the patient addresses of a feed of bundles with a request per
+address, as phdi's FHIR geocoding clients do, with a `GeocodeCache` holding results in
+memory only, and with a `GeocodeCache` backed by a persistent SQLite store, both when
+the store is empty and when it was filled by an earlier function instance.
+
+Addresses are drawn with a Zipf-like skew from --distinct-addresses addresses, as
+feeds repeat the addresses of the same patients, and about a third are spelled
+differently, e.g. in lower case, with "Street" for "St", or with a ZIP+4 code, so
+that the cache is only hit if addresses are normalized. The geocoder is a
+`FakeGeocoder` taking --latency seconds per request plus --address-cost seconds per
+address.
+
+For each configuration the benchmark reports the geocoder requests made, the
+addresses geocoded, which Smarty bills for, the hit ratio of the cache, and the time
+taken.
+
+Usage:
+    python benchmarks/bench_geocoding_cache.py --bundles 2000 --distinct-addresses 5000
+"""
+
+import argparse
+import random
+import time
+from phdi_cloud_function_utils import GeocodeCache, SQLiteGeocodeCacheStore
+from phdi_cloud_function_utils_testing.fakes import FakeGeocoder
+
+CONFIGURATIONS = ("uncached", "memory", "memory + store, cold", "memory + store, warm")
+
+
+def make_address(idx: int, rng: random.Random) -> dict:
+    address = {
+        "line": [f"{idx} Main St"],
+        "city": "Springfield",
+        "state": "IL",
+        "postalCode": "62701",
+    }
+    variant = rng.randrange(6)
+    if variant == 0:
+        address["line"] = [f"{idx} main street"]
+    elif variant == 1:
+        address["postalCode"] = "62701-1234"
+    return address
+
+
+def make_bundles(args: argparse.Namespace) -> list:
+    rng = random.Random(0)
+    weights = [1 / (rank + 1) for rank in range(args.distinct_addresses)]
+    bundles = []
+    for _ in range(args.bundles):
+        indices = rng.choices(
+            range(args.distinct_addresses), weights=weights, k=args.patients_per_bundle
+        )
+        bundles.append(
+            {
+                "resourceType": "Bundle",
+                "type": "batch",
+                "entry": [
+                    {
+                        "resource": {
+                            "resourceType": "Patient",
+                            "address": [make_address(idx, rng)],
+                        }
+                    }
+                    for idx in indices
+                ],
+            }
+        )
+    return bundles
+
+
+def run(configuration: str, bundles: list, args: argparse.Namespace) -> dict:
+    geocoder = FakeGeocoder(latency=args.latency, address_cost=args.address_cost)
+    geocode_cache = None
+    if configuration != "uncached":
+        store = None
+        if configuration.startswith("memory + store"):
+            store = SQLiteGeocodeCacheStore()
+            if configuration.endswith("warm"):
+                # An earlier instance filled the store.
+                GeocodeCache(FakeGeocoder(), store=store).geocode_addresses(
+                    address
+                    for bundle in bundles
+                    for entry in bundle["entry"]
+                    for address in entry["resource"]["address"]
+                )
+        geocode_cache = GeocodeCache(
+            geocoder, max_size=args.cache_size, store=store, batch_size=100
+        )
+
+    start = time.perf_counter()
+    for bundle in bundles:
+        if geocode_cache is None:
+            for entry in bundle["entry"]:
+                for address in entry["resource"]["address"]:
+                    geocoder([address])
+        else:
+            geocode_cache.geocode_bundle(bundle)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "requests": len(geocoder.request_sizes),
+        "addresses": geocoder.address_count,
+        "hit_ratio": geocode_cache.hit_ratio if geocode_cache else 0.0,
+        "seconds": elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bundles", type=int, default=2000)
+    parser.add_argument("--patients-per-bundle", type=int, default=5)
+    parser.add_argument("--distinct-addresses", type=int, default=5000)
+    parser.add_argument("--cache-size", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.001)
+    parser.add_argument("--address-cost", type=float, default=0.0001)
+    args = parser.parse_args()
+
+    bundles = make_bundles(args)
+    print(
+        f"{args.bundles} bundles of {args.patients_per_bundle} patients with "
+        f"{args.distinct_addresses} distinct addresses, {args.cache_size} results in "
+        "memory"
+    )
+    print(
+        f"{'configuration':>22} {'requests':>9} {'addresses':>10} {'hit ratio':>10} "
+        f"{'seconds':>8}"
+    )
+    for configuration in CONFIGURATIONS:
+        result = run(configuration, bundles, args)
+        print(
+            f"{configuration:>22} {result['requests']:9d} {result['addresses']:10d} "
+            f"{result['hit_ratio']:10.1%} {result['seconds']:8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
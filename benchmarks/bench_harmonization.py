@@ -0,0 +1,191 @@
+"""
+Compare running the harmonization chain of the ingestion pipeline as the workflow does
+by default, with a call to the ingestion service per step, which parses the bundle,
+runs the step, and serializes the bundle again, with running it in process with
+`run_harmonization_chain`, as the harmonize_bundle function does, in a single call.
+
+Both run against a local HTTP server, which sleeps for --hop-latency seconds per
+request to stand in for the network, authentication, and queueing of a real hop. The
+names and phone numbers are standardized with phdi; geocoding, adding the patient
+identifier, and uploading to the FHIR server are replaced by stubs, so that no
+credentials or network access are required.
+
+For each bundle size the benchmark reports the median time to harmonize a bundle with
+each configuration, and the bytes of JSON sent and received.
+
+Usage:
+    python benchmarks/bench_harmonization.py --bundles 20 --hop-latency 0.02
+"""
+
+import argparse
+import hashlib
+import http.client
+import io
+import json
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from phdi.fhir.harmonization import standardize_names, standardize_phones
+from phdi_cloud_function_utils import (
+    HarmonizationContext,
+    run_harmonization_chain,
+)
+from phdi_cloud_function_utils_testing.synthetic import write_fhir_bundle
+
+CONFIGURATIONS = ("5 hops", "in process")
+
+
+def stub_geocode_bundle(bundle: dict, context: HarmonizationContext) -> dict:
+    for entry in bundle.get("entry", []):
+        resource = entry.get("resource", {})
+        for address in resource.get("address", []):
+            address["extension"] = [
+                {
+                    "url": "http://hl7.org/fhir/StructureDefinition/geolocation",
+                    "extension": [
+                        {"url": "latitude", "valueDecimal": 45.0},
+                        {"url": "longitude", "valueDecimal": -122.0},
+                    ],
+                }
+            ]
+    return bundle
+
+
+def stub_add_patient_identifier(bundle: dict, context: HarmonizationContext) -> dict:
+    for entry in bundle.get("entry", []):
+        resource = entry.get("resource", {})
+        if resource.get("resourceType") == "Patient":
+            linking_string = json.dumps(
+                [resource.get("name"), resource.get("birthDate")], sort_keys=True
+            )
+            resource.setdefault("identifier", []).append(
+                {
+                    "system": "urn:ietf:rfc:3986",
+                    "value": hashlib.sha256(linking_string.encode()).hexdigest(),
+                }
+            )
+    return bundle
+
+
+def stub_upload(bundle: dict, context: HarmonizationContext) -> dict:
+    context.results["fhir_server_responses"] = [{"status_code": 200}]
+    return bundle
+
+
+STEPS = {
+    "standardize_names": lambda bundle, context: standardize_names(bundle),
+    "standardize_phones": lambda bundle, context: standardize_phones(bundle),
+    "geocode_bundle": stub_geocode_bundle,
+    "add_patient_identifier_in_bundle": stub_add_patient_identifier,
+    "upload_bundle_to_fhir_server": stub_upload,
+}
+
+
+def make_handler(hop_latency: float):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            time.sleep(hop_latency)
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            name = self.path.strip("/")
+            if name == "harmonize_bundle":
+                steps = list(STEPS.items())
+            else:
+                steps = [(name, STEPS[name])]
+            context = HarmonizationContext()
+            bundle = run_harmonization_chain(body["bundle"], steps, context)
+            if body.get("return_bundle", True):
+                payload = {"bundle": bundle, **context.results}
+            else:
+                payload = context.results
+            response = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def post(port: int, path: str, payload: dict) -> tuple:
+    body = json.dumps(payload).encode()
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    connection.request(
+        "POST", path, body=body, headers={"Content-Type": "application/json"}
+    )
+    response = connection.getresponse()
+    data = response.read()
+    connection.close()
+    return json.loads(data), len(body) + len(data)
+
+
+def harmonize(configuration: str, port: int, bundle: dict) -> int:
+    if configuration == "in process":
+        _, transferred = post(
+            port, "/harmonize_bundle", {"bundle": bundle, "return_bundle": False}
+        )
+        return transferred
+
+    transferred = 0
+    for name in STEPS:
+        payload, size = post(port, f"/{name}", {"bundle": bundle})
+        transferred += size
+        bundle = payload.get("bundle", bundle)
+    return transferred
+
+
+def make_bundle(patient_count: int, seed: int) -> dict:
+    file = io.StringIO()
+    write_fhir_bundle(file, patient_count=patient_count, seed=seed)
+    return json.loads(file.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bundles", type=int, default=20)
+    parser.add_argument(
+        "--patients",
+        type=int,
+        nargs="+",
+        default=[1, 10, 100],
+        help="Patients per bundle, each with 5 observations.",
+    )
+    parser.add_argument(
+        "--hop-latency",
+        type=float,
+        default=0.02,
+        help="Seconds added to every request.",
+    )
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(args.hop_latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    print(f"{args.bundles} bundles per case, {args.hop_latency}s per hop")
+    print(f"{'patients':>8} {'configuration':>14} {'median ms':>10} {'KB sent':>9}")
+    try:
+        for patient_count in args.patients:
+            bundles = [make_bundle(patient_count, seed) for seed in range(args.bundles)]
+            for configuration in CONFIGURATIONS:
+                durations = []
+                transferred = 0
+                for bundle in bundles:
+                    start = time.perf_counter()
+                    transferred += harmonize(configuration, port, bundle)
+                    durations.append(time.perf_counter() - start)
+                print(
+                    f"{patient_count:8d} {configuration:>14} "
+                    f"{statistics.median(durations) * 1000:10.1f} "
+                    f"{transferred / len(bundles) / 1024:9.1f}"
+                )
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
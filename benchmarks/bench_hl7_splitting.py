@@ -0,0 +1,103 @@
+"""
+Measure the throughput of splitting large synthetic batch files of HL7v2 messages
+with `phdi.harmonization.hl7.convert_hl7_batch_messages_to_list` (when phdi is
+installed), `stream_hl7_batch_messages`, and `iter_hl7_message_offsets`, both on its
+own and when building every message with `get_hl7_message`. The batch file is built
+by repeating one of the example messages with a unique control ID.
+
+Usage:
+    python benchmarks/bench_hl7_splitting.py --messages 1000 10000 50000
+"""
+
+import argparse
+import time
+from pathlib import Path
+from phdi_cloud_function_utils import (
+    get_hl7_message,
+    iter_hl7_message_offsets,
+    stream_hl7_batch_messages,
+)
+
+EXAMPLE_MESSAGE = (
+    Path(__file__).resolve().parent.parent
+    / "cloud-functions"
+    / "phdi_cloud_function_utils"
+    / "phdi_cloud_function_utils"
+    / "example_messages"
+    / "VXU-V04-01_success_single.hl7"
+)
+
+
+def make_batch(message_count: int) -> bytes:
+    message = EXAMPLE_MESSAGE.read_bytes().strip().replace(b"\n", b"\r\n")
+    messages = [
+        message.replace(b"MSG00001", f"MSG{idx:08d}".encode()) + b"\r\n"
+        for idx in range(message_count)
+    ]
+    return (
+        b"FHS|^~\\&|\r\nBHS|^~\\&|\r\n"
+        + b"".join(messages)
+        + f"BTS|{message_count}\r\nFTS|1\r\n".encode()
+    )
+
+
+def split_with_phdi(batch: bytes) -> int:
+    from phdi.harmonization.hl7 import convert_hl7_batch_messages_to_list
+
+    return len(convert_hl7_batch_messages_to_list(batch.decode("utf-8")))
+
+
+def split_with_stream(batch: bytes, chunk_size: int = 8 * 1024 * 1024) -> int:
+    view = memoryview(batch)
+    chunks = (
+        bytes(view[start:][:chunk_size]) for start in range(0, len(batch), chunk_size)
+    )
+    return sum(1 for _ in stream_hl7_batch_messages(chunks))
+
+
+def index_offsets(batch: bytes) -> int:
+    return len(list(iter_hl7_message_offsets(batch)))
+
+
+def split_with_offsets(batch: bytes) -> int:
+    return sum(
+        1
+        for start, end in iter_hl7_message_offsets(batch)
+        if get_hl7_message(batch, start, end)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, nargs="+", default=[1000, 10000])
+    args = parser.parse_args()
+
+    splitters = {
+        "stream_hl7_batch_messages": split_with_stream,
+        "iter_hl7_message_offsets": index_offsets,
+        "offsets + get_hl7_message": split_with_offsets,
+    }
+    try:
+        import phdi.harmonization.hl7  # noqa: F401
+
+        splitters = {"phdi (str)": split_with_phdi, **splitters}
+    except ImportError:
+        print("phdi is not installed, skipping convert_hl7_batch_messages_to_list.")
+
+    for message_count in args.messages:
+        batch = make_batch(message_count)
+        megabytes = len(batch) / 1024 / 1024
+        print(f"\n{message_count} messages, {megabytes:.1f} MiB")
+        for name, splitter in splitters.items():
+            start = time.perf_counter()
+            count = splitter(batch)
+            elapsed = time.perf_counter() - start
+            assert count == message_count, f"{name} found {count} messages"
+            print(
+                f"{name:>28}: {elapsed:7.3f} s {megabytes / elapsed:9.1f} MiB/s "
+                f"{message_count / elapsed:10.0f} msg/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Measure the cost per message of logging each published message, as read_source_data
+does, with an eagerly formatted f-string, as before MessageLogger was added, and with
+MessageLogger in each MESSAGE_LOG_MODE. Each configuration is run with the root logger
+at INFO, so that the lines it calls for are emitted to a handler writing to
+os.devnull, and at WARNING, so that they are not.
+
+For each run the benchmark reports the nanoseconds spent logging per message and the
+number of lines emitted. Progress lines are logged every --interval seconds in every
+MessageLogger mode.
+
+Usage:
+    python benchmarks/bench_logging.py --messages 200000
+"""
+
+import argparse
+import logging
+import os
+import time
+from phdi_cloud_function_utils import MessageLogger
+
+CONFIGURATIONS = ("f-string", "all", "sampled", "failures")
+TOPIC_PATH = "projects/some-project/topics/some-topic"
+
+
+class CountingHandler(logging.StreamHandler):
+    def __init__(self, stream):
+        super().__init__(stream)
+        self.count = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.count += 1
+        super().emit(record)
+
+
+def run(configuration: str, level: int, args: argparse.Namespace) -> dict:
+    root = logging.getLogger()
+    root.setLevel(level)
+    with open(os.devnull, "w") as devnull:
+        handler = CountingHandler(devnull)
+        handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        root.addHandler(handler)
+        try:
+            source = "source-data/vxu/batch.hl7"
+            if configuration == "f-string":
+                start = time.perf_counter()
+                for idx in range(args.messages):
+                    logging.info(
+                        f"Message {idx} in {source} was published to {TOPIC_PATH} "
+                        f"with message ID {idx}."
+                    )
+            else:
+                message_logger = MessageLogger(
+                    source=source,
+                    mode=configuration,
+                    sample_rate=args.sample_rate,
+                    progress_interval=args.interval,
+                )
+                start = time.perf_counter()
+                for idx in range(args.messages):
+                    message_logger.message(
+                        "Message %d in %s was published to %s with message ID %s.",
+                        idx,
+                        source,
+                        TOPIC_PATH,
+                        idx,
+                    )
+            elapsed = time.perf_counter() - start
+        finally:
+            root.removeHandler(handler)
+
+    return {
+        "ns_per_message": elapsed / args.messages * 1e9,
+        "lines": handler.count,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--sample-rate", type=int, default=100)
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=30.0,
+        help="Seconds between progress lines.",
+    )
+    args = parser.parse_args()
+
+    print(f"{args.messages} messages, sampling 1 in {args.sample_rate}")
+    print(f"{'level':>8} {'configuration':>14} {'ns/message':>11} {'lines':>8}")
+    for level in (logging.INFO, logging.WARNING):
+        for configuration in CONFIGURATIONS:
+            result = run(configuration, level, args)
+            print(
+                f"{logging.getLevelName(level):>8} {configuration:>14} "
+                f"{result['ns_per_message']:11.0f} {result['lines']:8d}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Compare the throughput of publishing messages one at a time, waiting on each
+message's future before publishing the next, with publishing through
+ConcurrentPublisher. Both use a local fake publisher that resolves each future after a
+simulated round trip.
+
+Usage:
+    python benchmarks/bench_publishing.py --messages 2000 --latency 0.005
+"""
+
+import argparse
+import time
+from phdi_cloud_function_utils import ConcurrentPublisher
+from phdi_cloud_function_utils_testing.fakes import FakePublisherClient
+
+
+def publish_serially(publisher: FakePublisherClient, payloads: list) -> None:
+    for payload in payloads:
+        publisher.publish("some-topic", payload, origin="benchmark").result()
+
+
+def publish_concurrently(
+    publisher: FakePublisherClient, payloads: list, max_in_flight_messages: int
+) -> None:
+    concurrent_publisher = ConcurrentPublisher(
+        publisher=publisher,
+        topic_path="some-topic",
+        source="benchmark",
+        failure_handler=lambda idx, message, error: None,
+        max_in_flight_messages=max_in_flight_messages,
+        origin="benchmark",
+    )
+    for idx, payload in enumerate(payloads):
+        concurrent_publisher.publish(idx, payload, payload)
+    concurrent_publisher.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--message-size", type=int, default=2048)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.005,
+        help="Simulated Pub/Sub round trip time in seconds.",
+    )
+    parser.add_argument("--max-in-flight-messages", type=int, default=1000)
+    args = parser.parse_args()
+
+    payloads = [b"x" * args.message_size for _ in range(args.messages)]
+    results = {}
+
+    start = time.perf_counter()
+    publish_serially(FakePublisherClient(latency=args.latency), payloads)
+    results["serial"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    publish_concurrently(
+        FakePublisherClient(latency=args.latency),
+        payloads,
+        args.max_in_flight_messages,
+    )
+    results["concurrent"] = time.perf_counter() - start
+
+    print(
+        f"{args.messages} messages of {args.message_size} bytes, "
+        f"{args.latency * 1000:.1f} ms simulated latency"
+    )
+    for mode, elapsed in results.items():
+        print(f"{mode:>12}: {elapsed:8.3f} s {args.messages / elapsed:12.0f} msg/s")
+    print(f"     speedup: {results['serial'] / results['concurrent']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
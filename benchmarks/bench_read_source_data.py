@@ -0,0 +1,216 @@
+"""
+Drive read_source_data end to end against `FakeStorageClient` and
+`FakePublisherClient`, for ELR and VXU batch files and eCR documents of increasing
+size, and report throughput, peak RSS, and per-message latency.
+
+Each case runs in a fresh Python process so that its peak RSS is not affected by the
+cases before it. Batch files are written to a temporary directory and served by
+`FakeStorageClient` from disk, so neither the benchmark nor the fake holds the whole
+file in memory. Source data is generated with
+`phdi_cloud_function_utils_testing.synthetic`.
+For ELR and VXU a case is a single batch file holding the given number of messages.
+For eCR, whose files hold a single CCD document, a case is that many files, each read
+by its own invocation.
+
+Columns:
+- MiB: the total size of the source data.
+- msg/s and MiB/s: throughput over the whole case.
+- peak RSS: the peak resident set size of the process, and how much of it was added
+  while running the case.
+- µs/msg: the mean wall time per message.
+- publish p50/p99: the latency of Pub/Sub publish requests from the function's
+  metrics (for eCR, the latency of whole invocations).
+- failed: messages that could not be published and were written to storage.
+
+Usage:
+    python benchmarks/bench_read_source_data.py --sizes 1 1000 100000
+    python benchmarks/bench_read_source_data.py --types vxu --sizes 1000000 \\
+        --latency 0.02 --failure-rate 0.001
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+FUNCTION_DIRECTORY = (
+    Path(__file__).resolve().parent.parent / "cloud-functions" / "read_source_data"
+)
+MESSAGE_TYPES = ("elr", "vxu", "ecr")
+HL7_MESSAGE_TYPES = {"elr": "ORU_R01", "vxu": "VXU_V04"}
+
+
+def run_case(args: argparse.Namespace) -> dict:
+    """
+    Run a single case in this process and return its results.
+    """
+    sys.path.insert(0, str(FUNCTION_DIRECTORY))
+    os.environ.update(
+        {
+            "PROJECT_ID": "some-project",
+            "INGESTION_TOPIC": "some-topic",
+            "STREAM_SOURCE_DATA": "false" if args.no_stream else "true",
+            "PUBSUB_ENVELOPE": args.envelope,
+        }
+    )
+    import main
+    from phdi_cloud_function_utils_testing.fakes import (
+        FakePublisherClient,
+        FakeStorageClient,
+    )
+    from phdi_cloud_function_utils_testing.synthetic import (
+        write_ccd_document,
+        write_hl7_batch,
+    )
+
+    storage_client = FakeStorageClient()
+    publisher = FakePublisherClient(
+        latency=args.latency,
+        failure_rate=args.failure_rate,
+        seed=0,
+        keep_messages=False,
+    )
+    main._clients["storage"] = storage_client
+    main._clients["publisher"] = publisher
+    bucket = storage_client.bucket("some-bucket")
+
+    directory = Path(args.directory)
+    message_type, message_count = args.case
+    message_count = int(message_count)
+    if message_type == "ecr":
+        path = directory / "document.xml"
+        with open(path, "w", encoding="utf-8") as file:
+            write_ccd_document(file, seed=0, result_count=50)
+        filenames = [
+            f"source-data/ecr/document-{idx}.xml" for idx in range(message_count)
+        ]
+    else:
+        path = directory / f"{message_type}.hl7"
+        with open(path, "w", encoding="utf-8", newline="") as file:
+            write_hl7_batch(
+                file, HL7_MESSAGE_TYPES[message_type], message_count, seed=0
+            )
+        filenames = [f"source-data/{message_type}/batch.hl7"]
+    for filename in filenames:
+        bucket.blob(filename).upload_from_filename(path)
+    size = os.path.getsize(path) * len(filenames)
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    invocation_seconds = []
+    publish_latency = None
+    failure_count = 0
+    start = time.perf_counter()
+    for filename in filenames:
+        invocation_start = time.perf_counter()
+        response = main.read_source_data(
+            SimpleNamespace(data={"name": filename, "bucket": "some-bucket"})
+        )
+        invocation_seconds.append(time.perf_counter() - invocation_start)
+        metrics = response.json["metrics"]
+        failure_count += metrics["counters"].get("publish_failures", 0)
+        publish_latency = metrics["histograms"].get("publish_latency_seconds")
+    seconds = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if message_type == "ecr":
+        invocation_seconds.sort()
+        p50 = invocation_seconds[len(invocation_seconds) // 2]
+        p99 = invocation_seconds[len(invocation_seconds) * 99 // 100]
+    else:
+        p50, p99 = publish_latency["p50"], publish_latency["p99"]
+
+    return {
+        "type": message_type,
+        "messages": message_count,
+        "mib": size / 2**20,
+        "seconds": seconds,
+        "peak_rss_mib": peak_rss / 1024,
+        "added_rss_mib": (peak_rss - baseline_rss) / 1024,
+        "p50_ms": p50 * 1000,
+        "p99_ms": p99 * 1000,
+        "failed": failure_count,
+        "published": publisher.published_count,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--types",
+        nargs="+",
+        choices=MESSAGE_TYPES,
+        default=["elr", "vxu", "ecr"],
+    )
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1, 100, 10000])
+    parser.add_argument(
+        "--latency", type=float, default=0.005, help="Fake publish latency in seconds."
+    )
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.0,
+        help="Probability that a fake publish fails.",
+    )
+    parser.add_argument("--envelope", choices=["json", "binary"], default="binary")
+    parser.add_argument(
+        "--no-stream",
+        action="store_true",
+        help="Read batch files with phdi instead of streaming them.",
+    )
+    parser.add_argument("--case", nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument("--directory", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args)))
+        return
+
+    print(
+        f"{'type':>5} {'messages':>9} {'MiB':>8} {'seconds':>8} {'msg/s':>9} "
+        f"{'MiB/s':>7} {'peak RSS':>9} {'added':>7} {'µs/msg':>8} "
+        f"{'p50 ms':>7} {'p99 ms':>7} {'failed':>7}"
+    )
+    for message_type in args.types:
+        for size in args.sizes:
+            with tempfile.TemporaryDirectory() as directory:
+                command = [
+                    sys.executable,
+                    __file__,
+                    "--case",
+                    message_type,
+                    str(size),
+                    "--directory",
+                    directory,
+                    "--latency",
+                    str(args.latency),
+                    "--failure-rate",
+                    str(args.failure_rate),
+                    "--envelope",
+                    args.envelope,
+                ] + (["--no-stream"] if args.no_stream else [])
+                output = subprocess.run(
+                    command, check=True, capture_output=True, text=True
+                ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(
+                f"{result['type']:>5} {result['messages']:9d} {result['mib']:8.1f} "
+                f"{result['seconds']:8.2f} "
+                f"{result['messages'] / result['seconds']:9.0f} "
+                f"{result['mib'] / result['seconds']:7.1f} "
+                f"{result['peak_rss_mib']:9.1f} {result['added_rss_mib']:7.1f} "
+                f"{result['seconds'] / result['messages'] * 1e6:8.1f} "
+                f"{result['p50_ms']:7.2f} {result['p99_ms']:7.2f} "
+                f"{result['failed']:7d}"
+            )
+
+
+if __name__ == "__main__":
+    main()
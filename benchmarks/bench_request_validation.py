@@ -0,0 +1,143 @@
+"""
+Measure the cost of validating HTTP requests holding multi-MB FHIR bundles, as the
+HTTP Cloud Functions do before handling them.
+
+Each configuration validates a fresh flask.Request per run:
+
+- get_json: the previous validate_fhir_bundle_or_resource, which parsed the whole
+  body with request.get_json() to check its resourceType.
+- peek resourceType: validate_fhir_bundle_or_resource, which reads the resourceType
+  from the start of the body with the incremental parser.
+- count entries: `validate_request` checking the resourceType and the number of
+  entries against a limit, parsing entries one at a time and discarding them, for
+  rejecting requests before they are parsed.
+- parse once: `validate_request` parsing the body with `require_json_object` before
+  checking the resourceType and number of entries of the parsed body, followed by
+  the handler getting it with `get_request_body(request).json()`, as handlers that
+  need the parsed body do, so the body is parsed once.
+- over max_bytes: a body over the size limit, rejected by its Content-Length without
+  being read.
+
+For each bundle size the benchmark reports the median time per request and the peak
+memory allocated while validating, measured with tracemalloc in a separate run.
+
+Usage:
+    python benchmarks/bench_request_validation.py --sizes-mb 1 5 10 --runs 5
+"""
+
+import argparse
+import io
+import json
+import logging
+import statistics
+import time
+import tracemalloc
+import flask
+from phdi_cloud_function_utils import (
+    get_request_body,
+    require_json_object,
+    require_max_entries,
+    require_resource_type,
+    validate_fhir_bundle_or_resource,
+    validate_request,
+)
+from phdi_cloud_function_utils_testing.synthetic import write_fhir_bundle
+
+# The approximate number of bytes of a synthetic patient with 5 observations.
+BYTES_PER_PATIENT = 4800
+
+
+def validate_with_get_json(request: flask.Request) -> None:
+    if request.get_json().get("resourceType") is None:
+        raise ValueError("FHIR Resource Type not specified.")
+
+
+def validate_with_peek(request: flask.Request) -> None:
+    assert validate_fhir_bundle_or_resource(request).status_code == 200
+
+
+def validate_entry_count(request: flask.Request) -> None:
+    steps = [require_resource_type("Bundle"), require_max_entries(1000000)]
+    assert validate_request(request, steps).status_code == 200
+
+
+def validate_and_parse(request: flask.Request) -> None:
+    steps = [
+        require_json_object,
+        require_resource_type("Bundle"),
+        require_max_entries(1000000),
+    ]
+    assert validate_request(request, steps).status_code == 200
+    get_request_body(request).json()
+
+
+def reject_over_max_bytes(request: flask.Request) -> None:
+    response = validate_request(
+        request, [require_resource_type()], max_bytes=request.content_length - 1
+    )
+    assert response.status_code == 413
+
+
+CONFIGURATIONS = {
+    "get_json": validate_with_get_json,
+    "peek resourceType": validate_with_peek,
+    "count entries": validate_entry_count,
+    "parse once": validate_and_parse,
+    "over max_bytes": reject_over_max_bytes,
+}
+
+
+def make_body(size_mb: float) -> bytes:
+    file = io.StringIO()
+    patient_count = max(1, int(size_mb * 1024 * 1024 / BYTES_PER_PATIENT))
+    write_fhir_bundle(file, patient_count=patient_count, seed=0)
+    return file.getvalue().encode("utf-8")
+
+
+def make_request(body: bytes) -> flask.Request:
+    return flask.Request.from_values(data=body, content_type="application/json")
+
+
+def measure(validate, body: bytes, runs: int) -> tuple:
+    durations = []
+    for _ in range(runs):
+        request = make_request(body)
+        # The body is read before timing, as the functions framework has it in memory.
+        request.get_data(cache=True)
+        start = time.perf_counter()
+        validate(request)
+        durations.append(time.perf_counter() - start)
+
+    request = make_request(body)
+    request.get_data(cache=True)
+    tracemalloc.start()
+    validate(request)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(durations), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes-mb", type=float, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    # Rejected requests are logged as errors.
+    logging.disable(logging.ERROR)
+
+    print(f"{'size':>8} {'configuration':>18} {'ms':>9} {'peak MB':>9}")
+    for size_mb in args.sizes_mb:
+        body = make_body(size_mb)
+        entry_count = len(json.loads(body)["entry"])
+        size = f"{len(body) / 1024 / 1024:.1f} MB"
+        for name, validate in CONFIGURATIONS.items():
+            seconds, peak = measure(validate, body, args.runs)
+            print(
+                f"{size:>8} {name:>18} {seconds * 1000:9.2f} "
+                f"{peak / 1024 / 1024:9.2f}"
+            )
+        print(f"{'':>8} {entry_count} entries")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Compare how ConcurrentPublisher retries failed publish requests under each retry
+configuration: a single immediate retry, as before retry policies were added,
+exponential backoff with jitter, and backoff limited by a retry budget and a circuit
+breaker. Each configuration publishes the same messages to a local fake publisher
+that fails requests at random, during a total outage, and during an outage that ends
+part way through.
+
+For each run the benchmark reports the publish requests made per message, which is
+the load added to Pub/Sub, the share of messages published, the messages diverted to
+the failure manifest by the circuit breaker without being published, and the time
+taken.
+
+Usage:
+    python benchmarks/bench_retries.py --messages 1000 --latency 0.002
+"""
+
+import argparse
+import threading
+import time
+from google.api_core.exceptions import ServiceUnavailable
+from phdi_cloud_function_utils import (
+    CircuitBreaker,
+    ConcurrentPublisher,
+    Metrics,
+    RetryBudget,
+    RetryPolicy,
+)
+from phdi_cloud_function_utils_testing.fakes import FakePublisherClient
+
+CONFIGURATIONS = ("immediate", "backoff", "budget+breaker")
+
+
+def build_publisher(
+    configuration: str,
+    publisher: FakePublisherClient,
+    metrics: Metrics,
+    args: argparse.Namespace,
+) -> ConcurrentPublisher:
+    retry_budget = None
+    circuit_breaker = None
+    if configuration == "immediate":
+        retry_policy = RetryPolicy(max_attempts=2, initial_backoff=0.0)
+    else:
+        retry_policy = RetryPolicy(
+            max_attempts=args.max_attempts,
+            initial_backoff=args.initial_backoff,
+            seed=0,
+        )
+    if configuration == "budget+breaker":
+        retry_budget = RetryBudget(ratio=0.1)
+        circuit_breaker = CircuitBreaker(reset_timeout=args.reset_timeout)
+    return ConcurrentPublisher(
+        publisher=publisher,
+        topic_path="some-topic",
+        source="benchmark",
+        failure_handler=lambda idx, message, error: None,
+        max_in_flight_messages=args.max_in_flight_messages,
+        metrics=metrics,
+        retry_policy=retry_policy,
+        retry_budget=retry_budget,
+        circuit_breaker=circuit_breaker,
+        origin="benchmark",
+    )
+
+
+def run(
+    configuration: str,
+    failure_rate: float,
+    recover_after: float,
+    args: argparse.Namespace,
+) -> dict:
+    publisher = FakePublisherClient(
+        latency=args.latency,
+        failure_rate=failure_rate,
+        seed=1,
+        keep_messages=False,
+        failure_exception=ServiceUnavailable("Fake outage."),
+    )
+    metrics = Metrics()
+    concurrent_publisher = build_publisher(configuration, publisher, metrics, args)
+    payload = b"x" * args.message_size
+
+    recovery = None
+    if recover_after is not None:
+        recovery = threading.Timer(
+            recover_after, lambda: setattr(publisher, "failure_rate", 0.0)
+        )
+        recovery.start()
+    start = time.perf_counter()
+    for idx in range(args.messages):
+        concurrent_publisher.publish(idx, payload, payload)
+    concurrent_publisher.flush()
+    elapsed = time.perf_counter() - start
+    if recovery is not None:
+        recovery.cancel()
+
+    return {
+        "requests_per_message": publisher.attempt_count / args.messages,
+        "published": concurrent_publisher.success_count / args.messages,
+        "diverted": metrics.counters.get("publish_diverted", 0),
+        "seconds": elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--message-size", type=int, default=1024)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.002,
+        help="Simulated Pub/Sub round trip time in seconds.",
+    )
+    parser.add_argument("--max-in-flight-messages", type=int, default=50)
+    parser.add_argument("--max-attempts", type=int, default=5)
+    parser.add_argument(
+        "--initial-backoff",
+        type=float,
+        default=0.002,
+        help="The bound on the delay before the first retry, in seconds.",
+    )
+    parser.add_argument("--reset-timeout", type=float, default=0.25)
+    parser.add_argument(
+        "--transient-failure-rate",
+        type=float,
+        default=0.05,
+        help="The failure rate of the transient failures scenario.",
+    )
+    parser.add_argument(
+        "--outage-seconds",
+        type=float,
+        default=0.5,
+        help="How long the outage lasts in the recovering outage scenario.",
+    )
+    args = parser.parse_args()
+
+    scenarios = {
+        "transient": (args.transient_failure_rate, None),
+        "outage": (1.0, None),
+        "recovering": (1.0, args.outage_seconds),
+    }
+    print(
+        f"{args.messages} messages, {args.latency * 1000:.1f} ms simulated latency, "
+        f"at most {args.max_attempts} attempts per message"
+    )
+    print(
+        f"{'scenario':>12} {'configuration':>16} {'requests/msg':>13} "
+        f"{'published':>10} {'diverted':>9} {'seconds':>9}"
+    )
+    for scenario, (failure_rate, recover_after) in scenarios.items():
+        for configuration in CONFIGURATIONS:
+            result = run(configuration, failure_rate, recover_after, args)
+            print(
+                f"{scenario:>12} {configuration:>16} "
+                f"{result['requests_per_message']:13.2f} "
+                f"{result['published']:10.1%} {result['diverted']:9d} "
+                f"{result['seconds']:9.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
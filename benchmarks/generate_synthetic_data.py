@@ -0,0 +1,79 @@
+"""
+Generate seeded synthetic source data for load testing and benchmarks: VXU and ELR
+HL7v2 batch files, eCR CCD documents, and multi-patient FHIR bundles of any size. Data
+is written straight to disk one message or resource at a time, so generating very
+large files needs little memory. The same seed always generates the same file.
+
+Usage:
+    python benchmarks/generate_synthetic_data.py vxu 1000000 vxu.hl7 --batch-size 10000
+    python benchmarks/generate_synthetic_data.py elr 1000 elr.hl7 --seed 42
+    python benchmarks/generate_synthetic_data.py ecr 500 document.xml
+    python benchmarks/generate_synthetic_data.py fhir 10000 bundle.json
+"""
+
+import argparse
+import time
+
+from phdi_cloud_function_utils_testing.synthetic import (
+    write_ccd_document,
+    write_fhir_bundle,
+    write_hl7_batch,
+)
+
+HL7_MESSAGE_TYPES = {"elr": "ORU_R01", "vxu": "VXU_V04"}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("type", choices=["elr", "vxu", "ecr", "fhir"])
+    parser.add_argument(
+        "count",
+        type=int,
+        help="The number of messages for elr and vxu, of lab results for ecr, and of "
+        "patients for fhir.",
+    )
+    parser.add_argument("path", help="The file to write.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="The maximum number of HL7v2 messages in each BHS/BTS batch.",
+    )
+    parser.add_argument(
+        "--observations-per-patient",
+        type=int,
+        default=5,
+        help="The number of observations for each patient in a FHIR bundle.",
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with open(args.path, "w", encoding="utf-8", newline="") as file:
+        if args.type in HL7_MESSAGE_TYPES:
+            write_hl7_batch(
+                file,
+                HL7_MESSAGE_TYPES[args.type],
+                args.count,
+                seed=args.seed,
+                batch_size=args.batch_size,
+            )
+        elif args.type == "ecr":
+            write_ccd_document(file, seed=args.seed, result_count=args.count)
+        else:
+            write_fhir_bundle(
+                file,
+                args.count,
+                observations_per_patient=args.observations_per_patient,
+                seed=args.seed,
+            )
+        size = file.tell()
+    print(
+        f"Wrote {size / 2**20:.1f} MiB to {args.path} in "
+        f"{time.perf_counter() - start:.1f} seconds."
+    )
+
+
+if __name__ == "__main__":
+    main()
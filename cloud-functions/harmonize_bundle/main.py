@@ -0,0 +1,465 @@
+import dataclasses
+import functions_framework
+import json
+import logging
+import os
+import time
+import flask
+from typing import Callable, Dict, TYPE_CHECKING
+from phdi_cloud_function_utils import (
+    check_for_environment_variables,
+    log_error_and_generate_response,
+    get_request_body,
+    require_content_type,
+    require_json_object,
+    validate_request,
+    HarmonizationContext,
+    HarmonizationStep,
+    HarmonizationStepError,
+    run_harmonization_chain,
+    select_harmonization_steps,
+    Metrics,
+    make_response,
+    DEFAULT_CLAIM_CHECK_THRESHOLD,
+    DEFAULT_GEOCODE_CACHE_SIZE,
+    DEFAULT_GEOCODE_CACHE_TTL,
+    GCSGeocodeCacheStore,
+    GeocodeCache,
+)
+from phdi_cloud_function_utils.geocoding_cache import BatchGeocoder
+
+if TYPE_CHECKING:
+    from google.cloud import pubsub_v1, storage
+    from phdi.cloud.gcp import GcpCredentialManager
+    from phdi.fhir.geospatial import BaseFhirGeocodeClient
+
+GEOCODE_METHODS = ("smarty", "census")
+GEOCODE_CACHES = ("none", "memory", "gcs")
+
+# Steps by name, in the order they run in by default. Register new steps with
+# `register_harmonization_step`.
+HARMONIZATION_STEPS: Dict[str, HarmonizationStep] = {}
+
+# Clients are created on first use and reused by later invocations handled by the
+# same function instance.
+_clients = {}
+
+
+def register_harmonization_step(
+    name: str,
+) -> Callable[[HarmonizationStep], HarmonizationStep]:
+    """
+    Make a function available as a step of the harmonization chain.
+
+    :param name: The name of the step in HARMONIZATION_STEPS and in requests.
+    :return: A decorator registering the function it decorates.
+    """
+
+    def register(step: HarmonizationStep) -> HarmonizationStep:
+        HARMONIZATION_STEPS[name] = step
+        return step
+
+    return register
+
+
+@register_harmonization_step("standardize_names")
+def standardize_names(bundle: dict, context: HarmonizationContext) -> dict:
+    from phdi.fhir.harmonization import standardize_names
+
+    return standardize_names(bundle)
+
+
+@register_harmonization_step("standardize_phones")
+def standardize_phones(bundle: dict, context: HarmonizationContext) -> dict:
+    from phdi.fhir.harmonization import standardize_phones
+
+    return standardize_phones(bundle)
+
+
+@register_harmonization_step("geocode_bundle")
+def geocode_bundle(bundle: dict, context: HarmonizationContext) -> dict:
+    geocode_method = context.options.get(
+        "geocode_method", os.environ.get("GEOCODE_METHOD", "smarty")
+    )
+    if os.environ.get("GEOCODE_CACHE", "none") == "none":
+        return get_geocode_client(geocode_method).geocode_bundle(bundle)
+
+    geocode_cache = get_geocode_cache(geocode_method)
+    metrics = Metrics()
+    # Like phdi's census client, the census geocoder keeps the original street lines.
+    bundle = geocode_cache.geocode_bundle(
+        bundle, update_line=geocode_method != "census", metrics=metrics
+    )
+    counters = {
+        name: metrics.counters.get(f"geocode_cache_{name}", 0)
+        for name in geocode_cache.counters
+    }
+    hits = counters["memory_hits"] + counters["store_hits"]
+    context.results["geocode_cache"] = {
+        **counters,
+        "hit_ratio": hits / (hits + counters["misses"]) if hits else 0.0,
+        "instance_hit_ratio": geocode_cache.hit_ratio,
+    }
+    return bundle
+
+
+@register_harmonization_step("add_patient_identifier_in_bundle")
+def add_patient_identifier_in_bundle(
+    bundle: dict, context: HarmonizationContext
+) -> dict:
+    from phdi.fhir.linkage import add_patient_identifier_in_bundle
+
+    salt_str = os.environ.get("PATIENT_HASH_SALT")
+    if not salt_str:
+        raise ValueError("PATIENT_HASH_SALT must be set to add patient identifiers.")
+    return add_patient_identifier_in_bundle(bundle, salt_str=salt_str)
+
+
+@register_harmonization_step("upload_bundle_to_fhir_server")
+def upload_bundle_to_fhir_server(bundle: dict, context: HarmonizationContext) -> dict:
+    from phdi.fhir.transport import upload_bundle_to_fhir_server
+
+    fhir_url = context.options.get("fhir_url", os.environ.get("FHIR_URL"))
+    if not fhir_url:
+        raise ValueError("A fhir_url must be given to upload the bundle.")
+    responses = upload_bundle_to_fhir_server(
+        bundle=bundle, cred_manager=get_credential_manager(), fhir_url=fhir_url
+    )
+    results = []
+    for response in responses:
+        try:
+            body = response.json()
+        except ValueError:
+            body = response.text
+        results.append({"status_code": response.status_code, "body": body})
+    context.results["fhir_server_responses"] = results
+
+    failed = [
+        result["status_code"] for result in results if result["status_code"] != 200
+    ]
+    if failed:
+        raise RuntimeError(
+            f"The FHIR server responded with status {', '.join(map(str, failed))}."
+        )
+    return bundle
+
+
+@register_harmonization_step("publish_bundle_for_upload")
+def publish_bundle_for_upload(bundle: dict, context: HarmonizationContext) -> dict:
+    data = json.dumps(bundle).encode("utf-8")
+    if len(data) > DEFAULT_CLAIM_CHECK_THRESHOLD:
+        # Bundles too large for Pub/Sub are uploaded on their own.
+        return upload_bundle_to_fhir_server(bundle, context)
+
+    upload_topic = os.environ.get("UPLOAD_TOPIC")
+    if not upload_topic:
+        raise ValueError("UPLOAD_TOPIC must be set to publish bundles for upload.")
+    publisher = get_publisher_client()
+    topic_path = publisher.topic_path(os.environ.get("PROJECT_ID"), upload_topic)
+    message_id = publisher.publish(
+        topic_path, data, filename=context.options.get("filename", "")
+    ).result()
+    context.results["upload_message_id"] = message_id
+    return bundle
+
+
+# The steps run when neither the request nor HARMONIZATION_STEPS name them.
+DEFAULT_HARMONIZATION_STEPS = [
+    name for name in HARMONIZATION_STEPS if name != "publish_bundle_for_upload"
+]
+
+
+@functions_framework.http
+def harmonize_bundle(request: flask.Request) -> flask.Response:
+    """
+    Run the harmonization chain of the ingestion pipeline on a FHIR bundle in a single
+    process: standardize names and phone numbers, geocode addresses, add a patient
+    identifier for linkage, and upload the bundle to the FHIR server. The bundle is
+    parsed once and passed from step to step, instead of being serialized and sent to
+    the ingestion service for every step.
+
+    The request body is a JSON object holding:
+    - bundle: The FHIR bundle.
+    - fhir_url: The URL of the FHIR server to upload to, by default FHIR_URL.
+    - steps: Optionally, the names of the steps to run, in order, which default to the
+        comma separated HARMONIZATION_STEPS environment variable, or else to
+        DEFAULT_HARMONIZATION_STEPS.
+    - geocode_method: 'smarty' or 'census', by default GEOCODE_METHOD or 'smarty'.
+        SMARTY_AUTH_ID and SMARTY_AUTH_TOKEN must be set to geocode with smarty.
+    - return_bundle: Whether to include the harmonized bundle in the response, true by
+        default.
+    - filename: The name of the file the bundle came from, which bundles published
+        for upload are tagged with.
+
+    PATIENT_HASH_SALT must be set to add patient identifiers.
+
+    Geocoding results can be cached by setting GEOCODE_CACHE to 'memory', to keep up
+    to GEOCODE_CACHE_SIZE results in the memory of the function instance, or to 'gcs',
+    to also keep them in GEOCODE_CACHE_BUCKET for GEOCODE_CACHE_TTL_DAYS days, shared
+    by every instance. GEOCODE_CACHE_BUCKET must not trigger a function, and should
+    delete objects older than GEOCODE_CACHE_TTL_DAYS. Addresses missing from the
+    cache are geocoded in batches, and the response then holds the hits and misses
+    of the cache.
+
+    Steps are run in the order given, and every registered step is run by default
+    except publish_bundle_for_upload, which stands in for
+    upload_bundle_to_fhir_server when bundles are uploaded in merged batches by
+    `upload_fhir_batches`. It publishes the bundle to UPLOAD_TOPIC in PROJECT_ID,
+    unless the bundle is too large for Pub/Sub, in which case it is uploaded on its
+    own.
+
+    :param request: A flask.Request object.
+    :return: A flask.Response object. Once the chain has run the response is a JSON
+        object holding a message, the bundle unless return_bundle is false, the
+        responses of the FHIR server if the bundle was uploaded, and metrics timing
+        each step. If a step fails the status code is 400 and the JSON object also
+        names the failed step and holds the bundle as the earlier steps left it.
+    """
+    start_time = time.perf_counter()
+    validation_response = validate_request(
+        request, [require_content_type("application/json"), require_json_object]
+    )
+    if validation_response.status_code != 200:
+        return validation_response
+
+    options = get_request_body(request).json()
+    bundle = options.pop("bundle", None)
+    if not isinstance(bundle, dict) or bundle.get("resourceType") != "Bundle":
+        response = (
+            "Invalid request body - 'bundle' must be a FHIR bundle to be harmonized."
+        )
+        return log_error_and_generate_response(message=response, status_code=400)
+
+    if "steps" in options:
+        step_names, status_code = options.pop("steps"), 400
+    else:
+        step_names = os.environ.get("HARMONIZATION_STEPS") or ",".join(
+            DEFAULT_HARMONIZATION_STEPS
+        )
+        step_names, status_code = step_names.split(","), 500
+    try:
+        steps = select_harmonization_steps(step_names, HARMONIZATION_STEPS)
+    except ValueError as error:
+        return log_error_and_generate_response(
+            message=str(error), status_code=status_code
+        )
+
+    geocode_method = options.get(
+        "geocode_method", os.environ.get("GEOCODE_METHOD", "smarty")
+    )
+    if geocode_method not in GEOCODE_METHODS:
+        response = (
+            f"Unknown geocode_method: {geocode_method}. The geocode method must be one "
+            f"of {', '.join(GEOCODE_METHODS)}."
+        )
+        return log_error_and_generate_response(message=response, status_code=400)
+
+    geocode_cache = os.environ.get("GEOCODE_CACHE", "none")
+    if geocode_cache not in GEOCODE_CACHES:
+        response = (
+            f"Unknown GEOCODE_CACHE: {geocode_cache}. The geocode cache must be one "
+            f"of {', '.join(GEOCODE_CACHES)}."
+        )
+        return log_error_and_generate_response(message=response, status_code=500)
+    if geocode_cache == "gcs":
+        environment_check_response = check_for_environment_variables(
+            ["GEOCODE_CACHE_BUCKET"]
+        )
+        if environment_check_response.status_code != 200:
+            return environment_check_response
+
+    return_bundle = options.pop("return_bundle", True)
+    context = HarmonizationContext(options=options)
+    metrics = Metrics()
+    try:
+        bundle = run_harmonization_chain(
+            bundle=bundle, steps=steps, context=context, metrics=metrics
+        )
+    except HarmonizationStepError as error:
+        logging.error(str(error))
+        return make_response(
+            status_code=400,
+            json_payload={
+                "message": str(error),
+                "failed_step": error.step,
+                "bundle": error.bundle,
+                **context.results,
+                "metrics": metrics.summary(),
+            },
+        )
+
+    message = (
+        f"Harmonized a bundle of {len(bundle.get('entry', []))} entries with "
+        f"{', '.join(name for name, _ in steps)}."
+    )
+    logging.info(message)
+    json_payload = {"message": message}
+    if return_bundle:
+        json_payload["bundle"] = bundle
+    json_payload.update(context.results)
+    json_payload["duration_seconds"] = time.perf_counter() - start_time
+    json_payload["metrics"] = metrics.summary()
+    return make_response(status_code=200, json_payload=json_payload)
+
+
+def get_geocode_client(geocode_method: str) -> "BaseFhirGeocodeClient":
+    """
+    Get the geocoding client shared by all invocations handled by this function
+    instance, creating it on first use.
+
+    :param geocode_method: 'smarty' or 'census'.
+    :return: A SmartyFhirGeocodeClient authenticated with SMARTY_AUTH_ID and
+        SMARTY_AUTH_TOKEN, or a CensusFhirGeocodeClient.
+    """
+    cache_key = f"geocode_{geocode_method}"
+    if cache_key not in _clients:
+        from phdi.fhir.geospatial import (
+            CensusFhirGeocodeClient,
+            SmartyFhirGeocodeClient,
+        )
+
+        if geocode_method == "census":
+            _clients[cache_key] = CensusFhirGeocodeClient()
+        else:
+            _clients[cache_key] = SmartyFhirGeocodeClient(
+                smarty_auth_id=os.environ.get("SMARTY_AUTH_ID"),
+                smarty_auth_token=os.environ.get("SMARTY_AUTH_TOKEN"),
+            )
+    return _clients[cache_key]
+
+
+def make_batch_geocoder(geocode_method: str) -> BatchGeocoder:
+    """
+    Make a geocoder of batches of FHIR addresses for a GeocodeCache.
+
+    :param geocode_method: 'smarty' or 'census'.
+    :return: For smarty, a geocoder sending up to 100 addresses per request to the
+        Smarty US Street API, authenticated with SMARTY_AUTH_ID and SMARTY_AUTH_TOKEN.
+        For census, a geocoder sending a request per address, as the census client
+        has no batch lookup.
+    """
+
+    def to_dict(result) -> dict:
+        return dataclasses.asdict(result) if result else None
+
+    if geocode_method == "census":
+        from phdi.geospatial.census import CensusGeocodeClient
+
+        census_client = CensusGeocodeClient()
+
+        def geocode_census_batch(addresses: list) -> list:
+            return [
+                to_dict(
+                    census_client.geocode_from_dict(
+                        {**address, "street": " ".join(address.get("line", []))}
+                    )
+                )
+                for address in addresses
+            ]
+
+        return geocode_census_batch
+
+    from phdi.fhir.utils import get_one_line_address
+    from phdi.geospatial.smarty import SmartyGeocodeClient
+    from smartystreets_python_sdk import Batch
+    from smartystreets_python_sdk.us_street.lookup import Lookup
+
+    smarty_client = SmartyGeocodeClient(
+        smarty_auth_id=os.environ.get("SMARTY_AUTH_ID"),
+        smarty_auth_token=os.environ.get("SMARTY_AUTH_TOKEN"),
+    )
+
+    def geocode_smarty_batch(addresses: list) -> list:
+        results = []
+        for start in range(0, len(addresses), Batch.MAX_BATCH_SIZE):
+            end = start + Batch.MAX_BATCH_SIZE
+            batch = Batch()
+            for address in addresses[start:end]:
+                batch.add(Lookup(street=get_one_line_address(address)))
+            smarty_client.client.send_batch(batch)
+            results.extend(
+                to_dict(SmartyGeocodeClient._parse_smarty_result(lookup))
+                for lookup in batch
+            )
+        return results
+
+    return geocode_smarty_batch
+
+
+def get_geocode_cache(geocode_method: str) -> GeocodeCache:
+    """
+    Get the geocoding cache shared by all invocations handled by this function
+    instance, creating it on first use.
+
+    :param geocode_method: 'smarty' or 'census'.
+    :return: A GeocodeCache in front of the batch geocoder of the method, holding up
+        to GEOCODE_CACHE_SIZE results in memory, backed by GEOCODE_CACHE_BUCKET when
+        GEOCODE_CACHE is 'gcs'.
+    """
+    cache_key = f"geocode_cache_{geocode_method}"
+    if cache_key not in _clients:
+        store = None
+        if os.environ.get("GEOCODE_CACHE") == "gcs":
+            ttl_days = os.environ.get("GEOCODE_CACHE_TTL_DAYS")
+            store = GCSGeocodeCacheStore(
+                get_storage_client(),
+                os.environ.get("GEOCODE_CACHE_BUCKET"),
+                ttl=(
+                    float(ttl_days) * 24 * 60 * 60
+                    if ttl_days
+                    else DEFAULT_GEOCODE_CACHE_TTL
+                ),
+            )
+        _clients[cache_key] = GeocodeCache(
+            geocoder=make_batch_geocoder(geocode_method),
+            max_size=int(
+                os.environ.get("GEOCODE_CACHE_SIZE", DEFAULT_GEOCODE_CACHE_SIZE)
+            ),
+            store=store,
+        )
+    return _clients[cache_key]
+
+
+def get_credential_manager() -> "GcpCredentialManager":
+    """
+    Get the GCP credential manager shared by all invocations handled by this function
+    instance, creating it on first use, so that access tokens are reused until they
+    expire.
+
+    :return: A GcpCredentialManager scoped to the Cloud Platform.
+    """
+    if "credential_manager" not in _clients:
+        from phdi.cloud.gcp import GcpCredentialManager
+
+        _clients["credential_manager"] = GcpCredentialManager(
+            scope=["https://www.googleapis.com/auth/cloud-platform"]
+        )
+    return _clients["credential_manager"]
+
+
+def get_publisher_client() -> "pubsub_v1.PublisherClient":
+    """
+    Get the Pub/Sub publisher client shared by all invocations handled by this
+    function instance, creating it on first use.
+
+    :return: A pubsub_v1.PublisherClient.
+    """
+    if "publisher" not in _clients:
+        from google.cloud import pubsub_v1
+
+        _clients["publisher"] = pubsub_v1.PublisherClient()
+    return _clients["publisher"]
+
+
+def get_storage_client() -> "storage.Client":
+    """
+    Get the GCS client shared by all invocations handled by this function instance,
+    creating it on first use.
+
+    :return: A storage.Client.
+    """
+    if "storage" not in _clients:
+        from google.cloud import storage
+
+        _clients["storage"] = storage.Client()
+    return _clients["storage"]
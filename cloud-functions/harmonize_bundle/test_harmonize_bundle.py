@@ -0,0 +1,296 @@
+from main import harmonize_bundle
+from phdi_cloud_function_utils import get_sample_single_patient_bundle
+from phdi_cloud_function_utils_testing.fakes import (
+    FakeGeocoder,
+    FakePublisherClient,
+    FakeStorageClient,
+)
+from unittest import mock
+import flask
+import json
+import main
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def clear_client_cache():
+    main._clients.clear()
+    yield
+    main._clients.clear()
+
+
+TEST_ENVIRONMENT = {
+    "PATIENT_HASH_SALT": "some-salt",
+    "FHIR_URL": "https://some-fhir-server/fhir",
+}
+
+UPLOAD_ENVIRONMENT = {
+    **TEST_ENVIRONMENT,
+    "HARMONIZATION_STEPS": (
+        "standardize_names,standardize_phones,geocode_bundle,"
+        "upload_bundle_to_fhir_server"
+    ),
+}
+
+
+def make_request(body: dict) -> flask.Request:
+    return flask.Request.from_values(
+        data=json.dumps(body), content_type="application/json"
+    )
+
+
+def make_fhir_server_response(status_code: int) -> mock.Mock:
+    response = mock.Mock(status_code=status_code)
+    response.json.return_value = {"resourceType": "Bundle", "type": "batch-response"}
+    return response
+
+
+def fake_geocode_client() -> mock.Mock:
+    geocode_client = mock.Mock()
+    geocode_client.geocode_bundle.side_effect = lambda bundle: bundle
+    return geocode_client
+
+
+@mock.patch("main.get_credential_manager")
+@mock.patch("main.get_geocode_client")
+@mock.patch("phdi.fhir.transport.upload_bundle_to_fhir_server")
+@mock.patch.dict("main.os.environ", UPLOAD_ENVIRONMENT)
+def test_harmonize_bundle(
+    patched_upload, patched_get_geocode_client, patched_get_credential_manager
+):
+    patched_get_geocode_client.return_value = fake_geocode_client()
+    patched_upload.return_value = [make_fhir_server_response(200)]
+
+    actual_response = harmonize_bundle(
+        make_request({"bundle": get_sample_single_patient_bundle()})
+    )
+    assert actual_response.status_code == 200
+    payload = json.loads(actual_response.response[0])
+    patient = payload["bundle"]["entry"][0]["resource"]
+    assert patient["name"][0]["family"] == "SMITH"
+    assert patient["telecom"][0]["value"] == "+18015557777"
+    assert payload["fhir_server_responses"][0]["status_code"] == 200
+    assert list(payload["metrics"]["stage_seconds"]) == (
+        UPLOAD_ENVIRONMENT["HARMONIZATION_STEPS"].split(",")
+    )
+
+    # Every step ran on the same parsed bundle, which was uploaded once, to FHIR_URL.
+    patched_get_geocode_client.assert_called_once_with("smarty")
+    patched_upload.assert_called_once()
+    assert patched_upload.call_args.kwargs["fhir_url"] == TEST_ENVIRONMENT["FHIR_URL"]
+    assert patched_upload.call_args.kwargs["bundle"] == payload["bundle"]
+
+
+@mock.patch.dict("main.os.environ", TEST_ENVIRONMENT)
+def test_harmonize_bundle_selected_steps():
+    actual_response = harmonize_bundle(
+        make_request(
+            {
+                "bundle": get_sample_single_patient_bundle(),
+                "steps": ["standardize_names"],
+            }
+        )
+    )
+    assert actual_response.status_code == 200
+    payload = json.loads(actual_response.response[0])
+    patient = payload["bundle"]["entry"][0]["resource"]
+    assert patient["name"][0]["family"] == "SMITH"
+    assert patient["telecom"][0]["value"] == "8015557777"
+    assert "fhir_server_responses" not in payload
+
+    actual_response = harmonize_bundle(
+        make_request(
+            {"bundle": get_sample_single_patient_bundle(), "steps": ["translate"]}
+        )
+    )
+    assert actual_response.status_code == 400
+    assert (
+        actual_response.response[0]
+        .decode()
+        .startswith("Unknown harmonization step: translate.")
+    )
+
+
+@mock.patch.dict(
+    "main.os.environ", {**TEST_ENVIRONMENT, "HARMONIZATION_STEPS": "standardize"}
+)
+def test_unknown_harmonization_steps():
+    actual_response = harmonize_bundle(
+        make_request({"bundle": get_sample_single_patient_bundle()})
+    )
+    assert actual_response.status_code == 500
+
+
+def test_bad_harmonization_request():
+    request = mock.Mock(headers={"Content-Type": "text/plain"})
+    assert harmonize_bundle(request).status_code == 400
+    request = flask.Request.from_values(data="{", content_type="application/json")
+    actual_response = harmonize_bundle(request)
+    assert actual_response.status_code == 400
+    assert actual_response.response[0] == b"Invalid request body - Invalid JSON"
+
+    actual_response = harmonize_bundle(make_request({"fhir_url": "some-url"}))
+    assert actual_response.status_code == 400
+    assert actual_response.response[0] == (
+        b"Invalid request body - 'bundle' must be a FHIR bundle to be harmonized."
+    )
+
+    actual_response = harmonize_bundle(
+        make_request(
+            {
+                "bundle": get_sample_single_patient_bundle(),
+                "geocode_method": "somewhere",
+            }
+        )
+    )
+    assert actual_response.status_code == 400
+    assert actual_response.response[0] == (
+        b"Unknown geocode_method: somewhere. The geocode method must be one of "
+        b"smarty, census."
+    )
+
+
+@mock.patch("main.get_credential_manager")
+@mock.patch("main.get_geocode_client")
+@mock.patch("phdi.fhir.transport.upload_bundle_to_fhir_server")
+@mock.patch.dict("main.os.environ", UPLOAD_ENVIRONMENT)
+def test_failed_upload(
+    patched_upload, patched_get_geocode_client, patched_get_credential_manager
+):
+    patched_get_geocode_client.return_value = fake_geocode_client()
+    patched_upload.return_value = [make_fhir_server_response(400)]
+
+    actual_response = harmonize_bundle(
+        make_request(
+            {"bundle": get_sample_single_patient_bundle(), "return_bundle": False}
+        )
+    )
+    assert actual_response.status_code == 400
+    payload = json.loads(actual_response.response[0])
+    assert payload["failed_step"] == "upload_bundle_to_fhir_server"
+    assert payload["message"] == (
+        "The upload_bundle_to_fhir_server step failed: The FHIR server responded "
+        "with status 400."
+    )
+    # The bundle is kept as the earlier steps left it, to be written to storage.
+    assert payload["bundle"]["entry"][0]["resource"]["name"][0]["family"] == "SMITH"
+    assert payload["fhir_server_responses"][0]["status_code"] == 400
+
+
+@mock.patch.dict("main.os.environ", {"FHIR_URL": "https://some-fhir-server/fhir"})
+def test_missing_salt():
+    actual_response = harmonize_bundle(
+        make_request(
+            {
+                "bundle": get_sample_single_patient_bundle(),
+                "steps": ["add_patient_identifier_in_bundle"],
+            }
+        )
+    )
+    assert actual_response.status_code == 400
+    payload = json.loads(actual_response.response[0])
+    assert payload["failed_step"] == "add_patient_identifier_in_bundle"
+
+
+@mock.patch.dict(
+    "main.os.environ",
+    {**TEST_ENVIRONMENT, "PROJECT_ID": "some-project", "UPLOAD_TOPIC": "some-topic"},
+)
+def test_publish_bundle_for_upload():
+    publisher = FakePublisherClient()
+    main._clients["publisher"] = publisher
+
+    actual_response = harmonize_bundle(
+        make_request(
+            {
+                "bundle": get_sample_single_patient_bundle(),
+                "steps": ["standardize_names", "publish_bundle_for_upload"],
+                "filename": "source-data/vxu/some-file.hl7",
+                "return_bundle": False,
+            }
+        )
+    )
+    assert actual_response.status_code == 200
+    assert json.loads(actual_response.response[0])["upload_message_id"] == "1"
+    ((topic, data, attributes),) = publisher.published
+    assert topic == "projects/some-project/topics/some-topic"
+    assert attributes == {"filename": "source-data/vxu/some-file.hl7"}
+    assert json.loads(data)["entry"][0]["resource"]["name"][0]["family"] == "SMITH"
+
+    # Bundles are only published for upload when asked to.
+    assert "publish_bundle_for_upload" not in main.DEFAULT_HARMONIZATION_STEPS
+
+
+@mock.patch("main.make_batch_geocoder")
+@mock.patch.dict(
+    "main.os.environ",
+    {**TEST_ENVIRONMENT, "GEOCODE_CACHE": "gcs", "GEOCODE_CACHE_BUCKET": "some-bucket"},
+)
+def test_geocode_cache(patched_make_batch_geocoder):
+    geocoder = FakeGeocoder()
+    patched_make_batch_geocoder.return_value = geocoder
+    main._clients["storage"] = FakeStorageClient()
+    request_body = {
+        "bundle": get_sample_single_patient_bundle(),
+        "steps": ["geocode_bundle"],
+    }
+
+    actual_response = harmonize_bundle(make_request(request_body))
+    assert actual_response.status_code == 200
+    payload = json.loads(actual_response.response[0])
+    address = payload["bundle"]["entry"][0]["resource"]["address"][0]
+    assert address["extension"][-1]["url"] == (
+        "http://hl7.org/fhir/StructureDefinition/geolocation"
+    )
+    assert payload["geocode_cache"]["misses"] == 1
+    assert payload["geocode_cache"]["hit_ratio"] == 0
+
+    # The address is served from memory, then, in a new instance, from the bucket.
+    payload = json.loads(harmonize_bundle(make_request(request_body)).response[0])
+    assert payload["geocode_cache"]["memory_hits"] == 1
+    assert payload["geocode_cache"]["hit_ratio"] == 1
+    del main._clients["geocode_cache_smarty"]
+    payload = json.loads(harmonize_bundle(make_request(request_body)).response[0])
+    assert payload["geocode_cache"]["store_hits"] == 1
+    assert geocoder.address_count == 1
+    patched_make_batch_geocoder.assert_called_with("smarty")
+
+
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "GEOCODE_CACHE": "redis"})
+def test_unknown_geocode_cache():
+    actual_response = harmonize_bundle(
+        make_request({"bundle": get_sample_single_patient_bundle()})
+    )
+    assert actual_response.status_code == 500
+    assert actual_response.response[0] == (
+        b"Unknown GEOCODE_CACHE: redis. The geocode cache must be one of none, "
+        b"memory, gcs."
+    )
+
+
+@mock.patch("smartystreets_python_sdk.us_street.Client.send_batch")
+@mock.patch.dict(
+    "main.os.environ",
+    {"SMARTY_AUTH_ID": "some-id", "SMARTY_AUTH_TOKEN": "some-token"},
+)
+def test_make_smarty_batch_geocoder(patched_send_batch):
+    def send_batch(batch):
+        for lookup in batch:
+            lookup.result = []
+
+    patched_send_batch.side_effect = send_batch
+    geocode_batch = main.make_batch_geocoder("smarty")
+    addresses = [
+        {"line": [f"{idx} Main St"], "city": "Boston", "state": "MA"}
+        for idx in range(150)
+    ]
+
+    # Addresses are sent in batches of up to 100, the most Smarty allows.
+    assert geocode_batch(addresses) == [None] * 150
+    assert [len(call.args[0]) for call in patched_send_batch.call_args_list] == [
+        100,
+        50,
+    ]
+    assert patched_send_batch.call_args_list[0].args[0][0].street == (
+        "0 Main St Boston, MA"
+    )
@@ -2,7 +2,156 @@ import logging
 import json
 import os
 from pathlib import Path
+from typing import Iterable
 from flask import Request, Response
+from phdi_cloud_function_utils.hl7_batch import (  # noqa: F401
+    get_hl7_message,
+    iter_hl7_message_offsets,
+    stream_hl7_batch_message_offsets,
+    stream_hl7_batch_messages,
+    stream_hl7_message_offsets,
+)
+from phdi_cloud_function_utils.instrumentation import (  # noqa: F401
+    Histogram,
+    Metrics,
+    OpenTelemetryExporter,
+)
+from phdi_cloud_function_utils.publishing import ConcurrentPublisher  # noqa: F401
+from phdi_cloud_function_utils.rate_limiting import RateLimiter  # noqa: F401
+from phdi_cloud_function_utils.retries import (  # noqa: F401
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryBudget,
+    RetryPolicy,
+    is_retryable_error,
+)
+from phdi_cloud_function_utils.compression import (  # noqa: F401
+    CONTENT_ENCODINGS,
+    compress_payload,
+    decompress_payload,
+)
+from phdi_cloud_function_utils.archives import (  # noqa: F401
+    ARCHIVE_COMPRESSIONS,
+    ARCHIVE_EXTENSIONS,
+    get_archive_compression,
+    iter_archive_members,
+)
+from phdi_cloud_function_utils.envelopes import (  # noqa: F401
+    BINARY_ENVELOPE,
+    ENVELOPES,
+    JSON_ENVELOPE,
+    decode_envelope,
+    encode_envelope,
+)
+from phdi_cloud_function_utils.claim_check import (  # noqa: F401
+    DEFAULT_CLAIM_CHECK_THRESHOLD,
+    ClaimCheckResolver,
+    is_claim_check,
+    make_claim_check_attributes,
+)
+from phdi_cloud_function_utils.checkpoints import (  # noqa: F401
+    Checkpoint,
+    CheckpointStore,
+    GCSCheckpointStore,
+    InMemoryCheckpointStore,
+    SQLiteCheckpointStore,
+    make_checkpoint_key,
+)
+from phdi_cloud_function_utils.dedup import (  # noqa: F401
+    DedupIndex,
+    DedupStore,
+    GCSDedupStore,
+    SQLiteDedupStore,
+    hash_message,
+)
+from phdi_cloud_function_utils.failures import (  # noqa: F401
+    FAILURE_MANIFEST_CONTENT_TYPE,
+    FailureManifestWriter,
+    iter_failure_records,
+    make_failure_record,
+)
+from phdi_cloud_function_utils.fhir_batching import (  # noqa: F401
+    DEFAULT_FHIR_BATCH_MAX_BYTES,
+    DEFAULT_FHIR_BATCH_MAX_ENTRIES,
+    DEFAULT_FHIR_BATCH_WINDOW,
+    FHIR_BATCH_BUNDLE_TYPES,
+    EntrySource,
+    FhirBundleBatch,
+    get_entry_status_code,
+    get_patient_key,
+    is_successful_upload,
+)
+from phdi_cloud_function_utils.fhir_retries import (  # noqa: F401
+    RETRYABLE_FHIR_STATUS_CODES,
+    FhirUploadError,
+    PartialRetryResult,
+    get_retryable_entries,
+    is_retryable_fhir_error,
+    make_retry_bundle,
+    upload_with_partial_retry,
+)
+from phdi_cloud_function_utils.geocoding_cache import (  # noqa: F401
+    DEFAULT_GEOCODE_BATCH_SIZE,
+    DEFAULT_GEOCODE_CACHE_SIZE,
+    DEFAULT_GEOCODE_CACHE_TTL,
+    GCSGeocodeCacheStore,
+    GeocodeCache,
+    GeocodeCacheStore,
+    SQLiteGeocodeCacheStore,
+    apply_geocode_result,
+    normalize_address_key,
+)
+from phdi_cloud_function_utils.harmonization import (  # noqa: F401
+    HarmonizationContext,
+    HarmonizationStep,
+    HarmonizationStepError,
+    run_harmonization_chain,
+    select_harmonization_steps,
+)
+from phdi_cloud_function_utils.message_logging import (  # noqa: F401
+    DEFAULT_MESSAGE_LOG_INTERVAL,
+    DEFAULT_MESSAGE_LOG_SAMPLE_RATE,
+    MESSAGE_LOG_MODES,
+    MessageLogger,
+)
+from phdi_cloud_function_utils.ndjson import (  # noqa: F401
+    DEFAULT_FHIR_BUNDLE_SIZE,
+    DEFAULT_MAX_OPEN_BUNDLES,
+    get_patient_reference,
+    make_fhir_bundle,
+    stream_fhir_bundles,
+    stream_ndjson_lines,
+)
+from phdi_cloud_function_utils.sharding import (  # noqa: F401
+    DEFAULT_SHARD_BYTES,
+    ShardRange,
+    ShardTask,
+    ShardTracker,
+    decode_shard_task,
+    encode_shard_task,
+    plan_shards,
+)
+from phdi_cloud_function_utils.sniffing import (  # noqa: F401
+    DEFAULT_SNIFF_BYTES,
+    SNIFFED_FORMATS,
+    SniffResult,
+    get_hl7_root_template,
+    sniff_blob,
+    sniff_content,
+)
+from phdi_cloud_function_utils.validation import (  # noqa: F401
+    DEFAULT_MAX_REQUEST_BYTES,
+    BodySummary,
+    RequestBody,
+    RequestValidationError,
+    ValidationStep,
+    get_request_body,
+    require_content_type,
+    require_json_object,
+    require_max_entries,
+    require_resource_type,
+    summarize_json_resource,
+)
 
 
 def make_response(
@@ -90,14 +239,38 @@ def validate_fhir_bundle_or_resource(request: Request) -> Response:
         otherwise will return a generic 200 flask.Response
     """
 
-    request_json = request.get_json()
-    # Check that the request body contains a FHIR bundle or resource.
-    if request_json.get("resourceType") is None:
-        error_message = (
-            "FHIR Resource Type not specified. "
-            + "The request body must contain a valid FHIR bundle or resource."
-        )
-        return log_error_and_generate_response(status_code=400, message=error_message)
+    # The resourceType is read with an incremental parser, without parsing the whole
+    # body.
+    return validate_request(request, [require_resource_type()])
+
+
+def validate_request(
+    request: Request,
+    steps: Iterable[ValidationStep],
+    max_bytes: int = DEFAULT_MAX_REQUEST_BYTES,
+) -> Response:
+    """
+    Validate a request with a pipeline of validation steps, run in order until one
+    fails. The steps share the RequestBody cached on the request, so the body is read
+    and parsed at most once, and handlers can get the parsed body with
+    `get_request_body(request).json()` without parsing it again.
+
+    :param request: A flask.Request.
+    :param steps: The steps to run, e.g. `require_content_type("application/json")`,
+        `require_resource_type("Bundle")`, or `require_json_object`.
+    :param max_bytes: The maximum size of the body. Larger bodies are rejected with a
+        413 without being parsed.
+    :return: A flask.Response object containing the error of the first step that
+        failed, or a generic 200 flask.Response.
+    """
+    request_body = get_request_body(request, max_bytes=max_bytes)
+    for step in steps:
+        try:
+            step(request_body)
+        except RequestValidationError as error:
+            return log_error_and_generate_response(
+                status_code=error.status_code, message=error.message
+            )
 
     return make_response(status_code=200, message="Validation Succeeded!")
 
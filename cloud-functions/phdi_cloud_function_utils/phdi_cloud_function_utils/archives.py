@@ -0,0 +1,66 @@
+import gzip
+import zipfile
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from phdi_cloud_function_utils.compression import GZIP, IDENTITY, ZSTD, _get_zstandard
+from phdi_cloud_function_utils.sniffing import ZIP
+
+ARCHIVE_COMPRESSIONS = (GZIP, ZSTD, ZIP)
+ARCHIVE_EXTENSIONS = {".gz": GZIP, ".gzip": GZIP, ".zst": ZSTD, ".zip": ZIP}
+
+
+def get_archive_compression(filename: str) -> str:
+    """
+    Identify the compression of a file from its extension.
+
+    :param filename: The name of the file, e.g. 'source-data/elr/batch.hl7.gz'.
+    :return: 'gzip', 'zstd', or 'zip', or 'identity' if the extension is not one of
+        `ARCHIVE_EXTENSIONS`.
+    """
+    for extension, compression in ARCHIVE_EXTENSIONS.items():
+        if filename.lower().endswith(extension):
+            return compression
+    return IDENTITY
+
+
+def iter_archive_members(
+    file: BinaryIO, compression: str
+) -> Iterator[Tuple[Optional[str], BinaryIO]]:
+    """
+    Open each member of a compressed file as a stream that decompresses it while it
+    is read, so that neither the file nor its members are ever held in memory whole.
+
+    A gzip file holds a single stream, even if it was written as several members, as
+    does a zstd file written as several frames. A zip archive holds a member per
+    file, and is read by seeking to its central directory, so `file` must be
+    seekable, as the readers returned by `google.cloud.storage.Blob.open` are. Each
+    member must be read before the next is opened.
+
+    :param file: The compressed file, opened for reading in binary mode.
+    :param compression: 'gzip', 'zstd', or 'zip'. zstd requires the zstandard package.
+    :return: An iterator over the name of each member, or None for gzip and zstd
+        files, and a binary stream of its decompressed contents. Directories in zip
+        archives are skipped.
+    """
+    if compression == GZIP:
+        with gzip.GzipFile(fileobj=file, mode="rb") as member:
+            yield None, member
+
+    elif compression == ZSTD:
+        decompressor = _get_zstandard().ZstdDecompressor()
+        with decompressor.stream_reader(file, read_across_frames=True) as member:
+            yield None, member
+
+    elif compression == ZIP:
+        with zipfile.ZipFile(file) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with archive.open(info) as member:
+                    yield info.filename, member
+
+    else:
+        raise ValueError(
+            f"Unknown archive compression: {compression}. The compression must be "
+            f"one of {', '.join(ARCHIVE_COMPRESSIONS)}."
+        )
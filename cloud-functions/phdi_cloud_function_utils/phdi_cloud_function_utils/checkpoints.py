@@ -0,0 +1,174 @@
+import json
+import sqlite3
+import threading
+from typing import Any, Dict, NamedTuple, Optional, Union
+
+
+class Checkpoint(NamedTuple):
+    """
+    The progress made reading a source file and publishing its messages.
+
+    :param message_count: The number of messages at the start of the file that have
+        been handled, i.e. either published or written to storage after failing to
+        publish. This is also the index of the next message to handle.
+    :param byte_offset: The offset in the file just past the last handled message, if
+        known, so that reading can resume there instead of at the start of the file.
+    :param complete: Whether every message in the file has been handled.
+    """
+
+    message_count: int
+    byte_offset: Optional[int] = None
+    complete: bool = False
+
+
+def make_checkpoint_key(
+    bucket_name: str, filename: str, generation: Union[int, str] = None
+) -> str:
+    """
+    Build the key identifying the checkpoint of a single version of a file in GCS.
+
+    :param bucket_name: The bucket containing the file.
+    :param filename: The name of the file.
+    :param generation: The generation of the file, so that a file that is overwritten
+        is processed again from its start.
+    :return: The checkpoint key.
+    """
+    return f"{bucket_name}/{filename}/{generation if generation is not None else ''}"
+
+
+class CheckpointStore:
+    """
+    The interface of a store of checkpoints keyed by `make_checkpoint_key`. Subclasses
+    implement `get`, `put`, and `delete`.
+    """
+
+    def get(self, key: str) -> Optional[Checkpoint]:
+        """
+        :param key: The checkpoint key.
+        :return: The checkpoint stored for the key, or None if there is none.
+        """
+        raise NotImplementedError
+
+    def put(self, key: str, checkpoint: Checkpoint) -> None:
+        """
+        :param key: The checkpoint key.
+        :param checkpoint: The checkpoint to store, replacing any stored before.
+        """
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        """
+        :param key: The checkpoint key. Deleting a key with no checkpoint does
+            nothing.
+        """
+        raise NotImplementedError
+
+
+class InMemoryCheckpointStore(CheckpointStore):
+    """
+    A checkpoint store that only lasts as long as the process.
+    """
+
+    def __init__(self):
+        self.checkpoints: Dict[str, Checkpoint] = {}
+
+    def get(self, key: str) -> Optional[Checkpoint]:
+        return self.checkpoints.get(key)
+
+    def put(self, key: str, checkpoint: Checkpoint) -> None:
+        self.checkpoints[key] = checkpoint
+
+    def delete(self, key: str) -> None:
+        self.checkpoints.pop(key, None)
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+    """
+    A checkpoint store backed by a local SQLite database, for tests, benchmarks, and
+    running the pipeline outside of GCP.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        """
+        :param path: The path of the database file, which is created if it does not
+            exist.
+        """
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                "key TEXT PRIMARY KEY, message_count INTEGER NOT NULL, "
+                "byte_offset INTEGER, complete INTEGER NOT NULL)"
+            )
+
+    def get(self, key: str) -> Optional[Checkpoint]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT message_count, byte_offset, complete FROM checkpoints "
+                "WHERE key = ?",
+                (key,),
+            ).fetchone()
+        if row is None:
+            return None
+        message_count, byte_offset, complete = row
+        return Checkpoint(message_count, byte_offset, bool(complete))
+
+    def put(self, key: str, checkpoint: Checkpoint) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO checkpoints "
+                "(key, message_count, byte_offset, complete) VALUES (?, ?, ?, ?)",
+                (
+                    key,
+                    checkpoint.message_count,
+                    checkpoint.byte_offset,
+                    int(checkpoint.complete),
+                ),
+            )
+
+    def delete(self, key: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM checkpoints WHERE key = ?", (key,))
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class GCSCheckpointStore(CheckpointStore):
+    """
+    A checkpoint store keeping each checkpoint as a small JSON object in GCS, so that
+    checkpoints outlive the function instance that wrote them.
+    """
+
+    def __init__(
+        self, storage_client: Any, bucket_name: str, prefix: str = "checkpoints/"
+    ):
+        """
+        :param storage_client: A `google.cloud.storage.Client`, or an object with the
+            same interface such as
+            `phdi_cloud_function_utils_testing.fakes.FakeStorageClient`.
+        :param bucket_name: The bucket to store checkpoints in.
+        :param prefix: The prefix of the names of checkpoint objects.
+        """
+        self.bucket = storage_client.bucket(bucket_name)
+        self.prefix = prefix
+
+    def _get_blob(self, key: str) -> Any:
+        return self.bucket.blob(f"{self.prefix}{key}.json")
+
+    def get(self, key: str) -> Optional[Checkpoint]:
+        blob = self._get_blob(key)
+        if not blob.exists():
+            return None
+        return Checkpoint(**json.loads(blob.download_as_bytes()))
+
+    def put(self, key: str, checkpoint: Checkpoint) -> None:
+        self._get_blob(key).upload_from_string(
+            json.dumps(checkpoint._asdict()), content_type="application/json"
+        )
+
+    def delete(self, key: str) -> None:
+        blob = self._get_blob(key)
+        if blob.exists():
+            blob.delete()
@@ -0,0 +1,115 @@
+from typing import Any, BinaryIO, Dict
+
+CLAIM_CHECK_BUCKET_ATTRIBUTE = "claim-check-bucket"
+CLAIM_CHECK_OBJECT_ATTRIBUTE = "claim-check-object"
+CLAIM_CHECK_GENERATION_ATTRIBUTE = "claim-check-generation"
+CLAIM_CHECK_RANGE_ATTRIBUTE = "claim-check-range"
+
+# Pub/Sub rejects messages over 10 MB, including their attributes.
+DEFAULT_CLAIM_CHECK_THRESHOLD = 9 * 1024 * 1024
+
+
+def make_claim_check_attributes(
+    bucket_name: str,
+    object_name: str,
+    generation: int = None,
+    start: int = None,
+    end: int = None,
+) -> Dict[str, str]:
+    """
+    Build the attributes of a Pub/Sub message whose payload is stored in GCS rather
+    than in the message itself.
+
+    :param bucket_name: The bucket containing the payload.
+    :param object_name: The object containing the payload.
+    :param generation: The generation of the object, so that the payload can still
+        be found if the object is overwritten.
+    :param start: The offset of the first byte of the payload within the object.
+    :param end: The offset just past the last byte of the payload within the object.
+        If neither start nor end is given the payload is the whole object.
+    :return: A dictionary of message attributes.
+    """
+    attributes = {
+        CLAIM_CHECK_BUCKET_ATTRIBUTE: bucket_name,
+        CLAIM_CHECK_OBJECT_ATTRIBUTE: object_name,
+    }
+    if generation is not None:
+        attributes[CLAIM_CHECK_GENERATION_ATTRIBUTE] = str(generation)
+    if start is not None or end is not None:
+        attributes[CLAIM_CHECK_RANGE_ATTRIBUTE] = (
+            f"{start or 0}-{'' if end is None else end}"
+        )
+    return attributes
+
+
+def is_claim_check(attributes: Dict[str, str] = None) -> bool:
+    """
+    Check whether a Pub/Sub message holds a reference to its payload instead of the
+    payload itself.
+
+    :param attributes: The attributes of the Pub/Sub message.
+    :return: True if the message is a claim check.
+    """
+    return CLAIM_CHECK_OBJECT_ATTRIBUTE in (attributes or {})
+
+
+class ClaimCheckResolver:
+    """
+    Fetch the payloads of Pub/Sub messages published as claim checks from GCS. Nothing
+    is downloaded until a payload is requested, and large payloads can be streamed with
+    `open` rather than read into memory at once.
+    """
+
+    def __init__(self, storage_client: Any):
+        """
+        :param storage_client: A `google.cloud.storage.Client`, or an object with the
+            same interface such as
+            `phdi_cloud_function_utils_testing.fakes.FakeStorageClient`.
+        """
+        self.storage_client = storage_client
+
+    def _get_blob(self, attributes: Dict[str, str]) -> Any:
+        generation = attributes.get(CLAIM_CHECK_GENERATION_ATTRIBUTE)
+        bucket = self.storage_client.bucket(attributes[CLAIM_CHECK_BUCKET_ATTRIBUTE])
+        return bucket.blob(
+            attributes[CLAIM_CHECK_OBJECT_ATTRIBUTE],
+            generation=int(generation) if generation else None,
+        )
+
+    @staticmethod
+    def _get_range(attributes: Dict[str, str]) -> tuple:
+        if CLAIM_CHECK_RANGE_ATTRIBUTE not in attributes:
+            return None, None
+        start, end = attributes[CLAIM_CHECK_RANGE_ATTRIBUTE].split("-")
+        return int(start), int(end) if end else None
+
+    def resolve(self, data: bytes, attributes: Dict[str, str] = None) -> bytes:
+        """
+        Get the payload of a Pub/Sub message, downloading it if the message is a claim
+        check.
+
+        :param data: The data of the Pub/Sub message.
+        :param attributes: The attributes of the Pub/Sub message.
+        :return: The payload of the message.
+        """
+        if not is_claim_check(attributes):
+            return data
+
+        start, end = self._get_range(attributes)
+        # GCS treats the end of a range as inclusive.
+        return self._get_blob(attributes).download_as_bytes(
+            start=start, end=None if end is None else end - 1
+        )
+
+    def open(self, attributes: Dict[str, str]) -> BinaryIO:
+        """
+        Open the payload of a claim check as a file-like object, so that it is
+        downloaded in chunks as it is read.
+
+        :param attributes: The attributes of a Pub/Sub message that is a claim check.
+        :return: A binary file-like object positioned at the start of the payload.
+        """
+        start, end = self._get_range(attributes)
+        if start or end is not None:
+            raise ValueError("Only claim checks for whole objects can be opened.")
+        return self._get_blob(attributes).open("rb")
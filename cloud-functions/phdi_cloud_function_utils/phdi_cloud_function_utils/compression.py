@@ -0,0 +1,74 @@
+import gzip
+from typing import Dict, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+IDENTITY = "identity"
+GZIP = "gzip"
+ZSTD = "zstd"
+CONTENT_ENCODINGS = (IDENTITY, GZIP, ZSTD)
+CONTENT_ENCODING_ATTRIBUTE = "content-encoding"
+
+
+def _get_zstandard():
+    if zstandard is None:
+        raise ImportError(
+            "The zstandard package is required for zstd compression. Install it with "
+            "'pip install zstandard'."
+        )
+    return zstandard
+
+
+def compress_payload(
+    data: bytes, content_encoding: str, threshold: int = 1024
+) -> Tuple[bytes, Dict[str, str]]:
+    """
+    Compress the data of a Pub/Sub message. Data smaller than the threshold, or that
+    would not get smaller, is returned as is.
+
+    :param data: The data of the Pub/Sub message.
+    :param content_encoding: The compression to use, one of 'identity' (no
+        compression), 'gzip', or 'zstd'. zstd requires the zstandard package.
+    :param threshold: The size in bytes below which data is not compressed.
+    :return: A tuple of the possibly compressed data and the attributes to add to the
+        message, which include the content-encoding attribute if it was compressed.
+    """
+    if content_encoding not in CONTENT_ENCODINGS:
+        raise ValueError(
+            f"Unknown content encoding: {content_encoding}. The content encoding must "
+            f"be one of {', '.join(CONTENT_ENCODINGS)}."
+        )
+    if content_encoding == IDENTITY or len(data) < threshold:
+        return data, {}
+
+    if content_encoding == GZIP:
+        compressed = gzip.compress(data, compresslevel=6, mtime=0)
+    else:
+        compressed = _get_zstandard().ZstdCompressor(level=3).compress(data)
+
+    if len(compressed) >= len(data):
+        return data, {}
+    return compressed, {CONTENT_ENCODING_ATTRIBUTE: content_encoding}
+
+
+def decompress_payload(data: bytes, attributes: Dict[str, str] = None) -> bytes:
+    """
+    Decompress the data of a Pub/Sub message according to its content-encoding
+    attribute. Data without the attribute is returned as is.
+
+    :param data: The data of the Pub/Sub message.
+    :param attributes: The attributes of the Pub/Sub message.
+    :return: The uncompressed data.
+    """
+    content_encoding = (attributes or {}).get(CONTENT_ENCODING_ATTRIBUTE, IDENTITY)
+    if content_encoding == IDENTITY:
+        return data
+    elif content_encoding == GZIP:
+        return gzip.decompress(data)
+    elif content_encoding == ZSTD:
+        return _get_zstandard().ZstdDecompressor().decompress(data)
+
+    raise ValueError(f"Unknown content encoding: {content_encoding}.")
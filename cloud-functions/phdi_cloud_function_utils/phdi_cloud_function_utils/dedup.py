@@ -0,0 +1,424 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Set, Tuple, Union
+
+
+def hash_message(message: Union[str, bytes], namespace: str = "") -> str:
+    """
+    Compute a content hash identifying a message regardless of the file it was read
+    from. SHA-256 is used since OpenSSL accelerates it on CPUs with SHA extensions,
+    where it is faster than BLAKE2b and MD5 (see benchmarks/bench_dedup.py).
+
+    :param message: The message to hash.
+    :param namespace: A string hashed along with the message, e.g. its root template,
+        so that the same content read as different message types is not considered a
+        duplicate.
+    :return: The hex digest of the message.
+    """
+    if isinstance(message, str):
+        message = message.encode("utf-8")
+    digest = hashlib.sha256(namespace.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(message)
+    return digest.hexdigest()
+
+
+class DedupStore:
+    """
+    The interface of a persistent set of message hashes backing a `DedupIndex`.
+    Subclasses implement `contains` and `add`, and `flush` if they buffer hashes.
+    """
+
+    def contains(self, key: str) -> bool:
+        """
+        :param key: A message hash.
+        :return: True if the hash has been added to the store.
+        """
+        raise NotImplementedError
+
+    def add(self, key: str) -> None:
+        """
+        :param key: A message hash to add to the store.
+        """
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        """
+        Write hashes that were added but are still buffered. Stores that write hashes
+        as they are added do nothing.
+        """
+
+
+class SQLiteDedupStore(DedupStore):
+    """
+    A store of message hashes in a local SQLite database, for tests, benchmarks, and
+    running the pipeline outside of GCP.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        """
+        :param path: The path of the database file, which is created if it does not
+            exist.
+        """
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # A hash is added per message, so avoid syncing the database to disk on every
+        # commit. A hash lost in a crash only means a duplicate may be published.
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS message_hashes ("
+                "key TEXT PRIMARY KEY, added_at REAL NOT NULL)"
+            )
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM message_hashes WHERE key = ?", (key,)
+            ).fetchone()
+        return row is not None
+
+    def add(self, key: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO message_hashes (key, added_at) VALUES (?, ?)",
+                (key, time.time()),
+            )
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+# The time a shard was loaded, the names of the objects downloaded, and their hashes
+# by the day they were written.
+_Shard = Tuple[float, Set[str], Dict[int, Set[str]]]
+
+
+class GCSDedupStore(DedupStore):
+    """
+    A store of message hashes in GCS, shared by every function instance.
+
+    Hashes are grouped into shards by their first `shard_chars` hex digits. Added
+    hashes are buffered until `flush`, which writes the hashes added to each shard as
+    a new object under the shard's prefix, concurrently, so a flush costs one small
+    write per shard it touched however many hashes the shards already hold. Objects
+    are grouped in folders by the day they were written: folders older than
+    `ttl_days` are ignored, and should be deleted by a lifecycle rule on the bucket.
+    Once a day folder holds `compact_threshold` objects, `flush` merges them into
+    one, so the objects read per shard stay bounded.
+
+    A shard is loaded the first time a hash in it is looked up, by listing its
+    objects and downloading them, and is then searched in memory, so reading a file
+    costs a few requests per shard rather than one per message. Shards are listed
+    again once they are older than `refresh_interval`, downloading only the objects
+    added since, to see hashes added by other instances. At most
+    `max_cached_shards` shards are held in memory, evicting the least recently used,
+    so `shard_chars` should be raised to bound the memory used by indexes of many
+    millions of hashes. The bucket must not trigger functions on object changes.
+    """
+
+    def __init__(
+        self,
+        storage_client: Any,
+        bucket_name: str,
+        prefix: str = "dedup/",
+        shard_chars: int = 2,
+        ttl_days: int = 30,
+        refresh_interval: float = 300.0,
+        max_cached_shards: int = 256,
+        compact_threshold: int = 16,
+        max_workers: int = 16,
+        max_attempts: int = 5,
+        clock: Callable[[], float] = time.time,
+    ):
+        """
+        :param storage_client: A `google.cloud.storage.Client`, or an object with the
+            same interface such as
+            `phdi_cloud_function_utils_testing.fakes.FakeStorageClient`.
+        :param bucket_name: The bucket to store hashes in.
+        :param prefix: The prefix of the names of shard objects.
+        :param shard_chars: The number of leading hex digits of a hash naming its
+            shard, so there are 16 ** shard_chars shards.
+        :param ttl_days: The number of days a hash is kept for.
+        :param refresh_interval: The number of seconds a loaded shard is used for
+            before it is listed again.
+        :param max_cached_shards: The maximum number of shards held in memory.
+        :param compact_threshold: The number of objects in a day folder of a shard
+            from which they are merged into one.
+        :param max_workers: The maximum number of shards written at once by `flush`.
+        :param max_attempts: The number of times a shard is listed when objects
+            listed are deleted by another instance compacting it before they are
+            downloaded.
+        :param clock: A function returning the current time in seconds since the
+            epoch.
+        """
+        self.bucket = storage_client.bucket(bucket_name)
+        self.prefix = prefix
+        self.shard_chars = max(1, shard_chars)
+        self.ttl_days = max(1, ttl_days)
+        self.refresh_interval = refresh_interval
+        self.max_cached_shards = max(1, max_cached_shards)
+        self.compact_threshold = max(2, compact_threshold)
+        self.max_workers = max(1, max_workers)
+        self.max_attempts = max(1, max_attempts)
+        self.clock = clock
+        # Maps shard names to the shards loaded, from least to most recently used.
+        self._shards: "OrderedDict[str, _Shard]" = OrderedDict()
+        # Maps shard names to the hashes added since the last flush.
+        self._pending: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def _shard_name(self, key: str) -> str:
+        return f"{self.prefix}{key[:self.shard_chars]}/"
+
+    def _today(self) -> int:
+        return int(self.clock() // 86400)
+
+    def _object_day(self, shard_name: str, object_name: str) -> Optional[int]:
+        prefix_length = len(shard_name)
+        day = object_name[prefix_length:].split("/", 1)[0]
+        return int(day) if day.isdigit() else None
+
+    def _list_objects(self, shard_name: str, day: int = None) -> Dict[str, int]:
+        """
+        :return: The names of the unexpired objects of a shard, or of one of its day
+            folders, mapped to their day.
+        """
+        prefix = shard_name if day is None else f"{shard_name}{day:06d}/"
+        oldest_day = self._today() - self.ttl_days + 1
+        names = {}
+        for blob in self.bucket.list_blobs(prefix=prefix):
+            object_day = self._object_day(shard_name, blob.name)
+            if object_day is not None and object_day >= oldest_day:
+                names[blob.name] = object_day
+        return names
+
+    def _download_keys(self, name: str) -> Optional[Set[str]]:
+        try:
+            data = self.bucket.blob(name).download_as_bytes()
+        except Exception as error:
+            # The object was deleted by an instance compacting its day folder.
+            if getattr(error, "code", None) == 404:
+                return None
+            raise
+        return set(data.decode("utf-8").split())
+
+    def _load_shard(self, name: str) -> _Shard:
+        with self._lock:
+            cached = self._shards.get(name)
+        loaded_names, keys_by_day = (
+            (set(), {}) if cached is None else (set(cached[1]), dict(cached[2]))
+        )
+        for attempt in range(self.max_attempts):
+            loaded_at = self.clock()
+            listed = self._list_objects(name)
+            # Objects deleted by compaction are only dropped from the names loaded:
+            # their hashes were written to the merged object listed instead.
+            loaded_names &= set(listed)
+            missing = False
+            for object_name, day in sorted(listed.items()):
+                if object_name in loaded_names:
+                    continue
+                keys = self._download_keys(object_name)
+                if keys is None:
+                    missing = True
+                    continue
+                loaded_names.add(object_name)
+                keys_by_day[day] = keys_by_day.get(day, set()) | keys
+            if not missing or attempt + 1 == self.max_attempts:
+                break
+        oldest_day = self._today() - self.ttl_days + 1
+        keys_by_day = {
+            day: keys for day, keys in keys_by_day.items() if day >= oldest_day
+        }
+        return loaded_at, loaded_names, keys_by_day
+
+    def _cache_shard(self, name: str, shard: _Shard) -> None:
+        with self._lock:
+            self._shards[name] = shard
+            self._shards.move_to_end(name)
+            while len(self._shards) > self.max_cached_shards:
+                self._shards.popitem(last=False)
+
+    def contains(self, key: str) -> bool:
+        name = self._shard_name(key)
+        with self._lock:
+            if key in self._pending.get(name, ()):
+                return True
+            shard = self._shards.get(name)
+            if shard is not None:
+                self._shards.move_to_end(name)
+        if shard is None or self.clock() - shard[0] >= self.refresh_interval:
+            shard = self._load_shard(name)
+            self._cache_shard(name, shard)
+        return any(key in keys for keys in shard[2].values())
+
+    def add(self, key: str) -> None:
+        with self._lock:
+            self._pending.setdefault(self._shard_name(key), set()).add(key)
+
+    def _write_object(self, name: str, day: int, keys: Set[str]) -> str:
+        object_name = f"{name}{day:06d}/{uuid.uuid4().hex}.txt"
+        self.bucket.blob(object_name).upload_from_string(
+            "".join(f"{key}\n" for key in sorted(keys)),
+            content_type="text/plain",
+            if_generation_match=0,
+        )
+        return object_name
+
+    def _compact_day(
+        self, name: str, day: int
+    ) -> Optional[Tuple[str, Set[str], Set[str]]]:
+        """
+        Merge the objects of a day folder of a shard into one. The merged object is
+        written before the objects it replaces are deleted, so instances compacting
+        the same folder at once, or loading it meanwhile, never lose a hash.
+
+        :return: The name of the merged object, the names of the objects merged, and
+            their hashes, or None if the folder has too few objects to merge.
+        """
+        object_names = sorted(self._list_objects(name, day))
+        if len(object_names) < self.compact_threshold:
+            return None
+        keys = set()
+        merged_names = []
+        for object_name in object_names:
+            object_keys = self._download_keys(object_name)
+            if object_keys is not None:
+                keys |= object_keys
+                merged_names.append(object_name)
+        merged_object_name = self._write_object(name, day, keys)
+        for object_name in merged_names:
+            try:
+                self.bucket.blob(object_name).delete()
+            except Exception as error:
+                # Another instance compacted the folder at the same time.
+                if getattr(error, "code", None) != 404:
+                    raise
+        return merged_object_name, set(merged_names), keys
+
+    def _update_cached_shard(
+        self,
+        name: str,
+        day: int,
+        added_names: Set[str],
+        removed_names: Set[str],
+        keys: Set[str],
+    ) -> Optional[_Shard]:
+        with self._lock:
+            shard = self._shards.get(name)
+            if shard is None:
+                return None
+            keys_by_day = dict(shard[2])
+            keys_by_day[day] = keys_by_day.get(day, set()) | keys
+            shard = (shard[0], (shard[1] - removed_names) | added_names, keys_by_day)
+            self._shards[name] = shard
+            return shard
+
+    def _flush_shard(self, name: str, keys: Set[str]) -> None:
+        day = self._today()
+        object_name = self._write_object(name, day, keys)
+        shard = self._update_cached_shard(name, day, {object_name}, set(), keys)
+        # Only shards held in memory are compacted, as counting the objects of the
+        # others would cost a listing per flush.
+        if shard is None or (
+            sum(self._object_day(name, loaded) == day for loaded in shard[1])
+            < self.compact_threshold
+        ):
+            return
+        compacted = self._compact_day(name, day)
+        if compacted is not None:
+            merged_object_name, merged_names, merged_keys = compacted
+            self._update_cached_shard(
+                name, day, {merged_object_name}, merged_names, merged_keys
+            )
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(pending))
+        ) as executor:
+            futures = {
+                name: executor.submit(self._flush_shard, name, keys)
+                for name, keys in pending.items()
+            }
+        errors = {
+            name: future.exception()
+            for name, future in futures.items()
+            if future.exception() is not None
+        }
+        if errors:
+            # The hashes of shards that could not be written are kept for the next
+            # flush, and until then are only known to this instance.
+            with self._lock:
+                for name in errors:
+                    self._pending.setdefault(name, set()).update(pending[name])
+            raise next(iter(errors.values()))
+
+
+class DedupIndex:
+    """
+    A set of the hashes of messages that have already been handled, made of a bounded
+    in-memory LRU cache in front of an optional persistent `DedupStore`. Hashes found
+    in the store are added to the cache, so repeated lookups of the same hash only
+    reach the store once.
+    """
+
+    def __init__(self, max_size: int = 100000, store: DedupStore = None):
+        """
+        :param max_size: The maximum number of hashes held in memory.
+        :param store: An optional persistent store of hashes.
+        """
+        self.max_size = max(1, max_size)
+        self.store = store
+        self._cache: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key: str) -> None:
+        with self._lock:
+            self._cache[key] = None
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def contains(self, key: str) -> bool:
+        """
+        :param key: A message hash.
+        :return: True if the hash is in the cache or the store.
+        """
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return True
+        if self.store is not None and self.store.contains(key):
+            self._remember(key)
+            return True
+        return False
+
+    def add(self, key: str) -> None:
+        """
+        :param key: A message hash to add to the cache and the store.
+        """
+        self._remember(key)
+        if self.store is not None:
+            self.store.add(key)
+
+    def flush(self) -> None:
+        """
+        Write hashes buffered by the store, e.g. before a checkpoint or once a file
+        has been read.
+        """
+        if self.store is not None:
+            self.store.flush()
+
+    def __len__(self) -> int:
+        return len(self._cache)
@@ -0,0 +1,81 @@
+import json
+from typing import Dict, Tuple, Union
+from phdi_cloud_function_utils.compression import decompress_payload
+
+JSON_ENVELOPE = "json"
+BINARY_ENVELOPE = "binary"
+ENVELOPES = (JSON_ENVELOPE, BINARY_ENVELOPE)
+
+# The fields describing a message other than the message itself.
+ENVELOPE_FIELDS = ("message_type", "root_template", "filename")
+
+
+def encode_envelope(
+    message: Union[str, bytes],
+    message_type: str,
+    root_template: str,
+    filename: str,
+    envelope: str = JSON_ENVELOPE,
+) -> Tuple[bytes, Dict[str, str]]:
+    """
+    Build the data and attributes of a Pub/Sub message for a single message read from
+    source data.
+
+    With the JSON envelope the message and its fields are serialized together as a
+    JSON object, which escapes every carriage return and non-ASCII character in the
+    message. With the binary envelope the data is the raw message and the other fields
+    are sent as message attributes.
+
+    :param message: The message, e.g. a single HL7v2 message or CCDA document.
+    :param message_type: The type of the message, e.g. 'hl7v2' or 'ccda'.
+    :param root_template: The template used to convert the message to FHIR.
+    :param filename: The name of the file the message was read from.
+    :param envelope: The envelope to use, either 'json' or 'binary'.
+    :return: A tuple of the message data and message attributes.
+    """
+    if envelope == BINARY_ENVELOPE:
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        attributes = {
+            "message_type": message_type,
+            "root_template": root_template,
+            "filename": filename,
+        }
+        return message, attributes
+
+    elif envelope == JSON_ENVELOPE:
+        if isinstance(message, bytes):
+            message = message.decode("utf-8")
+        pubsub_message = {
+            "message": message,
+            "message_type": message_type,
+            "root_template": root_template,
+            "filename": filename,
+        }
+        return json.dumps(pubsub_message).encode("utf-8"), {}
+
+    raise ValueError(
+        f"Unknown envelope: {envelope}. The envelope must be one of "
+        f"{', '.join(ENVELOPES)}."
+    )
+
+
+def decode_envelope(data: bytes, attributes: Dict[str, str] = None) -> dict:
+    """
+    Read a Pub/Sub message built by `encode_envelope` with either envelope. Messages
+    whose attributes include every envelope field use the binary envelope. Data
+    compressed by `compress_payload` is decompressed first.
+
+    :param data: The data of the Pub/Sub message.
+    :param attributes: The attributes of the Pub/Sub message.
+    :return: A dictionary containing the message and its message_type, root_template,
+        and filename.
+    """
+    attributes = attributes or {}
+    data = decompress_payload(data, attributes)
+    if all(field in attributes for field in ENVELOPE_FIELDS):
+        decoded = {"message": data.decode("utf-8")}
+        decoded.update({field: attributes[field] for field in ENVELOPE_FIELDS})
+        return decoded
+
+    return json.loads(data)
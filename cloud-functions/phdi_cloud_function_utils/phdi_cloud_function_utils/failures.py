@@ -0,0 +1,217 @@
+import datetime
+import json
+import threading
+from typing import Any, Iterator, List
+
+from phdi_cloud_function_utils.instrumentation import Metrics
+
+FAILURE_MANIFEST_CONTENT_TYPE = "application/x-ndjson"
+DEFAULT_FAILURE_BUFFER_BYTES = 8 * 1024 * 1024
+
+# GCS composes at most 32 objects in a single request.
+_MAX_COMPOSE_SOURCES = 32
+
+
+def make_failure_record(
+    source: str,
+    idx: int,
+    message: str,
+    error: Exception,
+    message_type: str,
+    root_template: str,
+    generation: int = None,
+    offset: int = None,
+) -> dict:
+    """
+    Build the record of a message that could not be published, as kept in a failure
+    manifest.
+
+    :param source: The name of the file the message was read from.
+    :param idx: The index of the message within the file.
+    :param message: The message.
+    :param error: The error raised by the final attempt to publish the message.
+    :param message_type: The type of the message, e.g. 'hl7v2' or 'ccda'.
+    :param root_template: The root template of the message, e.g. 'VXU_V04'.
+    :param generation: The generation of the file the message was read from.
+    :param offset: The offset in the file just past the message, if known.
+    :return: A JSON serializable dictionary.
+    """
+    return {
+        "source": source,
+        "generation": generation,
+        "idx": idx,
+        "offset": offset,
+        "message_type": message_type,
+        "root_template": root_template,
+        "error_type": type(error).__name__,
+        "error": str(error),
+        "failed_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "message": message,
+    }
+
+
+class FailureManifestWriter:
+    """
+    Collect the records of messages that could not be published from a source file
+    and write them to GCS as a single newline delimited JSON object, instead of
+    writing an object per message.
+
+    Records are buffered in memory. When the buffer grows past `max_buffer_bytes`, or
+    `flush` is called, e.g. before saving a checkpoint, the buffer is written to a
+    part object named after the manifest and the index of its first record. `close`
+    writes the last records and composes every part into the manifest, so a
+    manifest written without flushing costs a single upload. When resuming an earlier
+    attempt to read the same file the parts it left behind are included, and a part
+    rewritten by the retried attempt replaces the original.
+    """
+
+    def __init__(
+        self,
+        bucket: Any,
+        name: str,
+        max_buffer_bytes: int = DEFAULT_FAILURE_BUFFER_BYTES,
+        resume: bool = False,
+        metrics: Metrics = None,
+    ):
+        """
+        :param bucket: The `google.cloud.storage.Bucket` to write the manifest to, or
+            an object with the same interface such as
+            `phdi_cloud_function_utils_testing.fakes.FakeBucket`.
+        :param name: The name of the manifest.
+        :param max_buffer_bytes: The size of buffered records at which they are
+            written to a part.
+        :param resume: Whether an earlier attempt to read the file may have left parts
+            behind, which are then listed and composed into the manifest on `close`.
+        :param metrics: Optional metrics counting records in failure_records and
+            objects written in failure_manifest_writes.
+        """
+        self.bucket = bucket
+        self.name = name
+        self.max_buffer_bytes = max_buffer_bytes
+        self.resume = resume
+        self.metrics = metrics
+        self.record_count = 0
+        self._buffer: List[str] = []
+        self._buffer_bytes = 0
+        self._buffer_start_idx = None
+        self._parts_written = False
+        self._lock = threading.Lock()
+
+    @property
+    def part_prefix(self) -> str:
+        return f"{self.name}.part-"
+
+    def add(self, record: dict) -> None:
+        """
+        :param record: The record of a message that could not be published, as built
+            by `make_failure_record`.
+        """
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            if self._buffer_start_idx is None:
+                self._buffer_start_idx = record.get("idx", self.record_count)
+            self._buffer.append(line)
+            self._buffer_bytes += len(line)
+            self.record_count += 1
+            if self._buffer_bytes >= self.max_buffer_bytes:
+                self._write_part()
+        if self.metrics is not None:
+            self.metrics.increment("failure_records")
+
+    def flush(self) -> None:
+        """
+        Write any buffered records to a part, so that they are kept if the function
+        stops before `close` is called.
+        """
+        with self._lock:
+            if self._buffer:
+                self._write_part()
+
+    def close(self, name: str = None, if_generation_match: int = None) -> None:
+        """
+        Write the manifest, if any message failed to publish, and delete its parts.
+        If the manifest cannot be written because of its precondition, the records
+        are kept, so `close` can be called again, e.g. with another name.
+
+        :param name: The name to write the manifest to. Defaults to `self.name`.
+        :param if_generation_match: Only write the manifest if its current generation
+            matches, or if it does not exist when 0, like GCS preconditions.
+        """
+        name = name or self.name
+        with self._lock:
+            if not (self._parts_written or self.resume):
+                if self._buffer:
+                    self._upload(
+                        name,
+                        "".join(self._buffer),
+                        if_generation_match=if_generation_match,
+                    )
+                    self._clear_buffer()
+                return
+
+            if self._buffer:
+                self._write_part()
+            parts = self._list_parts()
+            if parts:
+                self._compose(name, parts, if_generation_match=if_generation_match)
+                for part in parts:
+                    part.delete()
+
+    def _write_part(self) -> None:
+        self._upload(
+            f"{self.part_prefix}{self._buffer_start_idx:012d}", "".join(self._buffer)
+        )
+        self._parts_written = True
+        self._clear_buffer()
+
+    def _clear_buffer(self) -> None:
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._buffer_start_idx = None
+
+    def _list_parts(self) -> List[Any]:
+        parts = self.bucket.list_blobs(prefix=self.part_prefix)
+        return sorted(parts, key=lambda part: part.name)
+
+    def _upload(self, name: str, data: str, if_generation_match: int = None) -> None:
+        self.bucket.blob(name).upload_from_string(
+            data,
+            content_type=FAILURE_MANIFEST_CONTENT_TYPE,
+            if_generation_match=if_generation_match,
+        )
+        if self.metrics is not None:
+            self.metrics.increment("failure_manifest_writes")
+
+    def _compose(
+        self, name: str, parts: List[Any], if_generation_match: int = None
+    ) -> None:
+        # Compose in rounds, appending up to 31 parts to the manifest each time, so
+        # that any number of parts can be composed. Each round after the first is
+        # conditioned on the manifest written by the round before.
+        destination = self.bucket.blob(name)
+        destination.content_type = FAILURE_MANIFEST_CONTENT_TYPE
+        first = _MAX_COMPOSE_SOURCES
+        destination.compose(parts[:first], if_generation_match=if_generation_match)
+        for start in range(first, len(parts), _MAX_COMPOSE_SOURCES - 1):
+            stop = start + _MAX_COMPOSE_SOURCES - 1
+            destination.compose(
+                [destination] + parts[start:stop],
+                if_generation_match=destination.generation,
+            )
+        if self.metrics is not None:
+            self.metrics.increment("failure_manifest_writes")
+
+
+def iter_failure_records(blob: Any) -> Iterator[dict]:
+    """
+    Read the records of a failure manifest one at a time, without downloading the
+    whole manifest at once.
+
+    :param blob: The manifest, as a `google.cloud.storage.Blob` or an object with the
+        same interface such as `phdi_cloud_function_utils_testing.fakes.FakeBlob`.
+    :return: An iterator over the records of the manifest.
+    """
+    with blob.open("rb") as reader:
+        for line in reader:
+            if line.strip():
+                yield json.loads(line)
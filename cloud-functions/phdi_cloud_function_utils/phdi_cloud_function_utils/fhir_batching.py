@@ -0,0 +1,293 @@
+import json
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+# The number of entries phdi's upload_bundle_to_fhir_server puts in a single request,
+# which merged bundles are kept to by default.
+DEFAULT_FHIR_BATCH_MAX_ENTRIES = 500
+DEFAULT_FHIR_BATCH_MAX_BYTES = 8 * 1024 * 1024
+DEFAULT_FHIR_BATCH_WINDOW = 10.0
+FHIR_BATCH_BUNDLE_TYPES = ("batch", "transaction")
+
+# The system of the identifier phdi's add_patient_identifier_in_bundle adds to each
+# patient, a hash of the patient's name, birth date, and address.
+PATIENT_HASH_IDENTIFIER_SYSTEM = "urn:ietf:rfc:3986"
+
+
+class EntrySource(NamedTuple):
+    """
+    Where an entry of a merged bundle came from: the source, e.g. the ID of the
+    message holding the bundle, and the index of the entry in that bundle.
+    """
+
+    source: str
+    index: int
+
+
+def get_patient_key(resource: dict) -> Optional[str]:
+    """
+    Get a key identifying the patient a Patient resource is about, so that Patient
+    resources about the same patient from different bundles can be deduplicated.
+
+    :param resource: A FHIR resource.
+    :return: The patient hash added by add_patient_identifier_in_bundle if there is
+        one, else a reference such as 'Patient/123' if the resource has an ID, or None
+        if the resource is not a Patient or cannot be identified.
+    """
+    if resource.get("resourceType") != "Patient":
+        return None
+    for identifier in resource.get("identifier", []):
+        system = identifier.get("system")
+        if system == PATIENT_HASH_IDENTIFIER_SYSTEM and identifier.get("value"):
+            return f"{system}|{identifier['value']}"
+    if resource.get("id"):
+        return f"Patient/{resource['id']}"
+    return None
+
+
+def get_entry_status_code(entry_response: dict) -> int:
+    """
+    Get the HTTP status code of an entry of a batch or transaction response, whose
+    status is a string such as '201 Created'.
+
+    :param entry_response: The `response` of an entry of a batch-response or
+        transaction-response bundle.
+    :return: The status code, or 0 if the status is missing or malformed.
+    """
+    try:
+        return int(str(entry_response.get("status", "")).strip()[:3])
+    except ValueError:
+        return 0
+
+
+def _rewrite_references(value: Any, references: Dict[str, str]) -> Any:
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == "reference" and isinstance(item, str) and item in references:
+                value[key] = references[item]
+            else:
+                _rewrite_references(item, references)
+    elif isinstance(value, list):
+        for item in value:
+            _rewrite_references(item, references)
+    return value
+
+
+class FhirBundleBatch:
+    """
+    Merge the entries of many FHIR bundles, each from a separate source such as a
+    Pub/Sub message, into a single batch or transaction bundle, so that they are
+    uploaded to the FHIR server in a single request instead of a request per source.
+
+    Patient entries about the same patient, as identified by `get_patient_key`, are
+    uploaded once: the last is kept, in place of the first, so that the patient is
+    uploaded as most recently received, and references to the others are rewritten to
+    refer to it. The entries of the response to the merged bundle can be mapped back to
+    the sources and entries they came from with `map_response`.
+    """
+
+    def __init__(
+        self,
+        bundle_type: str = "batch",
+        max_entries: int = DEFAULT_FHIR_BATCH_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_FHIR_BATCH_MAX_BYTES,
+        window: float = DEFAULT_FHIR_BATCH_WINDOW,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        :param bundle_type: 'batch', whose entries succeed or fail separately, or
+            'transaction', which succeeds or fails as a whole but resolves references
+            between entries by their fullUrl.
+        :param max_entries: The maximum number of entries in the merged bundle.
+        :param max_bytes: The maximum size in bytes of the merged bundle.
+        :param window: The number of seconds after the first bundle is added that the
+            merged bundle is due to be uploaded, however few entries it has.
+        :param clock: A monotonic clock in seconds, replaceable in tests.
+        """
+        if bundle_type not in FHIR_BATCH_BUNDLE_TYPES:
+            raise ValueError(
+                f"Unknown FHIR batch bundle type: {bundle_type}. The bundle type must "
+                f"be one of {', '.join(FHIR_BATCH_BUNDLE_TYPES)}."
+            )
+        self.bundle_type = bundle_type
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.window = window
+        self.clock = clock
+        self.entries: List[dict] = []
+        self.entry_sources: List[List[EntrySource]] = []
+        self.sources: List[str] = []
+        self.size_bytes = 0
+        self.deduplicated_count = 0
+        self.started_at: Optional[float] = None
+        self._patients: Dict[str, int] = {}
+        # References to replaced patients, and the references to the patients kept
+        # they are rewritten to when the merged bundle is built.
+        self._references: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, source: str, bundle: dict, size_bytes: int = None) -> bool:
+        """
+        Add the entries of a bundle to the merged bundle if they fit.
+
+        :param source: What the bundle is from, e.g. a message ID, to map the
+            results of its entries back to.
+        :param bundle: The FHIR bundle. Its entries may be modified in place to
+            refer to deduplicated patients when the merged bundle is built.
+        :param size_bytes: The size of the bundle serialized as JSON, if known.
+        :return: Whether the bundle was added. A bundle that would take the merged
+            bundle over `max_entries` or `max_bytes` is not added, unless the merged
+            bundle is empty, so that a bundle too large to merge is uploaded alone.
+        """
+        entries = bundle.get("entry", [])
+        if size_bytes is None:
+            size_bytes = len(json.dumps(bundle))
+        if self.entries and (
+            len(self.entries) + len(entries) > self.max_entries
+            or self.size_bytes + size_bytes > self.max_bytes
+        ):
+            return False
+
+        if self.started_at is None:
+            self.started_at = self.clock()
+        self.sources.append(source)
+        self.size_bytes += size_bytes
+
+        for idx, entry in enumerate(entries):
+            key = get_patient_key(entry.get("resource", {}))
+            if key is not None and key in self._patients:
+                # The duplicate replaces the patient added before it, and references
+                # to that patient are rewritten to refer to the duplicate.
+                kept_idx = self._patients[key]
+                replaced = self.entries[kept_idx]
+                if not entry.get("fullUrl") and replaced.get("fullUrl"):
+                    entry["fullUrl"] = replaced["fullUrl"]
+                self.entries[kept_idx] = entry
+                self.entry_sources[kept_idx].append(EntrySource(source, idx))
+                self.deduplicated_count += 1
+                self._add_references(self._get_references(replaced, to_entry=entry))
+                continue
+            if key is not None:
+                self._patients[key] = len(self.entries)
+            self.entries.append(entry)
+            self.entry_sources.append([EntrySource(source, idx)])
+        return True
+
+    def _add_references(self, references: Dict[str, str]) -> None:
+        # References already rewritten to the replaced patient now go to the new one,
+        # and references to a patient kept are not rewritten.
+        for reference, to_reference in self._references.items():
+            self._references[reference] = references.get(to_reference, to_reference)
+        self._references.update(references)
+        for reference, to_reference in list(self._references.items()):
+            if reference == to_reference:
+                del self._references[reference]
+
+    @staticmethod
+    def _get_references(entry: dict, to_entry: dict) -> Dict[str, str]:
+        to_reference = to_entry.get("fullUrl")
+        to_id = to_entry.get("resource", {}).get("id")
+        if to_id:
+            to_reference = to_reference or f"Patient/{to_id}"
+        if not to_reference:
+            return {}
+        references = {}
+        if entry.get("fullUrl"):
+            references[entry["fullUrl"]] = to_reference
+        resource_id = entry.get("resource", {}).get("id")
+        if resource_id:
+            references[f"Patient/{resource_id}"] = (
+                f"Patient/{to_id}" if to_id else to_reference
+            )
+        return references
+
+    def is_full(self) -> bool:
+        """
+        :return: Whether the merged bundle has reached `max_entries` or `max_bytes`.
+        """
+        return (
+            len(self.entries) >= self.max_entries or self.size_bytes >= self.max_bytes
+        )
+
+    def is_due(self) -> bool:
+        """
+        :return: Whether `window` seconds have passed since the first bundle was added.
+        """
+        return (
+            self.started_at is not None
+            and self.clock() - self.started_at >= self.window
+        )
+
+    def to_bundle(self) -> dict:
+        """
+        :return: The merged bundle, whose entries are in the order they were added,
+            with references to replaced patients rewritten to the patients kept.
+        """
+        if self._references:
+            for entry in self.entries:
+                _rewrite_references(entry, self._references)
+        return {
+            "resourceType": "Bundle",
+            "type": self.bundle_type,
+            "entry": self.entries,
+        }
+
+    def map_response(self, response: dict) -> Dict[str, List[dict]]:
+        """
+        Map the entries of the response to the merged bundle back to the sources and
+        entries they came from.
+
+        :param response: The batch-response or transaction-response bundle returned by
+            the FHIR server, such as upload_response.json, with an entry per entry of
+            the merged bundle, in order.
+        :return: For each source, a result per entry of its bundle, in order, holding
+            the index of the entry, the `response` of its entry in the response to the
+            merged bundle, and its status code. Entries missing from the response are
+            given a status code of 0.
+        """
+        response_entries = response.get("entry", [])
+        results = {source: [] for source in self.sources}
+        for idx, entry_sources in enumerate(self.entry_sources):
+            if idx < len(response_entries):
+                entry_response = response_entries[idx].get("response", {})
+            else:
+                entry_response = {}
+            for source, source_idx in entry_sources:
+                results[source].append(
+                    {
+                        "index": source_idx,
+                        "response": entry_response,
+                        "status_code": get_entry_status_code(entry_response),
+                    }
+                )
+        for source_results in results.values():
+            source_results.sort(key=lambda result: result["index"])
+        return results
+
+    def map_failure(self, status_code: int, body: Any = None) -> Dict[str, List[dict]]:
+        """
+        Map a response to the merged bundle that failed as a whole, e.g. a failed
+        transaction, to every entry of every source.
+
+        :param status_code: The HTTP status code of the response.
+        :param body: The body of the response, e.g. an OperationOutcome.
+        :return: For each source, a result per entry of its bundle, as returned by
+            `map_response`, each with the status code and body of the response.
+        """
+        entry_response = {"status": str(status_code)}
+        if body is not None:
+            entry_response["outcome"] = body
+        return self.map_response(
+            {"entry": [{"response": entry_response}] * len(self.entries)}
+        )
+
+
+def is_successful_upload(results: List[dict]) -> bool:
+    """
+    :param results: The results of the entries of a source, as returned by
+        `FhirBundleBatch.map_response`.
+    :return: Whether every entry was created or updated.
+    """
+    return all(200 <= result["status_code"] < 300 for result in results)
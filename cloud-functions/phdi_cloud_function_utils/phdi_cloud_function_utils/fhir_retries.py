@@ -0,0 +1,178 @@
+import time
+from typing import Any, Callable, Iterable, List
+from phdi_cloud_function_utils.fhir_batching import get_entry_status_code
+from phdi_cloud_function_utils.retries import RetryPolicy
+
+# HTTP status codes of FHIR requests, and of the entries of batch responses, that may
+# succeed if tried again, e.g. once the FHIR store is under less load.
+RETRYABLE_FHIR_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+class FhirUploadError(Exception):
+    """
+    An upload to the FHIR server, or an entry of one, that failed with an HTTP status
+    code, which RetryPolicy decides whether to retry.
+    """
+
+    def __init__(self, code: int):
+        super().__init__(f"The FHIR server responded with status {code}.")
+        self.code = code
+
+
+def is_retryable_fhir_error(error: Exception) -> bool:
+    """
+    :param error: The error of a failed upload or entry, e.g. a FhirUploadError.
+    :return: True if the error has a status code in RETRYABLE_FHIR_STATUS_CODES.
+    """
+    return getattr(error, "code", None) in RETRYABLE_FHIR_STATUS_CODES
+
+
+def get_retryable_entries(
+    response: dict,
+    retryable: Callable[[Exception], bool] = is_retryable_fhir_error,
+) -> List[int]:
+    """
+    Find the entries of a batch upload that failed but may succeed if sent again.
+
+    :param response: The batch-response bundle returned by the FHIR server, such as
+        upload_response.json, with an entry per entry of the uploaded bundle.
+    :param retryable: A function deciding whether the error of an entry is worth
+        retrying.
+    :return: The indices of the entries whose status code is not a success and is
+        retryable.
+    """
+    indices = []
+    for idx, entry in enumerate(response.get("entry", [])):
+        code = get_entry_status_code(entry.get("response", {}))
+        if not 200 <= code < 300 and retryable(FhirUploadError(code)):
+            indices.append(idx)
+    return indices
+
+
+def make_retry_bundle(bundle: dict, indices: Iterable[int]) -> dict:
+    """
+    :param bundle: An uploaded batch bundle.
+    :param indices: The indices of the entries to send again.
+    :return: A bundle of the same type holding only those entries, in order.
+    """
+    entries = bundle.get("entry", [])
+    return {
+        "resourceType": "Bundle",
+        "type": bundle.get("type", "batch"),
+        "entry": [entries[idx] for idx in indices],
+    }
+
+
+class PartialRetryResult:
+    """
+    The outcome of uploading a bundle with `upload_with_partial_retry`.
+    """
+
+    def __init__(self, entry_count: int):
+        # The response of the last attempt at each entry, or None if it was never
+        # answered.
+        self.entry_responses: List[Any] = [None] * entry_count
+        self.attempts = 0
+        self.entries_sent = 0
+        self.status_code = 0
+
+    def to_response(self) -> dict:
+        """
+        :return: A batch-response bundle with the response of the last attempt at
+            each entry, in the order of the uploaded bundle, which can be passed to
+            `FhirBundleBatch.map_response`.
+        """
+        return {
+            "resourceType": "Bundle",
+            "type": "batch-response",
+            "entry": [
+                {"response": entry_response or {}}
+                for entry_response in self.entry_responses
+            ],
+        }
+
+    @property
+    def failed_entries(self) -> List[int]:
+        """
+        :return: The indices of the entries that were not uploaded.
+        """
+        return [
+            idx
+            for idx, entry_response in enumerate(self.entry_responses)
+            if not 200 <= get_entry_status_code(entry_response or {}) < 300
+        ]
+
+
+def upload_with_partial_retry(
+    bundle: dict,
+    upload: Callable[[dict], Any],
+    retry_policy: RetryPolicy = None,
+    sleep: Callable[[float], None] = time.sleep,
+) -> PartialRetryResult:
+    """
+    Upload a batch bundle to the FHIR server, and send the entries that failed with a
+    retryable status code again, with backoff, without sending the entries that
+    succeeded again.
+
+    When the whole request fails with a retryable status code, e.g. a 429 or a
+    transaction that failed because of one of its entries, every entry still pending
+    is sent again. Transaction bundles succeed or fail as a whole, so only batch
+    bundles benefit from retrying entries separately.
+
+    :param bundle: The batch or transaction bundle to upload.
+    :param upload: A function uploading a bundle in a single request and returning
+        the response, e.g. a requests.Response, with a `status_code` and a `json`
+        method returning the batch-response bundle.
+    :param retry_policy: How many times and how long after failed entries are sent
+        again. By default, up to 5 attempts are made, and only entries with a status
+        code in RETRYABLE_FHIR_STATUS_CODES are retried.
+    :param sleep: A function to wait a number of seconds, replaceable in tests.
+    :return: A PartialRetryResult with the response of the last attempt at each entry.
+    """
+    retry_policy = retry_policy or RetryPolicy(retryable=is_retryable_fhir_error)
+    entry_count = len(bundle.get("entry", []))
+    result = PartialRetryResult(entry_count)
+    pending = list(range(entry_count))
+    while pending:
+        result.attempts += 1
+        result.entries_sent += len(pending)
+        response = upload(make_retry_bundle(bundle, pending))
+        result.status_code = response.status_code
+
+        if response.status_code == 200:
+            response_entries = response.json().get("entry", [])
+            retryable = set(
+                get_retryable_entries(
+                    {"entry": response_entries}, retryable=retry_policy.retryable
+                )
+            )
+            retry = []
+            for response_idx, idx in enumerate(pending):
+                if response_idx >= len(response_entries):
+                    # Entries missing from the response are sent again.
+                    retry.append(idx)
+                    continue
+                result.entry_responses[idx] = response_entries[response_idx].get(
+                    "response", {}
+                )
+                if response_idx in retryable:
+                    retry.append(idx)
+            should_retry = result.attempts < retry_policy.max_attempts
+        else:
+            entry_response = {"status": str(response.status_code)}
+            try:
+                entry_response["outcome"] = response.json()
+            except ValueError:
+                pass
+            for idx in pending:
+                result.entry_responses[idx] = entry_response
+            retry = pending
+            should_retry = retry_policy.should_retry(
+                result.attempts, FhirUploadError(response.status_code)
+            )
+
+        if not retry or not should_retry:
+            break
+        sleep(retry_policy.backoff(result.attempts))
+        pending = retry
+    return result
@@ -0,0 +1,436 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+DEFAULT_GEOCODE_CACHE_SIZE = 100000
+DEFAULT_GEOCODE_CACHE_TTL = 90 * 24 * 60 * 60
+DEFAULT_GEOCODE_BATCH_SIZE = 100
+
+# A geocoder takes a batch of FHIR addresses and returns, in order, the geocoding
+# result of each as a dict with the fields of phdi.geospatial.GeocodeResult, or None
+# if the address could not be matched.
+BatchGeocoder = Callable[[List[dict]], List[Optional[dict]]]
+
+# Abbreviations of the USPS for common street suffixes, directions, and unit
+# designators, so that "123 Main Street Apartment 4" and "123 MAIN ST APT 4" share a
+# key.
+ADDRESS_ABBREVIATIONS = {
+    "AVENUE": "AVE",
+    "BOULEVARD": "BLVD",
+    "CIRCLE": "CIR",
+    "COURT": "CT",
+    "DRIVE": "DR",
+    "HIGHWAY": "HWY",
+    "LANE": "LN",
+    "PARKWAY": "PKWY",
+    "PLACE": "PL",
+    "ROAD": "RD",
+    "STREET": "ST",
+    "TERRACE": "TER",
+    "NORTH": "N",
+    "SOUTH": "S",
+    "EAST": "E",
+    "WEST": "W",
+    "NORTHEAST": "NE",
+    "NORTHWEST": "NW",
+    "SOUTHEAST": "SE",
+    "SOUTHWEST": "SW",
+    "APARTMENT": "APT",
+    "SUITE": "STE",
+    "UNIT": "UNIT",
+}
+
+_NON_ALPHANUMERIC = re.compile(r"[^A-Z0-9 ]+")
+
+
+def _normalize_address_part(value: Any) -> str:
+    words = _NON_ALPHANUMERIC.sub(" ", str(value or "").upper()).split()
+    return " ".join(ADDRESS_ABBREVIATIONS.get(word, word) for word in words)
+
+
+def normalize_address_key(address: dict) -> Optional[str]:
+    """
+    Build the key an address is cached under, the same for spellings of an address
+    that differ only in case, punctuation, whitespace, common abbreviations, or a ZIP+4
+    extension.
+
+    :param address: A FHIR address.
+    :return: The key, or None if the address has no street line, city, state, or
+        postal code, so cannot be geocoded.
+    """
+    line = _normalize_address_part(" ".join(address.get("line") or []))
+    city = _normalize_address_part(address.get("city"))
+    state = _normalize_address_part(address.get("state"))
+    postal_code = re.sub(r"[^0-9]", "", str(address.get("postalCode") or ""))[:5]
+    if not (line or city or state or postal_code):
+        return None
+    return f"{line}|{city}|{state}|{postal_code}"
+
+
+def apply_geocode_result(address: dict, result: dict, update_line: bool = True) -> None:
+    """
+    Update a FHIR address in place with a geocoding result, as phdi's FHIR geocoding
+    clients do: the standardized address fields, a geolocation extension, and a
+    census tract extension on each line if the result has a census tract.
+
+    :param address: The FHIR address to update.
+    :param result: The geocoding result, a dict with the fields of
+        phdi.geospatial.GeocodeResult.
+    :param update_line: Whether to replace the street lines and county of the address
+        with those of the result, as the smarty client does. The census client keeps
+        the original lines.
+    """
+    if update_line:
+        address["line"] = list(result["line"])
+        address["county"] = result.get("county_name")
+    address["city"] = result["city"]
+    address["state"] = result["state"]
+    address["postalCode"] = result["postal_code"]
+    address.setdefault("extension", []).append(
+        {
+            "url": "http://hl7.org/fhir/StructureDefinition/geolocation",
+            "extension": [
+                {"url": "latitude", "valueDecimal": result["lat"]},
+                {"url": "longitude", "valueDecimal": result["lng"]},
+            ],
+        }
+    )
+    if result.get("census_tract"):
+        census_extension = {
+            "url": "http://hl7.org/fhir/StructureDefinition/iso21090-ADXP-censusTract",
+            "valueString": result["census_tract"],
+        }
+        line_extensions = address.setdefault("_line", [])
+        for idx in range(len(address.get("line", []))):
+            if idx < len(line_extensions) and line_extensions[idx]:
+                line_extensions[idx].setdefault("extension", []).append(
+                    census_extension
+                )
+            elif idx < len(line_extensions):
+                line_extensions[idx] = {"extension": [census_extension]}
+            else:
+                line_extensions.append({"extension": [census_extension]})
+
+
+class GeocodeCacheStore:
+    """
+    The interface of a persistent store of geocoding results backing a
+    `GeocodeCache`, shared by function instances and kept across deployments.
+    Results older than the store's TTL are treated as missing, so that addresses are
+    eventually geocoded again as geocoders' reference data changes. Subclasses
+    implement `get_many` and `put_many`.
+    """
+
+    def get_many(self, keys: List[str]) -> Dict[str, Optional[dict]]:
+        """
+        :param keys: Address keys built by `normalize_address_key`.
+        :return: The result stored for each key that has an unexpired result. A
+            result of None means the address could not be matched.
+        """
+        raise NotImplementedError
+
+    def put_many(self, results: Dict[str, Optional[dict]]) -> None:
+        """
+        :param results: Results by address key to store, replacing any stored before.
+        """
+        raise NotImplementedError
+
+
+class SQLiteGeocodeCacheStore(GeocodeCacheStore):
+    """
+    A store of geocoding results in a local SQLite database, for tests, benchmarks,
+    and running the pipeline outside of GCP.
+    """
+
+    # SQLite limits the number of parameters of a statement.
+    _MAX_PARAMETERS = 500
+
+    def __init__(
+        self,
+        path: str = ":memory:",
+        ttl: float = DEFAULT_GEOCODE_CACHE_TTL,
+        clock: Callable[[], float] = time.time,
+    ):
+        """
+        :param path: The path of the database file, which is created if it does not
+            exist.
+        :param ttl: The number of seconds a result is kept for.
+        :param clock: A clock in seconds since the epoch, replaceable in tests.
+        """
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS geocode_results ("
+                "key TEXT PRIMARY KEY, result TEXT NOT NULL, cached_at REAL NOT NULL)"
+            )
+
+    def get_many(self, keys: List[str]) -> Dict[str, Optional[dict]]:
+        results = {}
+        oldest = self.clock() - self.ttl
+        for start in range(0, len(keys), self._MAX_PARAMETERS):
+            end = start + self._MAX_PARAMETERS
+            chunk = keys[start:end]
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT key, result FROM geocode_results WHERE cached_at >= ? "
+                    f"AND key IN ({', '.join('?' * len(chunk))})",
+                    (oldest, *chunk),
+                ).fetchall()
+            results.update((key, json.loads(result)) for key, result in rows)
+        return results
+
+    def put_many(self, results: Dict[str, Optional[dict]]) -> None:
+        cached_at = self.clock()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO geocode_results (key, result, cached_at) "
+                "VALUES (?, ?, ?)",
+                [
+                    (key, json.dumps(result), cached_at)
+                    for key, result in results.items()
+                ],
+            )
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class GCSGeocodeCacheStore(GeocodeCacheStore):
+    """
+    A store of geocoding results kept as small JSON objects in GCS, named by a hash of
+    their address key, so that the cache is shared by every function instance. As
+    each result is a separate object, lookups are made concurrently.
+    """
+
+    def __init__(
+        self,
+        storage_client: Any,
+        bucket_name: str,
+        prefix: str = "geocode_cache/",
+        ttl: float = DEFAULT_GEOCODE_CACHE_TTL,
+        max_workers: int = 16,
+        clock: Callable[[], float] = time.time,
+    ):
+        """
+        :param storage_client: A `google.cloud.storage.Client`, or an object with the
+            same interface such as
+            `phdi_cloud_function_utils_testing.fakes.FakeStorageClient`.
+        :param bucket_name: The bucket to store results in. It must not trigger a
+            function, as a result is written for every newly geocoded address, and
+            should have a lifecycle rule deleting objects after the TTL, as expired
+            results are only ever overwritten.
+        :param prefix: The prefix of the names of result objects.
+        :param ttl: The number of seconds a result is used for.
+        :param max_workers: The number of objects read or written at once.
+        :param clock: A clock in seconds since the epoch, replaceable in tests.
+        """
+        self.bucket = storage_client.bucket(bucket_name)
+        self.prefix = prefix
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self.clock = clock
+
+    def _get_blob_name(self, key: str) -> str:
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return f"{self.prefix}{digest}.json"
+
+    def _get(self, key: str) -> Optional[dict]:
+        blob = self.bucket.get_blob(self._get_blob_name(key))
+        if blob is None:
+            return None
+        return json.loads(blob.download_as_bytes())
+
+    def _put(self, key: str, result: Optional[dict], cached_at: float) -> None:
+        self.bucket.blob(self._get_blob_name(key)).upload_from_string(
+            json.dumps({"key": key, "result": result, "cached_at": cached_at}),
+            content_type="application/json",
+        )
+
+    def get_many(self, keys: List[str]) -> Dict[str, Optional[dict]]:
+        oldest = self.clock() - self.ttl
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            objects = list(executor.map(self._get, keys))
+        # The key is checked in case of a hash collision.
+        return {
+            key: stored["result"]
+            for key, stored in zip(keys, objects)
+            if stored is not None
+            and stored.get("key") == key
+            and stored.get("cached_at", 0) >= oldest
+        }
+
+    def put_many(self, results: Dict[str, Optional[dict]]) -> None:
+        cached_at = self.clock()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(
+                executor.map(
+                    lambda item: self._put(*item, cached_at=cached_at),
+                    results.items(),
+                )
+            )
+
+
+class GeocodeCache:
+    """
+    A geocoding cache in front of a batch geocoder such as Smarty, made of a bounded
+    in-memory LRU cache in front of an optional persistent `GeocodeCacheStore`.
+
+    Addresses are looked up by `normalize_address_key`. Addresses missing from memory
+    are looked up in the store in a single call, and those missing from the store are
+    geocoded in batches of `batch_size`, so a bundle costs at most one store lookup
+    and a geocoder request per batch of new addresses. Addresses that could not be
+    matched are cached too, so they are not sent to the geocoder again.
+
+    Counts of memory hits, store hits, and misses are kept in `counters`. Each address
+    looked up is counted once: repeats of an address within a lookup count as memory
+    hits.
+    """
+
+    def __init__(
+        self,
+        geocoder: BatchGeocoder,
+        max_size: int = DEFAULT_GEOCODE_CACHE_SIZE,
+        store: GeocodeCacheStore = None,
+        batch_size: int = DEFAULT_GEOCODE_BATCH_SIZE,
+    ):
+        """
+        :param geocoder: The batch geocoder to geocode addresses missing from the
+            cache with.
+        :param max_size: The maximum number of results held in memory.
+        :param store: An optional persistent store of results.
+        :param batch_size: The maximum number of addresses sent to the geocoder at
+            once.
+        """
+        self.geocoder = geocoder
+        self.max_size = max(1, max_size)
+        self.store = store
+        self.batch_size = max(1, batch_size)
+        self.counters = {
+            "memory_hits": 0,
+            "store_hits": 0,
+            "misses": 0,
+            "geocoder_requests": 0,
+        }
+        self._cache: "OrderedDict[str, Optional[dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    @property
+    def hit_ratio(self) -> float:
+        """
+        :return: The proportion of the addresses looked up so far that were served
+            from memory or the store, or 0 if none were looked up.
+        """
+        hits = self.counters["memory_hits"] + self.counters["store_hits"]
+        total = hits + self.counters["misses"]
+        return hits / total if total else 0.0
+
+    def _remember(self, results: Dict[str, Optional[dict]]) -> None:
+        with self._lock:
+            for key, result in results.items():
+                self._cache[key] = result
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def _count(self, counts: Dict[str, int], metrics: Any) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                self.counters[name] += value
+        if metrics is not None:
+            for name, value in counts.items():
+                metrics.increment(f"geocode_cache_{name}", value)
+
+    def geocode_addresses(
+        self, addresses: Iterable[dict], metrics: Any = None
+    ) -> List[Optional[dict]]:
+        """
+        Geocode addresses, from the cache where possible.
+
+        :param addresses: FHIR addresses.
+        :param metrics: An optional `Metrics` to count memory hits, store hits,
+            misses, and geocoder requests in, prefixed with 'geocode_cache_'.
+        :return: The result of each address, in order, or None for addresses that
+            could not be matched or have no key.
+        """
+        addresses = list(addresses)
+        keys = [normalize_address_key(address) for address in addresses]
+        counts = dict.fromkeys(self.counters, 0)
+        results: Dict[str, Optional[dict]] = {}
+        # The first address with each key missing from memory.
+        pending: Dict[str, dict] = {}
+        with self._lock:
+            for key, address in zip(keys, addresses):
+                if key is None:
+                    continue
+                if key in results or key in pending:
+                    counts["memory_hits"] += 1
+                elif key in self._cache:
+                    self._cache.move_to_end(key)
+                    results[key] = self._cache[key]
+                    counts["memory_hits"] += 1
+                else:
+                    pending[key] = address
+
+        if pending and self.store is not None:
+            stored = self.store.get_many(list(pending))
+            self._remember(stored)
+            results.update(stored)
+            counts["store_hits"] += len(stored)
+            for key in stored:
+                del pending[key]
+
+        pending_keys = list(pending)
+        for start in range(0, len(pending_keys), self.batch_size):
+            end = start + self.batch_size
+            batch_keys = pending_keys[start:end]
+            geocoded = self.geocoder([pending[key] for key in batch_keys])
+            batch_results = dict(zip(batch_keys, geocoded))
+            counts["geocoder_requests"] += 1
+            counts["misses"] += len(batch_keys)
+            self._remember(batch_results)
+            if self.store is not None:
+                self.store.put_many(batch_results)
+            results.update(batch_results)
+
+        self._count(counts, metrics)
+        return [results.get(key) if key is not None else None for key in keys]
+
+    def geocode_bundle(
+        self, bundle: dict, update_line: bool = True, metrics: Any = None
+    ) -> dict:
+        """
+        Geocode the addresses of the patients in a FHIR bundle in place, as phdi's
+        FHIR geocoding clients' `geocode_bundle` does, from the cache where possible.
+
+        :param bundle: A FHIR bundle.
+        :param update_line: Whether to replace the street lines of addresses with
+            those of their result, see `apply_geocode_result`.
+        :param metrics: An optional `Metrics` to count cache hits and misses in.
+        :return: The bundle.
+        """
+        addresses = [
+            address
+            for entry in bundle.get("entry", [])
+            if entry.get("resource", {}).get("resourceType") == "Patient"
+            for address in entry["resource"].get("address", [])
+        ]
+        for address, result in zip(
+            addresses, self.geocode_addresses(addresses, metrics=metrics)
+        ):
+            if result:
+                apply_geocode_result(address, result, update_line=update_line)
+        return bundle
@@ -0,0 +1,87 @@
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Tuple
+from phdi_cloud_function_utils.instrumentation import Metrics
+
+# A step of a harmonization chain is called with the bundle and the context shared by
+# the steps of the chain, and returns the bundle, which it may modify in place.
+HarmonizationStep = Callable[[dict, "HarmonizationContext"], dict]
+
+
+class HarmonizationContext:
+    """
+    What the steps of a harmonization chain share besides the bundle: the options the
+    chain was run with, e.g. the URL of the FHIR server to upload to, and the results
+    of earlier steps, e.g. the responses of the FHIR server.
+    """
+
+    def __init__(self, options: Mapping[str, Any] = None):
+        """
+        :param options: The options the chain was run with.
+        """
+        self.options = dict(options or {})
+        self.results: Dict[str, Any] = {}
+
+
+class HarmonizationStepError(Exception):
+    """
+    Raised when a step of a harmonization chain fails, naming the step and holding
+    the bundle as the earlier steps left it.
+    """
+
+    def __init__(self, step: str, bundle: dict, error: Exception):
+        super().__init__(f"The {step} step failed: {error}")
+        self.step = step
+        self.bundle = bundle
+        self.error = error
+
+
+def select_harmonization_steps(
+    names: Iterable[str], steps: Mapping[str, HarmonizationStep]
+) -> List[Tuple[str, HarmonizationStep]]:
+    """
+    Look up the steps of a harmonization chain by name.
+
+    :param names: The names of the steps, in the order to run them in.
+    :param steps: The available steps by name.
+    :return: The name and function of each step. Raises a ValueError if a name is not
+        one of the available steps.
+    """
+    selected = []
+    for name in names:
+        name = name.strip()
+        if not name:
+            continue
+        if name not in steps:
+            raise ValueError(
+                f"Unknown harmonization step: {name}. Steps must be one of "
+                f"{', '.join(steps)}."
+            )
+        selected.append((name, steps[name]))
+    return selected
+
+
+def run_harmonization_chain(
+    bundle: dict,
+    steps: Iterable[Tuple[str, HarmonizationStep]],
+    context: HarmonizationContext = None,
+    metrics: Metrics = None,
+) -> dict:
+    """
+    Run each step of a harmonization chain on a single parsed bundle, in process,
+    instead of serializing the bundle and sending it to a service for each step.
+
+    :param bundle: The FHIR bundle to harmonize.
+    :param steps: The name and function of each step, in order.
+    :param context: What the steps share besides the bundle.
+    :param metrics: Optional metrics timing each step under its name.
+    :return: The bundle returned by the last step. Raises a HarmonizationStepError if
+        a step fails.
+    """
+    context = context or HarmonizationContext()
+    metrics = metrics or Metrics()
+    for name, step in steps:
+        try:
+            with metrics.timer(name):
+                bundle = step(bundle, context)
+        except Exception as error:
+            raise HarmonizationStepError(step=name, bundle=bundle, error=error)
+    return bundle
@@ -0,0 +1,216 @@
+import heapq
+import mmap
+import re
+from typing import Iterable, Iterator, Tuple, Union
+
+BATCH_SEGMENTS = ("FHS", "BHS", "BTS", "FTS")
+
+# Searching for each segment ID as a literal is much faster than a single pattern
+# matching any of them, and works on any bytes-like object.
+_BOUNDARY_SEGMENT_PATTERNS = {
+    segment_id: re.compile(segment_id)
+    for segment_id in [b"MSH"] + [segment.encode() for segment in BATCH_SEGMENTS]
+}
+_LINE_ENDING_BYTES = (ord("\r"), ord("\n"))
+_CONTROL_CHARACTER_BYTES = (0x0B, 0x1C)
+_LEADING_CHARACTERS = b" \t\r\n\x0b\x0c\x1c"
+
+BytesLike = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+
+def _iter_segment_starts(
+    data: BytesLike, segment_id: bytes
+) -> Iterator[Tuple[int, int, bytes]]:
+    """
+    Find every segment with the given ID in raw batch data. Occurrences of the ID
+    that are not at the start of a line, ignoring vertical tab and file separator
+    characters, are skipped.
+
+    :param data: The raw contents of the batch file.
+    :param segment_id: The segment ID to search for, e.g. b"MSH".
+    :return: An iterator over the offset of the start of the line containing each
+        segment, the offset of the segment itself, and the segment ID, in order.
+    """
+    for match in _BOUNDARY_SEGMENT_PATTERNS[segment_id].finditer(data):
+        position = match.start()
+        line_start = position
+        while line_start > 0 and data[line_start - 1] in _CONTROL_CHARACTER_BYTES:
+            line_start -= 1
+        if line_start == 0 or data[line_start - 1] in _LINE_ENDING_BYTES:
+            yield line_start, position, segment_id
+
+
+def iter_hl7_message_offsets(data: BytesLike) -> Iterator[Tuple[int, int]]:
+    """
+    Find the individual messages in a batch file of HL7v2 messages without decoding
+    or copying it. Each message starts at an MSH segment and ends where the next MSH,
+    FHS, BHS, BTS, or FTS segment begins, or at the end of the data. Anything before
+    the first MSH segment, or between a batch trailer and the next header, is not part
+    of any message.
+
+    :param data: The raw contents of the batch file, e.g. bytes, a memoryview, or a
+        read-only mmap of the file.
+    :return: An iterator over the `(start, end)` offsets of each message in `data`.
+    """
+    boundaries = heapq.merge(
+        *[
+            _iter_segment_starts(data, segment_id)
+            for segment_id in _BOUNDARY_SEGMENT_PATTERNS
+        ]
+    )
+    start = None
+    for line_start, position, segment_id in boundaries:
+        if start is not None:
+            yield start, line_start
+            start = None
+        if segment_id == b"MSH":
+            start = position
+
+    if start is not None:
+        yield start, len(data)
+
+
+def get_hl7_message(
+    data: BytesLike,
+    start: int,
+    end: int,
+    encoding: str = "utf-8",
+    end_of_file: bool = True,
+) -> str:
+    """
+    Build a single message from the offsets found by `iter_hl7_message_offsets`,
+    normalized the same way as messages produced by `stream_hl7_batch_messages`:
+    segments are separated by carriage returns, and blank lines as well as vertical
+    tab and file separator characters are removed.
+
+    :param data: The raw contents of the batch file.
+    :param start: The offset of the start of the message.
+    :param end: The offset of the end of the message.
+    :param encoding: The encoding used to decode the message.
+    :param end_of_file: Whether the end of `data` is the end of the file, where
+        trailing whitespace is stripped from the last message. False when `data` is
+        a range of the file, e.g. a shard, so that its last message is the same as
+        when the whole file is read.
+    :return: The message.
+    """
+    message = bytes(memoryview(data)[start:end])
+    if b"\x0b" in message or b"\x1c" in message:
+        message = message.translate(None, b"\x0b\x1c")
+    if end_of_file and end == len(data):
+        message = message.rstrip()
+
+    # Plain replacements are much faster than a regular expression here.
+    message = message.replace(b"\r\n", b"\r").replace(b"\n", b"\r")
+    while b"\r\r" in message:
+        message = message.replace(b"\r\r", b"\r")
+    return (message.rstrip(b"\r") + b"\r").decode(encoding)
+
+
+def stream_hl7_batch_messages(
+    chunks: Iterable[Union[bytes, str]], encoding: str = "utf-8"
+) -> Iterator[str]:
+    """
+    Split a batch file of HL7v2 messages, provided as an iterable of chunks, into
+    individual messages. Each message is yielded as soon as the segment that follows
+    it (or the end of the file) is found, so only the chunk being read and the message
+    in progress are held in memory.
+
+    For well-formed batch files the messages produced are identical to those returned
+    by `phdi.harmonization.hl7.convert_hl7_batch_messages_to_list`: FHS, BHS, BTS, and
+    FTS segments are dropped, vertical tab and file separator characters are removed,
+    and segments are separated by carriage returns.
+
+    :param chunks: An iterable of bytes (or str) chunks of the batch file, e.g. the
+        successive reads from a file or GCS blob.
+    :param encoding: The encoding of the batch file.
+    :return: An iterator over the individual HL7v2 messages in the batch.
+    """
+    for message, _ in stream_hl7_batch_message_offsets(chunks, encoding):
+        yield message
+
+
+def stream_hl7_batch_message_offsets(
+    chunks: Iterable[Union[bytes, str]],
+    encoding: str = "utf-8",
+    offset: int = 0,
+    end_of_file: bool = True,
+) -> Iterator[Tuple[str, int]]:
+    """
+    Split a batch file of HL7v2 messages in the same way as
+    `stream_hl7_batch_messages`, also reporting where each message ends in the file.
+    Reading can be resumed after any message by streaming the file again from its
+    end offset.
+
+    :param chunks: An iterable of bytes (or str) chunks of the batch file.
+    :param encoding: The encoding of the batch file.
+    :param offset: The offset within the file of the first chunk, when the file is not
+        read from its start.
+    :param end_of_file: Whether the chunks run to the end of the file. False when
+        they end before it, e.g. at the end of a shard, so that the last message is
+        not stripped of trailing whitespace as the last message of a file is.
+    :return: An iterator over tuples of each message and the offset in the file just
+        past its last byte.
+    """
+    buffer = b""
+    buffer_offset = offset
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode(encoding)
+        if not buffer:
+            stripped_chunk = chunk.lstrip(_LEADING_CHARACTERS)
+            buffer_offset += len(chunk) - len(stripped_chunk)
+            chunk = stripped_chunk
+        buffer += chunk
+
+        # Every message but the last is known to be complete.
+        offsets = list(iter_hl7_message_offsets(buffer))
+        for start, end in offsets[:-1]:
+            yield get_hl7_message(buffer, start, end, encoding), buffer_offset + end
+
+        # Keep only the last message, or if no message has started the last line,
+        # which may hold the start of a segment ID.
+        if offsets:
+            keep_from = offsets[-1][0]
+        else:
+            keep_from = max(buffer.rfind(b"\r"), buffer.rfind(b"\n"), 0)
+        buffer = buffer[keep_from:]
+        buffer_offset += keep_from
+
+    for start, end in iter_hl7_message_offsets(buffer):
+        message = get_hl7_message(buffer, start, end, encoding, end_of_file=end_of_file)
+        yield message, buffer_offset + end
+
+
+def stream_hl7_message_offsets(
+    chunks: Iterable[bytes], offset: int = 0
+) -> Iterator[Tuple[int, int]]:
+    """
+    Find the individual messages in a batch file of HL7v2 messages, provided as an
+    iterable of chunks, in the same way as `iter_hl7_message_offsets`, but without
+    holding the whole file in memory. Messages are not decoded, so this is a cheap
+    way to index a large file, e.g. to split it into shards at message boundaries.
+
+    :param chunks: An iterable of bytes chunks of the batch file.
+    :param offset: The offset within the file of the first chunk, when the file is not
+        read from its start.
+    :return: An iterator over the `(start, end)` offsets of each message in the file.
+    """
+    buffer = b""
+    buffer_offset = offset
+    for chunk in chunks:
+        buffer += chunk
+        offsets = list(iter_hl7_message_offsets(buffer))
+        for start, end in offsets[:-1]:
+            yield buffer_offset + start, buffer_offset + end
+
+        # Keep only the last message, which may continue in the next chunk, or if no
+        # message has started the last line, which may hold the start of a segment ID.
+        if offsets:
+            keep_from = offsets[-1][0]
+        else:
+            keep_from = max(buffer.rfind(b"\r"), buffer.rfind(b"\n"), 0)
+        buffer = buffer[keep_from:]
+        buffer_offset += keep_from
+
+    for start, end in iter_hl7_message_offsets(buffer):
+        yield buffer_offset + start, buffer_offset + end
@@ -0,0 +1,214 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, TypeVar
+
+try:
+    from opentelemetry import metrics as otel_metrics
+except ImportError:
+    otel_metrics = None
+
+T = TypeVar("T")
+
+
+class Histogram:
+    """
+    A distribution of recorded values. The count, sum, minimum, and maximum are exact,
+    while percentiles are estimated from a uniform sample of at most `max_samples`
+    values, so memory stays bounded however many values are recorded.
+    """
+
+    def __init__(self, max_samples: int = 10000, seed: int = None):
+        """
+        :param max_samples: The maximum number of values kept to estimate percentiles.
+        :param seed: A seed for the random number generator used for sampling.
+        """
+        self.max_samples = max(1, max_samples)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self._samples: List[float] = []
+        self._random = random.Random(seed)
+
+    def record(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self._samples) < self.max_samples:
+            self._samples.append(value)
+        else:
+            # Reservoir sampling keeps each value with equal probability.
+            idx = self._random.randrange(self.count)
+            if idx < self.max_samples:
+                self._samples[idx] = value
+
+    def percentile(self, percent: float) -> float:
+        """
+        :param percent: The percentile to estimate, between 0 and 100.
+        :return: The estimated percentile, using the nearest-rank method, or None if
+            nothing has been recorded.
+        """
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        rank = max(1, -(-len(samples) * percent // 100))
+        return samples[min(len(samples), int(rank)) - 1]
+
+    def summary(self) -> dict:
+        """
+        :return: A dictionary of the count, sum, mean, minimum, maximum, and 50th, 90th,
+            and 99th percentiles of the recorded values.
+        """
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+        }
+
+
+class OpenTelemetryExporter:
+    """
+    Forward counters and histograms recorded by `Metrics` to OpenTelemetry instruments
+    created from the globally configured meter provider. Requires the
+    opentelemetry-api package.
+    """
+
+    def __init__(self, meter_name: str = "phdi", attributes: Dict[str, str] = None):
+        """
+        :param meter_name: The name of the meter instruments are created from.
+        :param attributes: Attributes attached to every measurement, e.g. the name of
+            the function.
+        """
+        if otel_metrics is None:
+            raise ImportError(
+                "The opentelemetry-api package is required to export metrics to "
+                "OpenTelemetry. Install it with 'pip install opentelemetry-api'."
+            )
+        self.meter = otel_metrics.get_meter(meter_name)
+        self.attributes = attributes or {}
+        self._counters = {}
+        self._histograms = {}
+
+    def increment(self, name: str, value: float) -> None:
+        if name not in self._counters:
+            self._counters[name] = self.meter.create_counter(name)
+        self._counters[name].add(value, attributes=self.attributes)
+
+    def record(self, name: str, value: float) -> None:
+        if name not in self._histograms:
+            self._histograms[name] = self.meter.create_histogram(name)
+        self._histograms[name].record(value, attributes=self.attributes)
+
+
+class Metrics:
+    """
+    Counters, histograms, and stage timers describing a single invocation of a
+    function. Metrics are safe to record from multiple threads, and are forwarded to
+    an exporter, such as `OpenTelemetryExporter`, as they are recorded.
+
+    Stage timers measure exclusive time: when a stage is timed within another on the
+    same thread, e.g. downloading a chunk while splitting messages from a stream of
+    chunks, its time is counted towards the inner stage only. The total time of each
+    stage is reported under `stage_seconds`.
+    """
+
+    def __init__(self, exporter: OpenTelemetryExporter = None):
+        """
+        :param exporter: An optional exporter that counters and histograms are
+            forwarded to.
+        """
+        self.exporter = exporter
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.stage_seconds: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._stages = threading.local()
+
+    def increment(self, name: str, value: float = 1) -> None:
+        """
+        :param name: The name of the counter.
+        :param value: The amount to increase the counter by.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.exporter is not None:
+            self.exporter.increment(name, value)
+
+    def record(self, name: str, value: float) -> None:
+        """
+        :param name: The name of the histogram.
+        :param value: The value to record.
+        """
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].record(value)
+        if self.exporter is not None:
+            self.exporter.record(name, value)
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        """
+        Time the code within a `with` block as part of a stage.
+
+        :param stage: The name of the stage, e.g. 'download' or 'publish'.
+        """
+        stack = getattr(self._stages, "stack", None)
+        if stack is None:
+            stack = self._stages.stack = []
+        # Each frame holds the time spent in stages nested within this one.
+        frame = [0.0]
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            if stack:
+                stack[-1][0] += elapsed
+            with self._lock:
+                self.stage_seconds[stage] = (
+                    self.stage_seconds.get(stage, 0.0) + elapsed - frame[0]
+                )
+
+    def time_iterator(self, stage: str, iterable: Iterable[T]) -> Iterator[T]:
+        """
+        Time how long it takes to produce each item of an iterable as part of a
+        stage, e.g. reading the next chunk of a file or splitting the next message.
+
+        :param stage: The name of the stage.
+        :param iterable: The iterable to time.
+        :return: An iterator over the same items.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def summary(self) -> dict:
+        """
+        :return: A JSON serializable dictionary of every counter, histogram, and stage
+            time.
+        """
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": {
+                    name: histogram.summary()
+                    for name, histogram in self.histograms.items()
+                },
+                "stage_seconds": dict(self.stage_seconds),
+            }
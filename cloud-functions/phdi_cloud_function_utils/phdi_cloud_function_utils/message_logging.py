@@ -0,0 +1,163 @@
+import logging
+import os
+import time
+from typing import Any, Callable, Mapping
+
+MESSAGE_LOG_MODES = ("all", "sampled", "failures")
+DEFAULT_MESSAGE_LOG_SAMPLE_RATE = 100
+DEFAULT_MESSAGE_LOG_INTERVAL = 30.0
+
+
+class MessageLogger:
+    """
+    Log what happens to each message of a file cheaply enough to do so on the hot
+    path of publishing millions of messages.
+
+    Log lines are formatted lazily, `%`-style, so nothing is formatted unless a line
+    is actually emitted. Depending on the mode, a line is emitted for every message,
+    for one in every `sample_rate` messages, or for none of them, while failures are
+    always logged. Every `progress_interval` seconds a single line sums up the
+    messages and failures since the last one, so that progress through a file stays
+    visible however few messages are logged.
+    """
+
+    def __init__(
+        self,
+        source: str,
+        mode: str = "all",
+        sample_rate: int = DEFAULT_MESSAGE_LOG_SAMPLE_RATE,
+        progress_interval: float = 0.0,
+        logger: logging.Logger = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        :param source: What the messages are from, e.g. the name of a file, which
+            progress lines name.
+        :param mode: 'all' to log every message, 'sampled' to log the first message
+            and every `sample_rate`th after it, or 'failures' to log no messages but
+            failures. Failures are logged in every mode.
+        :param sample_rate: How many messages are logged once in 'sampled' mode.
+        :param progress_interval: The number of seconds between progress lines, or 0
+            for none.
+        :param logger: The logger to log to, by default the root logger.
+        :param clock: A monotonic clock in seconds, replaceable in tests.
+        """
+        if mode not in MESSAGE_LOG_MODES:
+            raise ValueError(
+                f"Unknown message log mode: {mode}. The mode must be one of "
+                f"{', '.join(MESSAGE_LOG_MODES)}."
+            )
+        self.source = source
+        self.mode = mode
+        self.sample_rate = max(1, sample_rate)
+        self.progress_interval = progress_interval
+        self.logger = logger or logging.getLogger()
+        self.clock = clock
+        self.message_count = 0
+        self.failure_count = 0
+        self.logged_count = 0
+        self._interval_start = clock()
+        self._interval_message_count = 0
+        self._interval_failure_count = 0
+
+    @classmethod
+    def from_environment(
+        cls,
+        source: str,
+        environ: Mapping[str, str] = os.environ,
+        logger: logging.Logger = None,
+    ) -> "MessageLogger":
+        """
+        Create a MessageLogger configured by the MESSAGE_LOG_MODE ('all' by default),
+        MESSAGE_LOG_SAMPLE_RATE, and MESSAGE_LOG_INTERVAL environment variables.
+
+        :param source: What the messages are from, e.g. the name of a file.
+        :param environ: The environment variables.
+        :param logger: The logger to log to, by default the root logger.
+        :return: A MessageLogger. Raises a ValueError if MESSAGE_LOG_MODE is unknown.
+        """
+        return cls(
+            source=source,
+            mode=environ.get("MESSAGE_LOG_MODE", "all"),
+            sample_rate=int(
+                environ.get("MESSAGE_LOG_SAMPLE_RATE", DEFAULT_MESSAGE_LOG_SAMPLE_RATE)
+            ),
+            progress_interval=float(
+                environ.get("MESSAGE_LOG_INTERVAL", DEFAULT_MESSAGE_LOG_INTERVAL)
+            ),
+            logger=logger,
+        )
+
+    def message(self, msg: str, *args: Any, level: int = logging.INFO) -> None:
+        """
+        Count a message, and log it if the mode calls for it.
+
+        :param msg: The `%`-style format of the log line.
+        :param args: The arguments of the format, which is only applied if the line is
+            emitted.
+        :param level: The level of the log line.
+        """
+        self.message_count += 1
+        self._interval_message_count += 1
+        if self.mode == "all" or (
+            self.mode == "sampled" and (self.message_count - 1) % self.sample_rate == 0
+        ):
+            self._log(level, msg, args)
+        if self.progress_interval:
+            self._maybe_log_progress()
+
+    def failure(self, msg: str, *args: Any, level: int = logging.ERROR) -> None:
+        """
+        Count a failure and log it, whatever the mode.
+
+        :param msg: The `%`-style format of the log line.
+        :param args: The arguments of the format.
+        :param level: The level of the log line.
+        """
+        self.failure_count += 1
+        self._interval_failure_count += 1
+        self._log(level, msg, args)
+        if self.progress_interval:
+            self._maybe_log_progress()
+
+    def warning(self, msg: str, *args: Any) -> None:
+        """
+        Log a warning, such as a failed attempt that will be retried, whatever the
+        mode, without counting it as a failure.
+
+        :param msg: The `%`-style format of the log line.
+        :param args: The arguments of the format.
+        """
+        self._log(logging.WARNING, msg, args)
+
+    def log_progress(self) -> None:
+        """
+        Log the messages and failures counted since the last progress line, and in
+        total.
+        """
+        now = self.clock()
+        self._log(
+            logging.INFO,
+            "%s: %d messages and %d failures in the last %.1f seconds, %d messages "
+            "and %d failures in total.",
+            (
+                self.source,
+                self._interval_message_count,
+                self._interval_failure_count,
+                now - self._interval_start,
+                self.message_count,
+                self.failure_count,
+            ),
+        )
+        self._interval_start = now
+        self._interval_message_count = 0
+        self._interval_failure_count = 0
+
+    def _maybe_log_progress(self) -> None:
+        if self.clock() - self._interval_start >= self.progress_interval:
+            self.log_progress()
+
+    def _log(self, level: int, msg: str, args: tuple) -> None:
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, msg, *args)
+            self.logged_count += 1
@@ -0,0 +1,174 @@
+import json
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+DEFAULT_FHIR_BUNDLE_SIZE = 100
+DEFAULT_MAX_OPEN_BUNDLES = 10
+
+# The fields of a resource that refer to the patient it is about, in order of
+# preference.
+PATIENT_REFERENCE_FIELDS = ("subject", "patient", "beneficiary")
+
+
+def stream_ndjson_lines(
+    chunks: Iterable[bytes], offset: int = 0
+) -> Iterator[Tuple[bytes, int, int]]:
+    """
+    Split a newline delimited file, provided as an iterable of chunks, into lines
+    without holding more than a single line and chunk in memory. Lines are split as
+    bytes, so the file must be in an encoding compatible with ASCII, such as UTF-8,
+    and not UTF-16.
+
+    :param chunks: An iterable of bytes chunks of the file.
+    :param offset: The offset within the file of the first chunk, when the file is not
+        read from its start.
+    :return: An iterator over each line that is not blank, without its line ending,
+        and the offsets of its start and of the start of the next line.
+    """
+    buffer = b""
+    buffer_offset = offset
+    for chunk in chunks:
+        buffer += chunk
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end == -1:
+                break
+            line = buffer[start:end].strip()
+            if line:
+                yield line, buffer_offset + start, buffer_offset + end + 1
+            start = end + 1
+        buffer = buffer[start:]
+        buffer_offset += start
+
+    line = buffer.strip()
+    if line:
+        yield line, buffer_offset, buffer_offset + len(buffer)
+
+
+def get_patient_reference(resource: dict) -> Optional[str]:
+    """
+    Get a reference to the patient a FHIR resource is about.
+
+    :param resource: A FHIR resource.
+    :return: A reference such as 'Patient/123', the resource's own reference if it
+        is a Patient, or None if the resource does not refer to a patient.
+    """
+    if resource.get("resourceType") == "Patient" and resource.get("id"):
+        return f"Patient/{resource['id']}"
+    for field in PATIENT_REFERENCE_FIELDS:
+        value = resource.get(field)
+        if isinstance(value, dict):
+            reference = value.get("reference")
+            if isinstance(reference, str) and reference.startswith("Patient/"):
+                return reference
+    return None
+
+
+def make_fhir_bundle(resources: List[dict]) -> dict:
+    """
+    Wrap FHIR resources in a batch Bundle that creates or updates each of them.
+
+    :param resources: The FHIR resources.
+    :return: A Bundle with an entry per resource, which updates the resource with a
+        PUT when it has an ID, so that uploading it again does not duplicate it, or
+        creates it with a POST when it does not.
+    """
+    entries = []
+    for resource in resources:
+        resource_type = resource.get("resourceType")
+        if resource.get("id"):
+            request = {"method": "PUT", "url": f"{resource_type}/{resource['id']}"}
+        else:
+            request = {"method": "POST", "url": resource_type}
+        entries.append({"resource": resource, "request": request})
+    return {"resourceType": "Bundle", "type": "batch", "entry": entries}
+
+
+def stream_fhir_bundles(
+    chunks: Iterable[bytes],
+    bundle_size: int = DEFAULT_FHIR_BUNDLE_SIZE,
+    max_open_bundles: int = DEFAULT_MAX_OPEN_BUNDLES,
+    offset: int = 0,
+    encoding: str = "utf-8",
+    invalid_line_handler: Callable[[bytes, int, Exception], None] = None,
+) -> Iterator[Tuple[dict, int]]:
+    """
+    Group the resources in a FHIR NDJSON file, such as a FHIR Bulk Data export,
+    provided as an iterable of chunks, into Bundles.
+
+    Resources about the same patient are grouped in the same Bundle where possible. A
+    Bundle is started per patient, and per resources that are not about a patient,
+    but at most `max_open_bundles` are filled at once. Once that many are open, the
+    resources of another patient are added to the fullest open Bundle, which then
+    holds several patients, so Bundles are filled up to `bundle_size` even when the
+    resources of many patients are interleaved, as in Bulk Data exports of a
+    resource type, and the Bundles left open at the end of the file are combined. At
+    most `bundle_size * max_open_bundles` resources are held in memory, however large
+    the file is.
+
+    :param chunks: An iterable of bytes chunks of the file.
+    :param bundle_size: The maximum number of resources in a Bundle.
+    :param max_open_bundles: The maximum number of Bundles filled at once.
+    :param offset: The offset within the file of the first chunk, when the file is not
+        read from its start.
+    :param encoding: The text encoding of the file.
+    :param invalid_line_handler: Called with each line that is not a FHIR resource,
+        its offset, and the error, before it is skipped.
+    :return: An iterator over each Bundle, as built by `make_fhir_bundle`, and the
+        offset in the file to resume from after it. Every resource before that offset
+        is in this or an earlier Bundle. Resources after it may also have been, when
+        Bundles are completed out of order, so resuming from it may publish them
+        again.
+    """
+    # Each open Bundle is a list of the offset of its first resource, its resources,
+    # and the patients whose resources it is filled with.
+    open_bundles = []
+    bundles_by_key = {}
+    position = offset
+
+    def resume_offset() -> int:
+        if not open_bundles:
+            return position
+        return min(bundle_start for bundle_start, _, _ in open_bundles)
+
+    def complete(bundle: list) -> List[dict]:
+        open_bundles.remove(bundle)
+        for key in bundle[2]:
+            del bundles_by_key[key]
+        return bundle[1]
+
+    for line, start, end in stream_ndjson_lines(chunks, offset=offset):
+        # Until the resource on this line is in an open Bundle, it is where to resume.
+        position = start
+        try:
+            resource = json.loads(line.decode(encoding))
+            if not isinstance(resource, dict) or "resourceType" not in resource:
+                raise ValueError("The line is not a FHIR resource.")
+        except ValueError as error:
+            if invalid_line_handler is not None:
+                invalid_line_handler(line, start, error)
+            position = end
+            continue
+
+        key = get_patient_reference(resource)
+        bundle = bundles_by_key.get(key)
+        if bundle is None:
+            if len(open_bundles) < max_open_bundles:
+                bundle = [start, [], []]
+                open_bundles.append(bundle)
+            else:
+                # Full Bundles are completed at once, so the fullest has room.
+                bundle = max(open_bundles, key=lambda open_bundle: len(open_bundle[1]))
+            bundle[2].append(key)
+            bundles_by_key[key] = bundle
+        bundle[1].append(resource)
+        position = end
+        if len(bundle[1]) >= bundle_size:
+            yield make_fhir_bundle(complete(bundle)), resume_offset()
+
+    # The Bundles left open at the end of the file are combined where they fit.
+    while open_bundles:
+        resources = complete(open_bundles[0])
+        while open_bundles and len(resources) + len(open_bundles[0][1]) <= bundle_size:
+            resources += complete(open_bundles[0])
+        yield make_fhir_bundle(resources), resume_offset()
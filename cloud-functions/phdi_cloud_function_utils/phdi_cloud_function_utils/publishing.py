@@ -0,0 +1,299 @@
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, NamedTuple, Optional
+from phdi_cloud_function_utils.instrumentation import Metrics
+from phdi_cloud_function_utils.message_logging import MessageLogger
+from phdi_cloud_function_utils.rate_limiting import RateLimiter
+from phdi_cloud_function_utils.retries import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryBudget,
+    RetryPolicy,
+)
+
+
+class _PendingMessage(NamedTuple):
+    idx: int
+    message: Any
+    data: bytes
+    attributes: Dict[str, str]
+    future: Any
+    offset: Optional[int]
+
+
+class ConcurrentPublisher:
+    """
+    Publish messages to a Pub/Sub topic while keeping many publish futures in flight
+    at once, instead of waiting on each message before publishing the next.
+
+    The number of unresolved messages, and the total size of their payloads, is
+    bounded so that memory stays flat regardless of how many messages are published.
+    When a bound is reached the oldest future is resolved before publishing continues.
+    Messages are resolved in the order they were published, so the progress handler is
+    told about them in order.
+
+    A message whose future fails is published again according to the retry policy,
+    which by default retries once immediately, while the retry budget allows. Waiting
+    out the backoff before a retry also holds back new messages, easing the load on
+    Pub/Sub. A message that is out of attempts is passed to the failure handler. While
+    the circuit breaker is open no publish requests are made at all, and every new
+    message is passed to the failure handler with a `CircuitOpenError`, so that the
+    rest of a file is diverted quickly when Pub/Sub is unavailable.
+    """
+
+    def __init__(
+        self,
+        publisher: Any,
+        topic_path: str,
+        source: str,
+        failure_handler: Callable[[int, Any, Exception], None],
+        max_in_flight_messages: int = 1000,
+        max_in_flight_bytes: int = 10 * 1024 * 1024,
+        progress_handler: Callable[[int, Optional[int]], None] = None,
+        metrics: Metrics = None,
+        rate_limiter: RateLimiter = None,
+        retry_policy: RetryPolicy = None,
+        retry_budget: RetryBudget = None,
+        circuit_breaker: CircuitBreaker = None,
+        message_logger: MessageLogger = None,
+        **attributes: str,
+    ):
+        """
+        :param publisher: A `google.cloud.pubsub_v1.PublisherClient`, or any object
+            with a compatible `publish` method returning futures.
+        :param topic_path: The full path of the topic to publish to.
+        :param source: The name of the file the messages come from, used in logs.
+        :param failure_handler: A function called with the index, original message,
+            and final error of each message that could not be published.
+        :param max_in_flight_messages: The maximum number of messages awaiting a
+            result from Pub/Sub.
+        :param max_in_flight_bytes: The maximum total size of the payloads of messages
+            awaiting a result from Pub/Sub.
+        :param progress_handler: An optional function called with the index and offset
+            of each message once it has been published, passed to the failure
+            handler, or skipped.
+        :param metrics: Optional metrics recording the latency of each publish
+            request in the publish_latency_seconds histogram, and the
+            messages_published, bytes_published, publish_retries, and
+            publish_failures counters.
+        :param rate_limiter: An optional limit on how often publish requests are made,
+            including retries, which may be shared with other publishers. Time spent
+            waiting is counted in the rate_limit_wait_seconds counter.
+        :param retry_policy: When and how often to retry failed publish requests. Time
+            spent backing off is counted in the retry_backoff_seconds counter.
+        :param retry_budget: An optional limit on retries relative to publish
+            requests, which may be shared with other publishers. Retries refused by
+            the budget are counted in the retry_budget_exhausted counter.
+        :param circuit_breaker: An optional circuit breaker, which may be shared with
+            other publishers. Messages diverted while it is open are counted in the
+            publish_diverted counter.
+        :param message_logger: How each published message and failure is logged. By
+            default every message is logged.
+        :param attributes: Attributes to attach to every published message.
+        """
+        self.publisher = publisher
+        self.topic_path = topic_path
+        self.source = source
+        self.failure_handler = failure_handler
+        self.max_in_flight_messages = max(1, max_in_flight_messages)
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.progress_handler = progress_handler
+        self.metrics = metrics
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy(
+            max_attempts=2, initial_backoff=0.0
+        )
+        self.retry_budget = retry_budget
+        self.circuit_breaker = circuit_breaker
+        self.message_logger = message_logger or MessageLogger(source=source)
+        self.attributes = attributes
+        self.success_count = 0
+        self.failure_count = 0
+        self._pending: Deque[_PendingMessage] = deque()
+        self._pending_bytes = 0
+
+    def publish(
+        self,
+        idx: int,
+        message: Any,
+        data: bytes,
+        attributes: Dict[str, str] = None,
+        offset: int = None,
+    ) -> None:
+        """
+        Publish a message without waiting for its result, first resolving the oldest
+        in-flight messages if the in-flight limits have been reached.
+
+        :param idx: The index of the message within its source file.
+        :param message: The original message, passed to the failure handler if the
+            message cannot be published.
+        :param data: The payload to publish.
+        :param attributes: Attributes to attach to this message in addition to those
+            attached to every message.
+        :param offset: The offset in the source file just past the message, passed to
+            the progress handler.
+        """
+        while self._pending and (
+            len(self._pending) >= self.max_in_flight_messages
+            or self._pending_bytes + len(data) > self.max_in_flight_bytes
+        ):
+            self._resolve_oldest()
+
+        attributes = {**self.attributes, **(attributes or {})}
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow():
+            # Keep the message in line behind those already in flight, so that it is
+            # passed to the failure handler in order.
+            future = Future()
+            future.set_exception(
+                CircuitOpenError("Publishing is paused because Pub/Sub is failing.")
+            )
+        else:
+            if self.retry_budget is not None:
+                self.retry_budget.record_request()
+            future = self._publish(data, attributes)
+        self._pending.append(
+            _PendingMessage(idx, message, data, attributes, future, offset)
+        )
+        self._pending_bytes += len(data)
+
+    def skip(self, idx: int, offset: int = None) -> None:
+        """
+        Pass over a message without publishing it, e.g. because it is a duplicate,
+        reporting its progress once the messages published before it are resolved.
+
+        :param idx: The index of the message within its source file.
+        :param offset: The offset in the source file just past the message, passed to
+            the progress handler.
+        """
+        if not self._pending:
+            self._report_progress(idx, offset)
+            return
+        # Skipped messages wait in line, counting towards the in-flight messages so
+        # that a long run of them behind a slow message does not grow without bound.
+        while len(self._pending) >= self.max_in_flight_messages:
+            self._resolve_oldest()
+        if not self._pending:
+            self._report_progress(idx, offset)
+            return
+        self._pending.append(_PendingMessage(idx, None, b"", {}, None, offset))
+
+    def flush(self) -> None:
+        """
+        Wait until every message published so far has either been published
+        successfully or passed to the failure handler.
+        """
+        while self._pending:
+            self._resolve_oldest()
+
+    def _resolve_oldest(self) -> None:
+        """
+        Wait for the result of the oldest in-flight message, retrying it on failure.
+        """
+        idx, message, data, attributes, future, offset = self._pending.popleft()
+        self._pending_bytes -= len(data)
+        if future is None:
+            # The message was skipped.
+            self._report_progress(idx, offset)
+            return
+        attempt = 1
+        while True:
+            try:
+                message_id = future.result()
+                break
+            except CircuitOpenError as error:
+                if self.metrics is not None:
+                    self.metrics.increment("publish_diverted")
+                self._fail(idx, message, offset, error)
+                return
+            except Exception as error:
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.record_failure()
+                if not self._should_retry(attempt, error):
+                    self.message_logger.failure(
+                        "Publishing message %d in %s failed after %d attempts because "
+                        "%s.",
+                        idx,
+                        self.source,
+                        attempt,
+                        error,
+                    )
+                    self._fail(idx, message, offset, error)
+                    return
+
+                delay = self.retry_policy.backoff(attempt)
+                self.message_logger.warning(
+                    "Attempt %d to publish message %d in %s failed because %s. Trying "
+                    "again in %.3f seconds...",
+                    attempt,
+                    idx,
+                    self.source,
+                    error,
+                    delay,
+                )
+                if self.metrics is not None:
+                    self.metrics.increment("publish_retries")
+                    if delay:
+                        self.metrics.increment("retry_backoff_seconds", delay)
+                if delay:
+                    time.sleep(delay)
+                attempt += 1
+                future = self._publish(data, attributes)
+
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record_success()
+        self.message_logger.message(
+            "Message %d in %s was published to %s with message ID %s.",
+            idx,
+            self.source,
+            self.topic_path,
+            message_id,
+        )
+        self.success_count += 1
+        if self.metrics is not None:
+            self.metrics.increment("messages_published")
+            self.metrics.increment("bytes_published", len(data))
+        self._report_progress(idx, offset)
+
+    def _should_retry(self, attempt: int, error: Exception) -> bool:
+        if not self.retry_policy.should_retry(attempt, error):
+            return False
+        # The budget is checked before the breaker, as a half open breaker allowing
+        # the retry expects it to be made to learn whether to close again.
+        if self.retry_budget is not None and not self.retry_budget.try_spend():
+            if self.metrics is not None:
+                self.metrics.increment("retry_budget_exhausted")
+            return False
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow():
+            if self.retry_budget is not None:
+                self.retry_budget.refund()
+            return False
+        return True
+
+    def _fail(self, idx: int, message: Any, offset: Optional[int], error: Exception):
+        self.failure_count += 1
+        if self.metrics is not None:
+            self.metrics.increment("publish_failures")
+        self.failure_handler(idx, message, error)
+        self._report_progress(idx, offset)
+
+    def _publish(self, data: bytes, attributes: Dict[str, str]) -> Any:
+        if self.rate_limiter is not None:
+            waited = self.rate_limiter.acquire()
+            if waited and self.metrics is not None:
+                self.metrics.increment("rate_limit_wait_seconds", waited)
+        future = self.publisher.publish(self.topic_path, data, **attributes)
+        if self.metrics is not None:
+            # Record the time until Pub/Sub responds rather than until the result is
+            # waited for, which may be much later.
+            start = time.perf_counter()
+            future.add_done_callback(
+                lambda _: self.metrics.record(
+                    "publish_latency_seconds", time.perf_counter() - start
+                )
+            )
+        return future
+
+    def _report_progress(self, idx: int, offset: Optional[int]) -> None:
+        if self.progress_handler is not None:
+            self.progress_handler(idx, offset)
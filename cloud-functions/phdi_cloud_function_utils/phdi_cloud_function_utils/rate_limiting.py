@@ -0,0 +1,61 @@
+import threading
+import time
+from typing import Callable
+
+
+class RateLimiter:
+    """
+    A token bucket limiting how often an operation, such as publishing a message, may
+    happen. Tokens are added at `rate` per second up to `burst`, and each operation
+    waits until it can take a token. A single limiter may be shared by many threads to
+    enforce a limit across all of them.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        """
+        :param rate: The number of operations allowed per second.
+        :param burst: The maximum number of operations allowed at once after a quiet
+            period. Defaults to one second's worth of operations.
+        :param clock: A function returning the current time in seconds.
+        :param sleep: A function waiting for a number of seconds.
+        """
+        if rate <= 0:
+            raise ValueError(f"The rate must be positive, not {rate}.")
+        self.rate = rate
+        self.burst = max(1.0, burst if burst is not None else rate)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.burst
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        Wait until the given number of tokens are available and take them.
+
+        :param tokens: The number of tokens to take, at most `burst`.
+        :return: The number of seconds spent waiting.
+        """
+        tokens = min(tokens, self.burst)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+                # Allow for rounding errors, which could otherwise leave a sliver
+                # of a token that never arrives.
+                if self._tokens >= tokens - 1e-9:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            self._sleep(delay)
+            waited += delay
@@ -0,0 +1,247 @@
+import random
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque
+
+# HTTP status codes of errors that will not go away by trying again, e.g. an invalid
+# message or missing permissions. Exceptions from google.api_core carry their status
+# code in a `code` attribute.
+NON_RETRYABLE_STATUS_CODES = (400, 401, 403, 404, 413)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of making a request while a `CircuitBreaker` is open.
+    """
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """
+    Decide whether a failed request is worth trying again.
+
+    :param error: The error raised by the request.
+    :return: False if the error is a `CircuitOpenError` or has an HTTP status code
+        that will not change on retry, and True otherwise.
+    """
+    if isinstance(error, CircuitOpenError):
+        return False
+    return getattr(error, "code", None) not in NON_RETRYABLE_STATUS_CODES
+
+
+class RetryPolicy:
+    """
+    How many times, and how long after, a failed request is tried again. Delays grow
+    exponentially from `initial_backoff` up to `max_backoff`, and with full jitter
+    each delay is drawn uniformly between zero and that bound, so that requests that
+    failed together are not all retried together.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        initial_backoff: float = 0.1,
+        max_backoff: float = 10.0,
+        multiplier: float = 2.0,
+        jitter: bool = True,
+        retryable: Callable[[Exception], bool] = is_retryable_error,
+        seed: int = None,
+    ):
+        """
+        :param max_attempts: The maximum number of attempts at each request, including
+            the first.
+        :param initial_backoff: The bound on the delay before the first retry, in
+            seconds.
+        :param max_backoff: The bound on the delay before any retry, in seconds.
+        :param multiplier: The factor the bound grows by after each retry.
+        :param jitter: Whether to draw each delay at random below its bound rather
+            than waiting for the bound itself.
+        :param retryable: A function deciding whether an error is worth retrying.
+        :param seed: A seed for the random number generator used for jitter.
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.retryable = retryable
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def should_retry(self, attempt: int, error: Exception) -> bool:
+        """
+        :param attempt: The number of attempts made so far, starting from 1.
+        :param error: The error raised by the last attempt.
+        :return: True if another attempt is allowed.
+        """
+        return attempt < self.max_attempts and self.retryable(error)
+
+    def backoff(self, attempt: int) -> float:
+        """
+        :param attempt: The number of attempts made so far, starting from 1.
+        :return: The number of seconds to wait before the next attempt.
+        """
+        bound = min(
+            self.max_backoff, self.initial_backoff * self.multiplier ** (attempt - 1)
+        )
+        if not self.jitter or bound <= 0:
+            return max(0.0, bound)
+        with self._lock:
+            return self._random.uniform(0, bound)
+
+
+class RetryBudget:
+    """
+    A limit on retries relative to requests, so that retries add at most `ratio` to
+    the load on a struggling service. Each request adds `ratio` of a token to the
+    budget, up to `max_tokens`, and each retry spends a whole token. The budget starts
+    full, so that retries are possible before many requests have been made.
+    """
+
+    def __init__(self, ratio: float = 0.1, max_tokens: float = 100.0):
+        """
+        :param ratio: The number of retries allowed per request in the long run.
+        :param max_tokens: The most retries that can be saved up.
+        """
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def record_request(self) -> None:
+        """
+        Add to the budget for a request made for the first time.
+        """
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        """
+        :return: True if a retry is allowed, in which case it is taken from the
+            budget.
+        """
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def refund(self) -> None:
+        """
+        Return the token taken by `try_spend` for a retry that was not made.
+        """
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + 1)
+
+
+class CircuitBreaker:
+    """
+    Stop making requests to a service that is failing, instead of adding to its load
+    and waiting on each request to fail.
+
+    The breaker is closed while requests succeed. Once at least `min_requests` of the
+    last `window` results are known and `failure_threshold` of them are failures, the
+    breaker opens and `allow` refuses requests. After `reset_timeout` seconds it is
+    half open, and allows a single trial request: the breaker closes again if the
+    trial succeeds and reopens if it fails. A breaker may be shared by many publishers
+    and threads, e.g. every invocation handled by a function instance.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: float = 0.5,
+        min_requests: int = 20,
+        window: int = 100,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        :param failure_threshold: The fraction of recent requests that must fail for
+            the breaker to open.
+        :param min_requests: The number of recent results needed before the breaker
+            can open.
+        :param window: The number of recent results considered.
+        :param reset_timeout: The number of seconds the breaker stays open before
+            allowing a trial request.
+        :param clock: A function returning the current time in seconds.
+        """
+        self.failure_threshold = failure_threshold
+        self.min_requests = max(1, min_requests)
+        self.reset_timeout = reset_timeout
+        self.open_count = 0
+        self._clock = clock
+        self._results: Deque[bool] = deque(maxlen=max(self.min_requests, window))
+        self._failures = 0
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if (
+            self._state == self.OPEN
+            and self._clock() - self._opened_at >= self.reset_timeout
+        ):
+            self._state = self.HALF_OPEN
+            self._trial_in_flight = False
+        return self._state
+
+    def allow(self) -> bool:
+        """
+        :return: True if a request may be made now.
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            state = self._current_state()
+            if state == self.HALF_OPEN:
+                self._close()
+            elif state == self.CLOSED:
+                self._record(False)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            state = self._current_state()
+            if state == self.HALF_OPEN:
+                self._open()
+            elif state == self.CLOSED:
+                self._record(True)
+                count = len(self._results)
+                if (
+                    count >= self.min_requests
+                    and self._failures >= self.failure_threshold * count
+                ):
+                    self._open()
+
+    def _record(self, failed: bool) -> None:
+        if len(self._results) == self._results.maxlen:
+            self._failures -= self._results[0]
+        self._results.append(failed)
+        self._failures += failed
+
+    def _open(self) -> None:
+        self._state = self.OPEN
+        self._opened_at = self._clock()
+        self.open_count += 1
+
+    def _close(self) -> None:
+        self._state = self.CLOSED
+        self._results.clear()
+        self._failures = 0
@@ -0,0 +1,215 @@
+import json
+from typing import Any, Iterable, Iterator, NamedTuple, Optional, Set, Tuple
+
+DEFAULT_SHARD_BYTES = 64 * 1024 * 1024
+SHARD_TASK_CONTENT_TYPE = "application/json"
+
+
+class ShardRange(NamedTuple):
+    """
+    A run of whole messages in a batch file.
+
+    :param start: The offset of the start of the first message.
+    :param end: The offset just past the end of the last message.
+    :param first_message_idx: The index of the first message within the file.
+    :param message_count: The number of messages in the range.
+    """
+
+    start: int
+    end: int
+    first_message_idx: int
+    message_count: int
+
+
+class ShardTask(NamedTuple):
+    """
+    The instruction to read and publish a single shard of a batch file, published by
+    the coordinator of the file to the workers reading its shards.
+    """
+
+    bucket_name: str
+    filename: str
+    generation: Optional[int]
+    shard_idx: int
+    shard_count: int
+    start: int
+    end: int
+    first_message_idx: int
+    message_count: int
+    root_template: str
+    encoding: str = "utf-8"
+
+
+def plan_shards(
+    message_offsets: Iterable[Tuple[int, int]], shard_bytes: int = DEFAULT_SHARD_BYTES
+) -> Iterator[ShardRange]:
+    """
+    Group the messages of a batch file into shards of roughly equal size, each of
+    which starts and ends at a message boundary.
+
+    :param message_offsets: The `(start, end)` offsets of each message in the file, in
+        order, e.g. from `stream_hl7_message_offsets`.
+    :param shard_bytes: The size a shard is filled up to. A shard holds at least one
+        message, so a single message larger than this makes a shard of its own.
+    :return: An iterator over the range of each shard, in order.
+    """
+    shard = None
+    for idx, (start, end) in enumerate(message_offsets):
+        if shard is None:
+            shard = ShardRange(start, end, idx, 1)
+        else:
+            shard = shard._replace(end=end, message_count=shard.message_count + 1)
+        if shard.end - shard.start >= shard_bytes:
+            yield shard
+            shard = None
+    if shard is not None:
+        yield shard
+
+
+def encode_shard_task(task: ShardTask) -> bytes:
+    """
+    :param task: A shard task.
+    :return: The task as the data of a Pub/Sub message.
+    """
+    return json.dumps(task._asdict()).encode("utf-8")
+
+
+def decode_shard_task(data: bytes) -> ShardTask:
+    """
+    :param data: The data of a Pub/Sub message built by `encode_shard_task`.
+    :return: The shard task.
+    """
+    return ShardTask(**json.loads(data))
+
+
+class ShardTracker:
+    """
+    Track the shards of each file that have been read, so that the results of every
+    shard can be reported together once the last one completes.
+
+    State is kept in GCS under `prefix`, so that it is shared by the invocations
+    reading each shard: the coordinator writes the plan of a file and records each
+    task it published, each worker writes the result of its shard, and the worker
+    that finds every shard complete writes a summary. The summary is only written if
+    it does not exist yet, so it is reported exactly once even when the last shards
+    complete at the same time.
+    """
+
+    def __init__(self, storage_client: Any, bucket_name: str, prefix: str = "shards/"):
+        """
+        :param storage_client: A `google.cloud.storage.Client`, or an object with the
+            same interface such as
+            `phdi_cloud_function_utils_testing.fakes.FakeStorageClient`.
+        :param bucket_name: The bucket to keep state in.
+        :param prefix: The prefix of the names of state objects.
+        """
+        self.bucket = storage_client.bucket(bucket_name)
+        self.prefix = prefix
+
+    def _name(self, key: str, name: str) -> str:
+        return f"{self.prefix}{key}/{name}.json"
+
+    def _write(self, name: str, value: dict, if_generation_match: int = None) -> None:
+        self.bucket.blob(name).upload_from_string(
+            json.dumps(value),
+            content_type=SHARD_TASK_CONTENT_TYPE,
+            if_generation_match=if_generation_match,
+        )
+
+    def _read(self, name: str) -> Optional[dict]:
+        blob = self.bucket.blob(name)
+        if not blob.exists():
+            return None
+        return json.loads(blob.download_as_bytes())
+
+    def start(self, key: str, shard_count: int, message_count: int) -> None:
+        """
+        Record the plan of a file that is about to be read in shards.
+
+        :param key: The key of the file, as built by `make_checkpoint_key`.
+        :param shard_count: The number of shards.
+        :param message_count: The number of messages in the file.
+        """
+        self._write(
+            self._name(key, "plan"),
+            {"shard_count": shard_count, "message_count": message_count},
+        )
+
+    def record_task(self, key: str, shard_idx: int) -> None:
+        """
+        Record that the task of a shard was published, so that a coordinator handling
+        the same file again, e.g. after its event was redelivered, does not publish
+        it again.
+
+        :param key: The key of the file.
+        :param shard_idx: The index of the shard.
+        """
+        try:
+            self._write(
+                self._name(key, f"task-{shard_idx:06d}"),
+                {"shard_idx": shard_idx},
+                if_generation_match=0,
+            )
+        except Exception as error:
+            # Another coordinator published the task at the same time.
+            if getattr(error, "code", None) != 412:
+                raise
+
+    def get_published_tasks(self, key: str) -> Set[int]:
+        """
+        :param key: The key of the file.
+        :return: The indexes of the shards whose tasks were recorded by `record_task`.
+        """
+        blobs = self.bucket.list_blobs(prefix=f"{self.prefix}{key}/task-")
+        return {int(blob.name.rsplit("-", 1)[1].split(".")[0]) for blob in blobs}
+
+    def get_plan(self, key: str) -> Optional[dict]:
+        """
+        :param key: The key of the file.
+        :return: The plan recorded by `start`, or None if there is none.
+        """
+        return self._read(self._name(key, "plan"))
+
+    def get_summary(self, key: str) -> Optional[dict]:
+        """
+        :param key: The key of the file.
+        :return: The summary written once every shard completed, or None if some
+            shards have not completed.
+        """
+        return self._read(self._name(key, "summary"))
+
+    def complete_shard(self, key: str, shard_idx: int, result: dict) -> Optional[dict]:
+        """
+        Record the result of a shard. A shard read again, e.g. after a timeout,
+        replaces its earlier result.
+
+        :param key: The key of the file.
+        :param shard_idx: The index of the shard.
+        :param result: A JSON serializable dictionary of counts, e.g. the number of
+            messages published, which are summed across shards.
+        :return: The summary of the file if this completed its last shard, or None.
+        """
+        self._write(self._name(key, f"shard-{shard_idx:06d}"), result)
+        plan = self.get_plan(key)
+        if plan is None:
+            return None
+        results = [
+            json.loads(blob.download_as_bytes())
+            for blob in self.bucket.list_blobs(prefix=f"{self.prefix}{key}/shard-")
+        ]
+        if len(results) < plan["shard_count"]:
+            return None
+
+        summary = dict(plan)
+        for shard_result in results:
+            for name, value in shard_result.items():
+                summary[name] = summary.get(name, 0) + value
+        try:
+            self._write(self._name(key, "summary"), summary, if_generation_match=0)
+        except Exception as error:
+            # Another worker completed the last shard at the same time and reported
+            # the summary.
+            if getattr(error, "code", None) == 412:
+                return None
+            raise
+        return summary
@@ -0,0 +1,198 @@
+import codecs
+import re
+import struct
+import zlib
+from typing import Any, NamedTuple, Optional, Tuple
+
+from phdi_cloud_function_utils.compression import GZIP, IDENTITY, ZSTD
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_DECOMPRESSION_ERRORS = (zlib.error, struct.error) + (
+    (zstandard.ZstdError,) if zstandard is not None else ()
+)
+
+DEFAULT_SNIFF_BYTES = 4096
+
+HL7V2_FORMAT = "hl7v2"
+CCDA_FORMAT = "ccda"
+FHIR_FORMAT = "fhir"
+SNIFFED_FORMATS = (HL7V2_FORMAT, CCDA_FORMAT, FHIR_FORMAT)
+
+ZIP = "zip"
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_ZIP_MAGIC = b"PK\x03\x04"
+_ZIP_LOCAL_HEADER = struct.Struct("<4s5H3I2H")
+_ZIP_DEFLATED = 8
+_ZIP_STORED = 0
+
+_BYTE_ORDER_MARKS = (
+    (b"\xef\xbb\xbf", "utf-8-sig"),
+    (b"\xff\xfe", "utf-16"),
+    (b"\xfe\xff", "utf-16"),
+)
+_LEADING_CHARACTERS = " \t\r\n\x0b\x0c\x1c\ufeff"
+_HL7V2_HEADER_SEGMENTS = ("MSH", "FHS", "BHS")
+_MSH_PATTERN = re.compile(r"(?:^|[\r\n\x0b])(MSH.[^\r\n]*)")
+_RESOURCE_TYPE_PATTERN = re.compile(r'"resourceType"\s*:\s*"([A-Za-z]+)"')
+
+
+class SniffResult(NamedTuple):
+    """
+    What the first bytes of a file reveal about its contents.
+
+    - format: 'hl7v2', 'ccda', or 'fhir', or None if the contents are not recognized.
+    - encoding: The text encoding of the contents, e.g. 'utf-8', 'utf-8-sig' or
+        'utf-16' when they start with a byte order mark, 'utf-16-le' or 'utf-16-be'
+        when they do not, or 'latin-1' when they are not valid UTF-8. Decoding with
+        this encoding drops any byte order mark.
+    - compression: 'identity', 'gzip', 'zstd', or 'zip'. The format and encoding of a
+        compressed file describe its decompressed contents, as far as they can be
+        determined from its first bytes.
+    - root_template: The root template named by the contents, i.e. MSH-9 of the first
+        HL7v2 message, 'CCD' for a CCDA document, or the resourceType of a FHIR
+        resource, or None if it is not known.
+    """
+
+    format: Optional[str]
+    encoding: Optional[str]
+    compression: str = IDENTITY
+    root_template: Optional[str] = None
+
+
+def _detect_encoding(head: bytes) -> str:
+    for byte_order_mark, encoding in _BYTE_ORDER_MARKS:
+        if head.startswith(byte_order_mark):
+            return encoding
+
+    # UTF-16 text without a byte order mark has a NUL byte beside every ASCII
+    # character.
+    if head[1::2].count(0) > len(head) // 4:
+        return "utf-16-le"
+    if head[0::2].count(0) > len(head) // 4:
+        return "utf-16-be"
+
+    # The head may end part way through a multi-byte character, which an incremental
+    # decoder holds back rather than rejecting.
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+    except UnicodeDecodeError:
+        return "latin-1"
+    return "utf-8"
+
+
+def get_hl7_root_template(msh_segment: str) -> Optional[str]:
+    """
+    Get the root template named by the message type field, MSH-9, of an HL7v2
+    message, e.g. 'VXU_V04' for 'VXU^V04^VXU_V04' or 'ORU_R01' for 'ORU^R01'.
+
+    :param msh_segment: The MSH segment of the message.
+    :return: The message structure in MSH-9.3 if it is given, or else the message code
+        and trigger event in MSH-9.1 and MSH-9.2 joined by an underscore, or None if
+        MSH-9 is empty.
+    """
+    if len(msh_segment) < 8:
+        return None
+    field_separator = msh_segment[3]
+    component_separator = msh_segment[4]
+    fields = msh_segment.split(field_separator)
+    # MSH-1 is the field separator itself, so MSH-n is at index n - 1.
+    if len(fields) < 9:
+        return None
+    components = fields[8].split(component_separator)
+    if len(components) > 2 and components[2]:
+        return components[2]
+    if len(components) > 1 and components[0] and components[1]:
+        return f"{components[0]}_{components[1]}"
+    return components[0] or None
+
+
+def _sniff_text(text: str) -> Tuple[Optional[str], Optional[str]]:
+    stripped = text.lstrip(_LEADING_CHARACTERS)
+    if stripped[:3] in _HL7V2_HEADER_SEGMENTS:
+        match = _MSH_PATTERN.search(stripped)
+        root_template = get_hl7_root_template(match.group(1)) if match else None
+        return HL7V2_FORMAT, root_template
+    if stripped.startswith("<"):
+        if "<ClinicalDocument" in stripped:
+            return CCDA_FORMAT, "CCD"
+        return None, None
+    if stripped.startswith("{") or stripped.startswith("["):
+        match = _RESOURCE_TYPE_PATTERN.search(stripped)
+        if match:
+            return FHIR_FORMAT, match.group(1)
+    return None, None
+
+
+def _decompress_head(head: bytes, compression: str) -> bytes:
+    """
+    Decompress as much as possible of the first bytes of a compressed file.
+    """
+    try:
+        if compression == GZIP:
+            return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head)
+        if compression == ZSTD and zstandard is not None:
+            return zstandard.ZstdDecompressor().decompressobj().decompress(head)
+        if compression == ZIP and len(head) >= _ZIP_LOCAL_HEADER.size:
+            # Only the first member of an archive is sniffed.
+            fields = _ZIP_LOCAL_HEADER.unpack_from(head)
+            method, name_length, extra_length = fields[3], fields[9], fields[10]
+            start = _ZIP_LOCAL_HEADER.size + name_length + extra_length
+            data = head[start:]
+            if method == _ZIP_STORED:
+                return data
+            if method == _ZIP_DEFLATED:
+                return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+    except _DECOMPRESSION_ERRORS:
+        pass
+    return b""
+
+
+def sniff_content(head: bytes) -> SniffResult:
+    """
+    Identify the format, encoding, compression, and root template of a file from its
+    first bytes, without reading the rest of it.
+
+    :param head: The first bytes of the file, e.g. the first 4 KiB.
+    :return: A SniffResult. Its format is None if the file is empty or is not an HL7v2
+        message or batch, a CCDA document, or FHIR JSON.
+    """
+    compression = IDENTITY
+    if head.startswith(_GZIP_MAGIC):
+        compression = GZIP
+    elif head.startswith(_ZSTD_MAGIC):
+        compression = ZSTD
+    elif head.startswith(_ZIP_MAGIC):
+        compression = ZIP
+    if compression != IDENTITY:
+        head = _decompress_head(head, compression)
+
+    if not head:
+        return SniffResult(format=None, encoding=None, compression=compression)
+    encoding = _detect_encoding(head)
+    content_format, root_template = _sniff_text(head.decode(encoding, errors="ignore"))
+    return SniffResult(
+        format=content_format,
+        encoding=encoding,
+        compression=compression,
+        root_template=root_template,
+    )
+
+
+def sniff_blob(blob: Any, size: int = DEFAULT_SNIFF_BYTES) -> SniffResult:
+    """
+    Identify the contents of a file in GCS by reading only its first bytes with a
+    single ranged request.
+
+    :param blob: The file, as a `google.cloud.storage.Blob` or an object with the same
+        interface such as `phdi_cloud_function_utils_testing.fakes.FakeBlob`.
+    :param size: The number of bytes to read.
+    :return: A SniffResult, as returned by `sniff_content`.
+    """
+    # The end of the range is inclusive.
+    return sniff_content(blob.download_as_bytes(start=0, end=size - 1))
@@ -0,0 +1,298 @@
+import json
+from json.decoder import WHITESPACE, scanstring
+from typing import Any, Callable, NamedTuple, Optional, Tuple
+
+# Gen 1 HTTP Cloud Functions reject requests larger than 10 MB.
+DEFAULT_MAX_REQUEST_BYTES = 10 * 1024 * 1024
+
+# The number of bytes at the start of a body decoded to look for its resourceType
+# before decoding the whole body.
+DEFAULT_PEEK_BYTES = 64 * 1024
+
+# The name of the attribute the RequestBody of a request is cached in.
+REQUEST_BODY_ATTRIBUTE = "_phdi_request_body"
+
+_decoder = json.JSONDecoder()
+
+
+class RequestValidationError(Exception):
+    """
+    Raised by the steps of a request validation pipeline when a request is invalid,
+    with the message and HTTP status code to respond with.
+    """
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class BodySummary(NamedTuple):
+    """
+    What a JSON request body holds, read without parsing it in full.
+
+    :param resource_type: The top-level resourceType, or None if there is none.
+    :param entry_count: The number of items of the top-level entry array, or None if
+        entries were not counted or there is no entry array.
+    """
+
+    resource_type: Optional[str]
+    entry_count: Optional[int] = None
+
+
+def _skip_whitespace(text: str, idx: int) -> int:
+    return WHITESPACE.match(text, idx).end()
+
+
+def _expect(text: str, idx: int, character: str) -> int:
+    if not text.startswith(character, idx):
+        raise json.JSONDecodeError(f"Expecting '{character}'", text, idx)
+    return idx + 1
+
+
+def _count_array_items(text: str, idx: int) -> Tuple[int, int]:
+    # Items are decoded and discarded one at a time, so only one is held in memory.
+    idx = _skip_whitespace(text, _expect(text, idx, "["))
+    if text.startswith("]", idx):
+        return 0, idx + 1
+    count = 0
+    while True:
+        _, idx = _decoder.raw_decode(text, idx)
+        count += 1
+        idx = _skip_whitespace(text, idx)
+        if text.startswith("]", idx):
+            return count, idx + 1
+        idx = _skip_whitespace(text, _expect(text, idx, ","))
+
+
+def _summarize_json_object(text: str, count_entries: bool) -> BodySummary:
+    resource_type = None
+    entry_count = None
+    idx = _skip_whitespace(text, 0)
+    idx = _skip_whitespace(text, _expect(text, idx, "{"))
+    if text.startswith("}", idx):
+        return BodySummary(None, None)
+    while True:
+        key, idx = scanstring(text, _expect(text, idx, '"'))
+        idx = _skip_whitespace(text, idx)
+        idx = _skip_whitespace(text, _expect(text, idx, ":"))
+        if key == "entry" and count_entries and text.startswith("[", idx):
+            entry_count, idx = _count_array_items(text, idx)
+        else:
+            value, idx = _decoder.raw_decode(text, idx)
+            if key == "resourceType" and isinstance(value, str):
+                resource_type = value
+        if resource_type is not None and (not count_entries or entry_count is not None):
+            return BodySummary(resource_type, entry_count)
+        idx = _skip_whitespace(text, idx)
+        if text.startswith("}", idx):
+            return BodySummary(resource_type, entry_count)
+        idx = _skip_whitespace(text, _expect(text, idx, ","))
+
+
+def summarize_json_resource(
+    data: bytes, count_entries: bool = True, peek_bytes: int = DEFAULT_PEEK_BYTES
+) -> BodySummary:
+    """
+    Read the resourceType of a JSON FHIR resource, and the number of entries if it is
+    a bundle, without building the whole resource in memory. The members of the
+    top-level object are read in order, and reading stops as soon as what was asked
+    for is found, so when resourceType comes first, as FHIR serializers put it, only
+    the start of the body is decoded. Entries are parsed one at a time and discarded.
+
+    Only the top-level object is checked to be well formed, up to where reading
+    stopped, so a body that is summarized may still fail to parse in full.
+
+    :param data: The body, encoded in UTF-8.
+    :param count_entries: Whether to count the items of the top-level entry array.
+    :param peek_bytes: The number of bytes at the start of the body to look for the
+        resourceType in before decoding the whole body, when entries are not counted.
+    :return: A BodySummary. Raises a ValueError if the body is not a JSON object.
+    """
+    if not count_entries and len(data) > peek_bytes:
+        try:
+            # A multi-byte character cut at the end of the peek is dropped.
+            text = data[:peek_bytes].decode("utf-8", errors="ignore")
+            return _summarize_json_object(text, count_entries=False)
+        except ValueError:
+            # The peek ended before the resourceType, so decode the whole body.
+            pass
+    return _summarize_json_object(data.decode("utf-8"), count_entries=count_entries)
+
+
+class RequestBody:
+    """
+    The body of a flask.Request, read, parsed, and summarized at most once however
+    many validation steps and handlers look at it. Use `get_request_body` to get the
+    RequestBody cached on a request.
+    """
+
+    def __init__(self, request: Any, max_bytes: int = DEFAULT_MAX_REQUEST_BYTES):
+        """
+        :param request: A flask.Request.
+        :param max_bytes: The maximum size of the body. Larger bodies are rejected
+            with a 413 before they are parsed.
+        """
+        self.request = request
+        self.max_bytes = max_bytes
+        self._data: Optional[bytes] = None
+        self._json: Any = None
+        self._parsed = False
+        self._summary: Optional[BodySummary] = None
+        self._entries_counted = False
+
+    def _too_large(self, size: int) -> RequestValidationError:
+        return RequestValidationError(
+            f"Request body too large - {size} bytes is over the limit of "
+            f"{self.max_bytes} bytes.",
+            status_code=413,
+        )
+
+    @property
+    def data(self) -> bytes:
+        """
+        :return: The raw body. Raises a RequestValidationError if it is larger than
+            `max_bytes`, checking the Content-Length header before reading it.
+        """
+        if self._data is None:
+            content_length = self.request.content_length
+            if content_length is not None and content_length > self.max_bytes:
+                raise self._too_large(content_length)
+            data = self.request.get_data(cache=True)
+            if len(data) > self.max_bytes:
+                raise self._too_large(len(data))
+            self._data = data
+        return self._data
+
+    def json(self) -> Any:
+        """
+        :return: The parsed body. Raises a RequestValidationError if it is not JSON.
+        """
+        if not self._parsed:
+            try:
+                self._json = json.loads(self.data)
+            except ValueError:
+                raise RequestValidationError("Invalid request body - Invalid JSON")
+            self._parsed = True
+        return self._json
+
+    def summary(self, count_entries: bool = False) -> BodySummary:
+        """
+        :param count_entries: Whether the number of entries is needed.
+        :return: The resourceType and, if asked for, the number of entries of the
+            body, taken from the parsed body if it has been parsed, and read with
+            `summarize_json_resource` otherwise. Raises a RequestValidationError if
+            the body is not a JSON object.
+        """
+        if self._parsed:
+            if not isinstance(self._json, dict):
+                raise RequestValidationError(
+                    "Invalid request body - The body must be a JSON object."
+                )
+            entries = self._json.get("entry")
+            resource_type = self._json.get("resourceType")
+            return BodySummary(
+                resource_type if isinstance(resource_type, str) else None,
+                len(entries) if isinstance(entries, list) else None,
+            )
+        if self._summary is None or (count_entries and not self._entries_counted):
+            try:
+                self._summary = summarize_json_resource(
+                    self.data, count_entries=count_entries
+                )
+            except ValueError:
+                raise RequestValidationError("Invalid request body - Invalid JSON")
+            self._entries_counted = count_entries
+        return self._summary
+
+
+def get_request_body(
+    request: Any, max_bytes: int = DEFAULT_MAX_REQUEST_BYTES
+) -> RequestBody:
+    """
+    Get the RequestBody of a request, creating it and caching it on the request the
+    first time, so that the body is read and parsed once per request.
+
+    :param request: A flask.Request.
+    :param max_bytes: The maximum size of the body, if the RequestBody is created.
+    :return: The RequestBody of the request.
+    """
+    request_body = getattr(request, REQUEST_BODY_ATTRIBUTE, None)
+    if not isinstance(request_body, RequestBody):
+        request_body = RequestBody(request, max_bytes=max_bytes)
+        setattr(request, REQUEST_BODY_ATTRIBUTE, request_body)
+    return request_body
+
+
+# A step of a validation pipeline is called with the RequestBody of the request, and
+# raises a RequestValidationError if the request is invalid.
+ValidationStep = Callable[[RequestBody], None]
+
+
+def require_content_type(content_type: str) -> ValidationStep:
+    """
+    :param content_type: The Content-Type the request must have, e.g.
+        'application/json'.
+    :return: A step rejecting requests with another Content-Type.
+    """
+
+    def validate(request_body: RequestBody) -> None:
+        if request_body.request.headers.get("Content-Type") != content_type:
+            raise RequestValidationError(
+                f"Header must include: 'Content-Type:{content_type}'."
+            )
+
+    return validate
+
+
+def require_json_object(request_body: RequestBody) -> None:
+    """
+    A step parsing the body, rejecting bodies that are not a JSON object.
+    """
+    if not isinstance(request_body.json(), dict):
+        raise RequestValidationError(
+            "Invalid request body - The body must be a JSON object."
+        )
+
+
+def require_resource_type(*resource_types: str) -> ValidationStep:
+    """
+    :param resource_types: The resource types the body may have. If none are given,
+        any resource type is accepted.
+    :return: A step rejecting bodies without a resourceType, or with another one,
+        reading the resourceType without parsing the body in full.
+    """
+
+    def validate(request_body: RequestBody) -> None:
+        resource_type = request_body.summary().resource_type
+        if resource_type is None:
+            raise RequestValidationError(
+                "FHIR Resource Type not specified. The request body must contain a "
+                "valid FHIR bundle or resource."
+            )
+        if resource_types and resource_type not in resource_types:
+            raise RequestValidationError(
+                f"Unexpected FHIR Resource Type: {resource_type}. The resource type "
+                f"must be one of {', '.join(resource_types)}."
+            )
+
+    return validate
+
+
+def require_max_entries(max_entries: int) -> ValidationStep:
+    """
+    :param max_entries: The maximum number of entries of a bundle body.
+    :return: A step rejecting bodies with more entries with a 413, counting the
+        entries without parsing the body in full.
+    """
+
+    def validate(request_body: RequestBody) -> None:
+        entry_count = request_body.summary(count_entries=True).entry_count or 0
+        if entry_count > max_entries:
+            raise RequestValidationError(
+                f"Request body too large - {entry_count} entries is over the limit of "
+                f"{max_entries} entries.",
+                status_code=413,
+            )
+
+    return validate
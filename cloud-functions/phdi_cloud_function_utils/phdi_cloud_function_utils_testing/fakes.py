@@ -0,0 +1,492 @@
+import io
+import itertools
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Tuple, Union
+
+try:
+    from google.api_core.exceptions import NotFound, PreconditionFailed
+except ImportError:
+
+    class NotFound(Exception):
+        code = 404
+
+    class PreconditionFailed(Exception):
+        code = 412
+
+
+class FakePublisherClient:
+    """
+    An in-memory stand-in for `google.cloud.pubsub_v1.PublisherClient` for use in
+    tests and benchmarks. Publishing returns a future that is resolved `latency`
+    seconds later by a background thread, simulating the round trip to Pub/Sub, and
+    fails with probability `failure_rate`.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        failure_rate: float = 0.0,
+        seed: int = None,
+        keep_messages: bool = True,
+        failure_exception: Exception = None,
+    ):
+        """
+        :param latency: The number of seconds between publishing a message and its
+            future being resolved.
+        :param failure_rate: The probability that publishing a message fails. It may
+            be changed while publishing, e.g. to simulate an outage.
+        :param seed: A seed for the random number generator deciding failures.
+        :param keep_messages: Whether to keep published messages in `published`. When
+            False only `published_count` is updated, so memory stays flat in long
+            benchmarks.
+        :param failure_exception: The exception failed futures are resolved with, e.g.
+            a `google.api_core.exceptions.ResourceExhausted` to simulate exceeding a
+            quota.
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.keep_messages = keep_messages
+        self.published: List[Tuple[str, bytes, dict]] = []
+        self.published_count = 0
+        self.attempt_count = 0
+        self.failure_exception = failure_exception or Exception("Fake publish failure.")
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+
+    def topic_path(self, project: str, topic: str) -> str:
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic: str, data: bytes, **attributes: str) -> Future:
+        """
+        Record a message and return a future for its message ID.
+
+        :param topic: The full path of the topic to publish to.
+        :param data: The message payload.
+        :param attributes: The message attributes.
+        :return: A future resolved with the message ID, or with an exception if the
+            publish fails.
+        """
+        future = Future()
+        with self._lock:
+            self.attempt_count += 1
+            failed = self._random.random() < self.failure_rate
+            if not failed:
+                self.published_count += 1
+                if self.keep_messages:
+                    self.published.append((topic, data, attributes))
+            message_id = str(self.published_count)
+
+        if self.latency <= 0:
+            self._resolve(future, message_id, failed, self.failure_exception)
+        else:
+            self._start_worker()
+            self._queue.put(
+                (
+                    time.monotonic() + self.latency,
+                    future,
+                    message_id,
+                    failed,
+                    self.failure_exception,
+                )
+            )
+        return future
+
+    def _start_worker(self) -> None:
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+
+    def _run(self) -> None:
+        # Messages are queued in the order they are due, so each one can be resolved
+        # after sleeping until its due time.
+        while True:
+            due, future, message_id, failed, exception = self._queue.get()
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._resolve(future, message_id, failed, exception)
+
+    @staticmethod
+    def _resolve(
+        future: Future, message_id: str, failed: bool, exception: Exception
+    ) -> None:
+        if failed:
+            future.set_exception(exception)
+        else:
+            future.set_result(message_id)
+
+
+class FakeReceivedMessage(NamedTuple):
+    ack_id: str
+    message: SimpleNamespace
+    delivery_attempt: int
+
+
+class FakeSubscriberClient:
+    """
+    An in-memory stand-in for `google.cloud.pubsub_v1.SubscriberClient` for use in
+    tests and benchmarks, supporting synchronous pulls. Messages are added with
+    `publish`, and are delivered again by a later pull unless they are acknowledged
+    before the ack deadline passes or their ack deadline is modified to 0.
+    """
+
+    def __init__(self, ack_deadline: float = 600.0):
+        """
+        :param ack_deadline: The number of seconds a pulled message is held before it
+            is delivered again.
+        """
+        self.ack_deadline = ack_deadline
+        self.acknowledged: List[str] = []
+        self.pull_count = 0
+        # Maps message IDs to (data, attributes, delivery attempt, due) tuples, where
+        # due is the monotonic time at which the message may be delivered.
+        self._messages: Dict[str, Tuple[bytes, dict, int, float]] = {}
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def subscription_path(self, project: str, subscription: str) -> str:
+        return f"projects/{project}/subscriptions/{subscription}"
+
+    def publish(self, data: bytes, **attributes: str) -> str:
+        """
+        Add a message to the subscription.
+
+        :param data: The message payload.
+        :param attributes: The message attributes.
+        :return: The message ID.
+        """
+        with self._lock:
+            message_id = str(next(self._message_ids))
+            self._messages[message_id] = (data, attributes, 0, 0.0)
+        return message_id
+
+    def pull(
+        self,
+        request: dict = None,
+        subscription: str = None,
+        max_messages: int = None,
+        **kwargs,
+    ) -> SimpleNamespace:
+        request = request or {
+            "subscription": subscription,
+            "max_messages": max_messages,
+        }
+        received = []
+        now = time.monotonic()
+        with self._lock:
+            self.pull_count += 1
+            for message_id, (data, attributes, attempt, due) in self._messages.items():
+                if len(received) >= (request.get("max_messages") or 1):
+                    break
+                if due > now:
+                    continue
+                attempt += 1
+                self._messages[message_id] = (
+                    data,
+                    attributes,
+                    attempt,
+                    now + self.ack_deadline,
+                )
+                message = SimpleNamespace(
+                    data=data, attributes=dict(attributes), message_id=message_id
+                )
+                received.append(FakeReceivedMessage(message_id, message, attempt))
+        return SimpleNamespace(received_messages=received)
+
+    def acknowledge(
+        self, request: dict = None, subscription: str = None, ack_ids: List[str] = None
+    ) -> None:
+        ack_ids = request["ack_ids"] if request else ack_ids
+        with self._lock:
+            for ack_id in ack_ids:
+                if self._messages.pop(ack_id, None) is not None:
+                    self.acknowledged.append(ack_id)
+
+    def modify_ack_deadline(
+        self,
+        request: dict = None,
+        subscription: str = None,
+        ack_ids: List[str] = None,
+        ack_deadline_seconds: int = None,
+    ) -> None:
+        if request:
+            ack_ids = request["ack_ids"]
+            ack_deadline_seconds = request["ack_deadline_seconds"]
+        now = time.monotonic()
+        with self._lock:
+            for ack_id in ack_ids:
+                if ack_id in self._messages:
+                    data, attributes, attempt, _ = self._messages[ack_id]
+                    self._messages[ack_id] = (
+                        data,
+                        attributes,
+                        attempt,
+                        now + ack_deadline_seconds,
+                    )
+
+    @property
+    def outstanding_count(self) -> int:
+        """
+        :return: The number of messages that have not been acknowledged.
+        """
+        with self._lock:
+            return len(self._messages)
+
+
+class FakeStorageClient:
+    """
+    An in-memory stand-in for `google.cloud.storage.Client` for use in tests and
+    benchmarks. It supports the subset of the client, bucket, and blob interfaces used
+    in this repository, including object generations and ranged downloads. Each
+    method that would make a request to GCS sleeps for `latency` seconds first, to
+    simulate the round trip.
+
+    Objects uploaded with `upload_from_filename` are not copied into memory but read
+    from the local file whenever they are downloaded, so benchmarks can use files
+    larger than memory. Such files must not change while they are in use.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        """
+        :param latency: The number of seconds each request takes.
+        """
+        self.latency = latency
+        # Maps bucket names to object names to a list of (generation, data) tuples,
+        # the last of which is the live version of the object. The data is either
+        # bytes or the path of a local file.
+        self.objects: Dict[str, Dict[str, List[Tuple[int, Union[bytes, str]]]]] = {}
+        self._generations = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _request(self) -> None:
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def bucket(self, bucket_name: str) -> "FakeBucket":
+        return FakeBucket(self, bucket_name)
+
+    def get_bucket(self, bucket_name: str) -> "FakeBucket":
+        return self.bucket(bucket_name)
+
+    def list_blobs(self, bucket_or_name: Union[str, "FakeBucket"], prefix: str = ""):
+        if isinstance(bucket_or_name, FakeBucket):
+            bucket_or_name = bucket_or_name.name
+        return self.bucket(bucket_or_name).list_blobs(prefix=prefix)
+
+
+class FakeBucket:
+    def __init__(self, client: FakeStorageClient, name: str):
+        self.client = client
+        self.name = name
+
+    def blob(self, blob_name: str, generation: int = None) -> "FakeBlob":
+        return FakeBlob(self, blob_name, generation)
+
+    def get_blob(self, blob_name: str) -> "FakeBlob":
+        self.client._request()
+        blob = self.blob(blob_name)
+        return blob if blob._exists() else None
+
+    def list_blobs(self, prefix: str = "") -> List["FakeBlob"]:
+        self.client._request()
+        with self.client._lock:
+            names = sorted(self.client.objects.get(self.name, {}))
+        blobs = [self.blob(name) for name in names if name.startswith(prefix)]
+        return [blob for blob in blobs if blob._exists()]
+
+
+class FakeBlob:
+    def __init__(self, bucket: FakeBucket, name: str, generation: int = None):
+        self.bucket = bucket
+        self.name = name
+        self.generation = generation
+        self.size = None
+        # Like GCS, a blob deletes only its generation once it was given one or was
+        # reloaded.
+        self._pinned = generation is not None
+        if generation is None and self._exists():
+            self._reload()
+
+    def _versions(self) -> List[Tuple[int, Union[bytes, str]]]:
+        return self.bucket.client.objects.get(self.bucket.name, {}).get(self.name, [])
+
+    def _get_data(self) -> Union[bytes, str]:
+        with self.bucket.client._lock:
+            for generation, data in reversed(self._versions()):
+                if self.generation is None or generation == self.generation:
+                    return data
+        raise NotFound(f"gs://{self.bucket.name}/{self.name} was not found.")
+
+    def _exists(self) -> bool:
+        try:
+            self._get_data()
+            return True
+        except NotFound:
+            return False
+
+    def exists(self) -> bool:
+        self.bucket.client._request()
+        return self._exists()
+
+    def reload(self) -> None:
+        self.bucket.client._request()
+        self._reload()
+        self._pinned = True
+
+    def _reload(self) -> None:
+        data = self._get_data()
+        with self.bucket.client._lock:
+            if self.generation is None:
+                self.generation = self._versions()[-1][0]
+        self.size = os.path.getsize(data) if isinstance(data, str) else len(data)
+
+    def upload_from_string(
+        self,
+        data: Union[str, bytes],
+        content_type: str = None,
+        if_generation_match: int = None,
+    ) -> None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.bucket.client._request()
+        self._add_version(data, if_generation_match)
+
+    def upload_from_filename(
+        self, filename: str, content_type: str = None, if_generation_match: int = None
+    ) -> None:
+        self.bucket.client._request()
+        self._add_version(os.fspath(filename), if_generation_match)
+
+    def _add_version(
+        self, data: Union[bytes, str], if_generation_match: Optional[int]
+    ) -> None:
+        client = self.bucket.client
+        with client._lock:
+            versions = client.objects.setdefault(self.bucket.name, {}).setdefault(
+                self.name, []
+            )
+            if if_generation_match is not None:
+                current_generation = versions[-1][0] if versions else 0
+                if current_generation != if_generation_match:
+                    raise PreconditionFailed(
+                        f"gs://{self.bucket.name}/{self.name} is at generation "
+                        f"{current_generation}, not {if_generation_match}."
+                    )
+            self.generation = next(client._generations)
+            versions.append((self.generation, data))
+        self._reload()
+
+    def download_as_bytes(self, start: int = None, end: int = None) -> bytes:
+        self.bucket.client._request()
+        return self._download(start, end)
+
+    def _download(self, start: int = None, end: int = None) -> bytes:
+        # Like GCS, the end of the range is inclusive.
+        data = self._get_data()
+        start = start or 0
+        if isinstance(data, str):
+            with open(data, "rb") as file:
+                file.seek(start)
+                return file.read(-1 if end is None else end + 1 - start)
+        stop = len(data) if end is None else end + 1
+        return data[start:stop]
+
+    def download_as_text(self, encoding: str = "utf-8") -> str:
+        return self.download_as_bytes().decode(encoding)
+
+    def open(self, mode: str = "rb", chunk_size: int = None) -> BinaryIO:
+        if mode != "rb":
+            raise ValueError("FakeBlob only supports opening blobs with mode 'rb'.")
+        self.bucket.client._request()
+        data = self._get_data()
+        if isinstance(data, str):
+            return open(data, "rb")
+        return io.BytesIO(data)
+
+    def compose(
+        self, sources: List["FakeBlob"], if_generation_match: int = None
+    ) -> None:
+        self.bucket.client._request()
+        data = b"".join(source._download() for source in sources)
+        self._add_version(data, if_generation_match)
+
+    def delete(self) -> None:
+        client = self.bucket.client
+        client._request()
+        with client._lock:
+            objects = client.objects.get(self.bucket.name, {})
+            versions = objects.get(self.name, [])
+            remaining = [
+                version
+                for version in versions
+                if self._pinned and version[0] != self.generation
+            ]
+            if len(remaining) == len(versions):
+                raise NotFound(f"gs://{self.bucket.name}/{self.name} was not found.")
+            if remaining:
+                objects[self.name] = remaining
+            else:
+                objects.pop(self.name)
+
+
+class FakeGeocoder:
+    """
+    A stand-in for a batch geocoder such as Smarty for use with
+    `phdi_cloud_function_utils.GeocodeCache` in tests and benchmarks. Each address is
+    given a result derived from its fields, so the same address always gets the same
+    result, and each request takes `latency` seconds plus `address_cost` seconds per
+    address.
+    """
+
+    def __init__(
+        self, latency: float = 0.0, address_cost: float = 0.0, unmatched: str = None
+    ):
+        """
+        :param latency: The number of seconds each request takes.
+        :param address_cost: The number of seconds each address adds to a request.
+        :param unmatched: Addresses whose first line contains this string cannot be
+            matched, and get a result of None.
+        """
+        self.latency = latency
+        self.address_cost = address_cost
+        self.unmatched = unmatched
+        self.request_sizes: List[int] = []
+        self._lock = threading.Lock()
+
+    @property
+    def address_count(self) -> int:
+        """
+        :return: The number of addresses geocoded.
+        """
+        return sum(self.request_sizes)
+
+    def __call__(self, addresses: List[dict]) -> List[Optional[dict]]:
+        with self._lock:
+            self.request_sizes.append(len(addresses))
+        time.sleep(self.latency + self.address_cost * len(addresses))
+        return [self._geocode(address) for address in addresses]
+
+    def _geocode(self, address: dict) -> Optional[dict]:
+        line = [str(part).upper() for part in address.get("line") or []]
+        if not line or (self.unmatched and self.unmatched in line[0]):
+            return None
+        rng = random.Random(" ".join(line))
+        return {
+            "line": line,
+            "city": str(address.get("city", "")).upper(),
+            "state": str(address.get("state", "")).upper(),
+            "postal_code": str(address.get("postalCode", ""))[:5],
+            "county_fips": f"{rng.randrange(1000, 57000):05d}",
+            "county_name": "Fake County",
+            "lat": round(rng.uniform(25.0, 49.0), 6),
+            "lng": round(rng.uniform(-124.0, -67.0), 6),
+        }
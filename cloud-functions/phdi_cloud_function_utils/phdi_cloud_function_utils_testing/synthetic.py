@@ -0,0 +1,482 @@
+import datetime
+import json
+import random
+import uuid
+from typing import Iterator, NamedTuple, TextIO
+from xml.sax.saxutils import escape
+
+HL7_MESSAGE_TYPES = ("VXU_V04", "ORU_R01")
+
+_GIVEN_NAMES = (
+    ("F", "Mary"),
+    ("F", "Patricia"),
+    ("F", "Jennifer"),
+    ("F", "Linda"),
+    ("F", "Maria"),
+    ("F", "Aiyana"),
+    ("F", "Mei"),
+    ("F", "Renée"),
+    ("M", "James"),
+    ("M", "Robert"),
+    ("M", "John"),
+    ("M", "Michael"),
+    ("M", "José"),
+    ("M", "Hiroshi"),
+    ("M", "Kwame"),
+    ("M", "David"),
+)
+_FAMILY_NAMES = (
+    "Smith",
+    "Johnson",
+    "Williams",
+    "Brown",
+    "Garcia",
+    "Nguyen",
+    "O'Connor",
+    "Müller",
+    "Hernández",
+    "Kim",
+    "Begay",
+    "Okafor",
+)
+_ADDRESSES = (
+    ("Ann Arbor", "MI", "48104", "26161"),
+    ("Phoenix", "AZ", "85004", "04013"),
+    ("Atlanta", "GA", "30303", "13121"),
+    ("Seattle", "WA", "98101", "53033"),
+    ("Chicago", "IL", "60601", "17031"),
+    ("Houston", "TX", "77002", "48201"),
+    ("Albuquerque", "NM", "87102", "35001"),
+    ("Bangor", "ME", "04401", "23019"),
+)
+_STREETS = ("Main St", "Oak Ave", "Maple Dr", "Cedar Ln", "Elm St", "Lake Rd")
+_RACES = (
+    ("2106-3", "White"),
+    ("2054-5", "Black or African American"),
+    ("2028-9", "Asian"),
+    ("1002-5", "American Indian or Alaska Native"),
+    ("2076-8", "Native Hawaiian or Other Pacific Islander"),
+    ("2131-1", "Other Race"),
+)
+_VACCINES = (
+    ("208", "COVID-19, mRNA, LNP-S, PF, 30 mcg/0.3 mL dose", "PFR", "0.3"),
+    ("207", "COVID-19, mRNA, LNP-S, PF, 100 mcg/0.5mL dose", "MOD", "0.5"),
+    ("141", "Influenza, seasonal, injectable", "SKB", "0.5"),
+    ("115", "Tdap", "SKB", "0.5"),
+    ("03", "MMR", "MSD", "0.5"),
+    ("21", "varicella", "MSD", "0.5"),
+)
+_LAB_TESTS = (
+    ("94500-6", "SARS-CoV-2 RNA Resp Ql NAA+probe"),
+    ("5195-3", "Hepatitis B virus surface Ag [Presence] in Serum"),
+    ("20507-0", "Reagin Ab [Presence] in Serum by RPR"),
+    ("43304-5", "Chlamydia trachomatis rRNA [Presence] in Specimen by NAA+probe"),
+    ("80382-5", "Influenza virus A Ag [Presence] in Upper respiratory specimen"),
+)
+_LAB_RESULTS = (("260373001", "Detected"), ("260415000", "Not detected"))
+_VITAL_SIGNS = (
+    ("8302-2", "Body Height", "cm", 150.0, 195.0),
+    ("29463-7", "Body Weight", "kg", 45.0, 120.0),
+    ("8867-4", "Heart rate", "/min", 55.0, 100.0),
+    ("8310-5", "Body temperature", "Cel", 36.1, 38.5),
+    ("39156-5", "Body mass index (BMI) [Ratio]", "kg/m2", 18.0, 35.0),
+)
+_START_DATE = datetime.datetime(2022, 1, 1)
+
+
+class SyntheticPatient(NamedTuple):
+    id: str
+    mrn: str
+    given_name: str
+    family_name: str
+    sex: str
+    birth_date: datetime.date
+    street: str
+    city: str
+    state: str
+    zip_code: str
+    county: str
+    race_code: str
+    race_display: str
+
+
+def _uuid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def _timestamp(rng: random.Random) -> datetime.datetime:
+    return _START_DATE + datetime.timedelta(seconds=rng.randrange(365 * 24 * 60 * 60))
+
+
+def generate_patient(rng: random.Random) -> SyntheticPatient:
+    """
+    Generate a random patient.
+
+    :param rng: The random number generator to draw from.
+    :return: A SyntheticPatient.
+    """
+    sex, given_name = rng.choice(_GIVEN_NAMES)
+    city, state, zip_code, county = rng.choice(_ADDRESSES)
+    race_code, race_display = rng.choice(_RACES)
+    return SyntheticPatient(
+        id=_uuid(rng),
+        mrn=f"{rng.randrange(10**9):09d}",
+        given_name=given_name,
+        family_name=rng.choice(_FAMILY_NAMES),
+        sex=sex,
+        birth_date=datetime.date(1930, 1, 1)
+        + datetime.timedelta(days=rng.randrange(90 * 365)),
+        street=f"{rng.randrange(1, 9999)} {rng.choice(_STREETS)}",
+        city=city,
+        state=state,
+        zip_code=zip_code,
+        county=county,
+        race_code=race_code,
+        race_display=race_display,
+    )
+
+
+def _hl7_escape(value: str) -> str:
+    return (
+        value.replace("\\", "\\E\\")
+        .replace("|", "\\F\\")
+        .replace("^", "\\S\\")
+        .replace("&", "\\T\\")
+        .replace("~", "\\R\\")
+    )
+
+
+def _pid_segment(patient: SyntheticPatient) -> str:
+    return (
+        f"PID|1||{patient.mrn}^^^SYNTHETIC^MR||"
+        f"{_hl7_escape(patient.family_name)}^{_hl7_escape(patient.given_name)}||"
+        f"{patient.birth_date:%Y%m%d}|{patient.sex}||"
+        f"{patient.race_code}^{patient.race_display}^CDCREC|"
+        f"{patient.street}^^{patient.city}^{patient.state}^{patient.zip_code}^USA^L^^"
+        f"{patient.county}"
+    )
+
+
+def generate_hl7_message(
+    rng: random.Random, message_type: str, control_id: str
+) -> Iterator[str]:
+    """
+    Generate the segments of a single random HL7v2 message for one patient.
+
+    :param rng: The random number generator to draw from.
+    :param message_type: 'VXU_V04' for an immunization record or 'ORU_R01' for an
+        electronic lab result.
+    :param control_id: The message control ID, MSH-10.
+    :return: An iterator over the segments of the message, without line endings.
+    """
+    if message_type not in HL7_MESSAGE_TYPES:
+        raise ValueError(
+            f"Unknown HL7v2 message type: {message_type}. The message type must be "
+            f"one of {', '.join(HL7_MESSAGE_TYPES)}."
+        )
+    patient = generate_patient(rng)
+    sent_at = _timestamp(rng)
+    event = message_type.split("_")[1]
+    yield (
+        f"MSH|^~\\&|SYNTHETIC|SYNTHETIC_FAC^2.16.840.1.113883.3.9999^ISO|PHDI|"
+        f"PHDI_FAC|{sent_at:%Y%m%d%H%M%S}||{message_type[:3]}^{event}^{message_type}|"
+        f"{control_id}|P|2.5.1|||ER|AL"
+    )
+    yield _pid_segment(patient)
+
+    if message_type == "VXU_V04":
+        for sequence in range(1, rng.randint(1, 3) + 1):
+            code, name, manufacturer, dose = rng.choice(_VACCINES)
+            administered_at = sent_at - datetime.timedelta(days=rng.randrange(30))
+            yield f"ORC|RE||{control_id}-{sequence}^SYNTHETIC"
+            yield (
+                f"RXA|0|1|{administered_at:%Y%m%d}|{administered_at:%Y%m%d}|"
+                f"{code}^{name}^CVX|{dose}|mL^mL^UCUM||00^New immunization record^"
+                f"NIP001||||||LOT{rng.randrange(10**6):06d}||{manufacturer}^^MVX|||CP|A"
+            )
+            yield "RXR|C28161^Intramuscular^NCIT|LD^Left Arm^HL70163"
+    else:
+        code, name = rng.choice(_LAB_TESTS)
+        result_code, result_name = rng.choice(_LAB_RESULTS)
+        collected_at = sent_at - datetime.timedelta(hours=rng.randrange(1, 72))
+        yield f"ORC|RE|{control_id}^SYNTHETIC|{control_id}^SYNTHETIC_LAB"
+        yield (
+            f"OBR|1|{control_id}^SYNTHETIC|{control_id}^SYNTHETIC_LAB|"
+            f"{code}^{name}^LN|||{collected_at:%Y%m%d%H%M%S}"
+        )
+        yield (
+            f"OBX|1|CWE|{code}^{name}^LN||{result_code}^{result_name}^SCT||||||F|||"
+            f"{collected_at:%Y%m%d%H%M%S}"
+        )
+        yield f"SPM|1|{control_id}||258500001^Nasopharyngeal swab^SCT"
+
+
+def write_hl7_batch(
+    file: TextIO,
+    message_type: str,
+    message_count: int,
+    seed: int = None,
+    batch_size: int = None,
+    line_ending: str = "\r\n",
+) -> None:
+    """
+    Write a batch file of random HL7v2 messages of one type, wrapped in FHS/BHS and
+    BTS/FTS segments. Messages are written one at a time, so files of any size can be
+    generated in constant memory.
+
+    :param file: A text file to write to, opened with `newline=""` so that line
+        endings are written as given.
+    :param message_type: 'VXU_V04' or 'ORU_R01'.
+    :param message_count: The number of messages to write.
+    :param seed: A seed for the random number generator, so that the same file is
+        generated every time.
+    :param batch_size: The maximum number of messages in each BHS/BTS batch. By
+        default all messages are written in a single batch.
+    :param line_ending: The characters separating segments.
+    """
+    rng = random.Random(seed)
+    batch_size = batch_size or max(1, message_count)
+    created_at = f"{_timestamp(rng):%Y%m%d%H%M%S}"
+    file.write(f"FHS|^~\\&|SYNTHETIC|SYNTHETIC_FAC|PHDI|PHDI_FAC|{created_at}")
+    file.write(line_ending)
+
+    batch_count = 0
+    for batch_start in range(0, message_count, batch_size):
+        batch_count += 1
+        file.write(
+            f"BHS|^~\\&|SYNTHETIC|SYNTHETIC_FAC|PHDI|PHDI_FAC|{created_at}|||"
+            f"BATCH{batch_count}"
+        )
+        file.write(line_ending)
+        batch_end = min(message_count, batch_start + batch_size)
+        for idx in range(batch_start, batch_end):
+            for segment in generate_hl7_message(rng, message_type, f"MSG{idx:09d}"):
+                file.write(segment)
+                file.write(line_ending)
+        file.write(f"BTS|{batch_end - batch_start}")
+        file.write(line_ending)
+
+    file.write(f"FTS|{batch_count}")
+    file.write(line_ending)
+
+
+def write_ccd_document(file: TextIO, seed: int = None, result_count: int = 10) -> None:
+    """
+    Write a random C-CDA Continuity of Care Document for one patient, with a results
+    section holding the given number of lab results. Results are written one at a
+    time, so documents of any size can be generated in constant memory.
+
+    :param file: A text file to write to.
+    :param seed: A seed for the random number generator.
+    :param result_count: The number of lab results in the document.
+    """
+    rng = random.Random(seed)
+    patient = generate_patient(rng)
+    created_at = _timestamp(rng)
+    file.write(
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<ClinicalDocument xmlns="urn:hl7-org:v3" '
+        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n'
+        '  <realmCode code="US"/>\n'
+        '  <typeId root="2.16.840.1.113883.1.3" extension="POCD_HD000040"/>\n'
+        '  <templateId root="2.16.840.1.113883.10.20.22.1.1"/>\n'
+        '  <templateId root="2.16.840.1.113883.10.20.22.1.2"/>\n'
+        f'  <id root="{_uuid(rng)}"/>\n'
+        '  <code code="34133-9" codeSystem="2.16.840.1.113883.6.1" '
+        'displayName="Summarization of Episode Note"/>\n'
+        "  <title>Continuity of Care Document</title>\n"
+        f'  <effectiveTime value="{created_at:%Y%m%d%H%M%S}"/>\n'
+        "  <recordTarget>\n"
+        "    <patientRole>\n"
+        f'      <id root="2.16.840.1.113883.3.9999" extension="{patient.mrn}"/>\n'
+        '      <addr use="HP">\n'
+        f"        <streetAddressLine>{escape(patient.street)}</streetAddressLine>\n"
+        f"        <city>{escape(patient.city)}</city>\n"
+        f"        <state>{patient.state}</state>\n"
+        f"        <postalCode>{patient.zip_code}</postalCode>\n"
+        "        <country>US</country>\n"
+        "      </addr>\n"
+        "      <patient>\n"
+        "        <name>\n"
+        f"          <given>{escape(patient.given_name)}</given>\n"
+        f"          <family>{escape(patient.family_name)}</family>\n"
+        "        </name>\n"
+        f'        <administrativeGenderCode code="{patient.sex}" '
+        'codeSystem="2.16.840.1.113883.5.1"/>\n'
+        f'        <birthTime value="{patient.birth_date:%Y%m%d}"/>\n'
+        f'        <raceCode code="{patient.race_code}" '
+        f'codeSystem="2.16.840.1.113883.6.238" '
+        f'displayName="{escape(patient.race_display)}"/>\n'
+        "      </patient>\n"
+        "    </patientRole>\n"
+        "  </recordTarget>\n"
+        "  <component>\n"
+        "    <structuredBody>\n"
+        "      <component>\n"
+        "        <section>\n"
+        '          <templateId root="2.16.840.1.113883.10.20.22.2.3.1"/>\n'
+        '          <code code="30954-2" codeSystem="2.16.840.1.113883.6.1" '
+        'displayName="Relevant diagnostic tests and/or laboratory data"/>\n'
+        "          <title>Results</title>\n"
+    )
+    for _ in range(result_count):
+        code, name = rng.choice(_LAB_TESTS)
+        result_code, result_name = rng.choice(_LAB_RESULTS)
+        file.write(
+            '          <entry typeCode="DRIV">\n'
+            '            <organizer classCode="BATTERY" moodCode="EVN">\n'
+            f'              <id root="{_uuid(rng)}"/>\n'
+            "              <component>\n"
+            '                <observation classCode="OBS" moodCode="EVN">\n'
+            f'                  <code code="{code}" '
+            'codeSystem="2.16.840.1.113883.6.1" '
+            f'displayName="{escape(name)}"/>\n'
+            '                  <statusCode code="completed"/>\n'
+            f'                  <effectiveTime value="{_timestamp(rng):%Y%m%d%H%M%S}"/>'
+            "\n"
+            '                  <value xsi:type="CD" '
+            f'code="{result_code}" codeSystem="2.16.840.1.113883.6.96" '
+            f'displayName="{result_name}"/>\n'
+            "                </observation>\n"
+            "              </component>\n"
+            "            </organizer>\n"
+            "          </entry>\n"
+        )
+    file.write(
+        "        </section>\n"
+        "      </component>\n"
+        "    </structuredBody>\n"
+        "  </component>\n"
+        "</ClinicalDocument>\n"
+    )
+
+
+def _fhir_patient(patient: SyntheticPatient) -> dict:
+    return {
+        "resourceType": "Patient",
+        "id": patient.id,
+        "extension": [
+            {
+                "url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race",
+                "extension": [
+                    {
+                        "url": "ombCategory",
+                        "valueCoding": {
+                            "system": "urn:oid:2.16.840.1.113883.6.238",
+                            "code": patient.race_code,
+                            "display": patient.race_display,
+                        },
+                    },
+                    {"url": "text", "valueString": patient.race_display},
+                ],
+            }
+        ],
+        "identifier": [
+            {
+                "type": {
+                    "coding": [
+                        {
+                            "system": "http://terminology.hl7.org/CodeSystem/v2-0203",
+                            "code": "MR",
+                        }
+                    ]
+                },
+                "system": "urn:oid:2.16.840.1.113883.3.9999",
+                "value": patient.mrn,
+            }
+        ],
+        "name": [
+            {
+                "use": "official",
+                "family": patient.family_name,
+                "given": [patient.given_name],
+            }
+        ],
+        "gender": "female" if patient.sex == "F" else "male",
+        "birthDate": patient.birth_date.isoformat(),
+        "address": [
+            {
+                "line": [patient.street],
+                "city": patient.city,
+                "state": patient.state,
+                "postalCode": patient.zip_code,
+                "country": "US",
+            }
+        ],
+    }
+
+
+def _fhir_observation(rng: random.Random, patient_id: str) -> dict:
+    code, display, unit, low, high = rng.choice(_VITAL_SIGNS)
+    effective_at = _timestamp(rng).isoformat()
+    return {
+        "resourceType": "Observation",
+        "id": _uuid(rng),
+        "status": "final",
+        "category": [
+            {
+                "coding": [
+                    {
+                        "system": "http://terminology.hl7.org/CodeSystem/"
+                        "observation-category",
+                        "code": "vital-signs",
+                        "display": "vital-signs",
+                    }
+                ]
+            }
+        ],
+        "code": {
+            "coding": [
+                {"system": "http://loinc.org", "code": code, "display": display}
+            ],
+            "text": display,
+        },
+        "subject": {"reference": f"urn:uuid:{patient_id}"},
+        "effectiveDateTime": effective_at,
+        "issued": effective_at,
+        "valueQuantity": {
+            "value": round(rng.uniform(low, high), 1),
+            "unit": unit,
+            "system": "http://unitsofmeasure.org",
+            "code": unit,
+        },
+    }
+
+
+def write_fhir_bundle(
+    file: TextIO,
+    patient_count: int,
+    observations_per_patient: int = 5,
+    seed: int = None,
+    bundle_type: str = "transaction",
+) -> None:
+    """
+    Write a FHIR bundle of random patients, each followed by observations referring to
+    it, in the same shape as multi_patient_obs_bundle.json. Entries are serialized one
+    at a time, so bundles of any size can be generated in constant memory.
+
+    :param file: A text file to write to.
+    :param patient_count: The number of patients in the bundle.
+    :param observations_per_patient: The number of observations for each patient.
+    :param seed: A seed for the random number generator.
+    :param bundle_type: The type of the bundle. Entries of transaction and batch
+        bundles include a POST request.
+    """
+    rng = random.Random(seed)
+    file.write(f'{{"resourceType": "Bundle", "type": {json.dumps(bundle_type)}, ')
+    file.write('"entry": [')
+    first = True
+    for _ in range(patient_count):
+        patient = generate_patient(rng)
+        resources = [_fhir_patient(patient)] + [
+            _fhir_observation(rng, patient.id) for _ in range(observations_per_patient)
+        ]
+        for resource in resources:
+            entry = {"fullUrl": f"urn:uuid:{resource['id']}", "resource": resource}
+            if bundle_type in ("transaction", "batch"):
+                entry["request"] = {"method": "POST", "url": resource["resourceType"]}
+            if not first:
+                file.write(", ")
+            file.write(json.dumps(entry))
+            first = False
+    file.write("]}\n")
@@ -7,7 +7,7 @@ setup(
     url="https://github.com/CDCgov/phdi-google-cloud/tree/main/cloud-functions/phdi_cloud_function_utils",  # noqa
     author="PHDI",
     license="CC0 1.0 Universal",
-    packages=["phdi_cloud_function_utils"],
+    packages=["phdi_cloud_function_utils", "phdi_cloud_function_utils_testing"],
     package_data={
         "phdi_cloud_function_utils": [
             "./single_patient_bundle.json",
@@ -16,5 +16,8 @@ setup(
         ]
     },
     install_requires=["flask"],
+    # Needed to read or publish zstd compressed data, e.g. messages published by
+    # read_source_data with PUBSUB_COMPRESSION set to 'zstd'.
+    extras_require={"zstd": ["zstandard"]},
     zip_safe=False,
 )
@@ -0,0 +1,53 @@
+import gzip
+import io
+import zipfile
+from phdi_cloud_function_utils import get_archive_compression, iter_archive_members
+import pytest
+
+
+def test_get_archive_compression():
+    assert get_archive_compression("source-data/elr/batch.hl7.gz") == "gzip"
+    assert get_archive_compression("source-data/elr/batch.hl7.ZST") == "zstd"
+    assert get_archive_compression("source-data/elr/batches.zip") == "zip"
+    assert get_archive_compression("source-data/elr/batch.hl7") == "identity"
+
+
+def test_iter_archive_members_gzip():
+    data = gzip.compress(b"MSH|1\r") + gzip.compress(b"MSH|2\r")
+    members = [
+        (name, member.read())
+        for name, member in iter_archive_members(io.BytesIO(data), "gzip")
+    ]
+    assert members == [(None, b"MSH|1\rMSH|2\r")]
+
+
+def test_iter_archive_members_zstd():
+    zstandard = pytest.importorskip("zstandard")
+    compressor = zstandard.ZstdCompressor()
+    data = compressor.compress(b"MSH|1\r") + compressor.compress(b"MSH|2\r")
+    members = [
+        (name, member.read())
+        for name, member in iter_archive_members(io.BytesIO(data), "zstd")
+    ]
+    assert members == [(None, b"MSH|1\rMSH|2\r")]
+
+
+def test_iter_archive_members_zip():
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("a.hl7", b"MSH|a\r" * 1000)
+        zip_file.writestr("directory/", b"")
+        zip_file.writestr("directory/b.hl7", b"MSH|b\r")
+    archive.seek(0)
+
+    # Members are decompressed a chunk at a time.
+    members = []
+    for name, member in iter_archive_members(archive, "zip"):
+        chunks = iter(lambda: member.read(100), b"")
+        members.append((name, [len(chunk) for chunk in chunks]))
+    assert members == [("a.hl7", [100] * 60), ("directory/b.hl7", [6])]
+
+
+def test_iter_archive_members_unknown():
+    with pytest.raises(ValueError):
+        list(iter_archive_members(io.BytesIO(b""), "identity"))
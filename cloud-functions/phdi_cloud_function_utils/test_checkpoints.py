@@ -0,0 +1,63 @@
+from phdi_cloud_function_utils import (
+    Checkpoint,
+    GCSCheckpointStore,
+    InMemoryCheckpointStore,
+    SQLiteCheckpointStore,
+    make_checkpoint_key,
+)
+from phdi_cloud_function_utils_testing.fakes import FakeStorageClient
+import pytest
+
+
+def test_make_checkpoint_key():
+    assert make_checkpoint_key("some-bucket", "source-data/elr/some-file", 17) == (
+        "some-bucket/source-data/elr/some-file/17"
+    )
+    assert make_checkpoint_key("some-bucket", "source-data/elr/some-file") == (
+        "some-bucket/source-data/elr/some-file/"
+    )
+
+
+@pytest.fixture(params=["memory", "sqlite", "gcs"])
+def checkpoint_store(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryCheckpointStore()
+    elif request.param == "sqlite":
+        return SQLiteCheckpointStore(str(tmp_path / "checkpoints.db"))
+    return GCSCheckpointStore(FakeStorageClient(), "some-bucket")
+
+
+def test_checkpoint_store(checkpoint_store):
+    key = make_checkpoint_key("some-bucket", "some-file", 1)
+    assert checkpoint_store.get(key) is None
+
+    checkpoint_store.put(key, Checkpoint(message_count=10, byte_offset=1000))
+    assert checkpoint_store.get(key) == Checkpoint(10, 1000, False)
+    assert checkpoint_store.get(make_checkpoint_key("some-bucket", "some-file", 2)) is (
+        None
+    )
+
+    checkpoint_store.put(key, Checkpoint(message_count=20, complete=True))
+    assert checkpoint_store.get(key) == Checkpoint(20, None, True)
+
+    checkpoint_store.delete(key)
+    assert checkpoint_store.get(key) is None
+    checkpoint_store.delete(key)
+
+
+def test_sqlite_checkpoint_store_persists(tmp_path):
+    path = str(tmp_path / "checkpoints.db")
+    checkpoint_store = SQLiteCheckpointStore(path)
+    checkpoint_store.put("some-key", Checkpoint(5, 50))
+    checkpoint_store.close()
+
+    assert SQLiteCheckpointStore(path).get("some-key") == Checkpoint(5, 50)
+
+
+def test_gcs_checkpoint_store_objects():
+    storage_client = FakeStorageClient()
+    checkpoint_store = GCSCheckpointStore(storage_client, "some-bucket")
+    checkpoint_store.put("some-bucket/some-file/1", Checkpoint(5, 50))
+
+    [blob] = storage_client.list_blobs("some-bucket")
+    assert blob.name == "checkpoints/some-bucket/some-file/1.json"
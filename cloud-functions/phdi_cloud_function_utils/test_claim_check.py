@@ -0,0 +1,90 @@
+from phdi_cloud_function_utils import (
+    ClaimCheckResolver,
+    is_claim_check,
+    make_claim_check_attributes,
+)
+from phdi_cloud_function_utils_testing.fakes import FakeStorageClient
+import pytest
+
+
+def test_make_claim_check_attributes():
+    assert make_claim_check_attributes("some-bucket", "some-object") == {
+        "claim-check-bucket": "some-bucket",
+        "claim-check-object": "some-object",
+    }
+    assert make_claim_check_attributes(
+        "some-bucket", "some-object", generation=7, start=10, end=20
+    ) == {
+        "claim-check-bucket": "some-bucket",
+        "claim-check-object": "some-object",
+        "claim-check-generation": "7",
+        "claim-check-range": "10-20",
+    }
+    assert make_claim_check_attributes("some-bucket", "some-object", start=10)[
+        "claim-check-range"
+    ] == ("10-")
+
+
+def test_is_claim_check():
+    assert is_claim_check(make_claim_check_attributes("some-bucket", "some-object"))
+    assert not is_claim_check({"message_type": "hl7v2"})
+    assert not is_claim_check(None)
+
+
+def test_resolve_inline_message():
+    resolver = ClaimCheckResolver(FakeStorageClient())
+    assert resolver.resolve(b"some-data", {"message_type": "hl7v2"}) == b"some-data"
+    assert resolver.resolve(b"some-data") == b"some-data"
+
+
+def test_resolve_claim_check():
+    storage_client = FakeStorageClient()
+    blob = storage_client.bucket("some-bucket").blob("some-object")
+    blob.upload_from_string(b"0123456789")
+    resolver = ClaimCheckResolver(storage_client)
+
+    attributes = make_claim_check_attributes("some-bucket", "some-object")
+    assert resolver.resolve(b"", attributes) == b"0123456789"
+
+    attributes = make_claim_check_attributes(
+        "some-bucket", "some-object", start=2, end=5
+    )
+    assert resolver.resolve(b"", attributes) == b"234"
+
+    attributes = make_claim_check_attributes("some-bucket", "some-object", start=7)
+    assert resolver.resolve(b"", attributes) == b"789"
+
+
+def test_resolve_claim_check_generation():
+    storage_client = FakeStorageClient()
+    blob = storage_client.bucket("some-bucket").blob("some-object")
+    blob.upload_from_string(b"first")
+    first_generation = blob.generation
+    blob.upload_from_string(b"second")
+    resolver = ClaimCheckResolver(storage_client)
+
+    attributes = make_claim_check_attributes(
+        "some-bucket", "some-object", generation=first_generation
+    )
+    assert resolver.resolve(b"", attributes) == b"first"
+    attributes = make_claim_check_attributes("some-bucket", "some-object")
+    assert resolver.resolve(b"", attributes) == b"second"
+
+
+def test_open_claim_check():
+    storage_client = FakeStorageClient()
+    storage_client.bucket("some-bucket").blob("some-object").upload_from_string(
+        b"0123456789"
+    )
+    resolver = ClaimCheckResolver(storage_client)
+
+    attributes = make_claim_check_attributes("some-bucket", "some-object")
+    with resolver.open(attributes) as reader:
+        assert reader.read(4) == b"0123"
+        assert reader.read() == b"456789"
+
+    attributes = make_claim_check_attributes(
+        "some-bucket", "some-object", start=2, end=5
+    )
+    with pytest.raises(ValueError):
+        resolver.open(attributes)
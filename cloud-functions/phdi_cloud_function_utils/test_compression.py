@@ -0,0 +1,61 @@
+import gzip
+from phdi_cloud_function_utils import (
+    compress_payload,
+    decode_envelope,
+    decompress_payload,
+    encode_envelope,
+)
+import pytest
+
+DATA = b"MSH|^~\\&|IMMAPP|GHHSFacility\rPID|1||EVERYMAN^ADAM\r" * 100
+
+
+def test_compress_payload_gzip():
+    compressed, attributes = compress_payload(DATA, "gzip")
+    assert attributes == {"content-encoding": "gzip"}
+    assert len(compressed) < len(DATA)
+    assert gzip.decompress(compressed) == DATA
+    assert decompress_payload(compressed, attributes) == DATA
+
+
+def test_compress_payload_zstd():
+    pytest.importorskip("zstandard")
+    compressed, attributes = compress_payload(DATA, "zstd")
+    assert attributes == {"content-encoding": "zstd"}
+    assert len(compressed) < len(DATA)
+    assert decompress_payload(compressed, attributes) == DATA
+
+
+def test_compress_payload_not_compressed():
+    # Below the threshold.
+    assert compress_payload(DATA, "gzip", threshold=len(DATA) + 1) == (DATA, {})
+    # Compression disabled.
+    assert compress_payload(DATA, "identity") == (DATA, {})
+    # Compressed data would be larger.
+    assert compress_payload(b"abc", "gzip", threshold=0) == (b"abc", {})
+    assert decompress_payload(DATA) == DATA
+    assert decompress_payload(DATA, {"origin": "some-origin"}) == DATA
+
+
+def test_compress_payload_unknown_encoding():
+    with pytest.raises(ValueError):
+        compress_payload(DATA, "brotli")
+    with pytest.raises(ValueError):
+        decompress_payload(DATA, {"content-encoding": "brotli"})
+
+
+@pytest.mark.parametrize("envelope", ["json", "binary"])
+def test_decode_compressed_envelope(envelope):
+    fields = {
+        "message_type": "hl7v2",
+        "root_template": "ORU_R01",
+        "filename": "source-data/elr/some-file.hl7",
+    }
+    data, attributes = encode_envelope(DATA, envelope=envelope, **fields)
+    data, compression_attributes = compress_payload(data, "gzip")
+    attributes.update(compression_attributes)
+
+    assert decode_envelope(data, attributes) == {
+        "message": DATA.decode("utf-8"),
+        **fields,
+    }
@@ -0,0 +1,178 @@
+from phdi_cloud_function_utils import (
+    DedupIndex,
+    GCSDedupStore,
+    SQLiteDedupStore,
+    hash_message,
+)
+from phdi_cloud_function_utils_testing.fakes import FakeBlob, FakeStorageClient
+from unittest import mock
+import pytest
+
+
+def test_hash_message():
+    assert hash_message("MSH|1\r") == hash_message(b"MSH|1\r")
+    assert len(hash_message("MSH|1\r")) == 64
+    assert hash_message("MSH|1\r") != hash_message("MSH|2\r")
+    assert hash_message("MSH|1\r", namespace="ORU_R01") != hash_message(
+        "MSH|1\r", namespace="VXU_V04"
+    )
+
+
+def test_dedup_index_lru():
+    dedup_index = DedupIndex(max_size=2)
+    dedup_index.add("a")
+    dedup_index.add("b")
+    assert dedup_index.contains("a")
+
+    # "b" is now the least recently used hash, so it is evicted first.
+    dedup_index.add("c")
+    assert len(dedup_index) == 2
+    assert dedup_index.contains("a")
+    assert dedup_index.contains("c")
+    assert not dedup_index.contains("b")
+
+
+@pytest.fixture(params=["sqlite", "gcs"])
+def dedup_store(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteDedupStore(str(tmp_path / "dedup.db"))
+    return GCSDedupStore(FakeStorageClient(), "some-bucket")
+
+
+def test_dedup_store(dedup_store):
+    assert not dedup_store.contains("a")
+    dedup_store.add("a")
+    dedup_store.add("a")
+    assert dedup_store.contains("a")
+    assert not dedup_store.contains("b")
+
+
+def test_dedup_index_store():
+    store = mock.Mock(wraps=SQLiteDedupStore())
+    dedup_index = DedupIndex(max_size=1, store=store)
+    dedup_index.add("a")
+    dedup_index.add("b")
+    store.add.assert_has_calls([mock.call("a"), mock.call("b")])
+
+    # Hashes evicted from memory are found in the store and cached again.
+    assert dedup_index.contains("a")
+    assert dedup_index.contains("a")
+    assert store.contains.call_count == 1
+    assert not dedup_index.contains("c")
+
+
+def test_gcs_dedup_store():
+    storage_client = FakeStorageClient()
+    clock = mock.Mock(return_value=0.0)
+    store = GCSDedupStore(storage_client, "some-bucket", shard_chars=1, clock=clock)
+    other_store = GCSDedupStore(
+        storage_client, "some-bucket", shard_chars=1, clock=clock
+    )
+    for key in ["a1", "a2", "b1"]:
+        store.add(key)
+
+    # Hashes are buffered until they are flushed, and then written by shard to an
+    # object in the folder of the day.
+    assert storage_client.objects == {}
+    store.flush()
+    names = sorted(storage_client.objects["some-bucket"])
+    assert [name.rsplit("/", 1)[0] for name in names] == [
+        "dedup/a/000000",
+        "dedup/b/000000",
+    ]
+
+    # A shard is downloaded once and searched in memory.
+    with mock.patch.object(
+        FakeBlob,
+        "download_as_bytes",
+        autospec=True,
+        side_effect=FakeBlob.download_as_bytes,
+    ) as patched_download:
+        assert other_store.contains("a1")
+        assert other_store.contains("a2")
+        assert not other_store.contains("a3")
+        assert patched_download.call_count == 1
+
+    # A flush only writes the hashes added since the last one, in a new object.
+    store.add("a3")
+    store.flush()
+    a_names = sorted(storage_client.objects["some-bucket"])[:2]
+    assert {
+        storage_client.bucket("some-bucket").blob(name).download_as_bytes()
+        for name in a_names
+    } == {b"a1\na2\n", b"a3\n"}
+
+    # Shards are listed again once they are older than the refresh interval, and only
+    # the new objects are downloaded.
+    assert not other_store.contains("a3")
+    clock.return_value = 300.0
+    with mock.patch.object(
+        FakeBlob,
+        "download_as_bytes",
+        autospec=True,
+        side_effect=FakeBlob.download_as_bytes,
+    ) as patched_download:
+        assert other_store.contains("a3")
+        assert patched_download.call_count == 1
+
+    # Hashes are ignored once their day folder is older than the TTL.
+    clock.return_value = 30 * 86400.0
+    fresh_store = GCSDedupStore(
+        storage_client, "some-bucket", shard_chars=1, clock=clock
+    )
+    assert not fresh_store.contains("a1")
+    assert not other_store.contains("a1")
+
+
+def test_gcs_dedup_store_compaction():
+    storage_client = FakeStorageClient()
+    store = GCSDedupStore(
+        storage_client,
+        "some-bucket",
+        shard_chars=1,
+        compact_threshold=3,
+        clock=lambda: 0.0,
+    )
+    assert not store.contains("a0")
+    for idx in range(4):
+        store.add(f"a{idx}")
+        store.flush()
+
+    # Once a day folder holds 3 objects they are merged into one.
+    names = sorted(storage_client.objects["some-bucket"])
+    assert sorted(
+        storage_client.bucket("some-bucket").blob(name).download_as_bytes()
+        for name in names
+    ) == [b"a0\na1\na2\n", b"a3\n"]
+
+    # Objects merged by another instance after they were listed are found in the
+    # merged object.
+    other_store = GCSDedupStore(
+        storage_client, "some-bucket", shard_chars=1, clock=lambda: 0.0
+    )
+    list_objects = other_store._list_objects
+
+    def list_objects_then_compact(name, day=None):
+        listed = list_objects(name, day)
+        if not store.contains("a4"):
+            store.add("a4")
+            store.flush()
+        return listed
+
+    with mock.patch.object(
+        other_store, "_list_objects", side_effect=list_objects_then_compact
+    ) as patched_list_objects:
+        assert all(other_store.contains(f"a{idx}") for idx in range(5))
+        assert patched_list_objects.call_count == 2
+    assert len(storage_client.objects["some-bucket"]) == 1
+
+
+def test_gcs_dedup_store_max_cached_shards():
+    store = GCSDedupStore(
+        FakeStorageClient(), "some-bucket", shard_chars=1, max_cached_shards=2
+    )
+    for key in ["a1", "b1", "a2", "c1"]:
+        store.contains(key)
+
+    # "b" is the least recently used shard, so it is evicted first.
+    assert list(store._shards) == ["dedup/a/", "dedup/c/"]
@@ -0,0 +1,49 @@
+import json
+from phdi_cloud_function_utils import (
+    BINARY_ENVELOPE,
+    JSON_ENVELOPE,
+    decode_envelope,
+    encode_envelope,
+)
+import pytest
+
+MESSAGE = 'MSH|^~\\&|"quoted"\rPID|1||José\r'
+FIELDS = {
+    "message_type": "hl7v2",
+    "root_template": "VXU_V04",
+    "filename": "source-data/vxu/some-file.hl7",
+}
+
+
+def test_encode_json_envelope():
+    data, attributes = encode_envelope(MESSAGE, envelope=JSON_ENVELOPE, **FIELDS)
+    assert attributes == {}
+    assert data == json.dumps({"message": MESSAGE, **FIELDS}).encode("utf-8")
+    assert decode_envelope(data, attributes) == {"message": MESSAGE, **FIELDS}
+
+
+def test_encode_binary_envelope():
+    data, attributes = encode_envelope(MESSAGE, envelope=BINARY_ENVELOPE, **FIELDS)
+    assert data == MESSAGE.encode("utf-8")
+    assert attributes == FIELDS
+    assert decode_envelope(data, {"origin": "some-origin", **attributes}) == {
+        "message": MESSAGE,
+        **FIELDS,
+    }
+
+    json_data, _ = encode_envelope(MESSAGE, envelope=JSON_ENVELOPE, **FIELDS)
+    assert len(data) < len(json_data)
+
+
+def test_encode_envelope_bytes_message():
+    data, _ = encode_envelope(
+        MESSAGE.encode("utf-8"), envelope=BINARY_ENVELOPE, **FIELDS
+    )
+    assert data == MESSAGE.encode("utf-8")
+    data, _ = encode_envelope(MESSAGE.encode("utf-8"), envelope=JSON_ENVELOPE, **FIELDS)
+    assert json.loads(data)["message"] == MESSAGE
+
+
+def test_encode_unknown_envelope():
+    with pytest.raises(ValueError):
+        encode_envelope(MESSAGE, envelope="some-envelope", **FIELDS)
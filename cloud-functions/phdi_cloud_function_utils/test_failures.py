@@ -0,0 +1,92 @@
+from phdi_cloud_function_utils import (
+    FailureManifestWriter,
+    Metrics,
+    iter_failure_records,
+    make_failure_record,
+)
+from phdi_cloud_function_utils_testing.fakes import FakeStorageClient
+
+
+def make_record(idx: int) -> dict:
+    return make_failure_record(
+        source="source-data/vxu/some-file.hl7",
+        idx=idx,
+        message=f"MSH|{idx}\r",
+        error=TimeoutError("Deadline exceeded"),
+        message_type="hl7v2",
+        root_template="VXU_V04",
+        generation=7,
+        offset=(idx + 1) * 7,
+    )
+
+
+def test_make_failure_record():
+    record = make_record(3)
+    assert record["idx"] == 3
+    assert record["offset"] == 28
+    assert record["error_type"] == "TimeoutError"
+    assert record["error"] == "Deadline exceeded"
+    assert record["message"] == "MSH|3\r"
+
+
+def test_failure_manifest_single_upload():
+    bucket = FakeStorageClient().bucket("some-bucket")
+    metrics = Metrics()
+    writer = FailureManifestWriter(
+        bucket=bucket, name="publishing-failures/vxu/some-file.ndjson", metrics=metrics
+    )
+    for idx in range(100):
+        writer.add(make_record(idx))
+    writer.close()
+
+    assert metrics.counters["failure_records"] == 100
+    assert metrics.counters["failure_manifest_writes"] == 1
+    records = list(
+        iter_failure_records(bucket.blob("publishing-failures/vxu/some-file.ndjson"))
+    )
+    assert [record["idx"] for record in records] == list(range(100))
+
+
+def test_failure_manifest_nothing_to_write():
+    bucket = FakeStorageClient().bucket("some-bucket")
+    writer = FailureManifestWriter(bucket=bucket, name="some-manifest.ndjson")
+    writer.close()
+    assert bucket.list_blobs() == []
+
+
+def test_failure_manifest_parts():
+    bucket = FakeStorageClient().bucket("some-bucket")
+    # A tiny buffer writes a part per record, exceeding what GCS composes at once.
+    writer = FailureManifestWriter(
+        bucket=bucket, name="some-manifest.ndjson", max_buffer_bytes=1
+    )
+    for idx in range(70):
+        writer.add(make_record(idx))
+    assert len(bucket.list_blobs(prefix="some-manifest.ndjson.part-")) == 70
+    writer.close()
+
+    assert [blob.name for blob in bucket.list_blobs()] == ["some-manifest.ndjson"]
+    records = list(iter_failure_records(bucket.blob("some-manifest.ndjson")))
+    assert [record["idx"] for record in records] == list(range(70))
+
+
+def test_failure_manifest_resume():
+    bucket = FakeStorageClient().bucket("some-bucket")
+    writer = FailureManifestWriter(bucket=bucket, name="some-manifest.ndjson")
+    writer.add(make_record(0))
+    writer.add(make_record(1))
+    writer.flush()
+    # The first attempt stops after flushing, e.g. at a checkpoint. The retry
+    # includes its parts in the manifest.
+    writer.add(make_record(2))
+
+    writer = FailureManifestWriter(
+        bucket=bucket, name="some-manifest.ndjson", resume=True
+    )
+    writer.add(make_record(2))
+    writer.add(make_record(3))
+    writer.close()
+
+    assert [blob.name for blob in bucket.list_blobs()] == ["some-manifest.ndjson"]
+    records = list(iter_failure_records(bucket.blob("some-manifest.ndjson")))
+    assert [record["idx"] for record in records] == [0, 1, 2, 3]
@@ -0,0 +1,120 @@
+from phdi_cloud_function_utils_testing.fakes import (
+    FakePublisherClient,
+    FakeStorageClient,
+    FakeSubscriberClient,
+    NotFound,
+    PreconditionFailed,
+)
+from unittest import mock
+import pytest
+
+
+def test_fake_storage_client_generations():
+    storage_client = FakeStorageClient()
+    blob = storage_client.bucket("some-bucket").blob("some-object")
+    assert not blob.exists()
+    with pytest.raises(NotFound):
+        blob.download_as_bytes()
+
+    blob.upload_from_string("first")
+    first_generation = blob.generation
+    blob.upload_from_string(b"second", if_generation_match=first_generation)
+    with pytest.raises(PreconditionFailed):
+        blob.upload_from_string(b"third", if_generation_match=first_generation)
+
+    bucket = storage_client.bucket("some-bucket")
+    assert bucket.blob("some-object").download_as_text() == "second"
+    assert bucket.blob("some-object").size == 6
+    assert (
+        bucket.blob("some-object", generation=first_generation).download_as_bytes()
+        == b"first"
+    )
+
+    # A blob given a generation only deletes that version.
+    bucket.blob("some-object", generation=first_generation).delete()
+    assert bucket.blob("some-object").download_as_text() == "second"
+    with pytest.raises(NotFound):
+        bucket.blob("some-object", generation=first_generation).delete()
+
+    bucket.blob("some-object").delete()
+    assert bucket.get_blob("some-object") is None
+
+
+def test_fake_storage_client_files(tmp_path):
+    path = tmp_path / "some-file"
+    path.write_bytes(b"0123456789")
+    storage_client = FakeStorageClient()
+    storage_client.bucket("some-bucket").blob("some-object").upload_from_filename(path)
+
+    blob = storage_client.bucket("some-bucket").blob("some-object")
+    assert blob.size == 10
+    assert blob.download_as_bytes(start=2, end=4) == b"234"
+    with blob.open("rb") as reader:
+        reader.seek(7)
+        assert reader.read() == b"789"
+
+
+def test_fake_storage_client_list_blobs():
+    storage_client = FakeStorageClient()
+    bucket = storage_client.bucket("some-bucket")
+    for name in ["b/2", "a/1", "b/1"]:
+        bucket.blob(name).upload_from_string(name)
+
+    assert [blob.name for blob in storage_client.list_blobs("some-bucket")] == [
+        "a/1",
+        "b/1",
+        "b/2",
+    ]
+    assert [blob.name for blob in bucket.list_blobs(prefix="b/")] == ["b/1", "b/2"]
+
+
+def test_fake_storage_client_latency():
+    storage_client = FakeStorageClient(latency=0.01)
+    bucket = storage_client.bucket("some-bucket")
+    with mock.patch(
+        "phdi_cloud_function_utils_testing.fakes.time.sleep"
+    ) as patched_sleep:
+        # Getting a blob object makes no request, like in the GCS client.
+        blob = bucket.blob("some-object")
+        assert patched_sleep.call_count == 0
+        blob.upload_from_string("data")
+        assert bucket.get_blob("some-object").download_as_bytes() == b"data"
+        assert not blob.bucket.blob("other-object").exists()
+        assert patched_sleep.call_args_list == [mock.call(0.01)] * 4
+
+
+def test_fake_publisher_client_without_keeping_messages():
+    publisher = FakePublisherClient(keep_messages=False)
+    for _ in range(3):
+        assert publisher.publish("some-topic", b"data").result()
+    assert publisher.published == []
+    assert publisher.published_count == 3
+
+
+def test_fake_subscriber_client_redelivery():
+    subscriber = FakeSubscriberClient()
+    subscription = subscriber.subscription_path("some-project", "some-subscription")
+    for idx in range(3):
+        subscriber.publish(f"message {idx}".encode(), filename="some-file")
+
+    response = subscriber.pull(subscription=subscription, max_messages=2)
+    assert [received.message.data for received in response.received_messages] == [
+        b"message 0",
+        b"message 1",
+    ]
+    assert response.received_messages[0].message.attributes == {"filename": "some-file"}
+
+    # Pulled messages are held until acknowledged or their deadline is reset.
+    first, second = response.received_messages
+    subscriber.acknowledge(subscription=subscription, ack_ids=[first.ack_id])
+    subscriber.modify_ack_deadline(
+        subscription=subscription, ack_ids=[second.ack_id], ack_deadline_seconds=0
+    )
+    response = subscriber.pull(subscription=subscription, max_messages=10)
+    assert [received.message.data for received in response.received_messages] == [
+        b"message 1",
+        b"message 2",
+    ]
+    assert response.received_messages[0].delivery_attempt == 2
+    assert subscriber.acknowledged == [first.ack_id]
+    assert subscriber.outstanding_count == 2
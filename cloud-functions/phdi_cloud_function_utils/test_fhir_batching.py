@@ -0,0 +1,154 @@
+from phdi_cloud_function_utils import (
+    EntrySource,
+    FhirBundleBatch,
+    get_entry_status_code,
+    get_patient_key,
+    get_upload_response,
+    is_successful_upload,
+)
+import pytest
+
+
+def make_bundle(patient_id: str, patient_hash: str = None, observations: int = 1):
+    patient = {"resourceType": "Patient", "id": patient_id}
+    if patient_hash:
+        patient["identifier"] = [
+            {"system": "urn:ietf:rfc:3986", "value": patient_hash},
+        ]
+    entries = [
+        {
+            "fullUrl": f"urn:uuid:{patient_id}",
+            "resource": patient,
+            "request": {"method": "PUT", "url": f"Patient/{patient_id}"},
+        }
+    ]
+    for idx in range(observations):
+        observation_id = f"{patient_id}-obs-{idx}"
+        entries.append(
+            {
+                "fullUrl": f"urn:uuid:{observation_id}",
+                "resource": {
+                    "resourceType": "Observation",
+                    "id": observation_id,
+                    "subject": {"reference": f"Patient/{patient_id}"},
+                    "performer": [{"reference": f"urn:uuid:{patient_id}"}],
+                },
+                "request": {"method": "PUT", "url": f"Observation/{observation_id}"},
+            }
+        )
+    return {"resourceType": "Bundle", "type": "batch", "entry": entries}
+
+
+def test_get_patient_key():
+    assert get_patient_key({"resourceType": "Observation", "id": "1"}) is None
+    assert get_patient_key({"resourceType": "Patient"}) is None
+    assert get_patient_key({"resourceType": "Patient", "id": "1"}) == "Patient/1"
+    patient = make_bundle("1", patient_hash="abc")["entry"][0]["resource"]
+    assert get_patient_key(patient) == "urn:ietf:rfc:3986|abc"
+
+
+def test_get_entry_status_code():
+    assert get_entry_status_code({"status": "201 Created"}) == 201
+    assert get_entry_status_code({"status": "429"}) == 429
+    assert get_entry_status_code({"status": "Created"}) == 0
+    assert get_entry_status_code({}) == 0
+
+
+def test_merge_bundles_deduplicating_patients():
+    batch = FhirBundleBatch()
+    assert batch.add("message-1", make_bundle("a", patient_hash="same"))
+    assert batch.add("message-2", make_bundle("b", patient_hash="same"))
+    assert batch.add("message-3", make_bundle("c", patient_hash="other"))
+
+    bundle = batch.to_bundle()
+    assert bundle["type"] == "batch"
+    # The last patient received replaces the first.
+    assert [entry["resource"]["id"] for entry in bundle["entry"]] == [
+        "b",
+        "a-obs-0",
+        "b-obs-0",
+        "c",
+        "c-obs-0",
+    ]
+    assert batch.deduplicated_count == 1
+    assert batch.entry_sources[0] == [
+        EntrySource("message-1", 0),
+        EntrySource("message-2", 0),
+    ]
+
+    # References to the replaced patient now refer to the patient kept.
+    for entry in bundle["entry"][1:3]:
+        assert entry["resource"]["subject"] == {"reference": "Patient/b"}
+        assert entry["resource"]["performer"] == [{"reference": "urn:uuid:b"}]
+    assert bundle["entry"][4]["resource"]["subject"] == {"reference": "Patient/c"}
+
+
+def test_merge_bundles_replacing_patients_more_than_once():
+    batch = FhirBundleBatch()
+    for idx, patient_id in enumerate(["a", "b", "a", "d"]):
+        assert batch.add(f"message-{idx}", make_bundle(patient_id, patient_hash="same"))
+
+    bundle = batch.to_bundle()
+    assert len(bundle["entry"]) == 5
+    assert bundle["entry"][0]["resource"]["id"] == "d"
+    assert batch.deduplicated_count == 3
+    assert len(batch.entry_sources[0]) == 4
+    for entry in bundle["entry"][1:]:
+        assert entry["resource"]["subject"] == {"reference": "Patient/d"}
+        assert entry["resource"]["performer"] == [{"reference": "urn:uuid:d"}]
+    # Building the bundle again leaves the references as they are.
+    assert batch.to_bundle() == bundle
+
+
+def test_batch_limits():
+    clock_time = [0.0]
+    batch = FhirBundleBatch(max_entries=5, window=10.0, clock=lambda: clock_time[0])
+    assert not batch.is_due()
+
+    assert batch.add("message-1", make_bundle("a", observations=2))
+    assert not batch.add("message-2", make_bundle("b", observations=2))
+    assert not batch.is_full()
+    clock_time[0] = 10.0
+    assert batch.is_due()
+
+    # A bundle too large to merge is added to an empty batch to be uploaded alone.
+    batch = FhirBundleBatch(max_entries=5)
+    assert batch.add("message-1", make_bundle("a", observations=9))
+    assert batch.is_full()
+
+    batch = FhirBundleBatch(max_bytes=1000)
+    assert batch.add("message-1", make_bundle("a"), size_bytes=600)
+    assert not batch.add("message-2", make_bundle("b"), size_bytes=600)
+
+    with pytest.raises(ValueError):
+        FhirBundleBatch(bundle_type="collection")
+
+
+def test_map_response():
+    batch = FhirBundleBatch()
+    batch.add("message-1", make_bundle("a", patient_hash="same", observations=2))
+    batch.add("message-2", make_bundle("b", patient_hash="same", observations=2))
+    batch.add("message-3", make_bundle("c", observations=1))
+    assert len(batch) == 7
+
+    response = get_upload_response()
+    response["entry"] = response["entry"][:7]
+    response["entry"][4]["response"]["status"] = "429 Too Many Requests"
+    results = batch.map_response(response)
+
+    assert [result["index"] for result in results["message-1"]] == [0, 1, 2]
+    assert [result["index"] for result in results["message-2"]] == [0, 1, 2]
+    # The patient shared by the first two messages was uploaded once, for both.
+    assert results["message-2"][0]["response"] == response["entry"][0]["response"]
+    assert results["message-2"][2]["status_code"] == 429
+    assert is_successful_upload(results["message-1"])
+    assert not is_successful_upload(results["message-2"])
+    assert is_successful_upload(results["message-3"])
+
+    results = batch.map_failure(503, {"resourceType": "OperationOutcome"})
+    assert all(
+        not is_successful_upload(source_results) for source_results in results.values()
+    )
+    assert results["message-3"][1]["response"]["outcome"] == {
+        "resourceType": "OperationOutcome"
+    }
@@ -0,0 +1,145 @@
+from phdi_cloud_function_utils import (
+    FhirUploadError,
+    RetryPolicy,
+    get_retryable_entries,
+    get_upload_response,
+    is_retryable_fhir_error,
+    make_retry_bundle,
+    upload_with_partial_retry,
+)
+from unittest import mock
+
+
+def make_bundle(entry_count: int) -> dict:
+    return {
+        "resourceType": "Bundle",
+        "type": "batch",
+        "entry": [
+            {
+                "resource": {"resourceType": "Observation", "id": str(idx)},
+                "request": {"method": "PUT", "url": f"Observation/{idx}"},
+            }
+            for idx in range(entry_count)
+        ],
+    }
+
+
+def make_response(statuses: list = None, status_code: int = 200) -> mock.Mock:
+    response = mock.Mock(status_code=status_code)
+    if statuses is None:
+        response.json.return_value = {"resourceType": "OperationOutcome"}
+    else:
+        response.json.return_value = {
+            "resourceType": "Bundle",
+            "type": "batch-response",
+            "entry": [{"response": {"status": status}} for status in statuses],
+        }
+    return response
+
+
+class FakeFhirServer:
+    """
+    Answers each upload with the next list of statuses, recording the IDs of the
+    resources in each uploaded bundle.
+    """
+
+    def __init__(self, responses: list):
+        self.responses = list(responses)
+        self.uploaded = []
+
+    def upload(self, bundle: dict) -> mock.Mock:
+        self.uploaded.append([entry["resource"]["id"] for entry in bundle["entry"]])
+        return self.responses.pop(0)
+
+
+def test_is_retryable_fhir_error():
+    assert is_retryable_fhir_error(FhirUploadError(429))
+    assert is_retryable_fhir_error(FhirUploadError(503))
+    assert not is_retryable_fhir_error(FhirUploadError(400))
+    assert not is_retryable_fhir_error(FhirUploadError(412))
+    assert not is_retryable_fhir_error(ValueError())
+
+
+def test_get_retryable_entries():
+    response = get_upload_response()
+    assert get_retryable_entries(response) == []
+
+    response["entry"][1]["response"]["status"] = "429 Too Many Requests"
+    response["entry"][2]["response"]["status"] = "400 Bad Request"
+    response["entry"][5]["response"]["status"] = "503"
+    assert get_retryable_entries(response) == [1, 5]
+
+    bundle = make_bundle(len(response["entry"]))
+    retry_bundle = make_retry_bundle(bundle, get_retryable_entries(response))
+    assert retry_bundle["type"] == "batch"
+    assert retry_bundle["entry"] == [bundle["entry"][1], bundle["entry"][5]]
+
+
+def test_upload_with_partial_retry():
+    server = FakeFhirServer(
+        [
+            make_response(["201 Created", "429", "400 Bad Request", "503", "200 OK"]),
+            make_response(["201 Created", "503"]),
+            make_response(["200 OK"]),
+        ]
+    )
+    sleep = mock.Mock()
+    result = upload_with_partial_retry(
+        make_bundle(5),
+        upload=server.upload,
+        retry_policy=RetryPolicy(
+            initial_backoff=1.0, jitter=False, retryable=is_retryable_fhir_error
+        ),
+        sleep=sleep,
+    )
+
+    # Entries that succeeded, or failed with a status that will not change, are not
+    # sent again.
+    assert server.uploaded == [["0", "1", "2", "3", "4"], ["1", "3"], ["3"]]
+    assert sleep.call_args_list == [mock.call(1.0), mock.call(2.0)]
+    assert result.attempts == 3
+    assert result.entries_sent == 8
+    assert result.failed_entries == [2]
+    assert [entry["response"]["status"] for entry in result.to_response()["entry"]] == [
+        "201 Created",
+        "201 Created",
+        "400 Bad Request",
+        "200 OK",
+        "200 OK",
+    ]
+
+
+def test_upload_with_partial_retry_gives_up():
+    server = FakeFhirServer(
+        [make_response(["201 Created", "429"]), make_response(["429"])]
+    )
+    result = upload_with_partial_retry(
+        make_bundle(2),
+        upload=server.upload,
+        retry_policy=RetryPolicy(
+            max_attempts=2, initial_backoff=0, retryable=is_retryable_fhir_error
+        ),
+    )
+    assert server.uploaded == [["0", "1"], ["1"]]
+    assert result.failed_entries == [1]
+
+
+def test_upload_with_partial_retry_whole_request():
+    # A rejected request is sent again in full, unless retrying cannot help.
+    server = FakeFhirServer(
+        [make_response(status_code=429), make_response(["201 Created", "200 OK"])]
+    )
+    result = upload_with_partial_retry(
+        make_bundle(2), upload=server.upload, sleep=mock.Mock()
+    )
+    assert server.uploaded == [["0", "1"], ["0", "1"]]
+    assert result.failed_entries == []
+
+    server = FakeFhirServer([make_response(status_code=422)])
+    result = upload_with_partial_retry(
+        make_bundle(2), upload=server.upload, sleep=mock.Mock()
+    )
+    assert result.attempts == 1
+    assert result.status_code == 422
+    assert result.failed_entries == [0, 1]
+    assert result.entry_responses[0]["outcome"] == {"resourceType": "OperationOutcome"}
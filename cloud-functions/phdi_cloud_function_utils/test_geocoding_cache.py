@@ -0,0 +1,177 @@
+from phdi_cloud_function_utils import (
+    GCSGeocodeCacheStore,
+    GeocodeCache,
+    Metrics,
+    SQLiteGeocodeCacheStore,
+    apply_geocode_result,
+    get_sample_single_patient_bundle,
+    normalize_address_key,
+)
+from phdi_cloud_function_utils_testing.fakes import FakeGeocoder, FakeStorageClient
+from unittest import mock
+import pytest
+
+
+def make_address(line: str, postal_code: str = "10001") -> dict:
+    return {
+        "line": [line],
+        "city": "New York",
+        "state": "NY",
+        "postalCode": postal_code,
+    }
+
+
+def test_normalize_address_key():
+    assert normalize_address_key(
+        {
+            "line": ["123 Main Street", "Apartment 4"],
+            "city": "new york",
+            "state": "NY",
+            "postalCode": "10001-1234",
+        }
+    ) == normalize_address_key(
+        {
+            "line": ["123 MAIN ST.  APT #4"],
+            "city": "New York",
+            "state": "ny",
+            "postalCode": "10001",
+        }
+    )
+    assert normalize_address_key(make_address("123 Main St")) == (
+        "123 MAIN ST|NEW YORK|NY|10001"
+    )
+    assert normalize_address_key(make_address("124 Main St")) != (
+        normalize_address_key(make_address("123 Main St"))
+    )
+    assert normalize_address_key({}) is None
+    assert normalize_address_key({"line": [], "use": "home"}) is None
+
+
+def test_apply_geocode_result():
+    result = FakeGeocoder()([make_address("123 Main St")])[0]
+    address = make_address("123 Main St")
+    apply_geocode_result(address, result)
+    assert address["line"] == ["123 MAIN ST"]
+    assert address["county"] == "Fake County"
+    assert address["extension"][0]["extension"] == [
+        {"url": "latitude", "valueDecimal": result["lat"]},
+        {"url": "longitude", "valueDecimal": result["lng"]},
+    ]
+    assert "_line" not in address
+
+    address = make_address("123 Main St")
+    apply_geocode_result(address, {**result, "census_tract": "1234"}, update_line=False)
+    assert address["line"] == ["123 Main St"]
+    assert "county" not in address
+    assert address["_line"][0]["extension"][0]["valueString"] == "1234"
+
+
+def test_geocode_cache():
+    geocoder = FakeGeocoder(unmatched="PO BOX")
+    geocode_cache = GeocodeCache(geocoder, batch_size=2)
+    metrics = Metrics()
+    addresses = [
+        make_address("1 Main St"),
+        make_address("2 Main St"),
+        make_address("1 Main Street"),
+        make_address("PO Box 1"),
+        {},
+        make_address("3 Main St"),
+    ]
+    results = geocode_cache.geocode_addresses(addresses, metrics=metrics)
+
+    # Addresses with the same key are geocoded once, in batches.
+    assert geocoder.request_sizes == [2, 2]
+    assert results[0] == results[2]
+    assert results[3] is None
+    assert results[4] is None
+    assert results[5]["line"] == ["3 MAIN ST"]
+    assert metrics.counters["geocode_cache_misses"] == 4
+    assert metrics.counters["geocode_cache_memory_hits"] == 1
+
+    # Unmatched addresses are cached too.
+    assert geocode_cache.geocode_addresses(addresses[:4]) == results[:4]
+    assert geocoder.request_sizes == [2, 2]
+    assert geocode_cache.counters == {
+        "memory_hits": 5,
+        "store_hits": 0,
+        "misses": 4,
+        "geocoder_requests": 2,
+    }
+    assert geocode_cache.hit_ratio == 5 / 9
+
+
+def test_geocode_cache_lru():
+    geocoder = FakeGeocoder()
+    geocode_cache = GeocodeCache(geocoder, max_size=2)
+    for line in ["1 Main St", "2 Main St", "1 Main St", "3 Main St"]:
+        geocode_cache.geocode_addresses([make_address(line)])
+    assert len(geocode_cache) == 2
+
+    # "2 Main St" was the least recently used, so it was evicted.
+    geocode_cache.geocode_addresses([make_address("1 Main St")])
+    geocode_cache.geocode_addresses([make_address("2 Main St")])
+    assert geocoder.address_count == 4
+
+
+@pytest.fixture(params=["sqlite", "gcs"])
+def geocode_cache_store(request, tmp_path):
+    clock = mock.Mock(return_value=1000.0)
+    if request.param == "sqlite":
+        store = SQLiteGeocodeCacheStore(
+            str(tmp_path / "geocode.db"), ttl=100, clock=clock
+        )
+    else:
+        store = GCSGeocodeCacheStore(
+            FakeStorageClient(), "some-bucket", ttl=100, clock=clock
+        )
+    return store, clock
+
+
+def test_geocode_cache_store(geocode_cache_store):
+    store, clock = geocode_cache_store
+    store.put_many({"a": {"lat": 1.0}, "b": None})
+    assert store.get_many(["a", "b", "c"]) == {"a": {"lat": 1.0}, "b": None}
+
+    # Results expire after the TTL.
+    clock.return_value = 1050.0
+    store.put_many({"b": {"lat": 2.0}})
+    clock.return_value = 1120.0
+    assert store.get_many(["a", "b"]) == {"b": {"lat": 2.0}}
+
+
+def test_geocode_cache_with_store():
+    geocoder = FakeGeocoder()
+    store = mock.Mock(wraps=SQLiteGeocodeCacheStore())
+    addresses = [make_address("1 Main St"), make_address("2 Main St")]
+    GeocodeCache(geocoder, store=store).geocode_addresses(addresses)
+
+    # A new instance finds the results in the store, looked up in a single call.
+    geocode_cache = GeocodeCache(geocoder, store=store)
+    results = geocode_cache.geocode_addresses(addresses + [make_address("3 Main St")])
+    assert geocoder.request_sizes == [2, 1]
+    assert store.get_many.call_count == 2
+    assert results[1]["line"] == ["2 MAIN ST"]
+    assert geocode_cache.counters["store_hits"] == 2
+    assert geocode_cache.counters["misses"] == 1
+
+    # The results are then served from memory.
+    geocode_cache.geocode_addresses(addresses)
+    assert store.get_many.call_count == 2
+
+
+def test_geocode_bundle():
+    bundle = get_sample_single_patient_bundle()
+    geocode_cache = GeocodeCache(FakeGeocoder())
+    geocode_cache.geocode_bundle(bundle)
+    patient = next(
+        entry["resource"]
+        for entry in bundle["entry"]
+        if entry["resource"]["resourceType"] == "Patient"
+    )
+    for address in patient["address"]:
+        assert address["line"] == [line.upper() for line in address["line"]]
+        assert address["extension"][-1]["url"] == (
+            "http://hl7.org/fhir/StructureDefinition/geolocation"
+        )
+    assert geocode_cache.counters["misses"] == len(patient["address"])
@@ -0,0 +1,68 @@
+from phdi_cloud_function_utils import (
+    HarmonizationContext,
+    HarmonizationStepError,
+    Metrics,
+    run_harmonization_chain,
+    select_harmonization_steps,
+)
+import pytest
+
+
+def add_tag(tag: str):
+    def step(bundle: dict, context: HarmonizationContext) -> dict:
+        bundle.setdefault("tags", []).append(tag)
+        context.results[tag] = context.options.get("suffix", "")
+        return bundle
+
+    return step
+
+
+def fail(bundle: dict, context: HarmonizationContext) -> dict:
+    raise RuntimeError("Something went wrong.")
+
+
+STEPS = {"first": add_tag("first"), "second": add_tag("second"), "fail": fail}
+
+
+def test_select_harmonization_steps():
+    selected = select_harmonization_steps(["second", " first", ""], STEPS)
+    assert [name for name, _ in selected] == ["second", "first"]
+
+    with pytest.raises(
+        ValueError,
+        match="Unknown harmonization step: third. Steps must be one of first, "
+        "second, fail.",
+    ):
+        select_harmonization_steps(["first", "third"], STEPS)
+
+
+def test_run_harmonization_chain():
+    bundle = {"resourceType": "Bundle"}
+    context = HarmonizationContext(options={"suffix": "!"})
+    metrics = Metrics()
+
+    result = run_harmonization_chain(
+        bundle,
+        select_harmonization_steps(["first", "second"], STEPS),
+        context=context,
+        metrics=metrics,
+    )
+
+    # The same bundle is passed from step to step.
+    assert result is bundle
+    assert bundle["tags"] == ["first", "second"]
+    assert context.results == {"first": "!", "second": "!"}
+    assert set(metrics.stage_seconds) == {"first", "second"}
+
+
+def test_run_harmonization_chain_failure():
+    bundle = {"resourceType": "Bundle"}
+
+    with pytest.raises(HarmonizationStepError) as error:
+        run_harmonization_chain(
+            bundle, select_harmonization_steps(["first", "fail", "second"], STEPS)
+        )
+
+    assert error.value.step == "fail"
+    assert error.value.bundle == {"resourceType": "Bundle", "tags": ["first"]}
+    assert str(error.value) == "The fail step failed: Something went wrong."
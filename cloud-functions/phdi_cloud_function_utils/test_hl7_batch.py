@@ -0,0 +1,166 @@
+import mmap
+from pathlib import Path
+from phdi_cloud_function_utils import (
+    get_hl7_message,
+    iter_hl7_message_offsets,
+    stream_hl7_batch_message_offsets,
+    stream_hl7_batch_messages,
+    stream_hl7_message_offsets,
+)
+import pytest
+
+EXAMPLE_MESSAGES = (
+    Path(__file__).parent / "phdi_cloud_function_utils" / "example_messages"
+)
+
+
+def _chunk(data: bytes, chunk_size: int) -> list:
+    chunks = []
+    for start in range(0, len(data), chunk_size):
+        end = start + chunk_size
+        chunks.append(data[start:end])
+    return chunks
+
+
+def test_stream_hl7_batch_messages():
+    batch = (
+        "FHS|^~\\&|\r\nBHS|^~\\&|\r\n\u000bMSH|^~\\&|1\r\nPID|1\r\n\r\n\u001c\r\n"
+        "\u000bMSH|^~\\&|2\r\nPID|2  \r\nBTS|2\r\nFTS|1\r\n"
+    )
+    expected_messages = ["MSH|^~\\&|1\rPID|1\r", "MSH|^~\\&|2\rPID|2  \r"]
+
+    assert list(stream_hl7_batch_messages([batch])) == expected_messages
+    assert list(stream_hl7_batch_messages([batch.encode("utf-8")])) == (
+        expected_messages
+    )
+
+
+def test_stream_hl7_batch_messages_strips_ends_of_file():
+    batch = b"  \n  MSH|1\nPID|1  \n   \n"
+    assert list(stream_hl7_batch_messages([batch])) == ["MSH|1\rPID|1\r"]
+    assert list(stream_hl7_batch_messages([])) == []
+
+
+def test_stream_hl7_batch_message_offsets_range_of_file():
+    # A range of a file ending before the end of the file, as a shard does, ends with
+    # the same message as when the whole file is read.
+    batch = b"MSH|1\nPID|1  \nMSH|2\nPID|2  \n"
+    end = batch.index(b"MSH|2")
+    messages = list(stream_hl7_batch_message_offsets([batch]))
+    assert messages[0] == ("MSH|1\rPID|1  \r", end)
+    assert (
+        list(stream_hl7_batch_message_offsets([batch[:end]], end_of_file=False))
+        == messages[:1]
+    )
+    assert list(stream_hl7_batch_message_offsets([batch[:end]])) == [
+        ("MSH|1\rPID|1\r", end)
+    ]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 256, 1024 * 1024])
+def test_stream_hl7_batch_messages_chunk_boundaries(chunk_size):
+    # Multibyte characters and CRLF line endings may be split between chunks.
+    batch = "MSH|1\r\nPID|1|José\r\nMSH|2\r\nPID|2|Renée\r\n".encode("utf-8")
+    assert list(stream_hl7_batch_messages(_chunk(batch, chunk_size))) == [
+        "MSH|1\rPID|1|José\r",
+        "MSH|2\rPID|2|Renée\r",
+    ]
+
+
+@pytest.mark.parametrize(
+    "filename,expected_message_count",
+    [
+        ("VXU-V04-01_success_single.hl7", 1),
+        ("VXU-V04-02_success_batch.hl7", 2),
+        ("VXU-V04-02_failedConversion.hl7", 2),
+        ("VXU-V04-03_batch_1_success_1_failConversion.hl7", 2),
+    ],
+)
+def test_stream_hl7_batch_messages_example_messages(filename, expected_message_count):
+    batch = (EXAMPLE_MESSAGES / filename).read_bytes()
+    expected_messages = list(stream_hl7_batch_messages([batch]))
+
+    assert len(expected_messages) == expected_message_count
+    for message in expected_messages:
+        assert message.startswith("MSH")
+        assert "\n" not in message
+    assert list(stream_hl7_batch_messages(_chunk(batch, 100))) == expected_messages
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1024])
+def test_stream_hl7_batch_message_offsets(chunk_size):
+    batch = b"\r\nFHS|1\r\nMSH|1\r\nPID|1\r\nMSH|2\r\nPID|2\r\nMSH|3\r\nFTS|1\r\n"
+    messages = list(stream_hl7_batch_message_offsets(_chunk(batch, chunk_size)))
+    assert messages == [
+        ("MSH|1\rPID|1\r", 23),
+        ("MSH|2\rPID|2\r", 37),
+        ("MSH|3\r", 44),
+    ]
+
+    # Streaming from the end of a message resumes with the message after it.
+    _, end = messages[0]
+    assert (
+        list(
+            stream_hl7_batch_message_offsets(
+                _chunk(batch[end:], chunk_size), offset=end
+            )
+        )
+        == messages[1:]
+    )
+
+
+def test_iter_hl7_message_offsets():
+    batch = b"FHS|\r\nBHS|\r\n\x0bMSH|1\r\nPID|MSH\r\n\x1c\r\n\x0bMSH|2\r\nBTS|\r\nFTS|"
+
+    offsets = list(iter_hl7_message_offsets(batch))
+
+    assert offsets == [(13, 32), (33, 40)]
+    assert batch[13:32] == b"MSH|1\r\nPID|MSH\r\n\x1c\r\n"
+    assert get_hl7_message(batch, *offsets[0]) == "MSH|1\rPID|MSH\r"
+    assert get_hl7_message(batch, *offsets[1]) == "MSH|2\r"
+    assert list(iter_hl7_message_offsets(b"FHS|\nBHS|\nBTS|\nFTS|")) == []
+    assert list(iter_hl7_message_offsets(b"")) == []
+
+
+@pytest.mark.parametrize(
+    "filename",
+    [
+        "VXU-V04-01_success_single.hl7",
+        "VXU-V04-02_success_batch.hl7",
+        "VXU-V04-02_failedConversion.hl7",
+        "VXU-V04-02_failedUpload.hl7",
+        "VXU-V04-03_batch_1_success_1_failConversion.hl7",
+    ],
+)
+def test_iter_hl7_message_offsets_example_messages(filename, tmp_path):
+    path = EXAMPLE_MESSAGES / filename
+    batch = path.read_bytes()
+    expected_messages = list(stream_hl7_batch_messages([batch]))
+
+    for data in [batch, memoryview(batch)]:
+        messages = [
+            get_hl7_message(data, start, end)
+            for start, end in iter_hl7_message_offsets(data)
+        ]
+        assert messages == expected_messages
+
+    with path.open("rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offsets = list(iter_hl7_message_offsets(data))
+            messages = [get_hl7_message(data, start, end) for start, end in offsets]
+    assert messages == expected_messages
+    for start, end in offsets:
+        assert batch[start:end].startswith(b"MSH")
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 5, 13, 1000])
+def test_stream_hl7_message_offsets(chunk_size):
+    batch = b"FHS|\r\nBHS|\r\n\x0bMSH|1\r\nPID|MSH\r\n\x1c\r\n\x0bMSH|2\r\nBTS|\r\nFTS|"
+    assert list(stream_hl7_message_offsets(_chunk(batch, chunk_size))) == list(
+        iter_hl7_message_offsets(batch)
+    )
+    assert list(stream_hl7_message_offsets(_chunk(batch[13:], chunk_size), 13)) == [
+        (13, 32),
+        (33, 40),
+    ]
+    assert list(stream_hl7_message_offsets([])) == []
@@ -0,0 +1,102 @@
+from phdi_cloud_function_utils import Histogram, Metrics, OpenTelemetryExporter
+from unittest import mock
+import pytest
+import time
+
+
+def test_histogram():
+    histogram = Histogram()
+    assert histogram.summary()["p50"] is None
+    for value in range(1, 101):
+        histogram.record(value)
+
+    summary = histogram.summary()
+    assert summary["count"] == 100
+    assert summary["sum"] == 5050
+    assert summary["mean"] == 50.5
+    assert (summary["min"], summary["max"]) == (1, 100)
+    assert (summary["p50"], summary["p90"], summary["p99"]) == (50, 90, 99)
+
+
+def test_histogram_sampling():
+    histogram = Histogram(max_samples=100, seed=0)
+    for value in range(10000):
+        histogram.record(value)
+
+    assert len(histogram._samples) == 100
+    assert histogram.count == 10000
+    assert histogram.max == 9999
+    assert 3000 < histogram.percentile(50) < 7000
+
+
+def test_metrics_counters_and_histograms():
+    metrics = Metrics()
+    metrics.increment("messages")
+    metrics.increment("bytes", 10)
+    metrics.increment("bytes", 5)
+    metrics.record("latency", 0.5)
+
+    summary = metrics.summary()
+    assert summary["counters"] == {"messages": 1, "bytes": 15}
+    assert summary["histograms"]["latency"]["count"] == 1
+
+
+def test_metrics_timers_are_exclusive():
+    metrics = Metrics()
+
+    def chunks():
+        for _ in range(3):
+            with metrics.timer("download"):
+                time.sleep(0.01)
+            yield b"chunk"
+
+    for _ in metrics.time_iterator("split", chunks()):
+        pass
+
+    stage_seconds = metrics.summary()["stage_seconds"]
+    assert stage_seconds["download"] >= 0.03
+    assert stage_seconds["split"] < 0.01
+
+
+def test_metrics_exporter():
+    exporter = mock.Mock()
+    metrics = Metrics(exporter=exporter)
+    metrics.increment("messages", 2)
+    metrics.record("latency", 0.5)
+
+    exporter.increment.assert_called_with("messages", 2)
+    exporter.record.assert_called_with("latency", 0.5)
+
+
+def test_opentelemetry_exporter():
+    sdk_metrics = pytest.importorskip("opentelemetry.sdk.metrics")
+    export = pytest.importorskip("opentelemetry.sdk.metrics.export")
+    reader = export.InMemoryMetricReader()
+    meter_provider = sdk_metrics.MeterProvider(metric_readers=[reader])
+
+    with mock.patch(
+        "phdi_cloud_function_utils.instrumentation.otel_metrics.get_meter",
+        meter_provider.get_meter,
+    ):
+        metrics = Metrics(
+            exporter=OpenTelemetryExporter(attributes={"function": "some-function"})
+        )
+    metrics.increment("messages", 2)
+    metrics.increment("messages", 3)
+    metrics.record("latency", 0.5)
+
+    exported = {
+        metric.name: metric.data.data_points[0]
+        for resource_metrics in reader.get_metrics_data().resource_metrics
+        for scope_metrics in resource_metrics.scope_metrics
+        for metric in scope_metrics.metrics
+    }
+    assert exported["messages"].value == 5
+    assert exported["messages"].attributes == {"function": "some-function"}
+    assert exported["latency"].count == 1
+
+
+def test_opentelemetry_exporter_missing_package():
+    with mock.patch("phdi_cloud_function_utils.instrumentation.otel_metrics", None):
+        with pytest.raises(ImportError):
+            OpenTelemetryExporter()
@@ -0,0 +1,109 @@
+from phdi_cloud_function_utils import ConcurrentPublisher, MessageLogger
+from phdi_cloud_function_utils_testing.fakes import FakePublisherClient
+import logging
+import pytest
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_message_logger_modes(caplog):
+    caplog.set_level(logging.INFO)
+    for mode, expected_messages in [
+        ("all", [0, 1, 2, 3, 4, 5, 6]),
+        ("sampled", [0, 3, 6]),
+        ("failures", []),
+    ]:
+        caplog.clear()
+        message_logger = MessageLogger(source="some-file", mode=mode, sample_rate=3)
+        for idx in range(7):
+            message_logger.message("Message %d was published.", idx)
+        message_logger.failure("Message %d failed.", 7)
+
+        assert caplog.messages == [
+            f"Message {idx} was published." for idx in expected_messages
+        ] + ["Message 7 failed."]
+        assert caplog.records[-1].levelno == logging.ERROR
+        assert message_logger.message_count == 7
+        assert message_logger.failure_count == 1
+        assert message_logger.logged_count == len(expected_messages) + 1
+
+
+def test_message_logger_formats_lazily(caplog):
+    caplog.set_level(logging.WARNING)
+
+    class Unformattable:
+        def __str__(self):
+            raise AssertionError("Formatted a line that is not emitted.")
+
+    message_logger = MessageLogger(source="some-file")
+    message_logger.message("Message %s was published.", Unformattable())
+    assert caplog.messages == []
+    assert message_logger.logged_count == 0
+
+
+def test_message_logger_progress(caplog):
+    caplog.set_level(logging.INFO)
+    clock = Clock()
+    message_logger = MessageLogger(
+        source="some-file", mode="failures", progress_interval=10.0, clock=clock
+    )
+    for _ in range(5):
+        message_logger.message("Published.")
+        clock.now += 3.0
+    message_logger.failure("Failed.")
+
+    assert caplog.messages == [
+        "some-file: 5 messages and 0 failures in the last 12.0 seconds, 5 messages "
+        "and 0 failures in total.",
+        "Failed.",
+    ]
+    message_logger.log_progress()
+    assert caplog.messages[-1] == (
+        "some-file: 0 messages and 1 failures in the last 3.0 seconds, 5 messages "
+        "and 1 failures in total."
+    )
+
+
+def test_message_logger_from_environment():
+    message_logger = MessageLogger.from_environment(
+        source="some-file",
+        environ={"MESSAGE_LOG_MODE": "sampled", "MESSAGE_LOG_SAMPLE_RATE": "10"},
+    )
+    assert message_logger.mode == "sampled"
+    assert message_logger.sample_rate == 10
+    assert message_logger.progress_interval == 30.0
+
+    with pytest.raises(ValueError, match="Unknown message log mode: verbose."):
+        MessageLogger.from_environment(
+            source="some-file", environ={"MESSAGE_LOG_MODE": "verbose"}
+        )
+
+
+def test_concurrent_publisher_message_logger(caplog):
+    caplog.set_level(logging.INFO)
+    publisher = FakePublisherClient(failure_rate=1.0)
+    message_logger = MessageLogger(source="some-file", mode="failures")
+    concurrent_publisher = ConcurrentPublisher(
+        publisher=publisher,
+        topic_path="some-topic",
+        source="some-file",
+        failure_handler=lambda idx, message, error: None,
+        message_logger=message_logger,
+    )
+    concurrent_publisher.publish(0, "some-message", b"some-message")
+    concurrent_publisher.flush()
+
+    assert message_logger.failure_count == 1
+    assert [record.levelno for record in caplog.records] == [
+        logging.WARNING,
+        logging.ERROR,
+    ]
+    assert caplog.messages[-1].startswith(
+        "Publishing message 0 in some-file failed after 2 attempts because"
+    )
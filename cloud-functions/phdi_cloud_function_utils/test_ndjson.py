@@ -0,0 +1,151 @@
+from phdi_cloud_function_utils import (
+    get_patient_reference,
+    make_fhir_bundle,
+    stream_fhir_bundles,
+    stream_ndjson_lines,
+)
+import json
+import pytest
+
+
+def _chunk(data: bytes, chunk_size: int) -> list:
+    chunks = []
+    for start in range(0, len(data), chunk_size):
+        end = start + chunk_size
+        chunks.append(data[start:end])
+    return chunks
+
+
+def _ndjson(resources: list) -> bytes:
+    return "".join(json.dumps(resource) + "\n" for resource in resources).encode()
+
+
+def _ids(bundle: dict) -> list:
+    return [entry["resource"]["id"] for entry in bundle["entry"]]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 1000])
+def test_stream_ndjson_lines(chunk_size):
+    data = b'{"a": 1}\r\n\n  \n{"b": 2}\n{"c": 3}'
+    assert list(stream_ndjson_lines(_chunk(data, chunk_size))) == [
+        (b'{"a": 1}', 0, 10),
+        (b'{"b": 2}', 14, 23),
+        (b'{"c": 3}', 23, 31),
+    ]
+    assert list(stream_ndjson_lines(_chunk(data[14:], chunk_size), offset=14)) == [
+        (b'{"b": 2}', 14, 23),
+        (b'{"c": 3}', 23, 31),
+    ]
+    assert list(stream_ndjson_lines([])) == []
+
+
+def test_get_patient_reference():
+    assert get_patient_reference({"resourceType": "Patient", "id": "1"}) == (
+        "Patient/1"
+    )
+    assert get_patient_reference(
+        {"resourceType": "Observation", "subject": {"reference": "Patient/2"}}
+    ) == ("Patient/2")
+    assert get_patient_reference(
+        {"resourceType": "Immunization", "patient": {"reference": "Patient/3"}}
+    ) == ("Patient/3")
+    assert (
+        get_patient_reference(
+            {"resourceType": "Observation", "subject": {"reference": "Group/4"}}
+        )
+        is None
+    )
+    assert get_patient_reference({"resourceType": "Organization", "id": "5"}) is None
+
+
+def test_make_fhir_bundle():
+    bundle = make_fhir_bundle(
+        [{"resourceType": "Patient", "id": "1"}, {"resourceType": "Observation"}]
+    )
+    assert bundle["resourceType"] == "Bundle"
+    assert bundle["type"] == "batch"
+    assert [entry["request"] for entry in bundle["entry"]] == [
+        {"method": "PUT", "url": "Patient/1"},
+        {"method": "POST", "url": "Observation"},
+    ]
+
+
+def _observation(idx: int, patient: str) -> dict:
+    return {
+        "resourceType": "Observation",
+        "id": f"o{idx}",
+        "subject": {"reference": f"Patient/{patient}"},
+    }
+
+
+@pytest.mark.parametrize("chunk_size", [5, 1000])
+def test_stream_fhir_bundles_groups_by_patient(chunk_size):
+    resources = [
+        {"resourceType": "Patient", "id": "a"},
+        {"resourceType": "Patient", "id": "b"},
+        _observation(1, "a"),
+        _observation(2, "b"),
+        _observation(3, "a"),
+        {"resourceType": "Organization", "id": "org"},
+        _observation(4, "b"),
+    ]
+    data = _ndjson(resources)
+
+    bundles = list(stream_fhir_bundles(_chunk(data, chunk_size), bundle_size=3))
+
+    assert [_ids(bundle) for bundle, _ in bundles] == [
+        ["a", "o1", "o3"],
+        ["b", "o2", "o4"],
+        ["org"],
+    ]
+    # Resuming from the offset after each bundle reads every resource that was not in
+    # it or an earlier bundle.
+    assert bundles[0][1] == data.index(b'{"resourceType": "Patient", "id": "b"}')
+    assert bundles[1][1] == data.index(b'{"resourceType": "Organization"')
+    assert bundles[2][1] == len(data)
+
+
+def test_stream_fhir_bundles_limits_open_bundles():
+    resources = [_observation(idx, str(idx % 3)) for idx in range(6)]
+    data = _ndjson(resources)
+    starts = [start for _, start, _ in stream_ndjson_lines([data])]
+
+    bundles = list(stream_fhir_bundles([data], bundle_size=5, max_open_bundles=2))
+
+    # Patient 2 needs a third bundle, so its resources are added to the fullest.
+    assert [_ids(bundle) for bundle, _ in bundles] == [
+        ["o0", "o2", "o3", "o5"],
+        ["o1", "o4"],
+    ]
+    assert [offset for _, offset in bundles] == [starts[1], len(data)]
+
+
+def test_stream_fhir_bundles_interleaved_patients():
+    # A Bulk Data export of a resource type, not sorted by patient.
+    resources = [_observation(idx, str(idx % 1000)) for idx in range(10000)]
+    data = _ndjson(resources)
+
+    bundles = [bundle for bundle, _ in stream_fhir_bundles(_chunk(data, 65536))]
+
+    assert len(bundles) == 100
+    assert all(len(bundle["entry"]) == 100 for bundle in bundles)
+    assert sorted(id for bundle in bundles for id in _ids(bundle)) == sorted(
+        resource["id"] for resource in resources
+    )
+
+
+def test_stream_fhir_bundles_invalid_lines():
+    data = b'{"resourceType": "Patient", "id": "a"}\nnot json\n[1, 2]\n'
+    invalid_lines = []
+
+    bundles = list(
+        stream_fhir_bundles(
+            [data],
+            invalid_line_handler=lambda line, offset, error: invalid_lines.append(
+                (line, offset)
+            ),
+        )
+    )
+
+    assert [_ids(bundle) for bundle, _ in bundles] == [["a"]]
+    assert invalid_lines == [(b"not json", 39), (b"[1, 2]", 48)]
@@ -0,0 +1,151 @@
+from phdi_cloud_function_utils import ConcurrentPublisher
+from phdi_cloud_function_utils_testing.fakes import FakePublisherClient
+from unittest import mock
+
+
+def test_concurrent_publisher_success():
+    publisher = FakePublisherClient(latency=0.01)
+    failure_handler = mock.Mock()
+    concurrent_publisher = ConcurrentPublisher(
+        publisher=publisher,
+        topic_path="some-topic",
+        source="some-file",
+        failure_handler=failure_handler,
+        origin="some-origin",
+    )
+    for idx in range(50):
+        concurrent_publisher.publish(idx, f"message-{idx}", f"data-{idx}".encode())
+    concurrent_publisher.flush()
+
+    assert concurrent_publisher.success_count == 50
+    assert concurrent_publisher.failure_count == 0
+    assert not failure_handler.called
+    assert publisher.published[0] == (
+        "some-topic",
+        b"data-0",
+        {"origin": "some-origin"},
+    )
+    assert [data for _, data, _ in publisher.published] == [
+        f"data-{idx}".encode() for idx in range(50)
+    ]
+
+
+def test_concurrent_publisher_in_flight_limits():
+    publisher = mock.Mock()
+    futures = [mock.Mock() for _ in range(4)]
+    publisher.publish.side_effect = futures
+    concurrent_publisher = ConcurrentPublisher(
+        publisher=publisher,
+        topic_path="some-topic",
+        source="some-file",
+        failure_handler=mock.Mock(),
+        max_in_flight_messages=2,
+        max_in_flight_bytes=10,
+    )
+
+    concurrent_publisher.publish(0, "message-0", b"1234")
+    concurrent_publisher.publish(1, "message-1", b"1234")
+    assert not futures[0].result.called
+
+    # The message limit has been reached so the oldest message must be resolved.
+    concurrent_publisher.publish(2, "message-2", b"1234")
+    assert futures[0].result.called
+    assert not futures[1].result.called
+
+    # The byte limit would be exceeded so the oldest message must be resolved.
+    concurrent_publisher.publish(3, "message-3", b"123456")
+    assert futures[1].result.called
+    assert not futures[2].result.called
+
+    concurrent_publisher.flush()
+    assert concurrent_publisher.success_count == 4
+
+
+def test_concurrent_publisher_retry_and_failure():
+    publisher = mock.Mock()
+    failed_future = mock.Mock()
+    failed_future.result.side_effect = Exception("some-error")
+    successful_future = mock.Mock()
+    successful_future.result.return_value = "some-message-id"
+    publisher.publish.side_effect = [
+        failed_future,
+        failed_future,
+        successful_future,
+        failed_future,
+    ]
+    failure_handler = mock.Mock()
+    concurrent_publisher = ConcurrentPublisher(
+        publisher=publisher,
+        topic_path="some-topic",
+        source="some-file",
+        failure_handler=failure_handler,
+    )
+
+    concurrent_publisher.publish(0, "message-0", b"data-0")
+    concurrent_publisher.publish(1, "message-1", b"data-1")
+    concurrent_publisher.flush()
+
+    # Message 0 is retried successfully, message 1 fails twice.
+    assert publisher.publish.call_count == 4
+    assert concurrent_publisher.success_count == 1
+    assert concurrent_publisher.failure_count == 1
+    failure_handler.assert_called_once()
+    assert failure_handler.call_args.args[:2] == (1, "message-1")
+
+
+def test_concurrent_publisher_progress_handler():
+    progress_handler = mock.Mock()
+    concurrent_publisher = ConcurrentPublisher(
+        publisher=FakePublisherClient(latency=0.01, failure_rate=0.5, seed=0),
+        topic_path="some-topic",
+        source="some-file",
+        failure_handler=mock.Mock(),
+        max_in_flight_messages=3,
+        progress_handler=progress_handler,
+    )
+    for idx in range(10):
+        concurrent_publisher.publish(idx, "message", b"data", offset=idx * 10)
+    concurrent_publisher.flush()
+
+    # Every message is reported in order, whether or not it could be published.
+    assert progress_handler.call_args_list == [
+        mock.call(idx, idx * 10) for idx in range(10)
+    ]
+
+
+def test_fake_publisher_client_failures():
+    publisher = FakePublisherClient(failure_rate=1.0)
+    future = publisher.publish("some-topic", b"some-data")
+    assert future.exception() is not None
+    assert publisher.published == []
+    assert publisher.topic_path("some-project", "some-topic") == (
+        "projects/some-project/topics/some-topic"
+    )
+
+
+def test_concurrent_publisher_skip():
+    progress_handler = mock.Mock()
+    publisher = FakePublisherClient(latency=0.01)
+    concurrent_publisher = ConcurrentPublisher(
+        publisher=publisher,
+        topic_path="some-topic",
+        source="some-file",
+        failure_handler=mock.Mock(),
+        max_in_flight_messages=3,
+        progress_handler=progress_handler,
+    )
+    concurrent_publisher.skip(0, offset=0)
+    assert progress_handler.call_args_list == [mock.call(0, 0)]
+    for idx in range(1, 10):
+        if idx % 3:
+            concurrent_publisher.skip(idx, offset=idx * 10)
+        else:
+            concurrent_publisher.publish(idx, "message", b"data", offset=idx * 10)
+    concurrent_publisher.flush()
+
+    # Skipped messages are reported in order with those published around them.
+    assert progress_handler.call_args_list == [mock.call(0, 0)] + [
+        mock.call(idx, idx * 10) for idx in range(1, 10)
+    ]
+    assert len(publisher.published) == 3
+    assert concurrent_publisher.success_count == 3
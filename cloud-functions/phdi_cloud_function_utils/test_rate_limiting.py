@@ -0,0 +1,57 @@
+from phdi_cloud_function_utils import ConcurrentPublisher, Metrics, RateLimiter
+from phdi_cloud_function_utils_testing.fakes import FakePublisherClient
+from unittest import mock
+import pytest
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+def test_rate_limiter():
+    clock = FakeClock()
+    rate_limiter = RateLimiter(rate=10, burst=5, clock=clock, sleep=clock.sleep)
+
+    # The burst is available immediately, after which tokens arrive at the rate.
+    assert [rate_limiter.acquire() for _ in range(5)] == [0.0] * 5
+    assert rate_limiter.acquire() == pytest.approx(0.1)
+    for _ in range(9):
+        rate_limiter.acquire()
+    assert clock.now == pytest.approx(1.0)
+
+    # Tokens accumulate while idle, up to the burst.
+    clock.now += 10
+    assert [rate_limiter.acquire() for _ in range(5)] == [0.0] * 5
+    assert rate_limiter.acquire() > 0
+
+
+def test_rate_limiter_invalid_rate():
+    with pytest.raises(ValueError):
+        RateLimiter(rate=0)
+
+
+def test_concurrent_publisher_rate_limit():
+    rate_limiter = mock.Mock()
+    rate_limiter.acquire.return_value = 0.5
+    metrics = Metrics()
+    concurrent_publisher = ConcurrentPublisher(
+        publisher=FakePublisherClient(),
+        topic_path="some-topic",
+        source="some-file",
+        failure_handler=mock.Mock(),
+        metrics=metrics,
+        rate_limiter=rate_limiter,
+    )
+    for idx in range(3):
+        concurrent_publisher.publish(idx, f"message-{idx}", b"data")
+    concurrent_publisher.flush()
+
+    assert rate_limiter.acquire.call_count == 3
+    assert metrics.counters["rate_limit_wait_seconds"] == 1.5
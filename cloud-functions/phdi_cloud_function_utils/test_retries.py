@@ -0,0 +1,230 @@
+from phdi_cloud_function_utils import (
+    CircuitBreaker,
+    CircuitOpenError,
+    ConcurrentPublisher,
+    Metrics,
+    RetryBudget,
+    RetryPolicy,
+    is_retryable_error,
+)
+from phdi_cloud_function_utils_testing.fakes import FakePublisherClient
+from unittest import mock
+import pytest
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class StatusError(Exception):
+    def __init__(self, code: int):
+        super().__init__(f"Status {code}")
+        self.code = code
+
+
+def test_is_retryable_error():
+    assert is_retryable_error(Exception("some-error"))
+    assert is_retryable_error(StatusError(429))
+    assert is_retryable_error(StatusError(503))
+    assert not is_retryable_error(StatusError(400))
+    assert not is_retryable_error(CircuitOpenError())
+
+
+def test_retry_policy_backoff():
+    policy = RetryPolicy(initial_backoff=0.1, max_backoff=0.3, jitter=False)
+    assert [policy.backoff(attempt) for attempt in range(1, 5)] == pytest.approx(
+        [0.1, 0.2, 0.3, 0.3]
+    )
+
+    policy = RetryPolicy(initial_backoff=0.1, max_backoff=10, seed=0)
+    delays = [policy.backoff(3) for _ in range(100)]
+    assert all(0 <= delay <= 0.4 for delay in delays)
+    assert len(set(delays)) == 100
+
+
+def test_retry_policy_should_retry():
+    policy = RetryPolicy(max_attempts=3)
+    assert policy.should_retry(1, Exception())
+    assert policy.should_retry(2, Exception())
+    assert not policy.should_retry(3, Exception())
+    assert not policy.should_retry(1, StatusError(403))
+
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.5, max_tokens=2)
+    assert budget.try_spend()
+    assert budget.try_spend()
+    assert not budget.try_spend()
+
+    # Each request earns half a retry.
+    budget.record_request()
+    assert not budget.try_spend()
+    budget.record_request()
+    assert budget.try_spend()
+
+    # A retry that is not made returns its token.
+    budget.refund()
+    assert budget.try_spend()
+
+
+def test_circuit_breaker():
+    clock = FakeClock()
+    breaker = CircuitBreaker(
+        failure_threshold=0.5, min_requests=4, window=10, reset_timeout=30, clock=clock
+    )
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    # Once the reset timeout has passed a single trial request is allowed, and its
+    # failure opens the breaker again.
+    clock.now = 30
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.open_count == 2
+
+    # A successful trial closes the breaker.
+    clock.now = 60
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_concurrent_publisher_backoff():
+    publisher = FakePublisherClient(
+        failure_rate=0.5, seed=1, failure_exception=StatusError(429)
+    )
+    metrics = Metrics()
+    failure_handler = mock.Mock()
+    concurrent_publisher = ConcurrentPublisher(
+        publisher=publisher,
+        topic_path="some-topic",
+        source="some-file",
+        failure_handler=failure_handler,
+        metrics=metrics,
+        retry_policy=RetryPolicy(max_attempts=10, initial_backoff=0.001, seed=1),
+    )
+    for idx in range(50):
+        concurrent_publisher.publish(idx, f"message-{idx}", b"data")
+    concurrent_publisher.flush()
+
+    assert concurrent_publisher.success_count == 50
+    assert not failure_handler.called
+    assert metrics.counters["publish_retries"] == publisher.attempt_count - 50
+    assert metrics.counters["retry_backoff_seconds"] > 0
+
+
+def test_concurrent_publisher_non_retryable_error():
+    publisher = FakePublisherClient(
+        failure_rate=1.0, failure_exception=StatusError(400)
+    )
+    failure_handler = mock.Mock()
+    concurrent_publisher = ConcurrentPublisher(
+        publisher=publisher,
+        topic_path="some-topic",
+        source="some-file",
+        failure_handler=failure_handler,
+        retry_policy=RetryPolicy(max_attempts=5),
+    )
+    concurrent_publisher.publish(0, "message-0", b"data")
+    concurrent_publisher.flush()
+
+    assert publisher.attempt_count == 1
+    failure_handler.assert_called_once()
+
+
+def test_concurrent_publisher_retry_budget():
+    publisher = FakePublisherClient(failure_rate=1.0)
+    metrics = Metrics()
+    concurrent_publisher = ConcurrentPublisher(
+        publisher=publisher,
+        topic_path="some-topic",
+        source="some-file",
+        failure_handler=mock.Mock(),
+        metrics=metrics,
+        retry_policy=RetryPolicy(max_attempts=5, initial_backoff=0.0),
+        retry_budget=RetryBudget(ratio=0.1, max_tokens=5),
+    )
+    for idx in range(20):
+        concurrent_publisher.publish(idx, f"message-{idx}", b"data")
+    concurrent_publisher.flush()
+
+    # The budget is already full when the requests are made, so only the 5 retries it
+    # starts with are allowed.
+    assert publisher.attempt_count == 25
+    assert concurrent_publisher.failure_count == 20
+    assert metrics.counters["retry_budget_exhausted"] > 0
+
+
+def test_concurrent_publisher_circuit_breaker():
+    publisher = FakePublisherClient(failure_rate=1.0)
+    metrics = Metrics()
+    progress_handler = mock.Mock()
+    failure_handler = mock.Mock()
+    concurrent_publisher = ConcurrentPublisher(
+        publisher=publisher,
+        topic_path="some-topic",
+        source="some-file",
+        failure_handler=failure_handler,
+        max_in_flight_messages=5,
+        progress_handler=progress_handler,
+        metrics=metrics,
+        retry_policy=RetryPolicy(max_attempts=3, initial_backoff=0.0),
+        circuit_breaker=CircuitBreaker(min_requests=10, reset_timeout=60),
+    )
+    for idx in range(100):
+        concurrent_publisher.publish(idx, f"message-{idx}", b"data")
+    concurrent_publisher.flush()
+
+    # Once the breaker opens the rest of the messages are diverted without being
+    # published, still in order.
+    assert publisher.attempt_count < 20
+    assert concurrent_publisher.failure_count == 100
+    assert metrics.counters["publish_diverted"] > 80
+    assert isinstance(failure_handler.call_args.args[2], CircuitOpenError)
+    assert progress_handler.call_args_list == [
+        mock.call(idx, None) for idx in range(100)
+    ]
+
+
+def test_concurrent_publisher_retry_budget_with_half_open_breaker():
+    clock = FakeClock()
+    breaker = CircuitBreaker(min_requests=1, reset_timeout=30, clock=clock)
+    record_failure = breaker.record_failure
+
+    def record_failure_then_wait():
+        # The failure opens the breaker, which is half open by the time the retry is
+        # decided on.
+        record_failure()
+        clock.now += 30
+
+    breaker.record_failure = record_failure_then_wait
+    publisher = FakePublisherClient(failure_rate=1.0)
+    concurrent_publisher = ConcurrentPublisher(
+        publisher=publisher,
+        topic_path="some-topic",
+        source="some-file",
+        failure_handler=mock.Mock(),
+        retry_policy=RetryPolicy(max_attempts=3, initial_backoff=0.0),
+        retry_budget=RetryBudget(ratio=0.0, max_tokens=0),
+        circuit_breaker=breaker,
+    )
+    concurrent_publisher.publish(0, "message-0", b"data")
+    concurrent_publisher.flush()
+
+    # The retry refused by the budget does not take the trial request of the breaker,
+    # so the next request can still close it.
+    assert publisher.attempt_count == 1
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
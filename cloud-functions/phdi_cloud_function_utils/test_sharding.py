@@ -0,0 +1,81 @@
+from phdi_cloud_function_utils import (
+    ShardRange,
+    ShardTask,
+    ShardTracker,
+    decode_shard_task,
+    encode_shard_task,
+    plan_shards,
+)
+from phdi_cloud_function_utils_testing.fakes import FakeStorageClient
+
+
+def test_plan_shards():
+    offsets = [(0, 10), (10, 25), (25, 30), (31, 60), (60, 65)]
+
+    assert list(plan_shards(offsets, shard_bytes=20)) == [
+        ShardRange(start=0, end=25, first_message_idx=0, message_count=2),
+        ShardRange(start=25, end=60, first_message_idx=2, message_count=2),
+        ShardRange(start=60, end=65, first_message_idx=4, message_count=1),
+    ]
+    assert list(plan_shards(offsets, shard_bytes=1000)) == [ShardRange(0, 65, 0, 5)]
+    assert list(plan_shards(offsets, shard_bytes=1)) == [
+        ShardRange(start, end, idx, 1) for idx, (start, end) in enumerate(offsets)
+    ]
+    assert list(plan_shards([])) == []
+
+
+def test_encode_shard_task():
+    task = ShardTask(
+        bucket_name="some-bucket",
+        filename="source-data/vxu/some-file.hl7",
+        generation=17,
+        shard_idx=1,
+        shard_count=3,
+        start=100,
+        end=200,
+        first_message_idx=10,
+        message_count=5,
+        root_template="VXU_V04",
+    )
+    assert decode_shard_task(encode_shard_task(task)) == task
+
+
+def test_shard_tracker():
+    storage_client = FakeStorageClient()
+    tracker = ShardTracker(storage_client, "some-bucket")
+    tracker.start("some-key", shard_count=2, message_count=10)
+    assert tracker.get_plan("some-key") == {"shard_count": 2, "message_count": 10}
+
+    assert tracker.complete_shard("some-key", 0, {"published": 4}) is None
+    # Reading a shard again replaces its result.
+    assert tracker.complete_shard("some-key", 0, {"published": 5}) is None
+    assert tracker.get_summary("some-key") is None
+
+    summary = tracker.complete_shard("some-key", 1, {"published": 3})
+    assert summary == {"shard_count": 2, "message_count": 10, "published": 8}
+    assert tracker.get_summary("some-key") == summary
+    assert (
+        storage_client.bucket("some-bucket")
+        .blob("shards/some-key/summary.json")
+        .exists()
+    )
+
+    # The summary is only reported by the first worker to complete the last shard.
+    assert tracker.complete_shard("some-key", 1, {"published": 3}) is None
+
+
+def test_shard_tracker_tasks():
+    tracker = ShardTracker(FakeStorageClient(), "some-bucket")
+    assert tracker.get_published_tasks("some-key") == set()
+    tracker.record_task("some-key", 0)
+    tracker.record_task("some-key", 12)
+    # A task recorded by another coordinator is recorded once.
+    tracker.record_task("some-key", 12)
+    assert tracker.get_published_tasks("some-key") == {0, 12}
+    assert tracker.get_published_tasks("other-key") == set()
+
+
+def test_shard_tracker_without_plan():
+    tracker = ShardTracker(FakeStorageClient(), "some-bucket")
+    assert tracker.complete_shard("some-key", 0, {"published": 4}) is None
+    assert tracker.get_plan("some-key") is None
@@ -0,0 +1,119 @@
+import gzip
+import io
+import zipfile
+from phdi_cloud_function_utils import (
+    get_hl7_root_template,
+    sniff_blob,
+    sniff_content,
+)
+from phdi_cloud_function_utils_testing.fakes import FakeStorageClient
+from phdi_cloud_function_utils_testing.synthetic import (
+    write_ccd_document,
+    write_fhir_bundle,
+    write_hl7_batch,
+)
+from unittest import mock
+import pytest
+
+
+def make_hl7_batch(message_type: str = "VXU_V04", message_count: int = 20) -> bytes:
+    file = io.StringIO()
+    write_hl7_batch(file, message_type, message_count, seed=1)
+    return file.getvalue().encode("utf-8")
+
+
+def test_get_hl7_root_template():
+    assert get_hl7_root_template("MSH|^~\\&|A|B|C|D|2020||VXU^V04^VXU_V04|1") == (
+        "VXU_V04"
+    )
+    assert get_hl7_root_template("MSH|^~\\&|A|B|C|D|2020||ORU^R01|1") == "ORU_R01"
+    assert get_hl7_root_template("MSH#$~\\&#A#B#C#D#2020##ADT$A01#1") == "ADT_A01"
+    assert get_hl7_root_template("MSH|^~\\&|A|B|C|D|2020|||1") is None
+    assert get_hl7_root_template("MSH|^~\\&|A") is None
+
+
+def test_sniff_hl7_batch():
+    batch = make_hl7_batch("ORU_R01")
+    result = sniff_content(batch[:4096])
+    assert result.format == "hl7v2"
+    assert result.encoding == "utf-8"
+    assert result.compression == "identity"
+    assert result.root_template == "ORU_R01"
+
+    # A single message in MLLP framing.
+    result = sniff_content(b"\x0bMSH|^~\\&|A|B|C|D|2020||VXU^V04|1\rPID|1\r\x1c\r")
+    assert (result.format, result.root_template) == ("hl7v2", "VXU_V04")
+
+
+def test_sniff_ccda():
+    file = io.StringIO()
+    write_ccd_document(file, seed=1)
+    result = sniff_content(file.getvalue().encode("utf-8")[:4096])
+    assert (result.format, result.root_template) == ("ccda", "CCD")
+
+    assert sniff_content(b"<?xml version='1.0'?><html></html>").format is None
+
+
+def test_sniff_fhir():
+    file = io.StringIO()
+    write_fhir_bundle(file, patient_count=3, seed=1)
+    result = sniff_content(file.getvalue().encode("utf-8")[:4096])
+    assert (result.format, result.root_template) == ("fhir", "Bundle")
+
+    result = sniff_content(b'{"resourceType": "Patient", "id": "1"}\n{"resou')
+    assert (result.format, result.root_template) == ("fhir", "Patient")
+
+
+def test_sniff_encoding():
+    message = "MSH|^~\\&|HÔPITAL|B|C|D|2020||VXU^V04|1\rPID|1||JOSÉ\r"
+    assert sniff_content(message.encode("utf-8")).encoding == "utf-8"
+    assert sniff_content(message.encode("utf-8-sig")).encoding == "utf-8-sig"
+    assert sniff_content(message.encode("latin-1")).encoding == "latin-1"
+    for encoding in ("utf-16", "utf-16-le", "utf-16-be"):
+        result = sniff_content(message.encode(encoding))
+        assert result.encoding.startswith("utf-16")
+        assert (result.format, result.root_template) == ("hl7v2", "VXU_V04")
+
+    # The head may be cut off part way through a character.
+    assert sniff_content(message.encode("utf-8")[:55]).encoding == "utf-8"
+
+
+def test_sniff_compressed():
+    batch = make_hl7_batch()
+    result = sniff_content(gzip.compress(batch)[:4096])
+    assert (result.format, result.compression) == ("hl7v2", "gzip")
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("batch.hl7", batch)
+    result = sniff_content(archive.getvalue()[:4096])
+    assert (result.format, result.compression) == ("hl7v2", "zip")
+    assert result.root_template == "VXU_V04"
+
+
+def test_sniff_compressed_zstd():
+    zstandard = pytest.importorskip("zstandard")
+    compressed = zstandard.ZstdCompressor().compress(make_hl7_batch())
+    result = sniff_content(compressed[:4096])
+    assert (result.format, result.compression) == ("hl7v2", "zstd")
+
+
+def test_sniff_unknown():
+    assert sniff_content(b"").format is None
+    assert sniff_content(b"name,date of birth\nAdam,2000-01-01\n").format is None
+    assert sniff_content(b"\x89PNG\r\n\x1a\n\x00\x00").format is None
+    assert sniff_content(b'{"name": "not FHIR"}').format is None
+
+
+def test_sniff_blob():
+    storage_client = FakeStorageClient()
+    blob = storage_client.bucket("some-bucket").blob("source-data/vxu/batch.hl7")
+    blob.upload_from_string(make_hl7_batch(message_count=1000))
+
+    with mock.patch.object(
+        blob, "download_as_bytes", wraps=blob.download_as_bytes
+    ) as download_as_bytes:
+        result = sniff_blob(blob, size=1024)
+
+    download_as_bytes.assert_called_once_with(start=0, end=1023)
+    assert (result.format, result.root_template) == ("hl7v2", "VXU_V04")
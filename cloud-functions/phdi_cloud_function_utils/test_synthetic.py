@@ -0,0 +1,82 @@
+from phdi_cloud_function_utils import stream_hl7_batch_messages
+from phdi_cloud_function_utils_testing.synthetic import (
+    write_ccd_document,
+    write_fhir_bundle,
+    write_hl7_batch,
+)
+import io
+import json
+import pytest
+import xml.etree.ElementTree as ElementTree
+
+
+def generate_hl7_batch(*args, **kwargs) -> str:
+    file = io.StringIO(newline="")
+    write_hl7_batch(file, *args, **kwargs)
+    return file.getvalue()
+
+
+@pytest.mark.parametrize("message_type", ["VXU_V04", "ORU_R01"])
+def test_write_hl7_batch(message_type):
+    batch = generate_hl7_batch(message_type, 25, seed=1, batch_size=10)
+    segments = batch.split("\r\n")
+    assert segments[0].startswith("FHS|")
+    assert segments[1].startswith("BHS|")
+    assert segments[-2] == "FTS|3"
+    assert [segment for segment in segments if segment.startswith("BTS|")] == [
+        "BTS|10",
+        "BTS|10",
+        "BTS|5",
+    ]
+
+    messages = list(stream_hl7_batch_messages([batch]))
+    assert len(messages) == 25
+    for idx, message in enumerate(messages):
+        msh = message.split("\n")[0].split("|")
+        assert msh[8].endswith(f"^{message_type}")
+        assert msh[9] == f"MSG{idx:09d}"
+
+
+def test_write_hl7_batch_is_seeded():
+    assert generate_hl7_batch("VXU_V04", 5, seed=1) == generate_hl7_batch(
+        "VXU_V04", 5, seed=1
+    )
+    assert generate_hl7_batch("VXU_V04", 5, seed=1) != generate_hl7_batch(
+        "VXU_V04", 5, seed=2
+    )
+
+
+def test_write_hl7_batch_unknown_message_type():
+    with pytest.raises(ValueError):
+        generate_hl7_batch("ADT_A01", 1)
+
+
+def test_write_ccd_document():
+    file = io.StringIO()
+    write_ccd_document(file, seed=1, result_count=3)
+    root = ElementTree.fromstring(file.getvalue().encode("utf-8"))
+    namespace = {"hl7": "urn:hl7-org:v3"}
+    assert root.find("hl7:recordTarget/hl7:patientRole", namespace) is not None
+    assert len(root.findall(".//hl7:observation", namespace)) == 3
+
+
+def test_write_fhir_bundle():
+    file = io.StringIO()
+    write_fhir_bundle(file, patient_count=3, observations_per_patient=2, seed=1)
+    bundle = json.loads(file.getvalue())
+    assert bundle["type"] == "transaction"
+    resources = [entry["resource"] for entry in bundle["entry"]]
+    patients = [r for r in resources if r["resourceType"] == "Patient"]
+    observations = [r for r in resources if r["resourceType"] == "Observation"]
+    assert len(patients) == 3
+    assert len(observations) == 6
+    patient_urls = {f"urn:uuid:{patient['id']}" for patient in patients}
+    assert {o["subject"]["reference"] for o in observations} == patient_urls
+    assert all(entry["request"]["method"] == "POST" for entry in bundle["entry"])
+
+
+def test_write_fhir_bundle_without_requests():
+    file = io.StringIO()
+    write_fhir_bundle(file, patient_count=1, bundle_type="collection", seed=1)
+    bundle = json.loads(file.getvalue())
+    assert all("request" not in entry for entry in bundle["entry"])
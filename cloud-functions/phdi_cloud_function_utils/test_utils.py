@@ -97,8 +97,13 @@ def test_utils_bad_body():
     assert actual_result.response == expected_result.response
 
 
+def make_json_request(body: dict) -> flask.Request:
+    return flask.Request.from_values(
+        data=json.dumps(body), content_type="application/json"
+    )
+
+
 def test_utils_bad_resource_type():
-    mock_request = mock.Mock(headers={"Content-Type": "application/json"})
     body_with_wrong_resource_type = copy.deepcopy(test_request_body)
     body_with_wrong_resource_type["resourceType"] = None
 
@@ -106,7 +111,7 @@ def test_utils_bad_resource_type():
         "FHIR Resource Type not specified. "
         + "The request body must contain a valid FHIR bundle or resource."
     )
-    mock_request.get_json.return_value = body_with_wrong_resource_type
+    mock_request = make_json_request(body_with_wrong_resource_type)
     expected_result = make_response(status_code=400, message=error_message)
     actual_result = validate_fhir_bundle_or_resource(request=mock_request)
     assert actual_result.status == expected_result.status
@@ -115,10 +120,9 @@ def test_utils_bad_resource_type():
 
 
 def test_utils_request():
-    request = mock.Mock(headers={"Content-Type": "application/json"})
+    request = make_json_request(test_request_body)
 
     expected_result = make_response(status_code=200, message="Validation Succeeded!")
-    request.get_json.return_value = test_request_body
     actual_result = validate_fhir_bundle_or_resource(request)
 
     assert actual_result.status == expected_result.status
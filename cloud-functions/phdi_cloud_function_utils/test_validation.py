@@ -0,0 +1,148 @@
+from phdi_cloud_function_utils import (
+    BodySummary,
+    get_request_body,
+    get_sample_multi_patient_obs_bundle,
+    require_content_type,
+    require_json_object,
+    require_max_entries,
+    require_resource_type,
+    summarize_json_resource,
+    validate_request,
+)
+from unittest import mock
+import flask
+import json
+import pytest
+
+
+def make_request(data: bytes, content_type: str = "application/json") -> flask.Request:
+    return flask.Request.from_values(data=data, content_type=content_type)
+
+
+def test_summarize_json_resource():
+    bundle = get_sample_multi_patient_obs_bundle()
+    data = json.dumps(bundle).encode()
+    assert summarize_json_resource(data) == BodySummary("Bundle", len(bundle["entry"]))
+    assert summarize_json_resource(data, count_entries=False) == BodySummary(
+        "Bundle", None
+    )
+
+    # Members may come in any order, and entries are counted wherever they are.
+    data = json.dumps({"entry": bundle["entry"], "id": "1", "resourceType": "Bundle"})
+    assert summarize_json_resource(data.encode()) == BodySummary(
+        "Bundle", len(bundle["entry"])
+    )
+    assert summarize_json_resource(b' { "entry" : [ ] , "resourceType":"Bundle"}') == (
+        BodySummary("Bundle", 0)
+    )
+    assert summarize_json_resource(b'{"resourceType": "Patient"}') == BodySummary(
+        "Patient", None
+    )
+    assert summarize_json_resource(b"{}") == BodySummary(None, None)
+    assert summarize_json_resource(b'{"resourceType": null}') == BodySummary(None, None)
+
+    for invalid_data in [b"", b"[1, 2]", b'{"resourceType" "Bundle"}', b'{"entry": [']:
+        with pytest.raises(ValueError):
+            summarize_json_resource(invalid_data)
+
+
+def test_summarize_json_resource_peek():
+    # The resourceType is read from the start of a large body, unless it is after the
+    # peek, when the whole body is decoded.
+    padding = "é" * 100
+    data = json.dumps({"resourceType": "Bundle", "padding": padding}).encode()
+    assert summarize_json_resource(
+        data, count_entries=False, peek_bytes=30
+    ) == BodySummary("Bundle", None)
+    data = json.dumps(
+        {"padding": padding, "resourceType": "Bundle"}, ensure_ascii=False
+    ).encode()
+    assert summarize_json_resource(
+        data, count_entries=False, peek_bytes=33
+    ) == BodySummary("Bundle", None)
+
+
+def test_request_body_is_parsed_once():
+    bundle = get_sample_multi_patient_obs_bundle()
+    request = make_request(json.dumps(bundle).encode())
+    request_body = get_request_body(request)
+    assert get_request_body(request) is request_body
+
+    with mock.patch(
+        "phdi_cloud_function_utils.validation.summarize_json_resource",
+        wraps=summarize_json_resource,
+    ) as patched_summarize, mock.patch(
+        "phdi_cloud_function_utils.validation.json.loads", wraps=json.loads
+    ) as patched_loads:
+        assert request_body.summary().resource_type == "Bundle"
+        assert request_body.summary().resource_type == "Bundle"
+        assert request_body.summary(count_entries=True).entry_count == len(
+            bundle["entry"]
+        )
+        assert patched_summarize.call_count == 2
+
+        assert request_body.json() == bundle
+        assert request_body.json() is request_body.json()
+        assert patched_loads.call_count == 1
+
+        # Once parsed, the body is summarized from the parsed object.
+        assert request_body.summary(count_entries=True).entry_count == len(
+            bundle["entry"]
+        )
+        assert patched_summarize.call_count == 2
+
+
+def test_validate_request():
+    bundle = get_sample_multi_patient_obs_bundle()
+    data = json.dumps(bundle).encode()
+    steps = [
+        require_content_type("application/json"),
+        require_resource_type("Bundle"),
+        require_max_entries(len(bundle["entry"])),
+        require_json_object,
+    ]
+    actual_response = validate_request(make_request(data), steps)
+    assert actual_response.status_code == 200
+    assert actual_response.response == [b"Validation Succeeded!"]
+
+    actual_response = validate_request(make_request(data, "text/plain"), steps)
+    assert actual_response.status_code == 400
+    assert actual_response.response == [
+        b"Header must include: 'Content-Type:application/json'."
+    ]
+
+    actual_response = validate_request(
+        make_request(json.dumps(bundle["entry"][0]["resource"]).encode()), steps
+    )
+    assert actual_response.status_code == 400
+    assert actual_response.response == [
+        b"Unexpected FHIR Resource Type: Patient. The resource type must be one of "
+        b"Bundle."
+    ]
+
+    actual_response = validate_request(
+        make_request(data), [require_max_entries(len(bundle["entry"]) - 1)]
+    )
+    assert actual_response.status_code == 413
+
+    actual_response = validate_request(make_request(b"{"), [require_json_object])
+    assert actual_response.status_code == 400
+    assert actual_response.response == [b"Invalid request body - Invalid JSON"]
+
+    actual_response = validate_request(make_request(b"[]"), [require_json_object])
+    assert actual_response.status_code == 400
+
+
+def test_validate_request_max_bytes():
+    request = make_request(b'{"resourceType": "Bundle"}')
+    actual_response = validate_request(request, [require_json_object], max_bytes=10)
+    assert actual_response.status_code == 413
+    assert actual_response.response == [
+        b"Request body too large - 26 bytes is over the limit of 10 bytes."
+    ]
+
+    # Without a Content-Length, the size is checked once the body is read.
+    request = mock.Mock(content_length=None)
+    request.get_data.return_value = b'{"resourceType": "Bundle"}'
+    actual_response = validate_request(request, [require_json_object], max_bytes=10)
+    assert actual_response.status_code == 413
@@ -0,0 +1,377 @@
+"""
+Read every file under a prefix of a bucket and publish its messages, as if each file
+had just been uploaded, e.g. to load the historical data of a new jurisdiction from
+'source-data/', or to publish the messages written to 'publishing-failures/' during an
+outage again.
+
+Files are read by `main.read_source_data`, and failure manifests are replayed by
+`replay_failures.replay_failure_manifest`, so the same environment variables configure
+how messages are split and published. PROJECT_ID and INGESTION_TOPIC must be set. Files
+are read concurrently by a bounded pool of threads, or of processes when splitting is
+CPU bound, and publish requests across the whole pool are limited to --rate-limit per
+second. The result of each file is appended to a manifest, and files recorded there as
+complete are skipped when a backfill is run again, so an interrupted backfill resumes
+where it stopped. Set CHECKPOINT_STORE to also resume within the files that were being
+read.
+
+Usage:
+    python backfill.py --bucket some-bucket --prefix source-data/vxu/ \\
+        --manifest vxu-backfill.ndjson --workers 8 --rate-limit 2000
+    python backfill.py --bucket some-bucket --prefix publishing-failures/ \\
+        --manifest failures-backfill.ndjson --delete-published-failures
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import as_completed
+from types import SimpleNamespace
+from typing import Any, Iterator, Tuple
+
+import main
+from replay_failures import is_failure_manifest, replay_failure_manifest
+
+BACKFILL_PREFIXES = ("source-data", "publishing-failures")
+
+logger = logging.getLogger(__name__)
+
+
+class BackfillManifest:
+    """
+    The results of the files read by a backfill, kept as a newline delimited JSON file
+    with one result per line. Results are appended as soon as each file is read, so the
+    manifest survives the backfill being interrupted.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: The path of the manifest, which is created if it does not exist.
+        """
+        self.path = path
+        self.completed = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                for line in file:
+                    # A line cut short by a crash is ignored, so its file is read again.
+                    try:
+                        result = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if result.get("complete"):
+                        self.completed.add((result["name"], result["generation"]))
+
+    def is_complete(self, name: str, generation: int) -> bool:
+        """
+        :param name: The name of a file.
+        :param generation: The generation of the file.
+        :return: True if this version of the file was completely read by an earlier
+            run.
+        """
+        return (name, generation) in self.completed
+
+    def record(self, result: dict) -> None:
+        """
+        :param result: The result of reading a file, as returned by `backfill_file`.
+        """
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(result) + "\n")
+            if result.get("complete"):
+                self.completed.add((result["name"], result["generation"]))
+
+
+def list_files(
+    storage_client: Any, bucket_name: str, prefix: str
+) -> Iterator[Tuple[str, int]]:
+    """
+    List the files under a prefix of a bucket.
+
+    :param storage_client: A `google.cloud.storage.Client`, or an object with the same
+        interface such as `phdi_cloud_function_utils_testing.fakes.FakeStorageClient`.
+    :param bucket_name: The bucket to list.
+    :param prefix: The prefix of the names of the files to list.
+    :return: An iterator over the name and generation of each file.
+    """
+    for blob in storage_client.list_blobs(bucket_name, prefix=prefix):
+        # Parts of failure manifests are composed into a manifest by the function
+        # writing them.
+        if not blob.name.endswith("/") and ".ndjson.part-" not in blob.name:
+            yield blob.name, blob.generation
+
+
+def backfill_file(
+    bucket_name: str,
+    filename: str,
+    generation: int,
+    delete_published_failures: bool = False,
+) -> dict:
+    """
+    Read a single file with `main.read_source_data`, or publish the messages of a
+    failure manifest with `replay_failures.replay_failure_manifest`, and summarize
+    the result.
+
+    :param bucket_name: The bucket containing the file.
+    :param filename: The name of the file.
+    :param generation: The generation of the file to read.
+    :param delete_published_failures: Whether to delete a file written to
+        'publishing-failures/' by earlier versions of read_source_data, which held a
+        single message, once it has been published. Failure manifests are always
+        deleted once every message in them has been published.
+    :return: A JSON serializable dictionary of the name and generation of the file,
+        the HTTP status code and message of the response, the number of messages that
+        were published and that failed to publish, and whether the file was
+        completely read.
+    """
+    start = time.perf_counter()
+    result = {"name": filename, "generation": generation}
+    if is_failure_manifest(filename):
+        try:
+            replay_result = replay_failure_manifest(
+                bucket_name=bucket_name, manifest_name=filename, generation=generation
+            )
+        except Exception as error:
+            logger.exception(f"Replaying {filename} failed.")
+            result.update(
+                status_code=None,
+                message=f"{type(error).__name__}: {error}",
+                complete=False,
+                seconds=time.perf_counter() - start,
+            )
+            return result
+        result.update(
+            status_code=200,
+            message=(
+                f"Replayed {filename}, of which {replay_result['messages_published']} "
+                f"messages were published, and {replay_result['publish_failures']} "
+                "could not be published again."
+            ),
+            messages_published=replay_result["messages_published"],
+            publish_failures=replay_result["publish_failures"],
+            complete=True,
+            deleted=replay_result["deleted"],
+            seconds=time.perf_counter() - start,
+        )
+        return result
+
+    try:
+        response = main.read_source_data(
+            SimpleNamespace(
+                data={"name": filename, "bucket": bucket_name, "generation": generation}
+            )
+        )
+    except Exception as error:
+        logger.exception(f"Backfilling {filename} failed.")
+        result.update(
+            status_code=None,
+            message=f"{type(error).__name__}: {error}",
+            complete=False,
+            seconds=time.perf_counter() - start,
+        )
+        return result
+
+    if response.is_json:
+        payload = response.json
+        counters = payload["metrics"]["counters"]
+        result.update(
+            message=payload["message"],
+            messages_published=counters.get("messages_published", 0),
+            publish_failures=counters.get("publish_failures", 0),
+        )
+    else:
+        result.update(
+            message=response.get_data(as_text=True),
+            messages_published=0,
+            publish_failures=0,
+        )
+    result.update(
+        status_code=response.status_code, complete=response.status_code == 200
+    )
+
+    if (
+        delete_published_failures
+        and result["complete"]
+        and result["publish_failures"] == 0
+        and filename.startswith("publishing-failures/")
+    ):
+        storage_client = main.get_storage_client()
+        storage_client.bucket(bucket_name).blob(
+            filename, generation=generation
+        ).delete()
+        result["deleted"] = True
+
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def _initialize_worker(environment: dict) -> None:
+    """
+    Configure a worker process of a backfill run with processes.
+    """
+    os.environ.update(environment)
+    logging.basicConfig(level=logging.WARNING)
+
+
+def run_backfill(
+    bucket_name: str,
+    prefix: str,
+    manifest_path: str,
+    workers: int = 8,
+    use_processes: bool = False,
+    rate_limit: float = None,
+    delete_published_failures: bool = False,
+) -> dict:
+    """
+    Read every file under a prefix of a bucket that is not recorded as complete in
+    the manifest, using a pool of workers.
+
+    :param bucket_name: The bucket to read files from.
+    :param prefix: The prefix of the names of the files to read, which must be within
+        'source-data/' or 'publishing-failures/'.
+    :param manifest_path: The path of the manifest recording the result of each file.
+    :param workers: The number of files read at once.
+    :param use_processes: Whether to read files in worker processes instead of
+        threads. Each process creates its own GCP clients.
+    :param rate_limit: The maximum number of publish requests per second across all
+        workers. Unlimited by default.
+    :param delete_published_failures: Whether to delete single message files written
+        to 'publishing-failures/' by earlier versions of read_source_data once they
+        have been published.
+    :return: A dictionary of the number of files listed, skipped because an earlier
+        run completed them, completed, and not completed, the number of messages
+        published and that failed to publish, and the duration of the backfill.
+    """
+    if prefix.split("/")[0] not in BACKFILL_PREFIXES:
+        raise ValueError(
+            f"Unknown prefix: {prefix}. The prefix must be within one of "
+            + ", ".join(
+                f"'{backfill_prefix}/'" for backfill_prefix in BACKFILL_PREFIXES
+            )
+            + "."
+        )
+    workers = max(1, workers)
+
+    # Messages that fail to publish again are written to new manifests, or new
+    # versions of manifests, under 'publishing-failures/', so the files to read are
+    # listed before any are read.
+    manifest = BackfillManifest(manifest_path)
+    files = list(list_files(main.get_storage_client(), bucket_name, prefix))
+    pending = [
+        (filename, generation)
+        for filename, generation in files
+        if not manifest.is_complete(filename, generation)
+    ]
+    logger.info(
+        f"Backfilling {len(pending)} of {len(files)} files under {prefix} in "
+        f"{bucket_name}. The remaining files were completed by an earlier run."
+    )
+
+    # Threads share a single rate limiter, while each process limits itself to its
+    # share of the rate.
+    environment = {"SOURCE_PREFIXES": ",".join(BACKFILL_PREFIXES)}
+    if rate_limit:
+        process_rate_limit = rate_limit / workers if use_processes else rate_limit
+        environment["PUBLISH_RATE_LIMIT"] = str(process_rate_limit)
+    os.environ.update(environment)
+
+    executor: Executor
+    if use_processes:
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_initialize_worker,
+            initargs=(environment,),
+        )
+    else:
+        # Create the shared clients before the threads that use them.
+        main.get_publisher_client()
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+    summary = {
+        "files": len(files),
+        "skipped": len(files) - len(pending),
+        "completed": 0,
+        "not_completed": 0,
+        "messages_published": 0,
+        "publish_failures": 0,
+    }
+    start = time.perf_counter()
+    with executor:
+        futures = [
+            executor.submit(
+                backfill_file,
+                bucket_name,
+                filename,
+                generation,
+                delete_published_failures,
+            )
+            for filename, generation in pending
+        ]
+        for count, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            manifest.record(result)
+            summary["completed" if result["complete"] else "not_completed"] += 1
+            summary["messages_published"] += result.get("messages_published", 0)
+            summary["publish_failures"] += result.get("publish_failures", 0)
+            log = logger.info if result["complete"] else logger.error
+            log(f"[{count}/{len(pending)}] {result['message']}")
+
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--bucket", required=True, help="The bucket to read.")
+    parser.add_argument(
+        "--prefix",
+        required=True,
+        help="The prefix of the files to read, e.g. 'source-data/elr/'.",
+    )
+    parser.add_argument(
+        "--manifest",
+        required=True,
+        help="The manifest recording the result of each file, used to resume.",
+    )
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument(
+        "--processes",
+        action="store_true",
+        help="Read files in worker processes instead of threads.",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        help="The maximum number of publish requests per second across all workers.",
+    )
+    parser.add_argument(
+        "--delete-published-failures",
+        action="store_true",
+        help="Delete single message files from 'publishing-failures/' once they have "
+        "been published. Failure manifests are always deleted once replayed.",
+    )
+    args = parser.parse_args()
+
+    # Each message is logged by read_source_data and ConcurrentPublisher, which would
+    # drown out the progress of the backfill.
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    summary = run_backfill(
+        bucket_name=args.bucket,
+        prefix=args.prefix,
+        manifest_path=args.manifest,
+        workers=args.workers,
+        use_processes=args.processes,
+        rate_limit=args.rate_limit,
+        delete_published_failures=args.delete_published_failures,
+    )
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,16 +1,140 @@
+import base64
+import codecs
 import functions_framework
+import itertools
+import json
 import logging
-from phdi.harmonization.hl7 import convert_hl7_batch_messages_to_list
 import os
-from google.cloud import pubsub_v1
-from google.cloud import storage
-import json
+import time
 import flask
 from cloudevents.http import CloudEvent
+from typing import (
+    BinaryIO,
+    Dict,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TYPE_CHECKING,
+)
 from phdi_cloud_function_utils import (
     log_error_and_generate_response,
     log_info_and_generate_response,
+    stream_hl7_batch_message_offsets,
+    ConcurrentPublisher,
+    encode_envelope,
+    ENVELOPES,
+    BINARY_ENVELOPE,
+    compress_payload,
+    CONTENT_ENCODINGS,
+    make_claim_check_attributes,
+    DEFAULT_CLAIM_CHECK_THRESHOLD,
+    Checkpoint,
+    CheckpointStore,
+    GCSCheckpointStore,
+    SQLiteCheckpointStore,
+    make_checkpoint_key,
+    DedupIndex,
+    GCSDedupStore,
+    SQLiteDedupStore,
+    hash_message,
+    Metrics,
+    OpenTelemetryExporter,
+    RateLimiter,
+    RetryPolicy,
+    RetryBudget,
+    CircuitBreaker,
+    FailureManifestWriter,
+    make_failure_record,
+    sniff_blob,
+    sniff_content,
+    DEFAULT_SNIFF_BYTES,
+    get_archive_compression,
+    iter_archive_members,
+    stream_hl7_message_offsets,
+    plan_shards,
+    ShardTask,
+    ShardTracker,
+    encode_shard_task,
+    decode_shard_task,
+    DEFAULT_SHARD_BYTES,
+    stream_fhir_bundles,
+    DEFAULT_FHIR_BUNDLE_SIZE,
+    DEFAULT_MAX_OPEN_BUNDLES,
+    MessageLogger,
+    MESSAGE_LOG_MODES,
+    make_response,
 )
+from phdi_cloud_function_utils.compression import ZSTD, _get_zstandard
+
+DEFAULT_STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_PUBLISH_MAX_IN_FLIGHT_MESSAGES = 1000
+DEFAULT_PUBLISH_MAX_IN_FLIGHT_BYTES = 10 * 1024 * 1024
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+CHECKPOINT_STORES = ("none", "gcs", "sqlite")
+DEFAULT_CHECKPOINT_INTERVAL = 100
+DEFAULT_CHECKPOINT_PATH = "/tmp/checkpoints.db"
+DEDUP_STORES = ("none", "memory", "gcs", "sqlite")
+DEFAULT_DEDUP_CACHE_SIZE = 100000
+DEFAULT_DEDUP_PATH = "/tmp/dedup.db"
+DEFAULT_DEDUP_TTL_DAYS = 30
+METRICS_EXPORTERS = ("none", "opentelemetry")
+DEFAULT_SOURCE_PREFIXES = "source-data"
+DEFAULT_PUBLISH_MAX_ATTEMPTS = 5
+DEFAULT_PUBLISH_INITIAL_BACKOFF = 0.1
+DEFAULT_PUBLISH_MAX_BACKOFF = 10.0
+DEFAULT_CIRCUIT_BREAKER_MIN_REQUESTS = 20
+DEFAULT_CIRCUIT_BREAKER_RESET_SECONDS = 30.0
+
+# The GCP client libraries and phdi are slow to import, so they are imported when
+# first needed rather than when the function instance starts.
+if TYPE_CHECKING:
+    from google.cloud import pubsub_v1
+    from google.cloud import storage
+
+
+class SourceRoute(NamedTuple):
+    """
+    How the files in a directory under a source prefix are read, e.g. the files in
+    'source-data/vxu/'.
+    """
+
+    name: str
+    message_type: str
+    root_template: str
+
+
+# Routes by the directory below the source prefix. Register new message types with
+# `register_source_route`.
+SOURCE_ROUTES: Dict[str, SourceRoute] = {}
+
+
+def register_source_route(
+    directory: str, name: str, message_type: str, root_template: str
+) -> None:
+    """
+    Read the files in a directory under each source prefix as messages of a type.
+
+    :param directory: The directory below the source prefix, e.g. 'vxu'.
+    :param name: The name of the message type in responses, e.g. 'VXU'.
+    :param message_type: The format of the messages, e.g. 'hl7v2' or 'ccda', which
+        sniffed files must match.
+    :param root_template: The root template of the messages, e.g. 'VXU_V04'. The
+        root template named in MSH-9 of sniffed HL7v2 files takes precedence.
+    """
+    SOURCE_ROUTES[directory] = SourceRoute(
+        name=name, message_type=message_type, root_template=root_template
+    )
+
+
+register_source_route("elr", name="ELR", message_type="hl7v2", root_template="ORU_R01")
+register_source_route("vxu", name="VXU", message_type="hl7v2", root_template="VXU_V04")
+register_source_route("ecr", name="eCR", message_type="ccda", root_template="CCD")
+register_source_route("fhir", name="FHIR", message_type="fhir", root_template="Bundle")
+
+# Clients are created on first use and reused by later invocations handled by the
+# same function instance.
+_clients = {}
 
 
 @functions_framework.cloud_event
@@ -18,20 +142,125 @@ def read_source_data(cloud_event: CloudEvent) -> flask.Response:
     """
     When this function is triggered with a CloudEvent payload read the new file if its
     name begins with 'source-data/', identify each individual messsage
-    (ELR, VXU, or eCR) contained in the file, and publish each one to a GCP pubsub
-    topic. PROJECT_ID and INGESTION_TOPIC must be set as environment variables
+    (ELR, VXU, eCR, or FHIR) contained in the file, and publish each one to a GCP
+    pubsub topic. PROJECT_ID and INGESTION_TOPIC must be set as environment variables
     specifying the pubsub topic to publish to and the GCP project it is located in.
+    Messages that cannot be published are written to a single newline delimited JSON
+    manifest per file under 'publishing-failures/', along with their offsets and the
+    errors raised, and can be published again with replay_failures.py.
+
+    The following optional environment variables tune how files are read and
+    published:
+    - STREAM_SOURCE_DATA: When 'true', batch HL7v2 files are read in chunks of
+        STREAM_CHUNK_SIZE bytes and each message is published as soon as it is found.
+    - PUBLISH_MAX_MESSAGES, PUBLISH_MAX_BYTES, PUBLISH_MAX_LATENCY: Pub/Sub client
+        batch settings.
+    - PUBLISH_MAX_IN_FLIGHT_MESSAGES, PUBLISH_MAX_IN_FLIGHT_BYTES: Limits on the
+        messages awaiting a result from Pub/Sub.
+    - PUBSUB_ENVELOPE: 'json' (default) to publish each message and its fields as a
+        JSON object, or 'binary' to publish the raw message with its fields as message
+        attributes.
+    - PUBSUB_COMPRESSION: 'identity' (default), 'gzip', or 'zstd'. Messages of at least
+        PUBSUB_COMPRESSION_THRESHOLD bytes are compressed and given a content-encoding
+        attribute. Consumers must decode them with
+        `phdi_cloud_function_utils.decode_envelope`, so this must stay 'identity'
+        while messages are consumed by the ingestion workflow.
+    - CLAIM_CHECK_THRESHOLD: Messages whose Pub/Sub data would be larger than this many
+        bytes (9 MiB by default) are published as claim checks. eCR files are referenced
+        in place, while other messages are first written to 'claim-checks/' in
+        CLAIM_CHECK_BUCKET, which must be set and must not be the bucket triggering
+        this function. It should delete objects once they can no longer be
+        delivered. The message data is left empty and consumers fetch the payload
+        with `phdi_cloud_function_utils.ClaimCheckResolver`.
+    - CHECKPOINT_STORE: 'none' (default), 'gcs', or 'sqlite'. When set, progress
+        through each version of a file is saved every CHECKPOINT_INTERVAL messages, and
+        an invocation retried after a timeout or crash resumes from the last
+        checkpoint instead of publishing every message again. 'gcs' stores checkpoints
+        under 'checkpoints/' in CHECKPOINT_BUCKET, which must not be the bucket
+        triggering this function, while 'sqlite' stores them in a local database at
+        CHECKPOINT_PATH.
+    - DEDUP_STORE: 'none' (default), 'memory', 'gcs', or 'sqlite'. When set, each
+        message is hashed along with its root template and skipped if a message with
+        the same hash was already handled, e.g. because the same file was uploaded
+        again under a new name. The most recent DEDUP_CACHE_SIZE hashes are kept in
+        memory by each function instance, in front of a persistent index: 'gcs' keeps
+        it in shards under 'dedup/' in DEDUP_BUCKET, which must not be the bucket
+        triggering this function as objects are added to the shards after every
+        file, and 'sqlite' in a local database at DEDUP_PATH. 'memory' keeps no
+        persistent index. 'gcs' ignores hashes older than DEDUP_TTL_DAYS (default
+        30), and DEDUP_BUCKET should delete objects after as many days.
+    - METRICS_EXPORTER: 'none' (default) or 'opentelemetry' to also export the metrics
+        of each invocation through the globally configured OpenTelemetry meter
+        provider. The metrics are always returned in the JSON response.
+    - PUBLISH_RATE_LIMIT: The maximum number of publish requests per second made by
+        this function instance, shared by all of its invocations. Unlimited by
+        default.
+    - PUBLISH_MAX_ATTEMPTS, PUBLISH_INITIAL_BACKOFF, PUBLISH_MAX_BACKOFF: Each message
+        is published up to 5 times. Retries wait for an exponentially growing,
+        jittered delay, from at most 0.1 seconds up to at most 10 seconds. Errors
+        that retrying cannot fix, such as permission errors, are not retried.
+    - MESSAGE_LOG_MODE: 'all' (default) to log every published message, 'sampled' to
+        log one in every MESSAGE_LOG_SAMPLE_RATE (100 by default), or 'failures' to
+        only log messages that could not be published. Unless MESSAGE_LOG_INTERVAL is
+        '0', a line summing up the messages published and failed is also logged
+        every MESSAGE_LOG_INTERVAL seconds (30 by default).
+    - PUBLISH_RETRY_BUDGET_RATIO: When set, retries are limited to this fraction of
+        the publish requests made by this function instance, e.g. '0.1', so that
+        retries add little load to a struggling Pub/Sub.
+    - CIRCUIT_BREAKER_FAILURE_THRESHOLD: When set, e.g. to '0.5', publishing stops
+        once this fraction of at least CIRCUIT_BREAKER_MIN_REQUESTS recent publish
+        requests have failed. The remaining messages of the file are written to its
+        failure manifest straight away, and a single trial request is allowed every
+        CIRCUIT_BREAKER_RESET_SECONDS until publishing succeeds again. The breaker is
+        shared by all invocations handled by this function instance.
+    - SNIFF_SOURCE_DATA: When 'true', the first SNIFF_BYTES bytes (4 KiB by default)
+        of each file are read before the rest of it, and the file is rejected unless
+        they hold the start of the type of messages its directory is registered for.
+        The encoding of the file is detected, and the root template of HL7v2 messages
+        is taken from MSH-9 of the first message.
+    - Files compressed with gzip, zstd, or zip, which are identified by sniffing or
+        else by a .gz, .zst, or .zip extension, are decompressed as they are
+        downloaded. A zip archive may hold many files, and the messages in each are
+        published with the filename 'source-data/elr/archive.zip/member.hl7'. Files in
+        an archive that do not hold the expected type of messages are skipped.
+        Checkpoints within compressed files record only the number of messages
+        handled.
+    - SOURCE_PREFIXES: A comma separated list of the top-level directories whose
+        files are read, 'source-data' by default. backfill.py adds
+        'publishing-failures' to publish failed messages again.
+    - SHARD_THRESHOLD_BYTES: When set, uncompressed HL7v2 batch files of at least this
+        many bytes are read in shards by many invocations at once. This invocation
+        indexes where the messages in the file start and end without splitting them,
+        groups them into shards of about SHARD_BYTES bytes (64 MiB by default), and
+        publishes a task for each shard to SHARD_TOPIC, which must trigger
+        `read_source_data_shard`. The completion of each shard is tracked under
+        'shards/' in SHARD_BUCKET, which must not be the bucket triggering this
+        function, and the invocation completing the last shard logs the counts of
+        the whole file.
+    - FHIR_BUNDLE_SIZE, FHIR_MAX_OPEN_BUNDLES: Files in 'source-data/fhir/' are FHIR
+        NDJSON files, such as FHIR Bulk Data exports, which are always read a line at
+        a time. Their resources are published in batch Bundles of up to
+        FHIR_BUNDLE_SIZE resources (100 by default), which the ingestion workflow
+        does not convert. Resources about the same patient share a Bundle where
+        possible, but at most FHIR_MAX_OPEN_BUNDLES Bundles (10 by default) are
+        filled at once, so memory use does not grow with the size of the file. Lines
+        that are not FHIR resources are logged and skipped, and files encoded in
+        UTF-16 are rejected.
 
     :param cloud_event: A CloudEvent object provided by GCP whenever a new file is
         written to the storage bucket containing source data to be ingested.
     :return: A flask.Response object containing a message describing the function's
-        outcome and associated HTTP status code.
+        outcome and associated HTTP status code. Once a file has been read the
+        response is a JSON object holding the message and a summary of the metrics
+        recorded while reading and publishing it.
     """
+    start_time = time.perf_counter()
 
     # Extract buck and file names.
     try:
         filename = cloud_event.data["name"]
         bucket_name = cloud_event.data["bucket"]
+        generation = cloud_event.data.get("generation")
     except AttributeError:
         response = "Bad CloudEvent payload - 'data' attribute missing."
         response = log_error_and_generate_response(message=response, status_code="400")
@@ -42,26 +271,95 @@ def read_source_data(cloud_event: CloudEvent) -> flask.Response:
         response = log_error_and_generate_response(message=response, status_code="400")
         return response
 
-    # Determine data type and root template.
-    filename_parts = filename.split("/")
-    if filename_parts[0] == "source-data":
+    return read_source_file(
+        filename=filename,
+        bucket_name=bucket_name,
+        generation=generation,
+        start_time=start_time,
+    )
+
+
+@functions_framework.cloud_event
+def read_source_data_shard(cloud_event: CloudEvent) -> flask.Response:
+    """
+    When this function is triggered by a shard task that `read_source_data` published
+    to SHARD_TOPIC, read the messages in that shard of the file and publish each one,
+    configured by the same environment variables as `read_source_data`. Progress
+    through each shard is checkpointed separately when CHECKPOINT_STORE is set, and
+    messages that cannot be published are written to a failure manifest per shard.
+
+    :param cloud_event: A CloudEvent object provided by GCP whenever a message is
+        published to SHARD_TOPIC.
+    :return: A flask.Response object, as returned by `read_source_data`, whose JSON
+        object also holds the summary of the whole file if this was the last of its
+        shards to complete.
+    """
+    start_time = time.perf_counter()
+    try:
+        shard = decode_shard_task(base64.b64decode(cloud_event.data["message"]["data"]))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        response = "Bad CloudEvent payload - the message is not a shard task."
+        response = log_error_and_generate_response(message=response, status_code="400")
+        return response
+    if not os.environ.get("SHARD_BUCKET"):
+        response = (
+            "Missing required environment variables. A value for SHARD_BUCKET must be "
+            "set."
+        )
+        response = log_error_and_generate_response(message=response, status_code="500")
+        return response
 
-        if filename_parts[1] == "elr":
-            message_type = "hl7v2"
-            root_template = "ORU_R01"
+    return read_source_file(
+        filename=shard.filename,
+        bucket_name=shard.bucket_name,
+        generation=None if shard.generation is None else str(shard.generation),
+        start_time=start_time,
+        shard=shard,
+    )
 
-        elif filename_parts[1] == "vxu":
-            message_type = "hl7v2"
-            root_template = "VXU_V04"
 
-        elif filename_parts[1] == "ecr":
-            message_type = "ccda"
-            root_template = "CCD"
+def read_source_file(
+    filename: str,
+    bucket_name: str,
+    generation: Optional[str],
+    start_time: float = None,
+    shard: ShardTask = None,
+) -> flask.Response:
+    """
+    Read a source file, or a single shard of it, and publish its messages, as
+    described by `read_source_data`.
+
+    :param filename: The name of the file.
+    :param bucket_name: The bucket containing the file.
+    :param generation: The generation of the file to read, or None for the latest.
+    :param start_time: When the invocation started, as returned by
+        `time.perf_counter`.
+    :param shard: The shard of the file to read, when reading a file in shards.
+    :return: A flask.Response object, as returned by `read_source_data`.
+    """
+    start_time = start_time or time.perf_counter()
+    description = (
+        filename
+        if shard is None
+        else f"shard {shard.shard_idx + 1} of {shard.shard_count} of {filename}"
+    )
+
+    # Determine data type and root template.
+    filename_parts = filename.split("/")
+    source_prefixes = os.environ.get("SOURCE_PREFIXES", DEFAULT_SOURCE_PREFIXES).split(
+        ","
+    )
+    if filename_parts[0] in source_prefixes and len(filename_parts) > 1:
+        route = SOURCE_ROUTES.get(filename_parts[1])
+        if route is not None:
+            message_type = route.message_type
+            root_template = route.root_template
 
         else:
+            names = [registered.name for registered in SOURCE_ROUTES.values()]
             response = (
                 f"Unknown message type: {filename_parts[1]}. Messages should be "
-                "ELR, VXU, or eCR."
+                f"{', '.join(names[:-1])}, or {names[-1]}."
             )
             response = log_error_and_generate_response(
                 message=response, status_code="400"
@@ -69,7 +367,9 @@ def read_source_data(cloud_event: CloudEvent) -> flask.Response:
             return response
     else:
         response = (
-            f"{filename} was not read because it does not begin with 'source-data/'."
+            f"{filename} was not read because it does not begin with "
+            + " or ".join(f"'{prefix}/'" for prefix in source_prefixes)
+            + "."
         )
         response = log_info_and_generate_response(message=response, status_code="200")
         return response
@@ -87,83 +387,1230 @@ def read_source_data(cloud_event: CloudEvent) -> flask.Response:
         response = log_error_and_generate_response(message=response, status_code="400")
         return response
 
-    # Read file.
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(filename)
-    file_contents = blob.download_as_text(encoding="utf-8")
+    envelope = os.environ.get("PUBSUB_ENVELOPE", "json")
+    if envelope not in ENVELOPES:
+        response = (
+            f"Unknown PUBSUB_ENVELOPE: {envelope}. The envelope must be one of "
+            f"{', '.join(ENVELOPES)}."
+        )
+        response = log_error_and_generate_response(message=response, status_code="500")
+        return response
 
-    # Handle batch Hl7v2 messages.
-    if message_type == "hl7v2":
-        messages = convert_hl7_batch_messages_to_list(content=file_contents)
+    compression = os.environ.get("PUBSUB_COMPRESSION", "identity")
+    if compression not in CONTENT_ENCODINGS:
+        response = (
+            f"Unknown PUBSUB_COMPRESSION: {compression}. The compression must be one "
+            f"of {', '.join(CONTENT_ENCODINGS)}."
+        )
+        response = log_error_and_generate_response(message=response, status_code="500")
+        return response
+    if compression == ZSTD:
+        # Fail before reading the file rather than on its first large message.
+        try:
+            _get_zstandard()
+        except ImportError as error:
+            response = log_error_and_generate_response(
+                message=str(error), status_code="500"
+            )
+            return response
+    compression_threshold = int(
+        os.environ.get("PUBSUB_COMPRESSION_THRESHOLD", DEFAULT_COMPRESSION_THRESHOLD)
+    )
+    claim_check_threshold = int(
+        os.environ.get("CLAIM_CHECK_THRESHOLD", DEFAULT_CLAIM_CHECK_THRESHOLD)
+    )
+    if not os.environ.get("CLAIM_CHECK_BUCKET"):
+        response = (
+            "Missing required environment variables. A value for CLAIM_CHECK_BUCKET "
+            "must be set."
+        )
+        response = log_error_and_generate_response(message=response, status_code="500")
+        return response
+
+    checkpoint_store_type = os.environ.get("CHECKPOINT_STORE", "none")
+    if checkpoint_store_type not in CHECKPOINT_STORES:
+        response = (
+            f"Unknown CHECKPOINT_STORE: {checkpoint_store_type}. The checkpoint store "
+            f"must be one of {', '.join(CHECKPOINT_STORES)}."
+        )
+        response = log_error_and_generate_response(message=response, status_code="500")
+        return response
+    if checkpoint_store_type == "gcs" and not os.environ.get("CHECKPOINT_BUCKET"):
+        response = (
+            "Missing required environment variables. A value for CHECKPOINT_BUCKET "
+            "must be set when CHECKPOINT_STORE is 'gcs'."
+        )
+        response = log_error_and_generate_response(message=response, status_code="500")
+        return response
+    checkpoint_interval = max(
+        1, int(os.environ.get("CHECKPOINT_INTERVAL", DEFAULT_CHECKPOINT_INTERVAL))
+    )
+
+    dedup_store_type = os.environ.get("DEDUP_STORE", "none")
+    if dedup_store_type not in DEDUP_STORES:
+        response = (
+            f"Unknown DEDUP_STORE: {dedup_store_type}. The dedup store must be one of "
+            f"{', '.join(DEDUP_STORES)}."
+        )
+        response = log_error_and_generate_response(message=response, status_code="500")
+        return response
+    if dedup_store_type == "gcs" and not os.environ.get("DEDUP_BUCKET"):
+        response = (
+            "Missing required environment variables. A value for DEDUP_BUCKET must be "
+            "set when DEDUP_STORE is 'gcs'."
+        )
+        response = log_error_and_generate_response(message=response, status_code="500")
+        return response
+
+    message_log_mode = os.environ.get("MESSAGE_LOG_MODE", "all")
+    if message_log_mode not in MESSAGE_LOG_MODES:
+        response = (
+            f"Unknown MESSAGE_LOG_MODE: {message_log_mode}. The message log mode must "
+            f"be one of {', '.join(MESSAGE_LOG_MODES)}."
+        )
+        response = log_error_and_generate_response(message=response, status_code="500")
+        return response
+
+    metrics_exporter = os.environ.get("METRICS_EXPORTER", "none")
+    if metrics_exporter not in METRICS_EXPORTERS:
+        response = (
+            f"Unknown METRICS_EXPORTER: {metrics_exporter}. The metrics exporter must "
+            f"be one of {', '.join(METRICS_EXPORTERS)}."
+        )
+        response = log_error_and_generate_response(message=response, status_code="500")
+        return response
+    metrics = Metrics(
+        exporter=(
+            OpenTelemetryExporter(
+                meter_name="read_source_data", attributes={"message_type": message_type}
+            )
+            if metrics_exporter == "opentelemetry"
+            else None
+        )
+    )
+
+    # Read file. The bucket is referenced directly to avoid fetching its metadata, and
+    # the version of the file that triggered the event is read.
+    storage_client = get_storage_client()
+    bucket = storage_client.bucket(bucket_name)
+    blob = bucket.blob(filename, generation=int(generation) if generation else None)
+    claim_check_bucket = storage_client.bucket(os.environ["CLAIM_CHECK_BUCKET"])
+    stream_source_data = os.environ.get("STREAM_SOURCE_DATA", "false").lower() == "true"
+
+    # Resume from the last checkpoint of an earlier attempt to process the file.
+    checkpoint_store = get_checkpoint_store(checkpoint_store_type=checkpoint_store_type)
+    file_key = make_checkpoint_key(
+        bucket_name=bucket_name, filename=filename, generation=generation
+    )
+    if shard is None:
+        checkpoint_key = file_key
+        initial_checkpoint = Checkpoint(message_count=0, byte_offset=0)
+    else:
+        checkpoint_key = f"{file_key}/shard-{shard.shard_idx:06d}"
+        initial_checkpoint = Checkpoint(
+            message_count=shard.first_message_idx, byte_offset=shard.start
+        )
+    checkpoint = checkpoint_store.get(checkpoint_key) if checkpoint_store else None
+    checkpoint = checkpoint or initial_checkpoint
+    if checkpoint.complete:
+        response = f"{description} was not read because it was already processed."
+        response = log_info_and_generate_response(message=response, status_code="200")
+        return response
+    elif checkpoint.message_count > initial_checkpoint.message_count:
+        logging.info(
+            f"Resuming {description} from message {checkpoint.message_count} at byte "
+            f"{checkpoint.byte_offset}."
+        )
+
+    # Check that the file holds what its directory promises before downloading it.
+    # The contents of compressed files are checked as each member is decompressed,
+    # and shards were checked by the coordinator of their file.
+    encoding = "utf-8"
+    archive_compression = get_archive_compression(filename)
+    if shard is not None:
+        archive_compression = "identity"
+        encoding = shard.encoding
+        root_template = shard.root_template
+    elif os.environ.get("SNIFF_SOURCE_DATA", "false").lower() == "true":
+        with metrics.timer("sniff"):
+            sniffed = sniff_blob(
+                blob, size=int(os.environ.get("SNIFF_BYTES", DEFAULT_SNIFF_BYTES))
+            )
+        archive_compression = sniffed.compression
+        if archive_compression == "identity" and sniffed.format != message_type:
+            response = (
+                f"{filename} was not read because it does not contain "
+                f"{route.name} messages. Its contents were identified as "
+                f"{sniffed.format or 'unknown'}, while {route.name} messages must be "
+                f"{message_type}."
+            )
+            response = log_error_and_generate_response(
+                message=response, status_code="400"
+            )
+            return response
+        encoding = sniffed.encoding or encoding
+        if (
+            archive_compression == "identity"
+            and message_type == "fhir"
+            and encoding.startswith("utf-16")
+        ):
+            # NDJSON is split into lines as bytes, which UTF-16 is not compatible
+            # with, and must be UTF-8 encoded anyway.
+            response = (
+                f"{filename} was not read because it is encoded in UTF-16, while FHIR "
+                "NDJSON files must be encoded in UTF-8."
+            )
+            response = log_error_and_generate_response(
+                message=response, status_code="400"
+            )
+            return response
+        if (
+            message_type == "hl7v2"
+            and sniffed.format == message_type
+            and sniffed.root_template
+        ):
+            root_template = sniffed.root_template
+
+    # Read large batch files in shards, unless an earlier attempt started reading the
+    # file itself.
+    chunk_size = int(os.environ.get("STREAM_CHUNK_SIZE", DEFAULT_STREAM_CHUNK_SIZE))
+    shard_threshold = int(os.environ.get("SHARD_THRESHOLD_BYTES", 0))
+    if (
+        shard is None
+        and shard_threshold > 0
+        and message_type == "hl7v2"
+        and archive_compression == "identity"
+        and not encoding.startswith("utf-16")
+        and checkpoint.message_count == 0
+    ):
+        if blob.size is None:
+            blob.reload()
+        if blob.size >= shard_threshold:
+            return coordinate_shards(
+                blob=blob,
+                bucket_name=bucket_name,
+                filename=filename,
+                generation=generation,
+                root_template=root_template,
+                encoding="utf-8" if encoding == "utf-8-sig" else encoding,
+                project_id=project_id,
+                chunk_size=chunk_size,
+                checkpoint_store=checkpoint_store,
+                checkpoint_key=checkpoint_key,
+                metrics=metrics,
+                start_time=start_time,
+            )
+
+    # Messages are paired with their end offsets in the file where they are known, and
+    # with the name of their source.
+    if archive_compression != "identity":
+        messages = itertools.islice(
+            read_archive_messages(
+                blob=blob,
+                compression=archive_compression,
+                filename=filename,
+                message_type=message_type,
+                chunk_size=chunk_size,
+                metrics=metrics,
+            ),
+            checkpoint.message_count,
+            None,
+        )
+
+    # Handle FHIR NDJSON files, which are always streamed.
+    elif message_type == "fhir" and checkpoint.byte_offset is not None:
+        start = checkpoint.byte_offset
+        if encoding == "utf-8-sig":
+            encoding = "utf-8"
+            start = start or len(codecs.BOM_UTF8)
+        chunks = read_blob_in_chunks(
+            blob=blob, chunk_size=chunk_size, start=start, metrics=metrics
+        )
+        messages = read_fhir_bundles(
+            chunks=metrics.time_iterator("download", chunks),
+            encoding=encoding,
+            source=filename,
+            metrics=metrics,
+            offset=start,
+        )
+
+    # Handle batch Hl7v2 messages. Batches are split as bytes, which UTF-16 is not
+    # compatible with.
+    elif (
+        message_type == "hl7v2"
+        and (stream_source_data or shard is not None)
+        and checkpoint.byte_offset is not None
+        and not encoding.startswith("utf-16")
+    ):
+        start = checkpoint.byte_offset
+        if encoding == "utf-8-sig":
+            # Skip the byte order mark, which would hide the first MSH segment.
+            encoding = "utf-8"
+            start = start or len(codecs.BOM_UTF8)
+        # The last shard is read to the end of the file, so that its last message is
+        # stripped of trailing whitespace as when the whole file is read, while the
+        # last message of other shards is not.
+        end_of_file = shard is None or shard.shard_idx == shard.shard_count - 1
+        chunks = read_blob_in_chunks(
+            blob=blob,
+            chunk_size=chunk_size,
+            start=start,
+            end=None if end_of_file else shard.end,
+            metrics=metrics,
+        )
+        messages = (
+            (message, offset, filename)
+            for message, offset in stream_hl7_batch_message_offsets(
+                chunks=metrics.time_iterator("download", chunks),
+                encoding=encoding,
+                offset=start,
+                end_of_file=end_of_file,
+            )
+        )
 
     else:
-        messages = [file_contents]
+        with metrics.timer("download"):
+            file_contents = blob.download_as_text(encoding=encoding)
+        metrics.increment("bytes_read", len(file_contents.encode(encoding)))
+
+        if message_type == "hl7v2":
+            from phdi.harmonization.hl7 import convert_hl7_batch_messages_to_list
+
+            with metrics.timer("split"):
+                messages = convert_hl7_batch_messages_to_list(content=file_contents)
+
+        else:
+            messages = [file_contents]
+
+        messages = itertools.islice(
+            zip(messages, itertools.repeat(None), itertools.repeat(filename)),
+            checkpoint.message_count,
+            None,
+        )
+
+    # Messages that fail to publish are collected into a single manifest per file,
+    # which replay_failures.py publishes from again. A failure is recorded once its
+    # offset is reported to the progress handler, and recorded failures are flushed
+    # to GCS before each checkpoint so that none are lost if the function stops.
+    failure_writer = FailureManifestWriter(
+        bucket=bucket,
+        name=get_failure_manifest_name(
+            filename=filename,
+            generation=generation,
+            shard_idx=None if shard is None else shard.shard_idx,
+        ),
+        resume=checkpoint.message_count > initial_checkpoint.message_count,
+        metrics=metrics,
+    )
+    failed_messages = {}
+    # The sources of messages in flight from the members of an archive.
+    member_sources = {}
 
-    # Publish messages to pub/sub topic
-    publisher = pubsub_v1.PublisherClient()
+    def handle_failure(idx: int, message: str, error: Exception) -> None:
+        failed_messages[idx] = (message, error)
+
+    def record_failure(idx: int, offset: Optional[int]) -> None:
+        message, error = failed_messages.pop(idx)
+        failure_writer.add(
+            make_failure_record(
+                source=member_sources.get(idx, filename),
+                generation=int(generation) if generation else None,
+                idx=idx,
+                offset=offset,
+                message=message,
+                error=error,
+                message_type=message_type,
+                root_template=root_template,
+            )
+        )
+
+    # Messages are only added to the dedup index once they have been published, so
+    # that a message is never skipped because an attempt to publish it was cut short
+    # or failed.
+    # Hashes of messages still in flight are tracked separately to catch duplicates
+    # within the file.
+    dedup_index = get_dedup_index(dedup_store_type=dedup_store_type)
+    pending_hashes = {}
+    pending_hash_indexes = {}
+
+    # Save progress every checkpoint_interval messages, whether they were published,
+    # failed, or skipped as duplicates.
+    def handle_progress(idx: int, offset: Optional[int]) -> None:
+        failed = idx in failed_messages
+        if failed:
+            record_failure(idx, offset)
+        member_sources.pop(idx, None)
+        if idx in pending_hashes:
+            message_hash = pending_hashes.pop(idx)
+            del pending_hash_indexes[message_hash]
+            # Messages that could not be published are left out of the index, so that
+            # they are published when the file is uploaded again.
+            if not failed:
+                dedup_index.add(message_hash)
+        if checkpoint_store is not None and (idx + 1) % checkpoint_interval == 0:
+            with metrics.timer("write_failures"):
+                failure_writer.flush()
+            if dedup_index is not None:
+                with metrics.timer("dedup"):
+                    dedup_index.flush()
+            with metrics.timer("checkpoint"):
+                checkpoint_store.put(
+                    checkpoint_key,
+                    Checkpoint(message_count=idx + 1, byte_offset=offset),
+                )
+
+    # Publish messages to pub/sub topic, keeping many publish requests in flight.
+    publisher = get_publisher_client()
     topic_path = publisher.topic_path(project_id, ingestion_topic)
-    failure_count = 0
-    message_count = messages.__len__()
-    for idx, message in enumerate(messages):
-        pubsub_message = {
-            "message": message,
-            "message_type": message_type,
-            "root_template": root_template,
-            "filename": filename,
-        }
-
-        pubsub_message = json.dumps(pubsub_message).encode("utf-8")
-        future = publisher.publish(
-            topic_path, pubsub_message, origin="read_source_data"
+    concurrent_publisher = ConcurrentPublisher(
+        publisher=publisher,
+        topic_path=topic_path,
+        source=filename,
+        failure_handler=handle_failure,
+        max_in_flight_messages=int(
+            os.environ.get(
+                "PUBLISH_MAX_IN_FLIGHT_MESSAGES", DEFAULT_PUBLISH_MAX_IN_FLIGHT_MESSAGES
+            )
+        ),
+        max_in_flight_bytes=int(
+            os.environ.get(
+                "PUBLISH_MAX_IN_FLIGHT_BYTES", DEFAULT_PUBLISH_MAX_IN_FLIGHT_BYTES
+            )
+        ),
+        progress_handler=handle_progress,
+        metrics=metrics,
+        rate_limiter=get_rate_limiter(),
+        retry_policy=get_retry_policy(),
+        retry_budget=get_retry_budget(),
+        circuit_breaker=get_circuit_breaker(),
+        message_logger=MessageLogger.from_environment(source=description),
+        origin="read_source_data",
+    )
+    message_count = checkpoint.message_count
+    duplicate_count = 0
+    offset = checkpoint.byte_offset
+    for idx, (message, offset, source) in enumerate(
+        metrics.time_iterator("split", messages), start=checkpoint.message_count
+    ):
+        message_count += 1
+        metrics.increment("messages_split")
+        if dedup_index is not None:
+            with metrics.timer("dedup"):
+                message_hash = hash_message(message=message, namespace=root_template)
+                is_duplicate = message_hash in pending_hash_indexes or (
+                    dedup_index.contains(message_hash)
+                )
+            if is_duplicate:
+                duplicate_count += 1
+                metrics.increment("duplicates_skipped")
+                # Duplicates still advance the checkpoints, so that a retried
+                # invocation does not hash them again.
+                concurrent_publisher.skip(idx=idx, offset=offset)
+                continue
+            pending_hashes[idx] = message_hash
+            pending_hash_indexes[message_hash] = idx
+        if source != filename:
+            member_sources[idx] = source
+
+        pubsub_message, attributes = prepare_pubsub_message(
+            message=message,
+            message_type=message_type,
+            root_template=root_template,
+            bucket=bucket,
+            claim_check_bucket=claim_check_bucket,
+            filename=source,
+            generation=generation,
+            idx=idx,
+            envelope=envelope,
+            compression=compression,
+            compression_threshold=compression_threshold,
+            claim_check_threshold=claim_check_threshold,
+            metrics=metrics,
+            in_place=archive_compression == "identity",
         )
-        try:
-            message_id = future.result()
+        with metrics.timer("publish"):
+            concurrent_publisher.publish(
+                idx=idx,
+                message=message,
+                data=pubsub_message,
+                attributes=attributes,
+                offset=offset,
+            )
+
+    with metrics.timer("publish"):
+        concurrent_publisher.flush()
+    if dedup_index is not None:
+        with metrics.timer("dedup"):
+            dedup_index.flush()
+    failure_count = concurrent_publisher.failure_count
+    if failure_writer.record_count or failure_writer.resume:
+        with metrics.timer("write_failures"):
+            failure_writer.close()
+    if failure_writer.record_count:
+        logging.info(
+            f"{failure_writer.record_count} messages in {description} that could not "
+            f"be published were written to {failure_writer.name} in {bucket_name}."
+        )
+    if checkpoint_store is not None:
+        with metrics.timer("checkpoint"):
+            checkpoint_store.put(
+                checkpoint_key,
+                Checkpoint(
+                    message_count=message_count, byte_offset=offset, complete=True
+                ),
+            )
+
+    success_count = (
+        message_count - checkpoint.message_count - duplicate_count - failure_count
+    )
+    earlier_count = checkpoint.message_count - initial_checkpoint.message_count
+    response = (
+        f"Processed {description}, which contained "
+        f"{message_count - initial_checkpoint.message_count} messages, of which "
+        f"{success_count} were successfully published, and {failure_count} could not "
+        "be published."
+    )
+    if dedup_index is not None:
+        response += (
+            f" {duplicate_count} duplicates of messages that were already handled "
+            "were skipped."
+        )
+    if earlier_count:
+        response += (
+            f" The first {earlier_count} messages were handled by an earlier attempt."
+        )
+    logging.info(response)
+    json_payload = {
+        "message": response,
+        "duration_seconds": time.perf_counter() - start_time,
+        "metrics": metrics.summary(),
+    }
+
+    if shard is not None:
+        summary = get_shard_tracker().complete_shard(
+            key=file_key,
+            shard_idx=shard.shard_idx,
+            result={
+                "messages_published": success_count,
+                "publish_failures": failure_count,
+                "duplicates_skipped": duplicate_count,
+                "handled_by_earlier_attempts": earlier_count,
+            },
+        )
+        if summary is not None:
             logging.info(
-                f"Message {idx} in {filename} was published to {topic_path} with"
-                f"message ID {message_id}."
+                f"Processed all {summary['shard_count']} shards of {filename}, which "
+                f"contained {summary['message_count']} messages, of which "
+                f"{summary['messages_published']} were successfully published, and "
+                f"{summary['publish_failures']} could not be published."
             )
-        except Exception as error:
-            error_message = str(error)
-            logging.warning(
-                f"First attempt to publish message {idx} in {filename} failed because "
-                "{error_message}. Trying again..."
+            json_payload["file_summary"] = summary
+    return make_response(status_code=200, json_payload=json_payload)
+
+
+def coordinate_shards(
+    blob: "storage.Blob",
+    bucket_name: str,
+    filename: str,
+    generation: Optional[str],
+    root_template: str,
+    encoding: str,
+    project_id: str,
+    chunk_size: int,
+    checkpoint_store: Optional[CheckpointStore],
+    checkpoint_key: str,
+    metrics: Metrics,
+    start_time: float,
+) -> flask.Response:
+    """
+    Split a large HL7v2 batch file into shards that are read by many invocations of
+    `read_source_data_shard` at once. The file is read once to find where its messages
+    start and end, without decoding or splitting them, and a task is published to
+    SHARD_TOPIC for each run of whole messages of about SHARD_BYTES bytes.
+
+    :param blob: The file.
+    :param bucket_name: The bucket containing the file.
+    :param filename: The name of the file.
+    :param generation: The generation of the file.
+    :param root_template: The root template of the messages in the file.
+    :param encoding: The text encoding of the file.
+    :param project_id: The project of SHARD_TOPIC.
+    :param chunk_size: The number of bytes to read from GCS per request.
+    :param checkpoint_store: The store of checkpoints, in which the file is marked as
+        complete once every task is published, if checkpoints are enabled.
+    :param checkpoint_key: The key of the checkpoint of the file.
+    :param metrics: The metrics of the invocation.
+    :param start_time: When the invocation started, as returned by
+        `time.perf_counter`.
+    :return: A flask.Response object whose JSON object holds a message, the number of
+        shards, the number of messages, and metrics.
+    """
+    shard_topic = os.environ.get("SHARD_TOPIC")
+    if not shard_topic or not os.environ.get("SHARD_BUCKET"):
+        response = (
+            "Missing required environment variables. Values for SHARD_TOPIC and "
+            "SHARD_BUCKET must be set when SHARD_THRESHOLD_BYTES is set."
+        )
+        response = log_error_and_generate_response(message=response, status_code="500")
+        return response
+
+    # A redelivered event only publishes the tasks that an earlier attempt did not,
+    # even without checkpoints.
+    shard_tracker = get_shard_tracker()
+    file_key = make_checkpoint_key(
+        bucket_name=bucket_name, filename=filename, generation=generation
+    )
+    plan = shard_tracker.get_plan(file_key)
+    published_tasks = (
+        set() if plan is None else shard_tracker.get_published_tasks(file_key)
+    )
+    if plan is not None and len(published_tasks) >= plan["shard_count"]:
+        response = (
+            f"{filename} was not split again because the tasks of its "
+            f"{plan['shard_count']} shards were already published."
+        )
+        response = log_info_and_generate_response(message=response, status_code="200")
+        return response
+
+    # Index the message boundaries of the file, skipping any byte order mark.
+    start = 0
+    with metrics.timer("sniff"):
+        head = blob.download_as_bytes(start=0, end=len(codecs.BOM_UTF8) - 1)
+    if head == codecs.BOM_UTF8:
+        start = len(codecs.BOM_UTF8)
+    chunks = read_blob_in_chunks(
+        blob=blob, chunk_size=chunk_size, start=start, metrics=metrics
+    )
+    shards = list(
+        plan_shards(
+            message_offsets=metrics.time_iterator(
+                "index", stream_hl7_message_offsets(chunks=chunks, offset=start)
+            ),
+            shard_bytes=int(os.environ.get("SHARD_BYTES", DEFAULT_SHARD_BYTES)),
+        )
+    )
+    message_count = sum(shard.message_count for shard in shards)
+    shard_tracker.start(
+        key=file_key, shard_count=len(shards), message_count=message_count
+    )
+
+    # Publish a task per shard, recording each task once it is published.
+    publisher = get_publisher_client()
+    topic_path = publisher.topic_path(project_id, shard_topic)
+    futures = {}
+    with metrics.timer("publish_shards"):
+        for shard_idx, shard in enumerate(shards):
+            if shard_idx in published_tasks:
+                continue
+            task = ShardTask(
+                bucket_name=bucket_name,
+                filename=filename,
+                generation=int(generation) if generation else None,
+                shard_idx=shard_idx,
+                shard_count=len(shards),
+                start=shard.start,
+                end=shard.end,
+                first_message_idx=shard.first_message_idx,
+                message_count=shard.message_count,
+                root_template=root_template,
+                encoding=encoding,
+            )
+            futures[shard_idx] = publisher.publish(
+                topic_path,
+                encode_shard_task(task),
+                filename=filename,
+                shard=str(shard_idx),
             )
-            # Retry publishing.
+        errors = []
+        for shard_idx, future in futures.items():
             try:
-                future = publisher.publish(
-                    topic_path, pubsub_message, origin="read_source_data"
-                )
-                message_id = future.result()
-                logging.info(
-                    f"Message {idx} in {filename} was published to {topic_path} with "
-                    f"message ID {message_id}."
-                )
-            # On second failure write the message to storage and continue.
+                future.result()
             except Exception as error:
-                error_message = str(error)
-                logging.error(
-                    f"Publishing message {idx} in {filename} failed because"
-                    f"{error_message}."
-                )
-                failure_filename = filename.split("/")
-                failure_filename[0] = "publishing-failures"
-                failure_filename[-1] = (
-                    ".".join(failure_filename[-1].split(".")[0:-1]) + f"-{idx}.txt"
-                )
-                failure_filename = "/".join(failure_filename)
-                blob = bucket.blob(failure_filename)
-                blob.upload_from_string(message)
-                logging.info(
-                    f"Message {idx} in {filename} was written to {failure_filename} in "
-                    f"{bucket_name}."
-                )
-                failure_count += 1
+                errors.append(error)
+                continue
+            shard_tracker.record_task(key=file_key, shard_idx=shard_idx)
+        if errors:
+            raise errors[0]
+    metrics.increment("shards_published", len(futures))
+
+    # Mark the file as read so that a redelivered event does not split it again.
+    if checkpoint_store is not None:
+        with metrics.timer("checkpoint"):
+            checkpoint_store.put(
+                checkpoint_key,
+                Checkpoint(
+                    message_count=message_count,
+                    byte_offset=blob.size,
+                    complete=True,
+                ),
+            )
 
     response = (
-        f"Processed {filename}, which contained {message_count} messages, of which "
-        f"{message_count-failure_count} were successfully published, "
-        f"and {failure_count} could not be published."
+        f"Split {filename}, which contained {message_count} messages, into "
+        f"{len(shards)} shards, which will be read by read_source_data_shard."
+    )
+    logging.info(response)
+    return make_response(
+        status_code=200,
+        json_payload={
+            "message": response,
+            "shard_count": len(shards),
+            "message_count": message_count,
+            "duration_seconds": time.perf_counter() - start_time,
+            "metrics": metrics.summary(),
+        },
+    )
+
+
+def get_derived_filename(filename: str, directory: str, suffix: str) -> str:
+    """
+    Name a file derived from a source file, e.g. a claim check or failure manifest,
+    by replacing the top-level directory and the extension of the source file.
+
+    :param filename: The name of the source file, e.g. 'source-data/elr/batch.hl7'.
+    :param directory: The top-level directory of the derived file, e.g.
+        'claim-checks'.
+    :param suffix: The suffix replacing the extension of the source file, e.g.
+        '-3.hl7'.
+    :return: The name of the derived file, e.g. 'claim-checks/elr/batch-3.hl7'.
+    """
+    filename_parts = filename.split("/")
+    filename_parts[0] = directory
+    filename_parts[-1] = ".".join(filename_parts[-1].split(".")[0:-1]) + suffix
+    return "/".join(filename_parts)
+
+
+def get_failure_manifest_name(
+    filename: str, generation: Optional[str] = None, shard_idx: int = None
+) -> str:
+    """
+    Name the manifest of the messages in a source file that could not be published.
+
+    :param filename: The name of the source file.
+    :param generation: The generation of the source file, so that the manifests of
+        different versions of the same file do not replace each other.
+    :param shard_idx: The index of the shard of the source file, when it was read in
+        shards, so that each shard has a manifest of its own.
+    :return: The name of the manifest under 'publishing-failures/'.
+    """
+    suffix = f"-{generation}" if generation else ""
+    if shard_idx is not None:
+        suffix += f"-shard-{shard_idx:06d}"
+    suffix += ".ndjson"
+    return get_derived_filename(
+        filename=filename, directory="publishing-failures", suffix=suffix
+    )
+
+
+def write_claim_check(
+    bucket: "storage.Bucket",
+    claim_check_bucket: "storage.Bucket",
+    filename: str,
+    generation: Optional[str],
+    message_type: str,
+    idx: int,
+    message: str,
+    metrics: Metrics,
+    in_place: bool = True,
+) -> dict:
+    """
+    Store a message too large to publish in GCS and return the attributes of a claim
+    check referring to it. An eCR file holds a single message, so the source file
+    itself is referenced where possible.
+
+    :param bucket: The bucket of the source file.
+    :param claim_check_bucket: The bucket claim checks are written to, which must
+        not trigger functions on object changes.
+    :param filename: The name of the source file.
+    :param generation: The generation of the source file.
+    :param message_type: The type of the message.
+    :param idx: The index of the message within the source file.
+    :param message: The message.
+    :param metrics: Metrics counting claim checks in claim_checks.
+    :param in_place: Whether an eCR message can be referenced in its source file,
+        which is not the case for a file in a compressed archive.
+    :return: The claim check attributes to publish the message with.
+    """
+    metrics.increment("claim_checks")
+    if message_type == "ccda" and in_place:
+        return make_claim_check_attributes(
+            bucket_name=bucket.name, object_name=filename, generation=generation
+        )
+
+    # The claim check bucket is not versioned, so claim checks of different versions
+    # of the same file must not replace each other.
+    suffix = f"-{generation}-{idx}" if generation else f"-{idx}"
+    if message_type == "fhir":
+        suffix, content_type = f"{suffix}.json", "application/fhir+json"
+    else:
+        suffix, content_type = f"{suffix}.hl7", "text/plain; charset=utf-8"
+    claim_check_filename = get_derived_filename(
+        filename=filename, directory="claim-checks", suffix=suffix
+    )
+    claim_check_blob = claim_check_bucket.blob(claim_check_filename)
+    with metrics.timer("write_claim_check"):
+        claim_check_blob.upload_from_string(message, content_type=content_type)
+    logging.info(
+        f"Message {idx} in {filename} was written to {claim_check_filename} in "
+        f"{claim_check_bucket.name} to be published as a claim check."
+    )
+    return make_claim_check_attributes(
+        bucket_name=claim_check_bucket.name,
+        object_name=claim_check_filename,
+        generation=claim_check_blob.generation,
+    )
+
+
+def prepare_pubsub_message(
+    message: str,
+    message_type: str,
+    root_template: str,
+    bucket: "storage.Bucket",
+    claim_check_bucket: "storage.Bucket",
+    filename: str,
+    generation: Optional[str],
+    idx: int,
+    envelope: str,
+    compression: str,
+    compression_threshold: int,
+    claim_check_threshold: int,
+    metrics: Metrics,
+    in_place: bool = True,
+) -> Tuple[bytes, dict]:
+    """
+    Serialize and compress a message for Pub/Sub, writing it to GCS and referring to
+    it with a claim check instead if it is too large to publish.
+
+    :param message: The message.
+    :param message_type: The type of the message.
+    :param root_template: The root template of the message.
+    :param bucket: The bucket of the source file.
+    :param claim_check_bucket: The bucket claim checks are written to.
+    :param filename: The name of the source file.
+    :param generation: The generation of the source file.
+    :param idx: The index of the message within the source file.
+    :param envelope: The Pub/Sub envelope, one of `ENVELOPES`.
+    :param compression: The content encoding, one of `CONTENT_ENCODINGS`.
+    :param compression_threshold: The size from which payloads are compressed.
+    :param claim_check_threshold: The size above which payloads are published as
+        claim checks.
+    :param metrics: Metrics timing the serialize stage.
+    :param in_place: Whether an eCR message can be referenced in its source file
+        when it is published as a claim check.
+    :return: The data and attributes to publish.
+    """
+    with metrics.timer("serialize"):
+        pubsub_message, attributes = encode_envelope(
+            message=message,
+            message_type=message_type,
+            root_template=root_template,
+            filename=filename,
+            envelope=envelope,
+        )
+        pubsub_message, compression_attributes = compress_payload(
+            data=pubsub_message,
+            content_encoding=compression,
+            threshold=compression_threshold,
+        )
+        attributes.update(compression_attributes)
+    if len(pubsub_message) > claim_check_threshold:
+        # Claim checks always carry the fields of the binary envelope as attributes,
+        # and their payload is the uncompressed message.
+        pubsub_message, attributes = encode_envelope(
+            message=b"",
+            message_type=message_type,
+            root_template=root_template,
+            filename=filename,
+            envelope=BINARY_ENVELOPE,
+        )
+        attributes.update(
+            write_claim_check(
+                bucket=bucket,
+                claim_check_bucket=claim_check_bucket,
+                filename=filename,
+                generation=generation,
+                message_type=message_type,
+                idx=idx,
+                message=message,
+                metrics=metrics,
+                in_place=in_place,
+            )
+        )
+    return pubsub_message, attributes
+
+
+def get_storage_client() -> "storage.Client":
+    """
+    Get the GCS client shared by all invocations handled by this function instance,
+    creating it on first use.
+
+    :return: A storage.Client.
+    """
+    if "storage" not in _clients:
+        from google.cloud import storage
+
+        _clients["storage"] = storage.Client()
+    return _clients["storage"]
+
+
+def get_publisher_client() -> "pubsub_v1.PublisherClient":
+    """
+    Get the Pub/Sub publisher client shared by all invocations handled by this
+    function instance, creating it on first use.
+
+    :return: A pubsub_v1.PublisherClient configured by `build_publisher_client`.
+    """
+    if "publisher" not in _clients:
+        _clients["publisher"] = build_publisher_client()
+    return _clients["publisher"]
+
+
+def get_checkpoint_store(checkpoint_store_type: str) -> Optional[CheckpointStore]:
+    """
+    Get the store of checkpoints selected by the CHECKPOINT_STORE environment
+    variable.
+
+    :param checkpoint_store_type: 'none', 'gcs', or 'sqlite'.
+    :return: A CheckpointStore, or None if checkpoints are disabled.
+    """
+    if checkpoint_store_type == "gcs":
+        return GCSCheckpointStore(
+            storage_client=get_storage_client(),
+            bucket_name=os.environ["CHECKPOINT_BUCKET"],
+        )
+    elif checkpoint_store_type == "sqlite":
+        if "sqlite_checkpoints" not in _clients:
+            _clients["sqlite_checkpoints"] = SQLiteCheckpointStore(
+                path=os.environ.get("CHECKPOINT_PATH", DEFAULT_CHECKPOINT_PATH)
+            )
+        return _clients["sqlite_checkpoints"]
+    return None
+
+
+def get_shard_tracker() -> ShardTracker:
+    """
+    Get the tracker of the shards of files read in shards, which keeps their state in
+    SHARD_BUCKET.
+
+    :return: A ShardTracker.
+    """
+    return ShardTracker(
+        storage_client=get_storage_client(), bucket_name=os.environ["SHARD_BUCKET"]
+    )
+
+
+def get_dedup_index(dedup_store_type: str) -> Optional[DedupIndex]:
+    """
+    Get the index of handled messages selected by the DEDUP_STORE environment
+    variable. The index is shared by all invocations handled by this function
+    instance, so its in-memory cache stays warm.
+
+    :param dedup_store_type: 'none', 'memory', 'gcs', or 'sqlite'.
+    :return: A DedupIndex, or None if deduplication is disabled.
+    """
+    if dedup_store_type == "none":
+        return None
+
+    if dedup_store_type == "gcs":
+        dedup_bucket_name = os.environ["DEDUP_BUCKET"]
+        cache_key = f"dedup_index:gcs:{dedup_bucket_name}"
+    else:
+        cache_key = f"dedup_index:{dedup_store_type}"
+
+    if cache_key not in _clients:
+        if dedup_store_type == "gcs":
+            store = GCSDedupStore(
+                storage_client=get_storage_client(),
+                bucket_name=dedup_bucket_name,
+                ttl_days=int(os.environ.get("DEDUP_TTL_DAYS", DEFAULT_DEDUP_TTL_DAYS)),
+            )
+        elif dedup_store_type == "sqlite":
+            store = SQLiteDedupStore(
+                path=os.environ.get("DEDUP_PATH", DEFAULT_DEDUP_PATH)
+            )
+        else:
+            store = None
+        _clients[cache_key] = DedupIndex(
+            max_size=int(os.environ.get("DEDUP_CACHE_SIZE", DEFAULT_DEDUP_CACHE_SIZE)),
+            store=store,
+        )
+    return _clients[cache_key]
+
+
+def get_rate_limiter() -> Optional[RateLimiter]:
+    """
+    Get the limit on publish requests set by the PUBLISH_RATE_LIMIT environment
+    variable, shared by all invocations handled by this function instance.
+
+    :return: A RateLimiter, or None if publishing is not rate limited.
+    """
+    rate = float(os.environ.get("PUBLISH_RATE_LIMIT", 0))
+    if rate <= 0:
+        return None
+    cache_key = f"rate_limiter:{rate}"
+    if cache_key not in _clients:
+        _clients[cache_key] = RateLimiter(rate=rate)
+    return _clients[cache_key]
+
+
+def get_retry_policy() -> RetryPolicy:
+    """
+    Get the policy for retrying publish requests set by the PUBLISH_MAX_ATTEMPTS,
+    PUBLISH_INITIAL_BACKOFF, and PUBLISH_MAX_BACKOFF environment variables.
+
+    :return: A RetryPolicy.
+    """
+    return RetryPolicy(
+        max_attempts=int(
+            os.environ.get("PUBLISH_MAX_ATTEMPTS", DEFAULT_PUBLISH_MAX_ATTEMPTS)
+        ),
+        initial_backoff=float(
+            os.environ.get("PUBLISH_INITIAL_BACKOFF", DEFAULT_PUBLISH_INITIAL_BACKOFF)
+        ),
+        max_backoff=float(
+            os.environ.get("PUBLISH_MAX_BACKOFF", DEFAULT_PUBLISH_MAX_BACKOFF)
+        ),
+    )
+
+
+def get_retry_budget() -> Optional[RetryBudget]:
+    """
+    Get the limit on publish retries set by the PUBLISH_RETRY_BUDGET_RATIO environment
+    variable, shared by all invocations handled by this function instance.
+
+    :return: A RetryBudget, or None if retries are only limited per message.
+    """
+    ratio = float(os.environ.get("PUBLISH_RETRY_BUDGET_RATIO", 0))
+    if ratio <= 0:
+        return None
+    cache_key = f"retry_budget:{ratio}"
+    if cache_key not in _clients:
+        _clients[cache_key] = RetryBudget(ratio=ratio)
+    return _clients[cache_key]
+
+
+def get_circuit_breaker() -> Optional[CircuitBreaker]:
+    """
+    Get the circuit breaker for publishing set by the
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_MIN_REQUESTS, and
+    CIRCUIT_BREAKER_RESET_SECONDS environment variables, shared by all invocations
+    handled by this function instance.
+
+    :return: A CircuitBreaker, or None if publishing never stops early.
+    """
+    failure_threshold = float(os.environ.get("CIRCUIT_BREAKER_FAILURE_THRESHOLD", 0))
+    if failure_threshold <= 0:
+        return None
+    min_requests = int(
+        os.environ.get(
+            "CIRCUIT_BREAKER_MIN_REQUESTS", DEFAULT_CIRCUIT_BREAKER_MIN_REQUESTS
+        )
+    )
+    reset_timeout = float(
+        os.environ.get(
+            "CIRCUIT_BREAKER_RESET_SECONDS", DEFAULT_CIRCUIT_BREAKER_RESET_SECONDS
+        )
+    )
+    cache_key = f"circuit_breaker:{failure_threshold}:{min_requests}:{reset_timeout}"
+    if cache_key not in _clients:
+        _clients[cache_key] = CircuitBreaker(
+            failure_threshold=failure_threshold,
+            min_requests=min_requests,
+            reset_timeout=reset_timeout,
+        )
+    return _clients[cache_key]
+
+
+def read_blob_in_chunks(
+    blob: "storage.Blob",
+    chunk_size: int,
+    start: int = 0,
+    end: int = None,
+    metrics: Metrics = None,
+) -> Iterator[bytes]:
+    """
+    Read a blob from GCS as a series of chunks so that the entire blob never has to be
+    held in memory.
+
+    :param blob: The GCS blob to read.
+    :param chunk_size: The maximum number of bytes to read from GCS per request.
+    :param start: The offset in the blob to start reading from.
+    :param end: The offset in the blob to stop reading at, or None to read to the end.
+    :param metrics: Optional metrics counting the bytes read in bytes_read.
+    :return: An iterator over the bytes chunks of the blob.
+    """
+    position = start
+    with blob.open("rb", chunk_size=chunk_size) as reader:
+        if start:
+            reader.seek(start)
+        while end is None or position < end:
+            size = chunk_size if end is None else min(chunk_size, end - position)
+            chunk = reader.read(size)
+            if not chunk:
+                break
+            position += len(chunk)
+            if metrics is not None:
+                metrics.increment("bytes_read", len(chunk))
+            yield chunk
+
+
+def read_archive_messages(
+    blob: "storage.Blob",
+    compression: str,
+    filename: str,
+    message_type: str,
+    chunk_size: int,
+    metrics: Metrics,
+) -> Iterator[Tuple[str, None, str]]:
+    """
+    Read the messages in a compressed file, decompressing each of its members as it
+    is downloaded, so that neither the file nor its members are held in memory whole.
+    Members that do not hold messages of the expected type are skipped.
+
+    :param blob: The GCS blob to read.
+    :param compression: 'gzip', 'zstd', or 'zip'.
+    :param filename: The name of the file.
+    :param message_type: The type of messages expected, 'hl7v2', 'ccda', or 'fhir'.
+    :param chunk_size: The maximum number of bytes to read from GCS per request, and
+        to decompress at a time.
+    :param metrics: Metrics counting decompressed bytes in bytes_decompressed, and
+        members read and skipped in archive_members and archive_members_skipped.
+    :return: An iterator over each message, None in place of its offset, which is
+        not meaningful within a compressed file, and the name of its source, which is
+        the name of the file followed by the name of the member for zip archives.
+    """
+
+    def read_member(member: BinaryIO, first_chunk: bytes) -> Iterator[bytes]:
+        chunk = first_chunk
+        while chunk:
+            metrics.increment("bytes_decompressed", len(chunk))
+            yield chunk
+            chunk = member.read(chunk_size)
+
+    with blob.open("rb", chunk_size=chunk_size) as reader:
+        for member_name, member in iter_archive_members(reader, compression):
+            source = filename if member_name is None else f"{filename}/{member_name}"
+            with metrics.timer("download"):
+                first_chunk = member.read(chunk_size)
+            sniffed = sniff_content(first_chunk[:DEFAULT_SNIFF_BYTES])
+            if sniffed.format != message_type:
+                logging.warning(
+                    f"{source} was skipped because it does not contain {message_type} "
+                    "messages."
+                )
+                metrics.increment("archive_members_skipped")
+                continue
+            metrics.increment("archive_members")
+
+            encoding = sniffed.encoding
+            if encoding == "utf-8-sig":
+                # Drop the byte order mark, which would hide the first MSH segment.
+                bom_length = len(codecs.BOM_UTF8)
+                first_chunk = first_chunk[bom_length:]
+                encoding = "utf-8"
+            chunks = metrics.time_iterator("download", read_member(member, first_chunk))
+            if message_type == "fhir":
+                if encoding.startswith("utf-16"):
+                    logging.warning(
+                        f"{source} was skipped because it is encoded in UTF-16, while "
+                        "FHIR NDJSON files must be encoded in UTF-8."
+                    )
+                    metrics.increment("archive_members_skipped")
+                    continue
+                for message, _, _ in read_fhir_bundles(
+                    chunks=chunks, encoding=encoding, source=source, metrics=metrics
+                ):
+                    yield message, None, source
+                continue
+            if message_type == "hl7v2" and not encoding.startswith("utf-16"):
+                for message, _ in stream_hl7_batch_message_offsets(
+                    chunks=chunks, encoding=encoding
+                ):
+                    yield message, None, source
+                continue
+
+            contents = b"".join(chunks).decode(encoding)
+            if message_type == "hl7v2":
+                from phdi.harmonization.hl7 import convert_hl7_batch_messages_to_list
+
+                for message in convert_hl7_batch_messages_to_list(content=contents):
+                    yield message, None, source
+            else:
+                yield contents, None, source
+
+
+def read_fhir_bundles(
+    chunks: Iterator[bytes],
+    encoding: str,
+    source: str,
+    metrics: Metrics,
+    offset: int = 0,
+) -> Iterator[Tuple[str, int, str]]:
+    """
+    Group the resources in a FHIR NDJSON file into Bundles of FHIR_BUNDLE_SIZE
+    resources, as described by `read_source_data`.
+
+    :param chunks: The bytes chunks of the file.
+    :param encoding: The text encoding of the file.
+    :param source: The name of the file, or of the member of an archive.
+    :param metrics: Metrics counting the resources read in fhir_resources, and the
+        lines skipped in fhir_lines_skipped.
+    :param offset: The offset within the file of the first chunk.
+    :return: An iterator over each Bundle serialized as JSON, the offset in the file
+        to resume from after it, and the name of its source.
+    """
+
+    def handle_invalid_line(line: bytes, line_offset: int, error: Exception) -> None:
+        metrics.increment("fhir_lines_skipped")
+        logging.warning(
+            f"The line at byte {line_offset} of {source} was skipped because it is "
+            f"not a FHIR resource: {error}"
+        )
+
+    for bundle, resume_offset in stream_fhir_bundles(
+        chunks=chunks,
+        bundle_size=int(os.environ.get("FHIR_BUNDLE_SIZE", DEFAULT_FHIR_BUNDLE_SIZE)),
+        max_open_bundles=int(
+            os.environ.get("FHIR_MAX_OPEN_BUNDLES", DEFAULT_MAX_OPEN_BUNDLES)
+        ),
+        offset=offset,
+        encoding=encoding,
+        invalid_line_handler=handle_invalid_line,
+    ):
+        metrics.increment("fhir_resources", len(bundle["entry"]))
+        yield json.dumps(bundle), resume_offset, source
+
+
+def build_publisher_client() -> "pubsub_v1.PublisherClient":
+    """
+    Create a Pub/Sub publisher client that batches messages according to the
+    PUBLISH_MAX_MESSAGES, PUBLISH_MAX_BYTES, and PUBLISH_MAX_LATENCY environment
+    variables and blocks new publish requests while PUBLISH_MAX_IN_FLIGHT_MESSAGES
+    messages or PUBLISH_MAX_IN_FLIGHT_BYTES bytes are outstanding.
+
+    :return: A configured pubsub_v1.PublisherClient.
+    """
+    from google.cloud import pubsub_v1
+
+    batch_settings = pubsub_v1.types.BatchSettings(
+        max_messages=int(os.environ.get("PUBLISH_MAX_MESSAGES", 100)),
+        max_bytes=int(os.environ.get("PUBLISH_MAX_BYTES", 1000 * 1000)),
+        max_latency=float(os.environ.get("PUBLISH_MAX_LATENCY", 0.01)),
+    )
+    flow_control = pubsub_v1.types.PublishFlowControl(
+        message_limit=int(
+            os.environ.get(
+                "PUBLISH_MAX_IN_FLIGHT_MESSAGES", DEFAULT_PUBLISH_MAX_IN_FLIGHT_MESSAGES
+            )
+        ),
+        byte_limit=int(
+            os.environ.get(
+                "PUBLISH_MAX_IN_FLIGHT_BYTES", DEFAULT_PUBLISH_MAX_IN_FLIGHT_BYTES
+            )
+        ),
+        limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK,
+    )
+    return pubsub_v1.PublisherClient(
+        batch_settings=batch_settings,
+        publisher_options=pubsub_v1.types.PublisherOptions(flow_control=flow_control),
     )
-    response = log_info_and_generate_response(message=response, status_code="200")
-    return response
@@ -0,0 +1,270 @@
+"""
+Publish the messages recorded in the failure manifests that read_source_data writes to
+'publishing-failures/' when messages cannot be published, e.g. once Pub/Sub has
+recovered from an outage.
+
+Messages are published straight from each manifest, without reading their source files
+again, and are serialized, compressed, and claim checked according to the same
+environment variables as read_source_data. PROJECT_ID, INGESTION_TOPIC, and
+CLAIM_CHECK_BUCKET must be set. A manifest whose messages were all published is
+deleted, while a manifest with messages that failed again is replaced by a manifest of
+only those messages, so replaying can simply be repeated. To replay many manifests
+concurrently use backfill.py with a 'publishing-failures/' prefix.
+
+Usage:
+    python replay_failures.py --bucket some-bucket \\
+        --manifest publishing-failures/elr/batch.ndjson
+    python replay_failures.py --bucket some-bucket --prefix publishing-failures/vxu/
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+from typing import Iterator
+
+import main
+from phdi_cloud_function_utils import (
+    ConcurrentPublisher,
+    FailureManifestWriter,
+    MessageLogger,
+    Metrics,
+    iter_failure_records,
+    make_failure_record,
+    DEFAULT_CLAIM_CHECK_THRESHOLD,
+)
+
+FAILURE_MANIFEST_SUFFIX = ".ndjson"
+
+logger = logging.getLogger(__name__)
+
+
+def is_failure_manifest(filename: str) -> bool:
+    """
+    :param filename: The name of a file.
+    :return: True if the file is a failure manifest written by read_source_data, and
+        not a part of a manifest still being written.
+    """
+    return filename.startswith("publishing-failures/") and filename.endswith(
+        FAILURE_MANIFEST_SUFFIX
+    )
+
+
+def get_conflict_manifest_name(manifest_name: str, generation: int) -> str:
+    """
+    Name the manifest of the messages that failed again while replaying a manifest
+    that was written again meanwhile.
+
+    :param manifest_name: The name of the manifest replayed.
+    :param generation: The generation of the manifest replayed.
+    :return: The name of a manifest replay_failures.py can replay in turn.
+    """
+    stem = manifest_name[: -len(FAILURE_MANIFEST_SUFFIX)]
+    return f"{stem}-replayed-{generation}{FAILURE_MANIFEST_SUFFIX}"
+
+
+def list_failure_manifests(
+    storage_client, bucket_name: str, prefix: str = "publishing-failures/"
+) -> Iterator[str]:
+    """
+    :param storage_client: A `google.cloud.storage.Client`, or an object with the same
+        interface such as `phdi_cloud_function_utils_testing.fakes.FakeStorageClient`.
+    :param bucket_name: The bucket to list.
+    :param prefix: The prefix of the manifests to list.
+    :return: An iterator over the names of the failure manifests under the prefix.
+    """
+    for blob in storage_client.list_blobs(bucket_name, prefix=prefix):
+        if is_failure_manifest(blob.name):
+            yield blob.name
+
+
+def replay_failure_manifest(
+    bucket_name: str, manifest_name: str, generation: int = None
+) -> dict:
+    """
+    Publish every message recorded in a failure manifest, then delete the manifest,
+    or replace it with a manifest of the messages that failed again, unless it was
+    written again meanwhile.
+
+    :param bucket_name: The bucket containing the manifest.
+    :param manifest_name: The name of the manifest.
+    :param generation: The generation of the manifest to replay. Defaults to the
+        latest.
+    :return: A JSON serializable dictionary of the name of the manifest, the number of
+        messages published and that failed to publish again, whether the manifest was
+        deleted, the name of the manifest the messages that failed again were written
+        to instead if the manifest was written again meanwhile, and a summary of the
+        metrics recorded while replaying it.
+    """
+    start = time.perf_counter()
+    project_id = os.environ["PROJECT_ID"]
+    ingestion_topic = os.environ["INGESTION_TOPIC"]
+    envelope = os.environ.get("PUBSUB_ENVELOPE", "json")
+    compression = os.environ.get("PUBSUB_COMPRESSION", "identity")
+    compression_threshold = int(
+        os.environ.get(
+            "PUBSUB_COMPRESSION_THRESHOLD", main.DEFAULT_COMPRESSION_THRESHOLD
+        )
+    )
+    claim_check_threshold = int(
+        os.environ.get("CLAIM_CHECK_THRESHOLD", DEFAULT_CLAIM_CHECK_THRESHOLD)
+    )
+
+    metrics = Metrics()
+    bucket = main.get_storage_client().bucket(bucket_name)
+    claim_check_bucket = main.get_storage_client().bucket(
+        os.environ["CLAIM_CHECK_BUCKET"]
+    )
+    manifest_blob = bucket.blob(manifest_name, generation=generation)
+    if generation is None:
+        # Pin the version being replayed, so that a manifest written meanwhile by
+        # read_source_data is not deleted.
+        manifest_blob.reload()
+
+    # Messages that fail again are collected into a new version of the manifest, which
+    # is only written once every message has been read from the current version.
+    failure_writer = FailureManifestWriter(
+        bucket=bucket, name=manifest_name, metrics=metrics
+    )
+
+    def handle_failure(idx: int, record: dict, error: Exception) -> None:
+        failure_writer.add(
+            make_failure_record(
+                source=record["source"],
+                generation=record["generation"],
+                idx=record["idx"],
+                offset=record["offset"],
+                message=record["message"],
+                error=error,
+                message_type=record["message_type"],
+                root_template=record["root_template"],
+            )
+        )
+
+    publisher = main.get_publisher_client()
+    concurrent_publisher = ConcurrentPublisher(
+        publisher=publisher,
+        topic_path=publisher.topic_path(project_id, ingestion_topic),
+        source=manifest_name,
+        failure_handler=handle_failure,
+        max_in_flight_messages=int(
+            os.environ.get(
+                "PUBLISH_MAX_IN_FLIGHT_MESSAGES",
+                main.DEFAULT_PUBLISH_MAX_IN_FLIGHT_MESSAGES,
+            )
+        ),
+        max_in_flight_bytes=int(
+            os.environ.get(
+                "PUBLISH_MAX_IN_FLIGHT_BYTES", main.DEFAULT_PUBLISH_MAX_IN_FLIGHT_BYTES
+            )
+        ),
+        metrics=metrics,
+        rate_limiter=main.get_rate_limiter(),
+        retry_policy=main.get_retry_policy(),
+        retry_budget=main.get_retry_budget(),
+        circuit_breaker=main.get_circuit_breaker(),
+        message_logger=MessageLogger.from_environment(source=manifest_name),
+        origin="replay_failures",
+    )
+    records = iter_failure_records(manifest_blob)
+    for record in metrics.time_iterator("download", records):
+        pubsub_message, attributes = main.prepare_pubsub_message(
+            message=record["message"],
+            message_type=record["message_type"],
+            root_template=record["root_template"],
+            bucket=bucket,
+            claim_check_bucket=claim_check_bucket,
+            filename=record["source"],
+            generation=record["generation"],
+            idx=record["idx"],
+            envelope=envelope,
+            compression=compression,
+            compression_threshold=compression_threshold,
+            claim_check_threshold=claim_check_threshold,
+            metrics=metrics,
+            # The source of an eCR message may be a member of an archive, which
+            # cannot be referenced, so large messages are always copied.
+            in_place=False,
+        )
+        with metrics.timer("publish"):
+            concurrent_publisher.publish(
+                idx=record["idx"],
+                message=record,
+                data=pubsub_message,
+                attributes=attributes,
+            )
+    with metrics.timer("publish"):
+        concurrent_publisher.flush()
+
+    deleted = failure_writer.record_count == 0
+    conflict_manifest_name = None
+    with metrics.timer("write_failures"):
+        if deleted:
+            manifest_blob.delete()
+        else:
+            try:
+                failure_writer.close(if_generation_match=manifest_blob.generation)
+            except Exception as error:
+                if getattr(error, "code", None) != 412:
+                    raise
+                # read_source_data wrote a new version of the manifest while it was
+                # replayed, which is kept. The messages that failed again are written
+                # to a manifest of their own, and the version replayed is deleted.
+                conflict_manifest_name = get_conflict_manifest_name(
+                    manifest_name, manifest_blob.generation
+                )
+                failure_writer.close(name=conflict_manifest_name)
+                try:
+                    manifest_blob.delete()
+                except Exception as error:
+                    if getattr(error, "code", None) != 404:
+                        raise
+
+    result = {
+        "manifest": manifest_name,
+        "messages_published": concurrent_publisher.success_count,
+        "publish_failures": concurrent_publisher.failure_count,
+        "deleted": deleted,
+        "conflict_manifest": conflict_manifest_name,
+        "seconds": time.perf_counter() - start,
+        "metrics": metrics.summary(),
+    }
+    logger.info(
+        f"Replayed {manifest_name}, of which {result['messages_published']} messages "
+        f"were published, and {result['publish_failures']} could not be published "
+        "again."
+    )
+    if conflict_manifest_name is not None:
+        logger.warning(
+            f"{manifest_name} was written again while it was replayed, so the "
+            f"messages that failed again were written to {conflict_manifest_name}."
+        )
+    return result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--bucket", required=True)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--manifest", nargs="+", help="The manifests to replay.")
+    group.add_argument("--prefix", help="Replay every manifest under this prefix.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    manifests = args.manifest or list(
+        list_failure_manifests(main.get_storage_client(), args.bucket, args.prefix)
+    )
+    for manifest_name in manifests:
+        result = replay_failure_manifest(
+            bucket_name=args.bucket, manifest_name=manifest_name
+        )
+        result.pop("metrics")
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main_cli()
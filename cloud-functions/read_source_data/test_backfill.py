@@ -0,0 +1,148 @@
+from backfill import BackfillManifest, run_backfill
+from phdi_cloud_function_utils import decode_envelope
+from phdi_cloud_function_utils_testing.fakes import (
+    FakePublisherClient,
+    FakeStorageClient,
+)
+from unittest import mock
+import json
+import main
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def clear_client_cache():
+    main._clients.clear()
+    yield
+    main._clients.clear()
+
+
+TEST_ENVIRONMENT = {
+    "PROJECT_ID": "some-project",
+    "INGESTION_TOPIC": "some-topic",
+    "CLAIM_CHECK_BUCKET": "some-claim-check-bucket",
+    "STREAM_SOURCE_DATA": "true",
+    "PUBSUB_ENVELOPE": "binary",
+}
+
+
+def make_batch(name: str, message_count: int) -> str:
+    return "".join(
+        f"MSH|^~\\&|{name}-{idx}\rPID|{idx}\r" for idx in range(message_count)
+    )
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", TEST_ENVIRONMENT)
+def test_backfill_source_data(
+    patched_storage_client, patched_publisher_client, tmp_path
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    publisher = FakePublisherClient(latency=0.001)
+    patched_publisher_client.return_value = publisher
+    bucket = storage_client.bucket("some-bucket")
+    for idx in range(5):
+        bucket.blob(f"source-data/vxu/batch-{idx}.hl7").upload_from_string(
+            make_batch(f"batch-{idx}", 3)
+        )
+    bucket.blob("source-data/elr/other.hl7").upload_from_string(make_batch("elr", 1))
+    manifest_path = tmp_path / "manifest.ndjson"
+
+    summary = run_backfill(
+        bucket_name="some-bucket",
+        prefix="source-data/vxu/",
+        manifest_path=str(manifest_path),
+        workers=3,
+        rate_limit=1000,
+    )
+
+    assert summary["files"] == 5
+    assert summary["completed"] == 5
+    assert summary["messages_published"] == 15
+    assert publisher.published_count == 15
+    assert main.os.environ["PUBLISH_RATE_LIMIT"] == "1000"
+    results = [json.loads(line) for line in manifest_path.read_text().splitlines()]
+    assert sorted(result["name"] for result in results) == [
+        f"source-data/vxu/batch-{idx}.hl7" for idx in range(5)
+    ]
+    assert all(result["complete"] for result in results)
+
+    # Files completed by an earlier run are skipped, while new files are read.
+    bucket.blob("source-data/vxu/batch-5.hl7").upload_from_string(
+        make_batch("batch-5", 2)
+    )
+    summary = run_backfill(
+        bucket_name="some-bucket",
+        prefix="source-data/vxu/",
+        manifest_path=str(manifest_path),
+        workers=3,
+    )
+    assert summary["skipped"] == 5
+    assert summary["completed"] == 1
+    assert publisher.published_count == 17
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", TEST_ENVIRONMENT)
+def test_backfill_publishing_failures(
+    patched_storage_client, patched_publisher_client, tmp_path
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    publisher = FakePublisherClient()
+    patched_publisher_client.return_value = publisher
+    bucket = storage_client.bucket("some-bucket")
+    bucket.blob("publishing-failures/elr/batch-3.txt").upload_from_string(
+        "MSH|^~\\&|3\rPID|3\r"
+    )
+
+    summary = run_backfill(
+        bucket_name="some-bucket",
+        prefix="publishing-failures/",
+        manifest_path=str(tmp_path / "manifest.ndjson"),
+        delete_published_failures=True,
+    )
+
+    assert summary["completed"] == 1
+    data, attributes = publisher.published[0][1:]
+    assert decode_envelope(data, attributes)["message"] == "MSH|^~\\&|3\rPID|3\r"
+    assert attributes["root_template"] == "ORU_R01"
+    assert not bucket.blob("publishing-failures/elr/batch-3.txt").exists()
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", TEST_ENVIRONMENT)
+def test_backfill_not_completed(
+    patched_storage_client, patched_publisher_client, tmp_path
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    patched_publisher_client.return_value = FakePublisherClient()
+    storage_client.bucket("some-bucket").blob(
+        "source-data/unknown/some-file"
+    ).upload_from_string("some data")
+    manifest_path = tmp_path / "manifest.ndjson"
+
+    summary = run_backfill(
+        bucket_name="some-bucket",
+        prefix="source-data/",
+        manifest_path=str(manifest_path),
+    )
+
+    assert summary["not_completed"] == 1
+    (result,) = [json.loads(line) for line in manifest_path.read_text().splitlines()]
+    assert result["status_code"] == 400
+    assert not BackfillManifest(str(manifest_path)).completed
+
+
+def test_backfill_unknown_prefix(tmp_path):
+    with pytest.raises(ValueError):
+        run_backfill(
+            bucket_name="some-bucket",
+            prefix="claim-checks/",
+            manifest_path=str(tmp_path / "manifest.ndjson"),
+        )
@@ -1,6 +1,49 @@
-from main import read_source_data, log_info_and_generate_response
+from main import (
+    read_source_data,
+    read_source_data_shard,
+    build_publisher_client,
+    get_publisher_client,
+    get_storage_client,
+)
+from phdi_cloud_function_utils import (
+    Checkpoint,
+    ClaimCheckResolver,
+    GCSCheckpointStore,
+    make_checkpoint_key,
+    decode_envelope,
+    is_claim_check,
+    iter_failure_records,
+)
+from phdi_cloud_function_utils_testing.fakes import (
+    FakeBlob,
+    FakePublisherClient,
+    FakeStorageClient,
+)
 from unittest import mock
+import base64
+import codecs
+import gzip
+import io
 import json
+import logging
+import main
+import pytest
+import zipfile
+
+
+@pytest.fixture(autouse=True)
+def clear_client_cache():
+    main._clients.clear()
+    yield
+    main._clients.clear()
+
+
+TEST_ENVIRONMENT = {
+    "PROJECT_ID": "some-project",
+    "INGESTION_TOPIC": "some-topic",
+    "CLAIM_CHECK_BUCKET": "some-claim-check-bucket",
+    "PUBLISH_INITIAL_BACKOFF": "0",
+}
 
 
 def test_bad_cloud_event():
@@ -38,17 +81,16 @@ def test_unknown_message():
     actual_response = read_source_data(cloud_event)
     assert actual_response.response[0] == (
         b"Unknown message type: unknown-message-type. Messages "
-        b"should be ELR, VXU, or eCR."
+        b"should be ELR, VXU, eCR, or FHIR."
     )
 
 
-@mock.patch("main.pubsub_v1.PublisherClient")
-@mock.patch("main.storage.Client")
-@mock.patch("main.os.environ")
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", {}, clear=True)
 def test_missing_environment_variables(
-    patched_environ, patched_storage_client, patched_publisher_client
+    patched_storage_client, patched_publisher_client
 ):
-    patched_environ.__getitem__.side_effect = KeyError()
     cloud_event = mock.MagicMock()
     cloud_event.data.__getitem__.side_effect = [
         "source-data/elr/some-filename",
@@ -61,12 +103,11 @@ def test_missing_environment_variables(
     )
 
 
-@mock.patch("main.pubsub_v1.PublisherClient")
-@mock.patch("main.convert_hl7_batch_messages_to_list")
-@mock.patch("main.storage.Client")
-@mock.patch("main.os.environ")
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("phdi.harmonization.hl7.convert_hl7_batch_messages_to_list")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", TEST_ENVIRONMENT)
 def test_handle_batch_hl7(
-    patched_environ,
     patched_storage_client,
     patched_batch_converter,
     patched_publisher_client,
@@ -81,12 +122,11 @@ def test_handle_batch_hl7(
     patched_batch_converter.assert_called()
 
 
-@mock.patch("main.pubsub_v1.PublisherClient")
-@mock.patch("main.convert_hl7_batch_messages_to_list")
-@mock.patch("main.storage.Client")
-@mock.patch("main.os.environ")
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("phdi.harmonization.hl7.convert_hl7_batch_messages_to_list")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", TEST_ENVIRONMENT)
 def test_publishing_initial_success(
-    patched_environ,
     patched_storage_client,
     patched_batch_converter,
     patched_publisher_client,
@@ -113,7 +153,7 @@ def test_publishing_initial_success(
         patched_batch_converter.return_value = ["some-message"]
 
         patched_storage_client_instance = patched_storage_client.return_value
-        patched_bucket = patched_storage_client_instance.get_bucket.return_value
+        patched_bucket = patched_storage_client_instance.bucket.return_value
         patched_blob = patched_bucket.blob.return_value
         patched_blob.download_as_text.return_value = "some-message"
 
@@ -134,12 +174,11 @@ def test_publishing_initial_success(
         )
 
 
-@mock.patch("main.pubsub_v1.PublisherClient")
-@mock.patch("main.convert_hl7_batch_messages_to_list")
-@mock.patch("main.storage.Client")
-@mock.patch("main.os.environ")
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("phdi.harmonization.hl7.convert_hl7_batch_messages_to_list")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", TEST_ENVIRONMENT)
 def test_publishing_retry_success(
-    patched_environ,
     patched_storage_client,
     patched_batch_converter,
     patched_publisher_client,
@@ -153,7 +192,7 @@ def test_publishing_retry_success(
     patched_batch_converter.return_value = ["some-message"]
 
     patched_storage_client_instance = patched_storage_client.return_value
-    patched_bucket = patched_storage_client_instance.get_bucket.return_value
+    patched_bucket = patched_storage_client_instance.bucket.return_value
     patched_blob = patched_bucket.blob.return_value
     patched_blob.download_as_text.return_value = "some-message"
 
@@ -173,12 +212,143 @@ def test_publishing_retry_success(
     assert not patched_blob.upload_from_string.called
 
 
-@mock.patch("main.pubsub_v1.PublisherClient")
-@mock.patch("main.convert_hl7_batch_messages_to_list")
-@mock.patch("main.storage.Client")
-@mock.patch("main.os.environ")
-def test_publishing_failure(
-    patched_environ,
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "STREAM_SOURCE_DATA": "true"})
+def test_publishing_failure(patched_storage_client, patched_publisher_client):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    bucket = storage_client.bucket("some-bucket")
+    bucket.blob("source-data/elr/some-filename.txt").upload_from_string(
+        "MSH|^~\\&|1\rPID|1\rMSH|^~\\&|2\rPID|2\r"
+    )
+    patched_publisher_client.return_value = FakePublisherClient(failure_rate=1.0)
+    cloud_event = mock.MagicMock()
+    cloud_event.data = {
+        "name": "source-data/elr/some-filename.txt",
+        "bucket": "some-bucket",
+    }
+
+    actual_response = read_source_data(cloud_event)
+
+    assert actual_response.json["message"] == (
+        "Processed source-data/elr/some-filename.txt, which contained 2 messages, of "
+        "which 0 were successfully published, and 2 could not be published."
+    )
+    # Both failures are written to a single manifest.
+    assert [blob.name for blob in bucket.list_blobs(prefix="publishing-failures/")] == [
+        "publishing-failures/elr/some-filename.ndjson"
+    ]
+    assert actual_response.json["metrics"]["counters"]["failure_manifest_writes"] == 1
+    records = list(
+        iter_failure_records(
+            bucket.blob("publishing-failures/elr/some-filename.ndjson")
+        )
+    )
+    assert [record["message"] for record in records] == [
+        "MSH|^~\\&|1\rPID|1\r",
+        "MSH|^~\\&|2\rPID|2\r",
+    ]
+    assert [(record["idx"], record["offset"]) for record in records] == [
+        (0, 17),
+        (1, 34),
+    ]
+    assert records[0]["source"] == "source-data/elr/some-filename.txt"
+    assert records[0]["root_template"] == "ORU_R01"
+    assert records[0]["error"]
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict(
+    "main.os.environ",
+    {
+        **TEST_ENVIRONMENT,
+        "STREAM_SOURCE_DATA": "true",
+        "CIRCUIT_BREAKER_FAILURE_THRESHOLD": "0.5",
+        "CIRCUIT_BREAKER_MIN_REQUESTS": "4",
+        "PUBLISH_MAX_IN_FLIGHT_MESSAGES": "5",
+    },
+)
+def test_publishing_circuit_breaker(patched_storage_client, patched_publisher_client):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    bucket = storage_client.bucket("some-bucket")
+    bucket.blob("source-data/vxu/some-filename.hl7").upload_from_string(
+        "".join(f"MSH|^~\\&|{idx}\rPID|{idx}\r" for idx in range(50))
+    )
+    publisher = FakePublisherClient(failure_rate=1.0)
+    patched_publisher_client.return_value = publisher
+    cloud_event = mock.MagicMock()
+    cloud_event.data = {
+        "name": "source-data/vxu/some-filename.hl7",
+        "bucket": "some-bucket",
+    }
+
+    actual_response = read_source_data(cloud_event)
+
+    # Once the breaker opens the rest of the file is diverted to the failure manifest
+    # without being published.
+    counters = actual_response.json["metrics"]["counters"]
+    assert counters["publish_diverted"] > 40
+    assert publisher.attempt_count < 20
+    records = list(
+        iter_failure_records(
+            bucket.blob("publishing-failures/vxu/some-filename.ndjson")
+        )
+    )
+    assert [record["idx"] for record in records] == list(range(50))
+    assert records[-1]["error_type"] == "CircuitOpenError"
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+def test_publishing_failure_checkpoint(
+    patched_storage_client, patched_publisher_client, tmp_path
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    bucket = storage_client.bucket("some-bucket")
+    source_blob = bucket.blob("source-data/vxu/some-filename.hl7")
+    source_blob.upload_from_string(
+        "".join(f"MSH|^~\\&|{idx}\rPID|{idx}\r" for idx in range(6))
+    )
+    patched_publisher_client.return_value = FakePublisherClient(failure_rate=1.0)
+    cloud_event = mock.MagicMock()
+    cloud_event.data = {
+        "name": "source-data/vxu/some-filename.hl7",
+        "bucket": "some-bucket",
+        "generation": str(source_blob.generation),
+    }
+    environment = {
+        **TEST_ENVIRONMENT,
+        "STREAM_SOURCE_DATA": "true",
+        "CHECKPOINT_STORE": "sqlite",
+        "CHECKPOINT_PATH": str(tmp_path / "checkpoints.db"),
+        "CHECKPOINT_INTERVAL": "2",
+    }
+
+    # Failures are flushed to parts before each checkpoint, and the parts are
+    # composed into the manifest once the file has been read.
+    with mock.patch.dict("main.os.environ", environment):
+        read_source_data(cloud_event)
+
+    manifest_name = (
+        f"publishing-failures/vxu/some-filename-{source_blob.generation}.ndjson"
+    )
+    assert [blob.name for blob in bucket.list_blobs(prefix="publishing-failures/")] == [
+        manifest_name
+    ]
+    records = list(iter_failure_records(bucket.blob(manifest_name)))
+    assert [record["idx"] for record in records] == list(range(6))
+    assert all(record["generation"] == source_blob.generation for record in records)
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("phdi.harmonization.hl7.convert_hl7_batch_messages_to_list")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", TEST_ENVIRONMENT)
+def test_read_source_data(
     patched_storage_client,
     patched_batch_converter,
     patched_publisher_client,
@@ -192,55 +362,1406 @@ def test_publishing_failure(
     patched_batch_converter.return_value = ["some-message"]
 
     patched_storage_client_instance = patched_storage_client.return_value
-    patched_bucket = patched_storage_client_instance.get_bucket.return_value
+    patched_bucket = patched_storage_client_instance.bucket.return_value
     patched_blob = patched_bucket.blob.return_value
     patched_blob.download_as_text.return_value = "some-message"
 
+    actual_response = read_source_data(cloud_event)
+    assert actual_response.status_code == 200
+    assert actual_response.json["message"] == (
+        "Processed source-data/elr/some-filename.txt, which contained 1 "
+        "messages, of which 1 were successfully published, and 0 could not be "
+        "published."
+    )
+    metrics = actual_response.json["metrics"]
+    assert metrics["counters"]["bytes_read"] == len("some-message")
+    assert metrics["counters"]["messages_split"] == 1
+    assert set(metrics["stage_seconds"]) == {
+        "download",
+        "split",
+        "serialize",
+        "publish",
+    }
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("phdi.harmonization.hl7.convert_hl7_batch_messages_to_list")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict(
+    "main.os.environ",
+    {
+        **TEST_ENVIRONMENT,
+        "STREAM_SOURCE_DATA": "true",
+        "STREAM_CHUNK_SIZE": "16",
+    },
+)
+def test_read_source_data_streaming(
+    patched_storage_client,
+    patched_batch_converter,
+    patched_publisher_client,
+):
+    cloud_event = mock.MagicMock()
+    cloud_event.data.__getitem__.side_effect = [
+        "source-data/vxu/some-filename.hl7",
+        "some-bucket",
+    ]
+
+    patched_storage_client_instance = patched_storage_client.return_value
+    patched_bucket = patched_storage_client_instance.bucket.return_value
+    patched_blob = patched_bucket.blob.return_value
+    patched_reader = patched_blob.open.return_value.__enter__.return_value
+    patched_reader.read.side_effect = [
+        b"FHS|\nBHS|\nMSH|1\nPID|",
+        b"1\nMSH|2\nPID|2\n",
+        b"BTS|\nFTS|\n",
+        b"",
+    ]
+
     patched_publisher_client_instance = patched_publisher_client.return_value
     patched_publisher_client_instance.topic_path.return_value = "some-pubsub-topic"
-    future = mock.Mock()
-    future.result.side_effect = Exception()
-    patched_publisher_client_instance.publish.side_effect = [future, future]
 
-    read_source_data(cloud_event)
-    assert patched_publisher_client_instance.publish.call_count == 2
-    patched_bucket.blob.assert_called_with(
-        "publishing-failures/elr/some-filename-0.txt"
+    actual_response = read_source_data(cloud_event)
+
+    patched_blob.open.assert_called_with("rb", chunk_size=16)
+    assert not patched_blob.download_as_text.called
+    assert not patched_batch_converter.called
+    published_messages = [
+        json.loads(call.args[1])["message"]
+        for call in patched_publisher_client_instance.publish.call_args_list
+    ]
+    assert published_messages == ["MSH|1\rPID|1\r", "MSH|2\rPID|2\r"]
+    assert actual_response.json["message"] == (
+        "Processed source-data/vxu/some-filename.hl7, which contained 2 messages, "
+        "of which 2 were successfully published, and 0 could not be published."
     )
-    patched_blob.upload_from_string.assert_called_with("some-message")
 
 
-@mock.patch("main.pubsub_v1.PublisherClient")
-@mock.patch("main.convert_hl7_batch_messages_to_list")
-@mock.patch("main.storage.Client")
-@mock.patch("main.os.environ")
-def test_read_source_data(
-    patched_environ,
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("phdi.harmonization.hl7.convert_hl7_batch_messages_to_list")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", TEST_ENVIRONMENT)
+def test_publishing_concurrently(
     patched_storage_client,
     patched_batch_converter,
     patched_publisher_client,
 ):
-
     cloud_event = mock.MagicMock()
     cloud_event.data.__getitem__.side_effect = [
         "source-data/elr/some-filename.txt",
         "some-bucket",
     ]
+    patched_batch_converter.return_value = ["message-0", "message-1", "message-2"]
+
+    events = []
+    futures = []
+    for idx in range(3):
+        future = mock.Mock()
+        future.result.side_effect = lambda idx=idx: events.append(f"result-{idx}")
+        futures.append(future)
+
+    published = []
+
+    def publish(topic_path, data, **attributes):
+        events.append(f"publish-{len(published)}")
+        published.append(data)
+        return futures[len(published) - 1]
+
+    patched_publisher_client_instance = patched_publisher_client.return_value
+    patched_publisher_client_instance.publish.side_effect = publish
+
+    actual_response = read_source_data(cloud_event)
+
+    # Every message is published before any result is waited on.
+    assert events == [
+        "publish-0",
+        "publish-1",
+        "publish-2",
+        "result-0",
+        "result-1",
+        "result-2",
+    ]
+    assert actual_response.json["message"] == (
+        "Processed source-data/elr/some-filename.txt, which contained 3 messages, "
+        "of which 3 were successfully published, and 0 could not be published."
+    )
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch.dict(
+    "main.os.environ",
+    {
+        "PUBLISH_MAX_MESSAGES": "500",
+        "PUBLISH_MAX_BYTES": "2000000",
+        "PUBLISH_MAX_LATENCY": "0.05",
+        "PUBLISH_MAX_IN_FLIGHT_MESSAGES": "5000",
+        "PUBLISH_MAX_IN_FLIGHT_BYTES": "20000000",
+    },
+)
+def test_build_publisher_client(patched_publisher_client):
+    build_publisher_client()
+    batch_settings = patched_publisher_client.call_args.kwargs["batch_settings"]
+    publisher_options = patched_publisher_client.call_args.kwargs["publisher_options"]
+
+    assert batch_settings.max_messages == 500
+    assert batch_settings.max_bytes == 2000000
+    assert batch_settings.max_latency == 0.05
+    assert publisher_options.flow_control.message_limit == 5000
+    assert publisher_options.flow_control.byte_limit == 20000000
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+def test_clients_are_reused(patched_storage_client, patched_publisher_client):
+    assert get_storage_client() is get_storage_client()
+    assert get_publisher_client() is get_publisher_client()
+    patched_storage_client.assert_called_once()
+    patched_publisher_client.assert_called_once()
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("phdi.harmonization.hl7.convert_hl7_batch_messages_to_list")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", TEST_ENVIRONMENT)
+def test_clients_are_reused_across_invocations(
+    patched_storage_client,
+    patched_batch_converter,
+    patched_publisher_client,
+):
     patched_batch_converter.return_value = ["some-message"]
+    for _ in range(2):
+        cloud_event = mock.MagicMock()
+        cloud_event.data.__getitem__.side_effect = [
+            "source-data/elr/some-filename.txt",
+            "some-bucket",
+        ]
+        read_source_data(cloud_event)
 
+    patched_storage_client.assert_called_once()
+    patched_publisher_client.assert_called_once()
     patched_storage_client_instance = patched_storage_client.return_value
-    patched_bucket = patched_storage_client_instance.get_bucket.return_value
-    patched_blob = patched_bucket.blob.return_value
-    patched_blob.download_as_text.return_value = "some-message"
+    assert not patched_storage_client_instance.get_bucket.called
+    patched_storage_client_instance.bucket.assert_any_call("some-bucket")
+
+
+@mock.patch("main.get_publisher_client")
+@mock.patch("main.get_storage_client")
+def test_not_source_data_creates_no_clients(
+    patched_get_storage_client, patched_get_publisher_client
+):
+    cloud_event = mock.MagicMock()
+    cloud_event.data.__getitem__.side_effect = ["some-filename", "some-bucket"]
+    read_source_data(cloud_event)
+    assert not patched_get_storage_client.called
+    assert not patched_get_publisher_client.called
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("phdi.harmonization.hl7.convert_hl7_batch_messages_to_list")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "PUBSUB_ENVELOPE": "binary"})
+def test_publishing_binary_envelope(
+    patched_storage_client,
+    patched_batch_converter,
+    patched_publisher_client,
+):
+    cloud_event = mock.MagicMock()
+    cloud_event.data.__getitem__.side_effect = [
+        "source-data/vxu/some-filename.hl7",
+        "some-bucket",
+    ]
+    patched_batch_converter.return_value = ["MSH|some-message\r"]
+    patched_publisher_client_instance = patched_publisher_client.return_value
+    patched_publisher_client_instance.topic_path.return_value = "some-pubsub-topic"
+
+    read_source_data(cloud_event)
+
+    patched_publisher_client_instance.publish.assert_called_with(
+        "some-pubsub-topic",
+        b"MSH|some-message\r",
+        origin="read_source_data",
+        message_type="hl7v2",
+        root_template="VXU_V04",
+        filename="source-data/vxu/some-filename.hl7",
+    )
+
+
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "PUBSUB_ENVELOPE": "xml"})
+def test_unknown_envelope():
+    cloud_event = mock.MagicMock()
+    cloud_event.data.__getitem__.side_effect = [
+        "source-data/vxu/some-filename.hl7",
+        "some-bucket",
+    ]
+    actual_response = read_source_data(cloud_event)
+    assert actual_response.status_code == 500
+    assert actual_response.response[0] == (
+        b"Unknown PUBSUB_ENVELOPE: xml. The envelope must be one of json, binary."
+    )
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("phdi.harmonization.hl7.convert_hl7_batch_messages_to_list")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict(
+    "main.os.environ",
+    {
+        **TEST_ENVIRONMENT,
+        "PUBSUB_ENVELOPE": "binary",
+        "PUBSUB_COMPRESSION": "gzip",
+        "PUBSUB_COMPRESSION_THRESHOLD": "100",
+    },
+)
+def test_publishing_compressed(
+    patched_storage_client,
+    patched_batch_converter,
+    patched_publisher_client,
+):
+    cloud_event = mock.MagicMock()
+    cloud_event.data.__getitem__.side_effect = [
+        "source-data/elr/some-filename.hl7",
+        "some-bucket",
+    ]
+    large_message = "MSH|some-message\rOBX|some-observation\r" * 10
+    patched_batch_converter.return_value = ["MSH|small\r", large_message]
+    patched_publisher_client_instance = patched_publisher_client.return_value
+
+    read_source_data(cloud_event)
+
+    small_call, large_call = patched_publisher_client_instance.publish.call_args_list
+    assert small_call.args[1] == b"MSH|small\r"
+    assert "content-encoding" not in small_call.kwargs
+    assert large_call.kwargs["content-encoding"] == "gzip"
+    assert gzip.decompress(large_call.args[1]) == large_message.encode("utf-8")
+
+
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "PUBSUB_COMPRESSION": "lz4"})
+def test_unknown_compression():
+    cloud_event = mock.MagicMock()
+    cloud_event.data.__getitem__.side_effect = [
+        "source-data/vxu/some-filename.hl7",
+        "some-bucket",
+    ]
+    actual_response = read_source_data(cloud_event)
+    assert actual_response.status_code == 500
+    assert actual_response.response[0] == (
+        b"Unknown PUBSUB_COMPRESSION: lz4. The compression must be one of identity, "
+        b"gzip, zstd."
+    )
+
+
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "PUBSUB_COMPRESSION": "zstd"})
+@mock.patch("main._get_zstandard")
+def test_missing_zstandard(patched_get_zstandard):
+    patched_get_zstandard.side_effect = ImportError(
+        "The zstandard package is required for zstd compression."
+    )
+    cloud_event = mock.MagicMock()
+    cloud_event.data.__getitem__.side_effect = [
+        "source-data/vxu/some-filename.hl7",
+        "some-bucket",
+    ]
+    actual_response = read_source_data(cloud_event)
+    assert actual_response.status_code == 500
+    assert actual_response.response[0] == (
+        b"The zstandard package is required for zstd compression."
+    )
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict(
+    "main.os.environ",
+    {**TEST_ENVIRONMENT, "STREAM_SOURCE_DATA": "true", "CLAIM_CHECK_THRESHOLD": "200"},
+)
+def test_publishing_staged_claim_check(
+    patched_storage_client, patched_publisher_client
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    patched_publisher_client.return_value = FakePublisherClient()
+    large_message = "MSH|^~\\&|large\r" + "OBX|some-observation\r" * 20
+    source_blob = storage_client.bucket("some-bucket").blob(
+        "source-data/elr/some-filename.hl7"
+    )
+    source_blob.upload_from_string("MSH|^~\\&|small\r" + large_message)
+    cloud_event = mock.MagicMock()
+    cloud_event.data = {
+        "name": "source-data/elr/some-filename.hl7",
+        "bucket": "some-bucket",
+        "generation": str(source_blob.generation),
+    }
+
+    read_source_data(cloud_event)
+
+    (_, small_data, small_attributes), (
+        _,
+        large_data,
+        large_attributes,
+    ) = patched_publisher_client.return_value.published
+    assert json.loads(small_data)["message"] == "MSH|^~\\&|small\r"
+    assert not is_claim_check(small_attributes)
+    assert large_data == b""
+    # Claim checks are written out of the bucket triggering the function, named
+    # after the version of the source file.
+    assert large_attributes["claim-check-bucket"] == "some-claim-check-bucket"
+    assert large_attributes["claim-check-object"] == (
+        f"claim-checks/elr/some-filename-{source_blob.generation}-1.hl7"
+    )
+    assert storage_client.list_blobs("some-bucket", prefix="claim-checks/") == []
+    assert ClaimCheckResolver(storage_client).resolve(
+        large_data, large_attributes
+    ) == large_message.encode("utf-8")
+    assert decode_envelope(large_message.encode("utf-8"), large_attributes) == {
+        "message": large_message,
+        "message_type": "hl7v2",
+        "root_template": "ORU_R01",
+        "filename": "source-data/elr/some-filename.hl7",
+    }
+
+
+def test_missing_claim_check_bucket():
+    environment = {
+        name: value
+        for name, value in TEST_ENVIRONMENT.items()
+        if name != "CLAIM_CHECK_BUCKET"
+    }
+    cloud_event = mock.MagicMock()
+    cloud_event.data.__getitem__.side_effect = [
+        "source-data/elr/some-filename.hl7",
+        "some-bucket",
+    ]
+    with mock.patch.dict("main.os.environ", environment, clear=True):
+        actual_response = read_source_data(cloud_event)
+    assert actual_response.status_code == 500
+    assert actual_response.response[0] == (
+        b"Missing required environment variables. A value for CLAIM_CHECK_BUCKET "
+        b"must be set."
+    )
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict(
+    "main.os.environ", {**TEST_ENVIRONMENT, "CLAIM_CHECK_THRESHOLD": "100"}
+)
+def test_publishing_source_claim_check(
+    patched_storage_client, patched_publisher_client
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    patched_publisher_client.return_value = FakePublisherClient()
+    document = "<ClinicalDocument>" + "<section/>" * 20 + "</ClinicalDocument>"
+    source_blob = storage_client.bucket("some-bucket").blob(
+        "source-data/ecr/some-filename.xml"
+    )
+    source_blob.upload_from_string(document)
+    cloud_event = mock.MagicMock()
+    cloud_event.data = {
+        "name": "source-data/ecr/some-filename.xml",
+        "bucket": "some-bucket",
+        "generation": str(source_blob.generation),
+    }
+    # Overwriting the source does not change the payload of the claim check.
+    source_blob.upload_from_string("<ClinicalDocument/>")
+
+    read_source_data(cloud_event)
+
+    [(_, data, attributes)] = patched_publisher_client.return_value.published
+    assert data == b""
+    assert attributes["message_type"] == "ccda"
+    assert attributes["claim-check-object"] == "source-data/ecr/some-filename.xml"
+    assert ClaimCheckResolver(storage_client).resolve(
+        data, attributes
+    ) == document.encode("utf-8")
+    assert storage_client.list_blobs("some-bucket", prefix="claim-checks/") == []
+
+
+class CrashingPublisherClient(FakePublisherClient):
+    def __init__(self, crash_after: int):
+        super().__init__()
+        self.crash_after = crash_after
+
+    def publish(self, topic: str, data: bytes, **attributes: str):
+        if len(self.published) == self.crash_after:
+            raise RuntimeError("Function instance shut down.")
+        return super().publish(topic, data, **attributes)
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+def test_resuming_from_checkpoint(
+    patched_storage_client, patched_publisher_client, tmp_path
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    source_blob = storage_client.bucket("some-bucket").blob(
+        "source-data/elr/some-filename.hl7"
+    )
+    source_blob.upload_from_string(
+        "FHS|1\n" + "".join(f"MSH|^~\\&|{idx}\nPID|{idx}\n" for idx in range(5))
+    )
+    cloud_event = mock.MagicMock()
+    cloud_event.data = {
+        "name": "source-data/elr/some-filename.hl7",
+        "bucket": "some-bucket",
+        "generation": str(source_blob.generation),
+    }
+    environment = {
+        **TEST_ENVIRONMENT,
+        "STREAM_SOURCE_DATA": "true",
+        "CHECKPOINT_STORE": "sqlite",
+        "CHECKPOINT_PATH": str(tmp_path / "checkpoints.db"),
+        "CHECKPOINT_INTERVAL": "2",
+        "PUBLISH_MAX_IN_FLIGHT_MESSAGES": "1",
+    }
+
+    with mock.patch.dict("main.os.environ", environment):
+        patched_publisher_client.return_value = CrashingPublisherClient(crash_after=3)
+        with pytest.raises(RuntimeError):
+            read_source_data(cloud_event)
+
+        # The first two messages were checkpointed before the crash, so the retried
+        # invocation starts with the third.
+        main._clients.clear()
+        patched_publisher_client.return_value = FakePublisherClient()
+        actual_response = read_source_data(cloud_event)
+        assert [
+            decode_envelope(data, attributes)["message"]
+            for _, data, attributes in patched_publisher_client.return_value.published
+        ] == [f"MSH|^~\\&|{idx}\rPID|{idx}\r" for idx in range(2, 5)]
+        assert actual_response.json["message"] == (
+            "Processed source-data/elr/some-filename.hl7, which contained 5 "
+            "messages, of which 3 were successfully published, and 0 could not be "
+            "published. The first 2 messages were handled by an earlier attempt."
+        )
+
+        main._clients.clear()
+        patched_publisher_client.return_value = FakePublisherClient()
+        actual_response = read_source_data(cloud_event)
+        assert patched_publisher_client.return_value.published == []
+        assert actual_response.response[0] == (
+            b"source-data/elr/some-filename.hl7 was not read because it was already "
+            b"processed."
+        )
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+def test_checkpoints_on_duplicate_messages(
+    patched_storage_client, patched_publisher_client, tmp_path
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    source_blob = storage_client.bucket("some-bucket").blob(
+        "source-data/elr/some-filename.hl7"
+    )
+    # The second to fourth messages are duplicates of the first, and the checkpoints
+    # after the second and fourth messages fall on them.
+    source_blob.upload_from_string(
+        "".join(f"MSH|^~\\&|{idx}\n" for idx in [0, 0, 0, 0, 4, 5])
+    )
+    cloud_event = mock.MagicMock()
+    cloud_event.data = {
+        "name": "source-data/elr/some-filename.hl7",
+        "bucket": "some-bucket",
+        "generation": str(source_blob.generation),
+    }
+    environment = {
+        **TEST_ENVIRONMENT,
+        "STREAM_SOURCE_DATA": "true",
+        "CHECKPOINT_STORE": "sqlite",
+        "CHECKPOINT_PATH": str(tmp_path / "checkpoints.db"),
+        "CHECKPOINT_INTERVAL": "2",
+        "DEDUP_STORE": "memory",
+        "PUBLISH_MAX_IN_FLIGHT_MESSAGES": "1",
+    }
+
+    with mock.patch.dict("main.os.environ", environment):
+        patched_publisher_client.return_value = CrashingPublisherClient(crash_after=2)
+        with pytest.raises(RuntimeError):
+            read_source_data(cloud_event)
+
+        # The retried invocation resumes after the duplicates.
+        main._clients.clear()
+        patched_publisher_client.return_value = FakePublisherClient()
+        actual_response = read_source_data(cloud_event)
+        assert [
+            json.loads(data)["message"]
+            for _, data, _ in patched_publisher_client.return_value.published
+        ] == ["MSH|^~\\&|4\r", "MSH|^~\\&|5\r"]
+        assert actual_response.json["message"].endswith(
+            "The first 4 messages were handled by an earlier attempt."
+        )
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("phdi.harmonization.hl7.convert_hl7_batch_messages_to_list")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict(
+    "main.os.environ",
+    {**TEST_ENVIRONMENT, "CHECKPOINT_STORE": "gcs", "CHECKPOINT_BUCKET": "checkpoints"},
+)
+def test_resuming_from_checkpoint_without_offsets(
+    patched_storage_client, patched_batch_converter, patched_publisher_client
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    patched_publisher_client.return_value = FakePublisherClient()
+    patched_batch_converter.return_value = ["MSH|1\r", "MSH|2\r", "MSH|3\r"]
+    source_blob = storage_client.bucket("some-bucket").blob(
+        "source-data/vxu/some-filename.hl7"
+    )
+    source_blob.upload_from_string("some-batch")
+    checkpoint_key = make_checkpoint_key(
+        "some-bucket", "source-data/vxu/some-filename.hl7", str(source_blob.generation)
+    )
+    checkpoint_store = GCSCheckpointStore(storage_client, "checkpoints")
+    checkpoint_store.put(checkpoint_key, Checkpoint(message_count=2))
+    cloud_event = mock.MagicMock()
+    cloud_event.data = {
+        "name": "source-data/vxu/some-filename.hl7",
+        "bucket": "some-bucket",
+        "generation": str(source_blob.generation),
+    }
+
+    read_source_data(cloud_event)
+
+    [(_, data, _)] = patched_publisher_client.return_value.published
+    assert json.loads(data)["message"] == "MSH|3\r"
+    assert checkpoint_store.get(checkpoint_key) == Checkpoint(
+        message_count=3, complete=True
+    )
+
+
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "CHECKPOINT_STORE": "gcs"})
+def test_missing_checkpoint_bucket():
+    cloud_event = mock.MagicMock()
+    cloud_event.data.__getitem__.side_effect = [
+        "source-data/vxu/some-filename.hl7",
+        "some-bucket",
+    ]
+    actual_response = read_source_data(cloud_event)
+    assert actual_response.status_code == 500
+    assert actual_response.response[0] == (
+        b"Missing required environment variables. A value for CHECKPOINT_BUCKET must "
+        b"be set when CHECKPOINT_STORE is 'gcs'."
+    )
+
+
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "CHECKPOINT_STORE": "redis"})
+def test_unknown_checkpoint_store():
+    cloud_event = mock.MagicMock()
+    cloud_event.data.__getitem__.side_effect = [
+        "source-data/vxu/some-filename.hl7",
+        "some-bucket",
+    ]
+    actual_response = read_source_data(cloud_event)
+    assert actual_response.status_code == 500
+    assert actual_response.response[0] == (
+        b"Unknown CHECKPOINT_STORE: redis. The checkpoint store must be one of none, "
+        b"gcs, sqlite."
+    )
+
+
+@pytest.mark.parametrize("dedup_store", ["sqlite", "gcs"])
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+def test_skipping_duplicate_messages(
+    patched_storage_client, patched_publisher_client, dedup_store, tmp_path
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    batch = "MSH|^~\\&|1\rMSH|^~\\&|2\rMSH|^~\\&|1\r"
+    for name in ["source-data/elr/some-filename.hl7", "source-data/elr/copy.hl7"]:
+        storage_client.bucket("some-bucket").blob(name).upload_from_string(batch)
+    environment = {
+        **TEST_ENVIRONMENT,
+        "STREAM_SOURCE_DATA": "true",
+        "DEDUP_STORE": dedup_store,
+        "DEDUP_PATH": str(tmp_path / "dedup.db"),
+        "DEDUP_BUCKET": "some-dedup-bucket",
+    }
 
+    with mock.patch.dict("main.os.environ", environment):
+        patched_publisher_client.return_value = FakePublisherClient()
+        cloud_event = mock.MagicMock()
+        cloud_event.data = {
+            "name": "source-data/elr/some-filename.hl7",
+            "bucket": "some-bucket",
+        }
+        actual_response = read_source_data(cloud_event)
+        assert [
+            json.loads(data)["message"]
+            for _, data, _ in patched_publisher_client.return_value.published
+        ] == ["MSH|^~\\&|1\r", "MSH|^~\\&|2\r"]
+        assert actual_response.json["message"] == (
+            "Processed source-data/elr/some-filename.hl7, which contained 3 "
+            "messages, of which 2 were successfully published, and 0 could not be "
+            "published. 1 duplicates of messages that were already handled were "
+            "skipped."
+        )
+
+        if dedup_store == "gcs":
+            # Hashes are kept out of the bucket triggering the function.
+            assert all(
+                name.startswith("source-data/")
+                for name in storage_client.objects["some-bucket"]
+            )
+            assert len(storage_client.objects["some-dedup-bucket"]) == 2
+
+        # The persistent index is used by new function instances.
+        main._clients.clear()
+        patched_publisher_client.return_value = FakePublisherClient()
+        cloud_event.data = {"name": "source-data/elr/copy.hl7", "bucket": "some-bucket"}
+        actual_response = read_source_data(cloud_event)
+        assert patched_publisher_client.return_value.published == []
+        assert actual_response.json["message"] == (
+            "Processed source-data/elr/copy.hl7, which contained 3 messages, of "
+            "which 0 were successfully published, and 0 could not be published. 3 "
+            "duplicates of messages that were already handled were skipped."
+        )
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+def test_failed_messages_are_not_skipped_as_duplicates(
+    patched_storage_client, patched_publisher_client
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    batch = "MSH|^~\\&|1\rMSH|^~\\&|2\rMSH|^~\\&|3\r"
+    for name in ["source-data/elr/a.hl7", "source-data/elr/b.hl7"]:
+        storage_client.bucket("some-bucket").blob(name).upload_from_string(batch)
+    environment = {
+        **TEST_ENVIRONMENT,
+        "STREAM_SOURCE_DATA": "true",
+        "DEDUP_STORE": "memory",
+    }
+
+    with mock.patch.dict("main.os.environ", environment):
+        patched_publisher_client.return_value = FakePublisherClient(failure_rate=1.0)
+        cloud_event = mock.MagicMock()
+        cloud_event.data = {"name": "source-data/elr/a.hl7", "bucket": "some-bucket"}
+        actual_response = read_source_data(cloud_event)
+        assert actual_response.json["message"] == (
+            "Processed source-data/elr/a.hl7, which contained 3 messages, of which 0 "
+            "were successfully published, and 3 could not be published. 0 duplicates "
+            "of messages that were already handled were skipped."
+        )
+
+        # Once publishing recovers, the messages that failed are published from a
+        # new upload of the same content.
+        main._clients["publisher"] = FakePublisherClient()
+        cloud_event.data = {"name": "source-data/elr/b.hl7", "bucket": "some-bucket"}
+        actual_response = read_source_data(cloud_event)
+        assert len(main._clients["publisher"].published) == 3
+        assert actual_response.json["message"] == (
+            "Processed source-data/elr/b.hl7, which contained 3 messages, of which 3 "
+            "were successfully published, and 0 could not be published. 0 duplicates "
+            "of messages that were already handled were skipped."
+        )
+
+
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "DEDUP_STORE": "gcs"})
+def test_missing_dedup_bucket():
+    cloud_event = mock.MagicMock()
+    cloud_event.data.__getitem__.side_effect = [
+        "source-data/vxu/some-filename.hl7",
+        "some-bucket",
+    ]
     actual_response = read_source_data(cloud_event)
-    expected_response = log_info_and_generate_response(
-        200,
-        (
-            "Processed source-data/elr/some-filename.txt, which contained 1 "
-            "messages, of which 1 were successfully published, and 0 could not be "
-            "published."
+    assert actual_response.status_code == 500
+    assert actual_response.response[0] == (
+        b"Missing required environment variables. A value for DEDUP_BUCKET must be "
+        b"set when DEDUP_STORE is 'gcs'."
+    )
+
+
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "DEDUP_STORE": "redis"})
+def test_unknown_dedup_store():
+    cloud_event = mock.MagicMock()
+    cloud_event.data.__getitem__.side_effect = [
+        "source-data/vxu/some-filename.hl7",
+        "some-bucket",
+    ]
+    actual_response = read_source_data(cloud_event)
+    assert actual_response.status_code == 500
+    assert actual_response.response[0] == (
+        b"Unknown DEDUP_STORE: redis. The dedup store must be one of none, memory, "
+        b"gcs, sqlite."
+    )
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict(
+    "main.os.environ",
+    {**TEST_ENVIRONMENT, "STREAM_SOURCE_DATA": "true", "STREAM_CHUNK_SIZE": "8"},
+)
+def test_metrics_summary(patched_storage_client, patched_publisher_client):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    batch = "".join(f"MSH|^~\\&|{idx}\rPID|{idx}\r" for idx in range(20))
+    storage_client.bucket("some-bucket").blob(
+        "source-data/vxu/some-filename.hl7"
+    ).upload_from_string(batch)
+    patched_publisher_client.return_value = FakePublisherClient(
+        latency=0.001, failure_rate=0.2, seed=1
+    )
+    cloud_event = mock.MagicMock()
+    cloud_event.data = {
+        "name": "source-data/vxu/some-filename.hl7",
+        "bucket": "some-bucket",
+    }
+
+    actual_response = read_source_data(cloud_event)
+
+    metrics = actual_response.json["metrics"]
+    counters = metrics["counters"]
+    assert counters["bytes_read"] == len(batch)
+    assert counters["messages_split"] == 20
+    assert counters["publish_retries"] > 0
+    assert counters["messages_published"] + counters.get("publish_failures", 0) == 20
+    latency = metrics["histograms"]["publish_latency_seconds"]
+    assert latency["count"] == 20 + counters["publish_retries"]
+    assert latency["p50"] <= latency["p90"] <= latency["p99"] <= latency["max"]
+    assert {"download", "split", "serialize", "publish"} <= set(
+        metrics["stage_seconds"]
+    )
+    assert actual_response.json["duration_seconds"] > 0
+
+
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "METRICS_EXPORTER": "statsd"})
+def test_unknown_metrics_exporter():
+    cloud_event = mock.MagicMock()
+    cloud_event.data.__getitem__.side_effect = [
+        "source-data/vxu/some-filename.hl7",
+        "some-bucket",
+    ]
+    actual_response = read_source_data(cloud_event)
+    assert actual_response.status_code == 500
+    assert actual_response.response[0] == (
+        b"Unknown METRICS_EXPORTER: statsd. The metrics exporter must be one of none, "
+        b"opentelemetry."
+    )
+
+
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "MESSAGE_LOG_MODE": "debug"})
+def test_unknown_message_log_mode():
+    cloud_event = mock.MagicMock()
+    cloud_event.data.__getitem__.side_effect = [
+        "source-data/vxu/some-filename.hl7",
+        "some-bucket",
+    ]
+    actual_response = read_source_data(cloud_event)
+    assert actual_response.status_code == 500
+    assert actual_response.response[0] == (
+        b"Unknown MESSAGE_LOG_MODE: debug. The message log mode must be one of all, "
+        b"sampled, failures."
+    )
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict(
+    "main.os.environ",
+    {**TEST_ENVIRONMENT, "MESSAGE_LOG_MODE": "sampled", "MESSAGE_LOG_SAMPLE_RATE": "4"},
+)
+def test_message_log_sampling(patched_storage_client, patched_publisher_client, caplog):
+    caplog.set_level(logging.INFO)
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    patched_publisher_client.return_value = FakePublisherClient()
+    batch = "".join(f"MSH|^~\\&|{idx}\rPID|{idx}\r" for idx in range(10))
+
+    actual_response = read_uploaded_file(
+        storage_client, "source-data/vxu/batch.hl7", batch.encode()
+    )
+
+    assert actual_response.status_code == 200
+    published_lines = [
+        message for message in caplog.messages if " was published to " in message
+    ]
+    assert [line.split()[1] for line in published_lines] == ["0", "4", "8"]
+
+
+SNIFF_ENVIRONMENT = {
+    **TEST_ENVIRONMENT,
+    "STREAM_SOURCE_DATA": "true",
+    "SNIFF_SOURCE_DATA": "true",
+    "PUBSUB_ENVELOPE": "binary",
+}
+
+
+def read_uploaded_file(storage_client, filename: str, data: bytes):
+    storage_client.bucket("some-bucket").blob(filename).upload_from_string(data)
+    cloud_event = mock.MagicMock()
+    cloud_event.data = {"name": filename, "bucket": "some-bucket"}
+    return read_source_data(cloud_event)
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", SNIFF_ENVIRONMENT)
+def test_sniff_rejects_junk(patched_storage_client, patched_publisher_client):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    publisher = FakePublisherClient()
+    patched_publisher_client.return_value = publisher
+
+    # Only the first 4 KiB of the file are read before it is rejected.
+    with mock.patch.object(
+        FakeBlob, "download_as_bytes", autospec=True, return_value=b"\x89PNG\r\n"
+    ) as download_as_bytes:
+        actual_response = read_uploaded_file(
+            storage_client, "source-data/vxu/image.png", b"\x89PNG\r\n" * 100000
+        )
+
+    assert actual_response.status_code == 400
+    assert actual_response.get_data(as_text=True) == (
+        "source-data/vxu/image.png was not read because it does not contain VXU "
+        "messages. Its contents were identified as unknown, while VXU messages must "
+        "be hl7v2."
+    )
+    assert download_as_bytes.call_count == 1
+    assert download_as_bytes.call_args.kwargs == {"start": 0, "end": 4095}
+    assert publisher.published_count == 0
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", SNIFF_ENVIRONMENT)
+def test_sniff_rejects_misrouted_file(patched_storage_client, patched_publisher_client):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    patched_publisher_client.return_value = FakePublisherClient()
+
+    actual_response = read_uploaded_file(
+        storage_client,
+        "source-data/elr/some-document.xml",
+        b"<?xml version='1.0'?>\n<ClinicalDocument></ClinicalDocument>",
+    )
+    assert actual_response.status_code == 400
+    assert "Its contents were identified as ccda" in actual_response.get_data(
+        as_text=True
+    )
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", SNIFF_ENVIRONMENT)
+def test_sniff_root_template_and_encoding(
+    patched_storage_client, patched_publisher_client
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    publisher = FakePublisherClient()
+    patched_publisher_client.return_value = publisher
+    messages = [
+        "MSH|^~\\&|HÔPITAL|B|C|D|2020||ADT^A01^ADT_A01|1\rPID|1||JOSÉ\r",
+        "MSH|^~\\&|HÔPITAL|B|C|D|2020||ADT^A01^ADT_A01|2\rPID|2||ZOË\r",
+    ]
+
+    # The root template is taken from MSH-9, and the byte order mark is skipped.
+    actual_response = read_uploaded_file(
+        storage_client,
+        "source-data/elr/some-file.hl7",
+        "".join(messages).encode("utf-8-sig"),
+    )
+    assert actual_response.status_code == 200
+    assert "sniff" in actual_response.json["metrics"]["stage_seconds"]
+    assert [
+        attributes["root_template"] for _, _, attributes in publisher.published
+    ] == [
+        "ADT_A01",
+        "ADT_A01",
+    ]
+    assert [
+        decode_envelope(data, attributes)["message"]
+        for _, data, attributes in publisher.published
+    ] == messages
+
+    # Files that are not UTF-8 are decoded with the detected encoding.
+    for encoding in ("latin-1", "utf-16"):
+        publisher.published.clear()
+        actual_response = read_uploaded_file(
+            storage_client,
+            f"source-data/elr/some-file-{encoding}.hl7",
+            "".join(messages).encode(encoding),
+        )
+        assert actual_response.status_code == 200
+        assert [
+            decode_envelope(data, attributes)["message"]
+            for _, data, attributes in publisher.published
+        ] == messages
+
+
+def make_archive(members: dict) -> bytes:
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for name, data in members.items():
+            zip_file.writestr(name, data)
+    return archive.getvalue()
+
+
+@pytest.mark.parametrize("sniff", ["true", "false"])
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+def test_read_compressed_files(patched_storage_client, patched_publisher_client, sniff):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    publisher = FakePublisherClient()
+    patched_publisher_client.return_value = publisher
+    batch = "".join(f"MSH|^~\\&|{idx}\rPID|{idx}\r" for idx in range(3))
+    environment = {**SNIFF_ENVIRONMENT, "SNIFF_SOURCE_DATA": sniff}
+
+    def get_published() -> list:
+        published = [
+            (
+                attributes["filename"],
+                decode_envelope(data, attributes)["message"],
+            )
+            for _, data, attributes in publisher.published
+        ]
+        publisher.published.clear()
+        return published
+
+    with mock.patch.dict("main.os.environ", environment):
+        # Concatenated gzip members are read as a single stream.
+        gzipped = gzip.compress(batch[:17].encode()) + gzip.compress(
+            batch[17:].encode()
+        )
+        actual_response = read_uploaded_file(
+            storage_client, "source-data/elr/batch.hl7.gz", gzipped
+        )
+        assert actual_response.status_code == 200
+        assert actual_response.json["metrics"]["counters"]["bytes_decompressed"] == (
+            len(batch)
+        )
+        assert get_published() == [
+            ("source-data/elr/batch.hl7.gz", f"MSH|^~\\&|{idx}\rPID|{idx}\r")
+            for idx in range(3)
+        ]
+
+        # Each file in a zip archive is published with its own filename, and files
+        # that do not hold HL7v2 messages are skipped.
+        archive = make_archive(
+            {
+                "a.hl7": batch,
+                "README.txt": "Some notes.",
+                "nested/b.hl7": "MSH|^~\\&|b\rPID|b\r",
+            }
+        )
+        actual_response = read_uploaded_file(
+            storage_client, "source-data/elr/batches.zip", archive
+        )
+        assert actual_response.status_code == 200
+        counters = actual_response.json["metrics"]["counters"]
+        assert counters["archive_members"] == 2
+        assert counters["archive_members_skipped"] == 1
+        assert get_published() == [
+            ("source-data/elr/batches.zip/a.hl7", f"MSH|^~\\&|{idx}\rPID|{idx}\r")
+            for idx in range(3)
+        ] + [("source-data/elr/batches.zip/nested/b.hl7", "MSH|^~\\&|b\rPID|b\r")]
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict(
+    "main.os.environ", {**SNIFF_ENVIRONMENT, "CLAIM_CHECK_THRESHOLD": "100"}
+)
+def test_read_compressed_ecr(patched_storage_client, patched_publisher_client):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    publisher = FakePublisherClient()
+    patched_publisher_client.return_value = publisher
+    documents = {
+        f"document-{idx}.xml": f"<ClinicalDocument>{'x' * 200}{idx}</ClinicalDocument>"
+        for idx in range(2)
+    }
+
+    actual_response = read_uploaded_file(
+        storage_client, "source-data/ecr/documents.zip", make_archive(documents)
+    )
+
+    # Members of an archive cannot be referenced in place, so large documents are
+    # written to claim-checks/.
+    assert actual_response.status_code == 200
+    resolver = ClaimCheckResolver(storage_client=storage_client)
+    for (_, data, attributes), (name, document) in zip(
+        publisher.published, documents.items()
+    ):
+        assert attributes["filename"] == f"source-data/ecr/documents.zip/{name}"
+        assert is_claim_check(attributes)
+        assert attributes["claim-check-object"].startswith("claim-checks/")
+        assert resolver.resolve(data, attributes) == document.encode()
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+def test_read_compressed_file_checkpoint(
+    patched_storage_client, patched_publisher_client, compression, tmp_path
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    publisher = FakePublisherClient()
+    patched_publisher_client.return_value = publisher
+    batch = "".join(f"MSH|^~\\&|{idx}\rPID|{idx}\r" for idx in range(6)).encode()
+    if compression == "gzip":
+        data = gzip.compress(batch)
+    else:
+        zstandard = pytest.importorskip("zstandard")
+        data = zstandard.ZstdCompressor().compress(batch)
+    blob = storage_client.bucket("some-bucket").blob("source-data/vxu/batch.hl7.bin")
+    blob.upload_from_string(data)
+    checkpoint_path = str(tmp_path / "checkpoints.db")
+    store = main.SQLiteCheckpointStore(path=checkpoint_path)
+    store.put(
+        make_checkpoint_key(
+            bucket_name="some-bucket",
+            filename="source-data/vxu/batch.hl7.bin",
+            generation=str(blob.generation),
         ),
+        Checkpoint(message_count=4, byte_offset=None),
+    )
+    cloud_event = mock.MagicMock()
+    cloud_event.data = {
+        "name": "source-data/vxu/batch.hl7.bin",
+        "bucket": "some-bucket",
+        "generation": str(blob.generation),
+    }
+    environment = {
+        **SNIFF_ENVIRONMENT,
+        "CHECKPOINT_STORE": "sqlite",
+        "CHECKPOINT_PATH": checkpoint_path,
+    }
+
+    # The compression is sniffed, and a retried invocation skips the messages that
+    # were already handled.
+    with mock.patch.dict("main.os.environ", environment):
+        actual_response = read_source_data(cloud_event)
+
+    assert actual_response.status_code == 200
+    assert [
+        decode_envelope(data, attributes)["message"]
+        for _, data, attributes in publisher.published
+    ] == [f"MSH|^~\\&|{idx}\rPID|{idx}\r" for idx in range(4, 6)]
+
+
+SHARD_ENVIRONMENT = {
+    **TEST_ENVIRONMENT,
+    "SHARD_THRESHOLD_BYTES": "100",
+    "SHARD_BYTES": "60",
+    "SHARD_TOPIC": "shard-topic",
+    "CHECKPOINT_STORE": "gcs",
+    "CHECKPOINT_BUCKET": "some-state-bucket",
+    "SHARD_BUCKET": "some-state-bucket",
+}
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", SHARD_ENVIRONMENT)
+def test_read_source_data_in_shards(patched_storage_client, patched_publisher_client):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    publisher = FakePublisherClient()
+    patched_publisher_client.return_value = publisher
+    messages = [f"MSH|^~\\&|||||||VXU^V04|{idx}\rPID|{idx}" for idx in range(10)]
+    batch = "FHS|^~\\&|\r\nBHS|^~\\&|\r\n" + "\r\n".join(messages) + "\r\nFTS|1"
+
+    # The coordinator only publishes a task per shard.
+    actual_response = read_uploaded_file(
+        storage_client, "source-data/vxu/batch.hl7", batch.encode()
     )
-    assert actual_response.response == expected_response.response
-    assert actual_response.status_code == expected_response.status_code
+    assert actual_response.status_code == 200
+    assert actual_response.json["message_count"] == 10
+    shard_count = actual_response.json["shard_count"]
+    assert shard_count == 5
+    tasks = [
+        (data, attributes)
+        for topic, data, attributes in publisher.published
+        if topic == "projects/some-project/topics/shard-topic"
+    ]
+    assert len(tasks) == len(publisher.published) == shard_count
+    assert [attributes["shard"] for _, attributes in tasks] == ["0", "1", "2", "3", "4"]
+
+    # A redelivered event does not split the file again.
+    actual_response = read_uploaded_file(
+        storage_client, "source-data/vxu/batch.hl7", batch.encode()
+    )
+    assert actual_response.get_data(as_text=True).endswith("already processed.")
+
+    # Each worker publishes the messages of its shard, and the last one to complete
+    # reports the counts of the whole file.
+    publisher.published.clear()
+    responses = []
+    for data, _ in reversed(tasks):
+        cloud_event = mock.MagicMock()
+        cloud_event.data = {"message": {"data": base64.b64encode(data)}}
+        responses.append(read_source_data_shard(cloud_event))
+
+    assert all(response.status_code == 200 for response in responses)
+    assert "file_summary" not in responses[0].json
+    assert responses[-1].json["file_summary"] == {
+        "shard_count": shard_count,
+        "message_count": 10,
+        "messages_published": 10,
+        "publish_failures": 0,
+        "duplicates_skipped": 0,
+        "handled_by_earlier_attempts": 0,
+    }
+    assert responses[-1].json["message"] == (
+        "Processed shard 1 of 5 of source-data/vxu/batch.hl7, which contained 2 "
+        "messages, of which 2 were successfully published, and 0 could not be "
+        "published."
+    )
+    published = sorted(
+        json.loads(data)["message"] for _, data, _ in publisher.published
+    )
+    assert published == sorted(message + "\r" for message in messages)
+    assert {
+        json.loads(data)["root_template"] for _, data, _ in publisher.published
+    } == {"VXU_V04"}
+
+    # A redelivered task is not read again.
+    cloud_event = mock.MagicMock()
+    cloud_event.data = {"message": {"data": base64.b64encode(tasks[0][0])}}
+    actual_response = read_source_data_shard(cloud_event)
+    assert actual_response.get_data(as_text=True) == (
+        "shard 1 of 5 of source-data/vxu/batch.hl7 was not read because it was "
+        "already processed."
+    )
+
+    # Checkpoints and the state of shards are kept out of the bucket triggering the
+    # function.
+    assert list(storage_client.objects["some-bucket"]) == ["source-data/vxu/batch.hl7"]
+
+
+class FailingShardPublisherClient(FakePublisherClient):
+    def publish(self, topic: str, data: bytes, **attributes: str):
+        self.failure_rate = 1.0 if attributes.get("shard") == "2" else 0.0
+        return super().publish(topic, data, **attributes)
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+def test_redelivered_shards_without_checkpoints(
+    patched_storage_client, patched_publisher_client
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    patched_publisher_client.return_value = FailingShardPublisherClient()
+    messages = [f"MSH|^~\\&|||||||VXU^V04|{idx}\rPID|{idx}" for idx in range(10)]
+    batch = "FHS|^~\\&|\r\nBHS|^~\\&|\r\n" + "\r\n".join(messages) + "\r\nFTS|1"
+    environment = {
+        name: value
+        for name, value in SHARD_ENVIRONMENT.items()
+        if not name.startswith("CHECKPOINT_")
+    }
+
+    # The task of a shard fails to publish, so the event is redelivered.
+    with mock.patch.dict("main.os.environ", environment):
+        with pytest.raises(Exception, match="Fake publish failure."):
+            read_uploaded_file(
+                storage_client, "source-data/vxu/batch.hl7", batch.encode()
+            )
+
+        # Only the task that was not published is published again.
+        main._clients.clear()
+        publisher = FakePublisherClient()
+        patched_publisher_client.return_value = publisher
+        actual_response = read_uploaded_file(
+            storage_client, "source-data/vxu/batch.hl7", batch.encode()
+        )
+        assert actual_response.status_code == 200
+        assert [attributes["shard"] for _, _, attributes in publisher.published] == [
+            "2"
+        ]
+
+        # Once every task was published the file is not split again.
+        publisher.published.clear()
+        actual_response = read_uploaded_file(
+            storage_client, "source-data/vxu/batch.hl7", batch.encode()
+        )
+    assert actual_response.get_data(as_text=True) == (
+        "source-data/vxu/batch.hl7 was not split again because the tasks of its 5 "
+        "shards were already published."
+    )
+    assert publisher.published == []
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+def test_shards_match_unsharded_read(patched_storage_client, patched_publisher_client):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    batch = "".join(f"MSH|^~\\&|{idx}\r\nPID|{idx}  \r\n" for idx in range(10))
+    published = {}
+    for name, environment in [
+        ("unsharded", {**SHARD_ENVIRONMENT, "SHARD_THRESHOLD_BYTES": "100000"}),
+        ("sharded", SHARD_ENVIRONMENT),
+    ]:
+        main._clients.clear()
+        publisher = FakePublisherClient()
+        patched_publisher_client.return_value = publisher
+        with mock.patch.dict("main.os.environ", environment):
+            read_uploaded_file(
+                storage_client, f"source-data/vxu/{name}.hl7", batch.encode()
+            )
+            for _, data, _ in list(publisher.published):
+                cloud_event = mock.MagicMock()
+                cloud_event.data = {"message": {"data": base64.b64encode(data)}}
+                if name == "sharded":
+                    read_source_data_shard(cloud_event)
+        published[name] = sorted(
+            json.loads(data)["message"]
+            for topic, data, _ in publisher.published
+            if topic == "projects/some-project/topics/some-topic"
+        )
+
+    # Only the last message of the file is stripped of trailing whitespace.
+    assert published["sharded"] == published["unsharded"]
+    assert published["unsharded"][0] == "MSH|^~\\&|0\rPID|0  \r"
+    assert published["unsharded"][-1] == "MSH|^~\\&|9\rPID|9\r"
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict(
+    "main.os.environ", {**SHARD_ENVIRONMENT, "SHARD_THRESHOLD_BYTES": "100000"}
+)
+def test_small_files_are_not_sharded(patched_storage_client, patched_publisher_client):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    publisher = FakePublisherClient()
+    patched_publisher_client.return_value = publisher
+    batch = "".join(f"MSH|^~\\&|{idx}\rPID|{idx}\r" for idx in range(3))
+
+    actual_response = read_uploaded_file(
+        storage_client, "source-data/vxu/batch.hl7", batch.encode()
+    )
+
+    assert actual_response.status_code == 200
+    assert "shard_count" not in actual_response.json
+    assert len(publisher.published) == 3
+
+
+def test_bad_shard_task():
+    cloud_event = mock.MagicMock()
+    cloud_event.data = {"message": {"data": base64.b64encode(b"not a task")}}
+    actual_response = read_source_data_shard(cloud_event)
+    assert actual_response.status_code == 400
+    assert actual_response.response[0] == (
+        b"Bad CloudEvent payload - the message is not a shard task."
+    )
+
+
+@pytest.mark.parametrize("sniff", ["true", "false"])
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+def test_read_fhir_ndjson(patched_storage_client, patched_publisher_client, sniff):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    publisher = FakePublisherClient()
+    patched_publisher_client.return_value = publisher
+    resources = [{"resourceType": "Patient", "id": str(idx)} for idx in range(3)] + [
+        {
+            "resourceType": "Observation",
+            "id": f"o{idx}",
+            "subject": {"reference": f"Patient/{idx % 3}"},
+        }
+        for idx in range(6)
+    ]
+    ndjson = "".join(json.dumps(resource) + "\n" for resource in resources)
+    ndjson = ndjson.replace("\n", "\nnot a resource\n", 1)
+    environment = {
+        **SNIFF_ENVIRONMENT,
+        "SNIFF_SOURCE_DATA": sniff,
+        "STREAM_CHUNK_SIZE": "64",
+        "FHIR_BUNDLE_SIZE": "2",
+    }
+
+    with mock.patch.dict("main.os.environ", environment):
+        actual_response = read_uploaded_file(
+            storage_client, "source-data/fhir/Observation.ndjson", ndjson.encode()
+        )
+
+    assert actual_response.status_code == 200
+    counters = actual_response.json["metrics"]["counters"]
+    assert counters["fhir_resources"] == 9
+    assert counters["fhir_lines_skipped"] == 1
+    bundles = []
+    for _, data, attributes in publisher.published:
+        message = decode_envelope(data, attributes)
+        assert message["message_type"] == "fhir"
+        assert message["root_template"] == "Bundle"
+        bundles.append(json.loads(message["message"]))
+    assert all(bundle["type"] == "batch" for bundle in bundles)
+    assert [
+        [entry["resource"]["id"] for entry in bundle["entry"]] for bundle in bundles
+    ] == [["0", "o0"], ["1", "o1"], ["2", "o2"], ["o3", "o4"], ["o5"]]
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", SNIFF_ENVIRONMENT)
+def test_read_utf_16_fhir_ndjson(patched_storage_client, patched_publisher_client):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    publisher = FakePublisherClient()
+    patched_publisher_client.return_value = publisher
+    ndjson = "".join(
+        json.dumps({"resourceType": "Patient", "id": str(idx)}) + "\n"
+        for idx in range(3)
+    )
+    data = codecs.BOM_UTF16_LE + ndjson.encode("utf-16-le")
+
+    actual_response = read_uploaded_file(
+        storage_client, "source-data/fhir/Patient.ndjson", data
+    )
+
+    # Lines cannot be split as bytes, so the file is rejected rather than misread.
+    assert actual_response.status_code == 400
+    assert actual_response.response[0] == (
+        b"source-data/fhir/Patient.ndjson was not read because it is encoded in "
+        b"UTF-16, while FHIR NDJSON files must be encoded in UTF-8."
+    )
+    assert publisher.published == []
+
+    # Members of an archive encoded in UTF-16 are skipped.
+    actual_response = read_uploaded_file(
+        storage_client,
+        "source-data/fhir/resources.zip",
+        make_archive({"Patient.ndjson": data, "Other.ndjson": ndjson}),
+    )
+    assert actual_response.status_code == 200
+    counters = actual_response.json["metrics"]["counters"]
+    assert counters["archive_members_skipped"] == 1
+    assert counters["fhir_resources"] == 3
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", SNIFF_ENVIRONMENT)
+def test_read_compressed_fhir_ndjson(patched_storage_client, patched_publisher_client):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    publisher = FakePublisherClient()
+    patched_publisher_client.return_value = publisher
+    ndjson = "".join(
+        json.dumps({"resourceType": "Patient", "id": str(idx)}) + "\n"
+        for idx in range(3)
+    )
+
+    actual_response = read_uploaded_file(
+        storage_client,
+        "source-data/fhir/Patient.ndjson.gz",
+        gzip.compress(ndjson.encode()),
+    )
+
+    assert actual_response.status_code == 200
+    # The Bundle of each patient is combined into one at the end of the file.
+    assert len(publisher.published) == 1
+    assert actual_response.json["metrics"]["counters"]["fhir_resources"] == 3
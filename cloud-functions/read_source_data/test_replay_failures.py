@@ -0,0 +1,171 @@
+from backfill import run_backfill
+from phdi_cloud_function_utils import (
+    FailureManifestWriter,
+    decode_envelope,
+    iter_failure_records,
+    make_failure_record,
+)
+from phdi_cloud_function_utils_testing.fakes import (
+    FakePublisherClient,
+    FakeStorageClient,
+)
+from replay_failures import list_failure_manifests, replay_failure_manifest
+from unittest import mock
+import main
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def clear_client_cache():
+    main._clients.clear()
+    yield
+    main._clients.clear()
+
+
+TEST_ENVIRONMENT = {
+    "PROJECT_ID": "some-project",
+    "INGESTION_TOPIC": "some-topic",
+    "CLAIM_CHECK_BUCKET": "some-claim-check-bucket",
+    "PUBSUB_ENVELOPE": "binary",
+    "PUBLISH_INITIAL_BACKOFF": "0",
+}
+MANIFEST_NAME = "publishing-failures/vxu/some-filename.ndjson"
+
+
+def write_manifest(bucket, message_count: int) -> None:
+    writer = FailureManifestWriter(bucket=bucket, name=MANIFEST_NAME)
+    for idx in range(message_count):
+        writer.add(
+            make_failure_record(
+                source="source-data/vxu/some-filename.hl7",
+                idx=idx,
+                message=f"MSH|^~\\&|{idx}\rPID|{idx}\r",
+                error=TimeoutError("Deadline exceeded"),
+                message_type="hl7v2",
+                root_template="VXU_V04",
+            )
+        )
+    writer.close()
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", TEST_ENVIRONMENT)
+def test_replay_failure_manifest(patched_storage_client, patched_publisher_client):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    publisher = FakePublisherClient()
+    patched_publisher_client.return_value = publisher
+    bucket = storage_client.bucket("some-bucket")
+    write_manifest(bucket, 3)
+
+    result = replay_failure_manifest(
+        bucket_name="some-bucket", manifest_name=MANIFEST_NAME
+    )
+
+    assert result["messages_published"] == 3
+    assert result["deleted"]
+    assert not bucket.blob(MANIFEST_NAME).exists()
+    messages = [
+        decode_envelope(data, attributes) for _, data, attributes in publisher.published
+    ]
+    assert [message["message"] for message in messages] == [
+        f"MSH|^~\\&|{idx}\rPID|{idx}\r" for idx in range(3)
+    ]
+    assert messages[0]["root_template"] == "VXU_V04"
+    assert messages[0]["filename"] == "source-data/vxu/some-filename.hl7"
+    assert publisher.published[0][2]["origin"] == "replay_failures"
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "PUBLISH_MAX_ATTEMPTS": "2"})
+def test_replay_failure_manifest_fails_again(
+    patched_storage_client, patched_publisher_client
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    patched_publisher_client.return_value = FakePublisherClient(
+        failure_rate=0.5, seed=3
+    )
+    bucket = storage_client.bucket("some-bucket")
+    write_manifest(bucket, 20)
+
+    result = replay_failure_manifest(
+        bucket_name="some-bucket", manifest_name=MANIFEST_NAME
+    )
+
+    # The manifest is replaced by one holding only the messages that failed again.
+    assert 0 < result["publish_failures"] < 20
+    assert not result["deleted"]
+    records = list(iter_failure_records(bucket.blob(MANIFEST_NAME)))
+    assert len(records) == result["publish_failures"]
+    assert all(
+        record["source"] == "source-data/vxu/some-filename.hl7" for record in records
+    )
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "PUBLISH_MAX_ATTEMPTS": "1"})
+def test_replay_failure_manifest_written_meanwhile(
+    patched_storage_client, patched_publisher_client
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    bucket = storage_client.bucket("some-bucket")
+    write_manifest(bucket, 3)
+    replayed_generation = bucket.blob(MANIFEST_NAME).generation
+
+    # read_source_data writes a new version of the manifest while it is replayed.
+    class RewritingPublisherClient(FakePublisherClient):
+        def publish(self, topic, data, **attributes):
+            if bucket.blob(MANIFEST_NAME).generation == replayed_generation:
+                write_manifest(bucket, 1)
+            return super().publish(topic, data, **attributes)
+
+    patched_publisher_client.return_value = RewritingPublisherClient(failure_rate=1.0)
+    result = replay_failure_manifest(
+        bucket_name="some-bucket", manifest_name=MANIFEST_NAME
+    )
+
+    # The new version is kept, and the messages that failed again are written to a
+    # manifest of their own.
+    conflict_manifest_name = (
+        f"publishing-failures/vxu/some-filename-replayed-{replayed_generation}.ndjson"
+    )
+    assert result["publish_failures"] == 3
+    assert result["conflict_manifest"] == conflict_manifest_name
+    assert len(list(iter_failure_records(bucket.blob(MANIFEST_NAME)))) == 1
+    assert len(list(iter_failure_records(bucket.blob(conflict_manifest_name)))) == 3
+    assert not bucket.blob(MANIFEST_NAME, generation=replayed_generation).exists()
+
+
+@mock.patch("google.cloud.pubsub_v1.PublisherClient")
+@mock.patch("google.cloud.storage.Client")
+@mock.patch.dict("main.os.environ", TEST_ENVIRONMENT)
+def test_backfill_failure_manifests(
+    patched_storage_client, patched_publisher_client, tmp_path
+):
+    storage_client = FakeStorageClient()
+    patched_storage_client.return_value = storage_client
+    publisher = FakePublisherClient()
+    patched_publisher_client.return_value = publisher
+    bucket = storage_client.bucket("some-bucket")
+    write_manifest(bucket, 5)
+    bucket.blob(f"{MANIFEST_NAME}.part-000000000005").upload_from_string("")
+    assert list(list_failure_manifests(storage_client, "some-bucket")) == [
+        MANIFEST_NAME
+    ]
+
+    summary = run_backfill(
+        bucket_name="some-bucket",
+        prefix="publishing-failures/",
+        manifest_path=str(tmp_path / "manifest.ndjson"),
+    )
+
+    # Parts of manifests still being written are skipped.
+    assert summary["files"] == 1
+    assert summary["messages_published"] == 5
+    assert publisher.published_count == 5
+    assert not bucket.blob(MANIFEST_NAME).exists()
@@ -0,0 +1,442 @@
+import functions_framework
+import json
+import logging
+import os
+import time
+import flask
+from typing import Dict, List, TYPE_CHECKING
+from phdi_cloud_function_utils import (
+    check_for_environment_variables,
+    log_error_and_generate_response,
+    make_response,
+    DEFAULT_FHIR_BATCH_MAX_BYTES,
+    DEFAULT_FHIR_BATCH_MAX_ENTRIES,
+    DEFAULT_FHIR_BATCH_WINDOW,
+    FHIR_BATCH_BUNDLE_TYPES,
+    FhirBundleBatch,
+    FhirUploadError,
+    is_retryable_fhir_error,
+    is_successful_upload,
+    upload_with_partial_retry,
+    Metrics,
+    RetryPolicy,
+)
+
+if TYPE_CHECKING:
+    import requests
+    from google.cloud import pubsub_v1, storage
+    from phdi.cloud.gcp import GcpCredentialManager
+
+DEFAULT_PULL_MAX_MESSAGES = 100
+DEFAULT_UPLOAD_MAX_DURATION = 240.0
+
+DEFAULT_UPLOAD_MAX_ATTEMPTS = 3
+DEFAULT_UPLOAD_INITIAL_BACKOFF = 1.0
+DEFAULT_UPLOAD_MAX_BACKOFF = 10.0
+
+# Clients are created on first use and reused by later invocations handled by the
+# same function instance.
+_clients = {}
+
+
+@functions_framework.http
+def upload_fhir_batches(request: flask.Request) -> flask.Response:
+    """
+    Pull harmonized FHIR bundles from a Pub/Sub subscription, merge the bundles pulled
+    within a time window into larger batch or transaction bundles, and upload each
+    merged bundle to the FHIR server in a single request, instead of uploading each
+    bundle in its own request. This function is meant to be invoked on a schedule, and
+    pulls until the subscription is empty or UPLOAD_MAX_DURATION seconds (240 by
+    default) have passed.
+
+    PROJECT_ID, UPLOAD_SUBSCRIPTION, FHIR_URL, and FAILED_UPLOAD_BUCKET must be set as
+    environment variables. Each message holds a bundle as JSON, and the name of the
+    file it came from as its 'filename' attribute. Patient entries about the same
+    patient are uploaded once per merged bundle, and the result of each entry is
+    mapped back to the messages it came from. A message is acknowledged once all of
+    its entries are uploaded. Otherwise its bundle is written, along with the result
+    of each entry, to 'failed_fhir_upload/' in FAILED_UPLOAD_BUCKET, named after its
+    file and message ID, before it is acknowledged.
+
+    Entries that fail with a status code that may succeed later, such as 429 or 503,
+    are sent again on their own, up to UPLOAD_MAX_ATTEMPTS times in all (3 by
+    default), after a jittered backoff from at most UPLOAD_INITIAL_BACKOFF seconds up
+    to at most UPLOAD_MAX_BACKOFF seconds (1 and 10 by default), without sending the
+    entries that succeeded again. When the whole merged bundle is rejected with such a
+    status code, every entry is sent again. Each attempt is a single request, so a
+    merged bundle is sent at most UPLOAD_MAX_ATTEMPTS times. Messages whose entries
+    still fail only with such status codes, or that could not be sent because the FHIR
+    server could not be reached, are left to be delivered again, and no more messages
+    are pulled until the next invocation.
+
+    The following optional environment variables tune the merged bundles:
+    - FHIR_BATCH_MAX_ENTRIES: The maximum number of entries in a merged bundle, 500 by
+        default.
+    - FHIR_BATCH_MAX_BYTES: The maximum size of a merged bundle, 8 MiB by default.
+    - FHIR_BATCH_WINDOW: The number of seconds to wait for more bundles to merge after
+        the first, 10 by default. The ack deadline of the subscription must be longer.
+    - FHIR_BATCH_BUNDLE_TYPE: 'batch' (default), whose entries succeed or fail
+        separately, or 'transaction', which succeeds or fails as a whole but resolves
+        references between entries by their fullUrl.
+    - PULL_MAX_MESSAGES: The maximum number of messages pulled at once, 100 by default.
+
+    :param request: A flask.Request object, which is ignored.
+    :return: A flask.Response object holding a JSON object with the number of messages
+        pulled, uploaded, failed, and left to be delivered again, and metrics.
+    """
+    environment_check_response = check_for_environment_variables(
+        ["PROJECT_ID", "UPLOAD_SUBSCRIPTION", "FHIR_URL", "FAILED_UPLOAD_BUCKET"]
+    )
+    if environment_check_response.status_code == 500:
+        return environment_check_response
+
+    bundle_type = os.environ.get("FHIR_BATCH_BUNDLE_TYPE", "batch")
+    if bundle_type not in FHIR_BATCH_BUNDLE_TYPES:
+        response = (
+            f"Unknown FHIR_BATCH_BUNDLE_TYPE: {bundle_type}. The FHIR batch bundle "
+            f"type must be one of {', '.join(FHIR_BATCH_BUNDLE_TYPES)}."
+        )
+        return log_error_and_generate_response(message=response, status_code=500)
+
+    uploader = BatchUploader(
+        subscriber=get_subscriber_client(),
+        subscription_path=get_subscriber_client().subscription_path(
+            os.environ["PROJECT_ID"], os.environ["UPLOAD_SUBSCRIPTION"]
+        ),
+        fhir_url=os.environ["FHIR_URL"],
+        failed_upload_bucket=get_storage_client().bucket(
+            os.environ["FAILED_UPLOAD_BUCKET"]
+        ),
+        bundle_type=bundle_type,
+    )
+    max_duration = float(
+        os.environ.get("UPLOAD_MAX_DURATION", DEFAULT_UPLOAD_MAX_DURATION)
+    )
+    uploader.run(deadline=time.monotonic() + max_duration)
+
+    counters = uploader.metrics.counters
+    message = (
+        f"Pulled {counters.get('messages_pulled', 0)} bundles and uploaded them in "
+        f"{counters.get('upload_requests', 0)} requests: "
+        f"{counters.get('messages_uploaded', 0)} were uploaded, "
+        f"{counters.get('messages_failed', 0)} failed, and "
+        f"{counters.get('messages_redelivered', 0)} will be delivered again."
+    )
+    logging.info(message)
+    return make_response(
+        status_code=200,
+        json_payload={"message": message, "metrics": uploader.metrics.summary()},
+    )
+
+
+class BatchUploader:
+    """
+    Pull bundles from a subscription and upload them in merged bundles.
+    """
+
+    def __init__(
+        self,
+        subscriber: "pubsub_v1.SubscriberClient",
+        subscription_path: str,
+        fhir_url: str,
+        failed_upload_bucket: "storage.Bucket",
+        bundle_type: str = "batch",
+    ):
+        """
+        :param subscriber: A Pub/Sub subscriber client.
+        :param subscription_path: The full path of the subscription to pull from.
+        :param fhir_url: The URL of the FHIR server to upload to.
+        :param failed_upload_bucket: The bucket to write failed bundles to.
+        :param bundle_type: The type of the merged bundles.
+        """
+        self.subscriber = subscriber
+        self.subscription_path = subscription_path
+        self.fhir_url = fhir_url
+        self.failed_upload_bucket = failed_upload_bucket
+        self.bundle_type = bundle_type
+        self.metrics = Metrics()
+        # Set once the FHIR server asks for uploads to be retried later, so that the
+        # messages left to be delivered again are not pulled straight back.
+        self.backing_off = False
+        self.batch = self.new_batch()
+        # The pulled message and bundle of each source of the current merged bundle,
+        # by message ID.
+        self.received: Dict[str, tuple] = {}
+
+    def new_batch(self) -> FhirBundleBatch:
+        return FhirBundleBatch(
+            bundle_type=self.bundle_type,
+            max_entries=int(
+                os.environ.get("FHIR_BATCH_MAX_ENTRIES", DEFAULT_FHIR_BATCH_MAX_ENTRIES)
+            ),
+            max_bytes=int(
+                os.environ.get("FHIR_BATCH_MAX_BYTES", DEFAULT_FHIR_BATCH_MAX_BYTES)
+            ),
+            window=float(
+                os.environ.get("FHIR_BATCH_WINDOW", DEFAULT_FHIR_BATCH_WINDOW)
+            ),
+        )
+
+    def run(self, deadline: float) -> None:
+        """
+        Pull and upload bundles until the subscription is empty or the deadline
+        passes, then upload the last merged bundle.
+
+        :param deadline: The monotonic time after which no more messages are pulled.
+        """
+        max_messages = int(
+            os.environ.get("PULL_MAX_MESSAGES", DEFAULT_PULL_MAX_MESSAGES)
+        )
+        while time.monotonic() < deadline and not self.backing_off:
+            with self.metrics.timer("pull"):
+                response = self.subscriber.pull(
+                    subscription=self.subscription_path, max_messages=max_messages
+                )
+            if not response.received_messages:
+                break
+            for received in response.received_messages:
+                self.add(received)
+            if not self.backing_off and (self.batch.is_full() or self.batch.is_due()):
+                self.flush()
+
+        if self.backing_off:
+            held, self.received = self.received, {}
+            self.batch = self.new_batch()
+            self.redeliver([message for message, _ in held.values()])
+        else:
+            self.flush()
+
+    def add(self, received) -> None:
+        """
+        Add the bundle in a pulled message to the current merged bundle, first
+        uploading the current merged bundle if the bundle does not fit. Once backing
+        off, the message is left to be delivered again.
+        """
+        self.metrics.increment("messages_pulled")
+        if self.backing_off:
+            self.redeliver([received])
+            return
+        message = received.message
+        try:
+            bundle = json.loads(message.data)
+            if not isinstance(bundle, dict) or bundle.get("resourceType") != "Bundle":
+                raise ValueError("The message is not a FHIR bundle.")
+        except ValueError as error:
+            self.write_failure(message, {"message": str(error)})
+            self.acknowledge([received])
+            return
+
+        if not self.batch.add(message.message_id, bundle, len(message.data)):
+            self.flush()
+            if self.backing_off:
+                self.redeliver([received])
+                return
+            self.batch.add(message.message_id, bundle, len(message.data))
+        self.received[message.message_id] = (received, bundle)
+
+    def flush(self) -> None:
+        """
+        Upload the current merged bundle, map the result of each entry back to the
+        messages it came from, and start a new merged bundle.
+        """
+        batch, received = self.batch, self.received
+        self.batch, self.received = self.new_batch(), {}
+        if not len(batch):
+            # Bundles without entries have nothing to upload.
+            self.metrics.increment("messages_uploaded", len(received))
+            self.acknowledge([message for message, _ in received.values()])
+            return
+
+        self.metrics.increment("entries_uploaded", len(batch))
+        self.metrics.increment("patients_deduplicated", batch.deduplicated_count)
+        self.metrics.record("messages_per_request", len(batch.sources))
+        try:
+            with self.metrics.timer("upload"):
+                result = upload_with_partial_retry(
+                    batch.to_bundle(),
+                    upload=self.upload,
+                    retry_policy=get_retry_policy(),
+                )
+        except Exception as error:
+            logging.error(f"Uploading a merged bundle failed: {error}")
+            self.backing_off = True
+            self.redeliver([message for message, _ in received.values()])
+            return
+        self.metrics.increment("entries_retried", result.entries_sent - len(batch))
+
+        # Messages whose entries failed only with retryable status codes, even after
+        # the failed entries were sent again, are left to be delivered again.
+        results = batch.map_response(result.to_response())
+        redeliver = []
+        for message_id, (message, bundle) in received.items():
+            if is_successful_upload(results[message_id]):
+                self.metrics.increment("messages_uploaded")
+            elif all(
+                is_retryable_fhir_error(FhirUploadError(entry_result["status_code"]))
+                for entry_result in results[message_id]
+                if not 200 <= entry_result["status_code"] < 300
+            ):
+                redeliver.append(message)
+            else:
+                self.write_failure(
+                    message.message,
+                    {"bundle": bundle, "entry_results": results[message_id]},
+                )
+        self.acknowledge(
+            [message for message, _ in received.values() if message not in redeliver]
+        )
+        if redeliver:
+            logging.warning(
+                f"{len(redeliver)} of {len(batch.sources)} bundles could not be "
+                f"uploaded after {result.attempts} attempts, the last with status "
+                f"{result.status_code}. They will be delivered again."
+            )
+            self.backing_off = True
+            self.redeliver(redeliver)
+
+    def upload(self, bundle: dict):
+        self.metrics.increment("upload_requests")
+        return upload_bundle(bundle, self.fhir_url)
+
+    def write_failure(self, message, payload: dict) -> None:
+        """
+        Write a bundle that could not be uploaded to 'failed_fhir_upload/', named
+        after the file and message it came from.
+        """
+        self.metrics.increment("messages_failed")
+        filename = message.attributes.get("filename", "source-data/unknown")
+        name = f"{filename.replace('source-data', 'failed_fhir_upload', 1)}"
+        name = f"{name}-{message.message_id}.json"
+        logging.error(f"Message {message.message_id} could not be uploaded to {name}.")
+        self.failed_upload_bucket.blob(name).upload_from_string(
+            json.dumps(payload), content_type="application/json"
+        )
+
+    def acknowledge(self, received: List) -> None:
+        if received:
+            self.subscriber.acknowledge(
+                subscription=self.subscription_path,
+                ack_ids=[message.ack_id for message in received],
+            )
+
+    def redeliver(self, received: List) -> None:
+        self.metrics.increment("messages_redelivered", len(received))
+        if received:
+            self.subscriber.modify_ack_deadline(
+                subscription=self.subscription_path,
+                ack_ids=[message.ack_id for message in received],
+                ack_deadline_seconds=0,
+            )
+
+
+def upload_bundle(bundle: dict, fhir_url: str) -> "requests.Response":
+    """
+    Upload a merged bundle to the FHIR server in a single request. Unlike phdi's
+    upload_bundle_to_fhir_server, which retries each request up to 3 more times, the
+    request is not retried here, as failed uploads are retried by
+    `upload_with_partial_retry`. A request rejected with a 401 is sent once more with
+    a new access token, as phdi does.
+
+    :param bundle: The merged bundle.
+    :param fhir_url: The URL of the FHIR server.
+    :return: The requests.Response of the FHIR server.
+    """
+    credential_manager = get_credential_manager()
+
+    def post(access_token: str) -> "requests.Response":
+        return get_http_session().post(
+            fhir_url,
+            headers={
+                "Authorization": f"Bearer {access_token}",
+                "Accept": "application/fhir+json",
+                "Content-Type": "application/fhir+json",
+            },
+            json=bundle,
+        )
+
+    response = post(credential_manager.get_access_token())
+    if response.status_code == 401:
+        response = post(credential_manager.get_access_token())
+    return response
+
+
+def get_retry_policy() -> RetryPolicy:
+    """
+    Get the policy for sending failed entries of a merged bundle again set by the
+    UPLOAD_MAX_ATTEMPTS, UPLOAD_INITIAL_BACKOFF, and UPLOAD_MAX_BACKOFF environment
+    variables.
+
+    :return: A RetryPolicy retrying entries with a status code in
+        RETRYABLE_FHIR_STATUS_CODES.
+    """
+    return RetryPolicy(
+        max_attempts=int(
+            os.environ.get("UPLOAD_MAX_ATTEMPTS", DEFAULT_UPLOAD_MAX_ATTEMPTS)
+        ),
+        initial_backoff=float(
+            os.environ.get("UPLOAD_INITIAL_BACKOFF", DEFAULT_UPLOAD_INITIAL_BACKOFF)
+        ),
+        max_backoff=float(
+            os.environ.get("UPLOAD_MAX_BACKOFF", DEFAULT_UPLOAD_MAX_BACKOFF)
+        ),
+        retryable=is_retryable_fhir_error,
+    )
+
+
+def get_subscriber_client() -> "pubsub_v1.SubscriberClient":
+    """
+    Get the Pub/Sub subscriber client shared by all invocations handled by this
+    function instance, creating it on first use.
+
+    :return: A pubsub_v1.SubscriberClient.
+    """
+    if "subscriber" not in _clients:
+        from google.cloud import pubsub_v1
+
+        _clients["subscriber"] = pubsub_v1.SubscriberClient()
+    return _clients["subscriber"]
+
+
+def get_storage_client() -> "storage.Client":
+    """
+    Get the GCS client shared by all invocations handled by this function instance,
+    creating it on first use.
+
+    :return: A storage.Client.
+    """
+    if "storage" not in _clients:
+        from google.cloud import storage
+
+        _clients["storage"] = storage.Client()
+    return _clients["storage"]
+
+
+def get_http_session() -> "requests.Session":
+    """
+    Get the HTTP session shared by all invocations handled by this function instance,
+    creating it on first use, so that connections to the FHIR server are reused.
+
+    :return: A requests.Session, which does not retry requests.
+    """
+    if "http_session" not in _clients:
+        import requests
+
+        _clients["http_session"] = requests.Session()
+    return _clients["http_session"]
+
+
+def get_credential_manager() -> "GcpCredentialManager":
+    """
+    Get the GCP credential manager shared by all invocations handled by this function
+    instance, creating it on first use, so that access tokens are reused until they
+    expire.
+
+    :return: A GcpCredentialManager scoped to the Cloud Platform.
+    """
+    if "credential_manager" not in _clients:
+        from phdi.cloud.gcp import GcpCredentialManager
+
+        _clients["credential_manager"] = GcpCredentialManager(
+            scope=["https://www.googleapis.com/auth/cloud-platform"]
+        )
+    return _clients["credential_manager"]
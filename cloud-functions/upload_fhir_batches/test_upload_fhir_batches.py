@@ -0,0 +1,269 @@
+from main import upload_fhir_batches
+from phdi_cloud_function_utils_testing.fakes import (
+    FakeStorageClient,
+    FakeSubscriberClient,
+)
+from unittest import mock
+import json
+import main
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def clear_client_cache():
+    main._clients.clear()
+    yield
+    main._clients.clear()
+
+
+TEST_ENVIRONMENT = {
+    "PROJECT_ID": "some-project",
+    "UPLOAD_SUBSCRIPTION": "some-subscription",
+    "FHIR_URL": "https://some-fhir-server/fhir",
+    "FAILED_UPLOAD_BUCKET": "some-bucket",
+    "UPLOAD_INITIAL_BACKOFF": "0",
+}
+
+
+def make_bundle(patient_id: str, patient_hash: str) -> dict:
+    return {
+        "resourceType": "Bundle",
+        "type": "batch",
+        "entry": [
+            {
+                "fullUrl": f"urn:uuid:{patient_id}",
+                "resource": {
+                    "resourceType": "Patient",
+                    "id": patient_id,
+                    "identifier": [
+                        {"system": "urn:ietf:rfc:3986", "value": patient_hash}
+                    ],
+                },
+                "request": {"method": "PUT", "url": f"Patient/{patient_id}"},
+            },
+            {
+                "resource": {
+                    "resourceType": "Observation",
+                    "subject": {"reference": f"Patient/{patient_id}"},
+                },
+                "request": {"method": "POST", "url": "Observation"},
+            },
+        ],
+    }
+
+
+def make_fhir_server_response(statuses: list, status_code: int = 200) -> mock.Mock:
+    response = mock.Mock(status_code=status_code)
+    response.json.return_value = {
+        "resourceType": "Bundle",
+        "type": "batch-response",
+        "entry": [{"response": {"status": status}} for status in statuses],
+    }
+    return response
+
+
+def setup_clients(bundles: list) -> tuple:
+    subscriber = FakeSubscriberClient()
+    for idx, bundle in enumerate(bundles):
+        subscriber.publish(
+            json.dumps(bundle).encode(), filename=f"source-data/vxu/file-{idx}.hl7"
+        )
+    storage_client = FakeStorageClient()
+    main._clients["subscriber"] = subscriber
+    main._clients["storage"] = storage_client
+    return subscriber, storage_client
+
+
+@mock.patch("main.get_credential_manager")
+@mock.patch("main.get_http_session")
+@mock.patch.dict("main.os.environ", TEST_ENVIRONMENT)
+def test_upload_fhir_batches(patched_get_http_session, patched_get_credential_manager):
+    patched_upload = patched_get_http_session.return_value.post
+    subscriber, storage_client = setup_clients(
+        [
+            make_bundle("a", "same"),
+            make_bundle("b", "same"),
+            make_bundle("c", "other"),
+        ]
+    )
+    # The patient of the first two bundles is uploaded once. The observation of the
+    # third bundle fails.
+    patched_upload.return_value = make_fhir_server_response(
+        ["200 OK", "201 Created", "201 Created", "201 Created", "400 Bad Request"]
+    )
+
+    actual_response = upload_fhir_batches(mock.Mock())
+    assert actual_response.status_code == 200
+    payload = json.loads(actual_response.response[0])
+    assert payload["message"] == (
+        "Pulled 3 bundles and uploaded them in 1 requests: 2 were uploaded, 1 failed, "
+        "and 0 will be delivered again."
+    )
+    assert payload["metrics"]["counters"]["patients_deduplicated"] == 1
+
+    # The patient of the second bundle replaces the patient of the first.
+    merged_bundle = patched_upload.call_args.kwargs["json"]
+    assert len(merged_bundle["entry"]) == 5
+    assert merged_bundle["entry"][0]["resource"]["id"] == "b"
+    for entry in merged_bundle["entry"][1:3]:
+        assert entry["resource"]["subject"] == {"reference": "Patient/b"}
+
+    assert subscriber.outstanding_count == 0
+    failure = json.loads(
+        storage_client.bucket("some-bucket")
+        .blob("failed_fhir_upload/vxu/file-2.hl7-3.json")
+        .download_as_bytes()
+    )
+    assert failure["bundle"]["entry"][0]["resource"]["id"] == "c"
+    assert [result["status_code"] for result in failure["entry_results"]] == [201, 400]
+
+
+@mock.patch("main.get_credential_manager")
+@mock.patch("main.get_http_session")
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "FHIR_BATCH_MAX_ENTRIES": "4"})
+def test_upload_fhir_batches_limits(
+    patched_get_http_session, patched_get_credential_manager
+):
+    patched_upload = patched_get_http_session.return_value.post
+    subscriber, _ = setup_clients(
+        [make_bundle(patient_id, patient_id) for patient_id in "abcde"]
+    )
+    patched_upload.side_effect = lambda url, **kwargs: make_fhir_server_response(
+        ["201 Created"] * len(kwargs["json"]["entry"])
+    )
+
+    actual_response = upload_fhir_batches(mock.Mock())
+    payload = json.loads(actual_response.response[0])
+    assert patched_upload.call_count == 3
+    assert payload["metrics"]["counters"]["messages_uploaded"] == 5
+    assert subscriber.outstanding_count == 0
+
+
+@mock.patch("main.get_credential_manager")
+@mock.patch("main.get_http_session")
+@mock.patch.dict("main.os.environ", {**TEST_ENVIRONMENT, "FHIR_BATCH_MAX_ENTRIES": "4"})
+def test_upload_fhir_batches_redelivered(
+    patched_get_http_session, patched_get_credential_manager
+):
+    patched_upload = patched_get_http_session.return_value.post
+    subscriber, storage_client = setup_clients(
+        [make_bundle(patient_id, patient_id) for patient_id in "abcd"]
+    )
+    patched_upload.return_value = make_fhir_server_response([], status_code=429)
+
+    actual_response = upload_fhir_batches(mock.Mock())
+    payload = json.loads(actual_response.response[0])
+    # The first merged bundle is sent UPLOAD_MAX_ATTEMPTS times in all before its
+    # messages, and those pulled with them, are left to be delivered again.
+    assert patched_upload.call_count == 3
+    assert payload["metrics"]["counters"]["messages_redelivered"] == 4
+    assert "messages_failed" not in payload["metrics"]["counters"]
+    # The messages are not pulled again until the next invocation.
+    assert subscriber.pull_count == 1
+    assert subscriber.outstanding_count == 4
+    assert storage_client.bucket("some-bucket").list_blobs() == []
+
+
+@mock.patch("main.get_credential_manager")
+@mock.patch("main.get_http_session")
+@mock.patch.dict("main.os.environ", TEST_ENVIRONMENT)
+def test_upload_fhir_batches_partial_retry(
+    patched_get_http_session, patched_get_credential_manager
+):
+    patched_upload = patched_get_http_session.return_value.post
+    subscriber, storage_client = setup_clients(
+        [make_bundle("a", "a"), make_bundle("b", "b"), make_bundle("c", "c")]
+    )
+    patched_upload.side_effect = [
+        make_fhir_server_response(
+            [
+                "201 Created",
+                "429 Too Many Requests",
+                "201 Created",
+                "400 Bad Request",
+                "201 Created",
+                "503 Service Unavailable",
+            ]
+        ),
+        make_fhir_server_response(["201 Created", "503 Service Unavailable"]),
+        make_fhir_server_response(["503 Service Unavailable"]),
+    ]
+
+    actual_response = upload_fhir_batches(mock.Mock())
+    payload = json.loads(actual_response.response[0])
+    # Only the entries that failed with a retryable status are sent again.
+    retried_bundles = [
+        call.kwargs["json"] for call in patched_upload.call_args_list[1:]
+    ]
+    assert [len(bundle["entry"]) for bundle in retried_bundles] == [2, 1]
+    assert retried_bundles[0]["entry"][0]["resource"]["subject"] == {
+        "reference": "Patient/a"
+    }
+    counters = payload["metrics"]["counters"]
+    assert counters["entries_retried"] == 3
+    assert counters["upload_requests"] == 3
+
+    # The first message was uploaded once its observation was sent again, the second
+    # failed with a status that will not change, and the third is delivered again.
+    assert counters["messages_uploaded"] == 1
+    assert counters["messages_failed"] == 1
+    assert counters["messages_redelivered"] == 1
+    assert subscriber.outstanding_count == 1
+    assert [
+        blob.name for blob in storage_client.bucket("some-bucket").list_blobs()
+    ] == ["failed_fhir_upload/vxu/file-1.hl7-2.json"]
+
+
+@mock.patch("main.get_credential_manager")
+@mock.patch("main.get_http_session")
+def test_upload_bundle_reauthorizes(
+    patched_get_http_session, patched_get_credential_manager
+):
+    patched_upload = patched_get_http_session.return_value.post
+    patched_get_credential_manager.return_value.get_access_token.side_effect = [
+        "expired-token",
+        "new-token",
+    ]
+    patched_upload.side_effect = [
+        make_fhir_server_response([], status_code=401),
+        make_fhir_server_response(["201 Created"]),
+    ]
+    bundle = make_bundle("a", "a")
+
+    response = main.upload_bundle(bundle, "https://some-fhir-server/fhir")
+    assert response.status_code == 200
+    assert [
+        call.kwargs["headers"]["Authorization"]
+        for call in patched_upload.call_args_list
+    ] == ["Bearer expired-token", "Bearer new-token"]
+    assert patched_upload.call_args.kwargs["json"] is bundle
+
+
+@mock.patch.dict("main.os.environ", TEST_ENVIRONMENT)
+def test_invalid_bundle():
+    subscriber, storage_client = setup_clients([{"resourceType": "Patient"}])
+
+    actual_response = upload_fhir_batches(mock.Mock())
+    payload = json.loads(actual_response.response[0])
+    assert payload["metrics"]["counters"]["messages_failed"] == 1
+    assert subscriber.outstanding_count == 0
+    assert [
+        blob.name for blob in storage_client.bucket("some-bucket").list_blobs()
+    ] == ["failed_fhir_upload/vxu/file-0.hl7-1.json"]
+
+
+def test_missing_environment_variables():
+    actual_response = upload_fhir_batches(mock.Mock())
+    assert actual_response.status_code == 500
+
+
+@mock.patch.dict(
+    "main.os.environ", {**TEST_ENVIRONMENT, "FHIR_BATCH_BUNDLE_TYPE": "collection"}
+)
+def test_unknown_bundle_type():
+    actual_response = upload_fhir_batches(mock.Mock())
+    assert actual_response.status_code == 500
+    assert actual_response.response[0] == (
+        b"Unknown FHIR_BATCH_BUNDLE_TYPE: collection. The FHIR batch bundle type must "
+        b"be one of batch, transaction."
+    )
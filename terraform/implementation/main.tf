@@ -17,6 +17,7 @@ module "storage" {
   source                                    = "../modules/storage"
   project_id                                = var.project_id
   ingestion_container_service_account_email = module.ingestion.ingestion_container_service_account_email
+  geocode_cache_ttl_days                    = var.geocode_cache_ttl_days
   depends_on                                = [google_project_service.enable_google_apis]
 }
 
@@ -25,8 +26,19 @@ module "cloud-functions" {
   project_id                     = var.project_id
   functions_storage_bucket       = module.storage.functions_storage_bucket
   phi_storage_bucket             = module.storage.phi_storage_bucket
+  pipeline_state_bucket          = module.storage.pipeline_state_bucket
+  geocode_cache_bucket           = module.storage.geocode_cache_bucket
   read_source_data_source_zip    = module.storage.read_source_data_source_zip
+  harmonize_bundle_source_zip    = module.storage.harmonize_bundle_source_zip
+  upload_fhir_batches_source_zip = module.storage.upload_fhir_batches_source_zip
+  fhir_upload_topic              = module.pubsub.fhir_upload_topic
+  fhir_upload_subscription       = module.pubsub.fhir_upload_subscription
+  batched_fhir_upload            = var.batched_fhir_upload
+  geocode_cache                  = var.geocode_cache
+  geocode_cache_ttl_days         = var.geocode_cache_ttl_days
+  fhir_store_url                 = "https://healthcare.googleapis.com/v1/projects/${var.project_id}/locations/${var.region}/datasets/${module.fhir-store.fhir_dataset_id}/fhirStores/${module.fhir-store.fhir_store_id}/fhir"
   ingestion_topic                = module.pubsub.ingestion_topic
+  shard_topic                    = module.pubsub.shard_topic
   workflow_service_account_email = module.google-workflows.workflow_service_account_email
   depends_on                     = [google_project_service.enable_google_apis]
 }
@@ -43,6 +55,8 @@ module "google-workflows" {
   fhir_dataset_id             = module.fhir-store.fhir_dataset_id
   fhir_store_id               = module.fhir-store.fhir_store_id
   phi_storage_bucket          = module.storage.phi_storage_bucket
+  harmonize_bundle_url        = module.cloud-functions.harmonize_bundle_url
+  in_process_harmonization    = var.in_process_harmonization
   depends_on                  = [google_project_service.enable_google_apis]
 }
 
@@ -24,6 +24,7 @@ variable "gcp_services_list" {
     "cloudbuild.googleapis.com",
     "clouddebugger.googleapis.com",
     "cloudfunctions.googleapis.com",
+    "cloudscheduler.googleapis.com",
     "cloudtrace.googleapis.com",
     "compute.googleapis.com",
     "datastore.googleapis.com",
@@ -54,3 +55,27 @@ variable "smarty_auth_id" {
 variable "smarty_auth_token" {
   description = "value of the Smarty Streets Authorization Token"
 }
+
+variable "in_process_harmonization" {
+  type        = bool
+  description = "Harmonize and upload bundles with a single call to the harmonize_bundle Cloud Function, instead of a call to the ingestion service per step."
+  default     = false
+}
+
+variable "batched_fhir_upload" {
+  type        = bool
+  description = "Upload harmonized bundles to the FHIR store in merged batches with the upload_fhir_batches Cloud Function. Requires in_process_harmonization."
+  default     = false
+}
+
+variable "geocode_cache" {
+  type        = string
+  description = "Where harmonize_bundle caches geocoding results: none, memory, or gcs to share them between instances in the geocode cache bucket."
+  default     = "none"
+}
+
+variable "geocode_cache_ttl_days" {
+  type        = number
+  description = "The number of days cached geocoding results are used for before they are geocoded again and deleted from the geocode cache bucket."
+  default     = 90
+}
@@ -16,11 +16,146 @@ resource "google_cloudfunctions_function" "read_source_data" {
   service_account_email = var.workflow_service_account_email
 
   environment_variables = {
-    PROJECT_ID      = var.project_id
-    INGESTION_TOPIC = var.ingestion_topic
+    PROJECT_ID                        = var.project_id
+    INGESTION_TOPIC                   = var.ingestion_topic
+    STREAM_SOURCE_DATA                = "true"
+    SNIFF_SOURCE_DATA                 = "true"
+    PUBSUB_ENVELOPE                   = "binary"
+    CHECKPOINT_STORE                  = "gcs"
+    CHECKPOINT_BUCKET                 = var.pipeline_state_bucket
+    CLAIM_CHECK_BUCKET                = var.pipeline_state_bucket
+    PUBLISH_RETRY_BUDGET_RATIO        = "0.1"
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD = "0.5"
+    MESSAGE_LOG_MODE                  = "sampled"
+    SHARD_TOPIC                       = var.shard_topic
+    SHARD_THRESHOLD_BYTES             = "1073741824"
+    SHARD_BUCKET                      = var.pipeline_state_bucket
   }
   timeouts {
     create = "30m"
     delete = "30m"
   }
 }
+
+resource "google_cloudfunctions_function" "read_source_data_shard" {
+  name                  = "phdi-${terraform.workspace}-read_source_data_shard"
+  description           = "Read a shard of a large batch file and publish its messages to pub/sub topic for ingestion."
+  runtime               = "python39"
+  available_memory_mb   = 256
+  source_archive_bucket = var.functions_storage_bucket
+  source_archive_object = var.read_source_data_source_zip
+  event_trigger {
+    event_type = "google.pubsub.topic.publish"
+    resource   = var.shard_topic
+    failure_policy {
+      retry = true
+    }
+  }
+  entry_point           = "read_source_data_shard"
+  service_account_email = var.workflow_service_account_email
+
+  environment_variables = {
+    PROJECT_ID                        = var.project_id
+    INGESTION_TOPIC                   = var.ingestion_topic
+    PUBSUB_ENVELOPE                   = "binary"
+    CHECKPOINT_STORE                  = "gcs"
+    CHECKPOINT_BUCKET                 = var.pipeline_state_bucket
+    CLAIM_CHECK_BUCKET                = var.pipeline_state_bucket
+    PUBLISH_RETRY_BUDGET_RATIO        = "0.1"
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD = "0.5"
+    MESSAGE_LOG_MODE                  = "sampled"
+    SHARD_BUCKET                      = var.pipeline_state_bucket
+  }
+  timeouts {
+    create = "30m"
+    delete = "30m"
+  }
+}
+
+resource "google_cloudfunctions_function" "harmonize_bundle" {
+  name                  = "phdi-${terraform.workspace}-harmonize_bundle"
+  description           = "Standardize, geocode, link, and upload a FHIR bundle in a single invocation."
+  runtime               = "python39"
+  available_memory_mb   = 512
+  source_archive_bucket = var.functions_storage_bucket
+  source_archive_object = var.harmonize_bundle_source_zip
+  trigger_http          = true
+  ingress_settings      = "ALLOW_INTERNAL_ONLY"
+  entry_point           = "harmonize_bundle"
+  service_account_email = var.workflow_service_account_email
+
+  environment_variables = {
+    PROJECT_ID     = var.project_id
+    FHIR_URL       = var.fhir_store_url
+    GEOCODE_METHOD = "smarty"
+    UPLOAD_TOPIC   = var.fhir_upload_topic
+    # With batched uploads, bundles are published for upload_fhir_batches to upload
+    # instead of being uploaded one at a time.
+    HARMONIZATION_STEPS = var.batched_fhir_upload ? "standardize_names,standardize_phones,geocode_bundle,add_patient_identifier_in_bundle,publish_bundle_for_upload" : ""
+    # Geocoding results hold patient addresses, so are kept in their own bucket, as
+    # writes to the PHI bucket trigger read_source_data.
+    GEOCODE_CACHE          = var.geocode_cache
+    GEOCODE_CACHE_BUCKET   = var.geocode_cache_bucket
+    GEOCODE_CACHE_TTL_DAYS = var.geocode_cache_ttl_days
+  }
+  secret_environment_variables {
+    key     = "PATIENT_HASH_SALT"
+    secret  = "PATIENT_HASH_SALT"
+    version = "latest"
+  }
+  secret_environment_variables {
+    key     = "SMARTY_AUTH_ID"
+    secret  = "SMARTY_AUTH_ID"
+    version = "latest"
+  }
+  secret_environment_variables {
+    key     = "SMARTY_AUTH_TOKEN"
+    secret  = "SMARTY_AUTH_TOKEN"
+    version = "latest"
+  }
+  timeouts {
+    create = "30m"
+    delete = "30m"
+  }
+}
+
+resource "google_cloudfunctions_function" "upload_fhir_batches" {
+  name                  = "phdi-${terraform.workspace}-upload_fhir_batches"
+  description           = "Pull harmonized FHIR bundles and upload them to the FHIR store in merged batches."
+  runtime               = "python39"
+  available_memory_mb   = 512
+  timeout               = 300
+  source_archive_bucket = var.functions_storage_bucket
+  source_archive_object = var.upload_fhir_batches_source_zip
+  trigger_http          = true
+  ingress_settings      = "ALLOW_INTERNAL_ONLY"
+  entry_point           = "upload_fhir_batches"
+  service_account_email = var.workflow_service_account_email
+
+  environment_variables = {
+    PROJECT_ID           = var.project_id
+    UPLOAD_SUBSCRIPTION  = var.fhir_upload_subscription
+    FHIR_URL             = var.fhir_store_url
+    FAILED_UPLOAD_BUCKET = var.phi_storage_bucket
+    UPLOAD_MAX_DURATION  = "240"
+  }
+  timeouts {
+    create = "30m"
+    delete = "30m"
+  }
+}
+
+resource "google_cloud_scheduler_job" "upload_fhir_batches" {
+  count     = var.batched_fhir_upload ? 1 : 0
+  name      = "phdi-${terraform.workspace}-upload-fhir-batches"
+  schedule  = "* * * * *"
+  time_zone = "UTC"
+
+  http_target {
+    http_method = "POST"
+    uri         = google_cloudfunctions_function.upload_fhir_batches.https_trigger_url
+    oidc_token {
+      service_account_email = var.workflow_service_account_email
+    }
+  }
+}
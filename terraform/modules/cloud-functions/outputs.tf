@@ -1,3 +1,8 @@
 output "read_source_data_url" {
   value = google_cloudfunctions_function.read_source_data.https_trigger_url
 }
+
+
+output "harmonize_bundle_url" {
+  value = google_cloudfunctions_function.harmonize_bundle.https_trigger_url
+}
@@ -10,14 +10,63 @@ variable "phi_storage_bucket" {
   description = "value of google_pubsub_topic.ingestion_topic.name"
 }
 
+variable "pipeline_state_bucket" {
+  description = "value of google_storage_bucket.pipeline_state.name"
+}
+
+variable "geocode_cache_bucket" {
+  description = "value of google_storage_bucket.geocode_cache.name"
+}
+
 variable "ingestion_topic" {
   description = "value of google_storage_bucket.phi.name"
 }
 
+variable "shard_topic" {
+  description = "value of google_pubsub_topic.shard_topic.name"
+}
+
 variable "read_source_data_source_zip" {
   description = "value of google_storage_bucket_object.read_source_data_source_zip.name"
 }
 
+variable "harmonize_bundle_source_zip" {
+  description = "value of google_storage_bucket_object.harmonize_bundle_source_zip.name"
+}
+
+variable "fhir_store_url" {
+  description = "URL of the FHIR store harmonized bundles are uploaded to"
+}
+
+variable "fhir_upload_topic" {
+  description = "value of google_pubsub_topic.fhir_upload_topic.name"
+}
+
+variable "fhir_upload_subscription" {
+  description = "value of google_pubsub_subscription.fhir_upload_subscription.name"
+}
+
+variable "upload_fhir_batches_source_zip" {
+  description = "value of google_storage_bucket_object.upload_fhir_batches_source_zip.name"
+}
+
+variable "batched_fhir_upload" {
+  type        = bool
+  description = "Publish harmonized bundles to be uploaded in merged batches by upload_fhir_batches, instead of uploading each bundle on its own."
+  default     = false
+}
+
+variable "geocode_cache" {
+  type        = string
+  description = "Where harmonize_bundle caches geocoding results: none, memory, or gcs to share them between instances in the geocode cache bucket."
+  default     = "none"
+}
+
 variable "workflow_service_account_email" {
   description = "value of google_service_account.workflow_service_account.email"
 }
+
+variable "geocode_cache_ttl_days" {
+  type        = number
+  description = "The number of days harmonize_bundle uses cached geocoding results for, matching the lifecycle rule of the geocode cache bucket."
+}
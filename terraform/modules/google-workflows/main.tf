@@ -19,6 +19,7 @@ resource "google_workflows_workflow" "ingestion-pipeline" {
     ingestion_service_url = var.ingestion_service_url,
     fhir_store_url        = "https://healthcare.googleapis.com/v1/projects/${var.project_id}/locations/${var.region}/datasets/${var.fhir_dataset_id}/fhirStores/${var.fhir_store_id}/fhir",
     phi_storage_bucket    = var.phi_storage_bucket
+    harmonize_bundle_url  = var.in_process_harmonization ? var.harmonize_bundle_url : ""
   })
 }
 
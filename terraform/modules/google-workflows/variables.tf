@@ -39,3 +39,15 @@ variable "fhir_store_id" {
 variable "phi_storage_bucket" {
   description = "The cloud storage bucket for PHI data."
 }
+
+
+variable "harmonize_bundle_url" {
+  description = "URL of the Cloud Function that harmonizes and uploads a FHIR bundle in a single invocation."
+  default     = ""
+}
+
+variable "in_process_harmonization" {
+  type        = bool
+  description = "Harmonize and upload bundles with a single call to the harmonize_bundle function, instead of a call to the ingestion service per step."
+  default     = false
+}
@@ -9,3 +9,20 @@ resource "google_pubsub_topic_iam_member" "ingestion_topic_member" {
   role    = "roles/editor"
   member  = "serviceAccount:${var.workflow_service_account_email}"
 }
+
+resource "google_pubsub_topic" "shard_topic" {
+  name                       = "phdi-${terraform.workspace}-shard-topic"
+  message_retention_duration = "86400s"
+}
+
+resource "google_pubsub_topic" "fhir_upload_topic" {
+  name                       = "phdi-${terraform.workspace}-fhir-upload-topic"
+  message_retention_duration = "86400s"
+}
+
+resource "google_pubsub_subscription" "fhir_upload_subscription" {
+  name                       = "phdi-${terraform.workspace}-fhir-upload-subscription"
+  topic                      = google_pubsub_topic.fhir_upload_topic.name
+  ack_deadline_seconds       = 600
+  message_retention_duration = "86400s"
+}
@@ -1,3 +1,15 @@
 output "ingestion_topic" {
   value = google_pubsub_topic.ingestion_topic.name
-}
\ No newline at end of file
+}
+
+output "shard_topic" {
+  value = google_pubsub_topic.shard_topic.name
+}
+
+output "fhir_upload_topic" {
+  value = google_pubsub_topic.fhir_upload_topic.name
+}
+
+output "fhir_upload_subscription" {
+  value = google_pubsub_subscription.fhir_upload_subscription.name
+}
@@ -8,6 +8,44 @@ resource "google_storage_bucket" "phi_storage_bucket" {
   storage_class = "MULTI_REGIONAL"
 }
 
+# State kept by the cloud functions, such as checkpoints, the progress of sharded
+# files, and claim checks of messages too large for Pub/Sub, in its own bucket, as
+# every object written to the PHI bucket triggers read_source_data.
+resource "google_storage_bucket" "pipeline_state" {
+  name          = "phdi-${terraform.workspace}-pipeline-state-${var.project_id}"
+  location      = "US"
+  force_destroy = true
+  storage_class = "MULTI_REGIONAL"
+  # Events are retried for at most 7 days, after which this state is not needed.
+  lifecycle_rule {
+    condition {
+      age = 30
+    }
+    action {
+      type = "Delete"
+    }
+  }
+}
+
+# Geocoding results cached by harmonize_bundle hold patient addresses, so are PHI,
+# but are kept out of the PHI bucket, as every object written to it triggers
+# read_source_data. Results are deleted once they are older than the TTL the
+# function reads them with.
+resource "google_storage_bucket" "geocode_cache" {
+  name          = "phdi-${terraform.workspace}-geocode-cache-${var.project_id}"
+  location      = "US"
+  force_destroy = true
+  storage_class = "MULTI_REGIONAL"
+  lifecycle_rule {
+    condition {
+      age = var.geocode_cache_ttl_days
+    }
+    action {
+      type = "Delete"
+    }
+  }
+}
+
 locals {
   pipeline_modes = ["source-data", "failed_fhir_conversion", "failed_fhir_upload"]
   message_types  = ["elr", "vxu", "ecr"]
@@ -55,3 +93,29 @@ resource "google_storage_bucket_object" "read_source_data_source_zip" {
   name   = "src-${terraform.workspace}-${data.archive_file.read_source_data.output_md5}.zip"
   bucket = google_storage_bucket.functions.name
 }
+
+data "archive_file" "harmonize_bundle" {
+  type        = "zip"
+  source_dir  = "../../cloud-functions/harmonize_bundle"
+  output_path = "../../cloud-functions/harmonize_bundle.zip"
+}
+
+resource "google_storage_bucket_object" "harmonize_bundle_source_zip" {
+  source       = data.archive_file.harmonize_bundle.output_path
+  content_type = "application/zip"
+  name         = "src-${terraform.workspace}-${data.archive_file.harmonize_bundle.output_md5}.zip"
+  bucket       = google_storage_bucket.functions.name
+}
+
+data "archive_file" "upload_fhir_batches" {
+  type        = "zip"
+  source_dir  = "../../cloud-functions/upload_fhir_batches"
+  output_path = "../../cloud-functions/upload_fhir_batches.zip"
+}
+
+resource "google_storage_bucket_object" "upload_fhir_batches_source_zip" {
+  source       = data.archive_file.upload_fhir_batches.output_path
+  content_type = "application/zip"
+  name         = "src-${terraform.workspace}-${data.archive_file.upload_fhir_batches.output_md5}.zip"
+  bucket       = google_storage_bucket.functions.name
+}
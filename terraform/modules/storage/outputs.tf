@@ -6,6 +6,22 @@ output "read_source_data_source_zip" {
   value = google_storage_bucket_object.read_source_data_source_zip.name
 }
 
+output "harmonize_bundle_source_zip" {
+  value = google_storage_bucket_object.harmonize_bundle_source_zip.name
+}
+
+output "upload_fhir_batches_source_zip" {
+  value = google_storage_bucket_object.upload_fhir_batches_source_zip.name
+}
+
 output "phi_storage_bucket" {
   value = google_storage_bucket.phi_storage_bucket.name
 }
+
+output "pipeline_state_bucket" {
+  value = google_storage_bucket.pipeline_state.name
+}
+
+output "geocode_cache_bucket" {
+  value = google_storage_bucket.geocode_cache.name
+}
@@ -4,4 +4,9 @@ variable "project_id" {
 
 variable "ingestion_container_service_account_email" {
   description = "Email of the ingestion container service account"
-}
\ No newline at end of file
+}
+
+variable "geocode_cache_ttl_days" {
+  type        = number
+  description = "The number of days geocoding results are kept in the geocode cache bucket."
+}